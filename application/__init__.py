@@ -63,8 +63,15 @@ def create_app(config_name=None):
     else:
         CORS(app, supports_credentials=True)
 
+    # v7.3: Instrumentação por rota (tempo, MongoDB, bytes, cache + Server-Timing).
+    # Os hooks envolvem o Compress: o tamanho é medido antes e depois da compressão
+    from application.instrumentation import init_instrumentacao, medir_resposta_bruta
+    if init_instrumentacao(app):
+        logger.info("📏 Instrumentação por rota ativada")
+
     # v7.3: Configurar compressão gzip (reduz banda em 60-80%)
     Compress(app)
+    medir_resposta_bruta(app)
     logger.info("📦 Compressão gzip ativada (respostas 60-80% menores)")
 
     # Inicializar MongoDB
@@ -78,6 +85,39 @@ def create_app(config_name=None):
         # Salvar DB no app.config para acesso dos blueprints
         app.config['DB_CONNECTION'] = db
 
+        # v7.3: Resolver movimentações de estoque pendentes (outbox sem transações)
+        try:
+            from application.stock import reconciliar_movimentacoes, atualizar_niveis_estoque, normalizar_saldos_legados
+            reconciliar_movimentacoes(db)
+            # estoque legado em texto quebraria os guardas $inc/$gte de movimentar_estoque
+            normalizar_saldos_legados(db)
+            # nivel_estoque de produtos legados ou alterados fora do serviço de estoque
+            atualizar_niveis_estoque(db)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao reconciliar estoque: {e}")
+
+        # v7.3: Jobs que ficaram na fila/processando em workers que morreram
+        try:
+            from application.jobs import recolher_jobs_orfaos
+            recolher_jobs_orfaos(db)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao recolher jobs órfãos: {e}")
+
+        # v7.3: Série mensal de desempenho dos profissionais - inclui orçamentos legados em background
+        import threading
+        from application.commissions import garantir_desempenho
+
+        def _garantir_desempenho():
+            try:
+                garantir_desempenho(db)
+            except Exception as e:
+                logger.warning(f"⚠️ Falha ao montar desempenho dos profissionais: {e}")
+
+        threading.Thread(target=_garantir_desempenho, name='desempenho-profissionais', daemon=True).start()
+
+        # v7.3: Índice de busca em memória - montado sob demanda na primeira busca de cada
+        # worker (com preload_app uma thread iniciada aqui ficaria só no master)
+
     # Registrar Blueprints
     logger.info("📦 Registrando Blueprints...")
 
@@ -86,6 +126,10 @@ def create_app(config_name=None):
     app.register_blueprint(api_bp)
 
     logger.info("✅ Blueprint API registrado (todas as rotas consolidadas)")
+
+    # v7.3: Pré-compilar index.html (assets com fingerprint + shell em memória)
+    from application.assets import build_index
+    build_index(app)
     logger.info("✅ Sistema ultra-otimizado - BIOMA v7.3")
     logger.info("✅ Performance 100x melhor - Agregações MongoDB + Cache + Gzip")
 
@@ -8,7 +8,7 @@ Performance 100x melhor que v7.0
 
 from flask import request, jsonify, session, current_app, send_file, render_template, Response, stream_with_context
 from flask_cors import CORS
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from bson import ObjectId
@@ -44,6 +44,39 @@ from application.decorators import login_required, permission_required, get_user
 from application.utils import convert_objectid, allowed_file, registrar_auditoria, update_cliente_denormalized_fields, get_assistente_details
 from application.constants import ANAMNESE_FORM, PRONTUARIO_FORM, default_form_state
 from application.extensions import get_from_cache, set_in_cache, CacheManager
+from application.importer import (
+    normalizar_coluna, ler_linhas, importar_linhas, obter_lote, desfazer_lote, abandonar_lote,
+    IMPORT_BATCH_SIZE, TIPO_ALIASES, PARSERS, COLECOES_IMPORTAVEIS, MODOS_IMPORTACAO, CHAVES_NATURAIS
+)
+from application.jobs import JobManager, JobQueueFull, JobDuplicado, obter_job, ao_abandonar_job, MENSAGEM_ORFAO
+from application.stock import (
+    movimentar_estoque, ajustar_estoque, movimentacao_aplicada, posicao_estoque, snapshot_pendente, job_snapshot_estoque,
+    ProdutoNaoEncontrado, EstoqueInsuficiente,
+    classificar_nivel, filtro_nivel, atualizar_niveis_estoque, avaliar_estoque, invalidar_valorizacao,
+    NIVEL_CRITICO, NIVEL_ATENCAO, NIVEL_NORMAL, NIVEL_LABELS
+)
+from application.commissions import (
+    calcular_comissoes, registrar_comissoes, registros_historico, resumo_historico,
+    contribuicao_desempenho, aplicar_desempenho, serie_desempenho
+)
+from application.forecast import (
+    atualizar_previsao, previsao_desatualizada, CONSUMO_MINIMO
+)
+from application.images import (
+    IMAGE_VARIANTS, COLECOES_COM_FOTO, FOTO_PROJECAO_LISTA, salvar_imagem, campos_foto,
+    url_imagem, aplicar_foto, data_uri_para_bytes, obter_variante, resposta_imagem,
+    obter_logo, invalidar_logo
+)
+from application.search import (
+    indice_busca, busca_federada, hidratar, campos_busca, consulta_prefixo, SUGESTOES_POR_TIPO, SUGESTOES_MAX,
+    SUGESTOES_MAX_AGE
+)
+from application.pdf import gerar_pdf, arquivo_historico, PDFTimeout, HISTORICO_CURSOR_LOTE
+from application.reports import (
+    RELATORIOS, EXPORT_TTL, exportar, artefato_disponivel, nome_download
+)
+from application.exports import PLANILHAS, exportar_planilha
+from application.instrumentation import metricas_rotas
 
 logger = logging.getLogger(__name__)
 
@@ -88,6 +121,10 @@ def broadcast_sse_event(event_type, data):
 
         logger.debug(f"📡 SSE Broadcast: {event_type} → {len(sse_clients)} clientes")
 
+    # v7.3: Manter o índice de busca em memória (sem id = alteração em massa)
+    if event_type == 'data_changed' and isinstance(data, dict):
+        indice_busca.alterado(data.get('section'), data.get('id'))
+
 # ==================== FIM SSE BROADCAST SYSTEM ====================
 
 # Helper para obter DB
@@ -109,11 +146,14 @@ def get_db():
 
 @bp.route('/')
 def index():
-    """Renderiza index.html com cache busting via timestamp"""
+    """Serve o shell pré-compilado do index.html (fallback: render por request)"""
     from flask import make_response
     import time
+    from application import assets
 
-    db = get_db()
+    # v7.3: Shell renderizado uma vez por deploy (assets com fingerprint + ETag)
+    if assets.index_shell is not None:
+        return assets.resposta_shell()
 
     # Renderizar template
     html = render_template('index.html', cache_buster=str(int(time.time())))
@@ -126,6 +166,16 @@ def index():
 
     return response
 
+@bp.route('/static/build/<filename>')
+def static_build(filename):
+    """Assets extraídos do index.html (imutáveis, pré-comprimidos .br/.gz)"""
+    from application import assets
+
+    response = assets.resposta_asset(filename)
+    if response is None:
+        return jsonify({'success': False, 'message': 'Asset não encontrado'}), 404
+    return response
+
 @bp.route('/health')
 def health():
     """Health check endpoint com diagnóstico detalhado"""
@@ -176,6 +226,17 @@ def ping():
     """
     return jsonify({'success': True, 'status': 'online', 'timestamp': datetime.now().isoformat()}), 200
 
+@bp.route('/api/metricas/rotas', methods=['GET'])
+@permission_required('Admin')
+def metricas_por_rota():
+    """
+    Latência, tempo de MongoDB, bytes e cache por endpoint (deste worker)
+    ?formato=prometheus devolve o formato texto de exposição do Prometheus
+    """
+    if request.args.get('formato') == 'prometheus':
+        return Response(metricas_rotas.prometheus(), mimetype='text/plain; version=0.0.4')
+    return jsonify({'success': True, 'pid': os.getpid(), 'endpoints': metricas_rotas.resumo()})
+
 @bp.route('/api/login', methods=['POST'])
 def login():
     """Login v7.0 - Com segurança aprimorada e auditoria"""
@@ -563,7 +624,7 @@ def dashboard_stats_realtime():
                     {'$group': {'_id': None, 'total': {'$sum': '$valor_item'}}}
                 ],
                 'baixo_estoque': [
-                    {'$match': {'$expr': {'$lt': ['$estoque', '$estoque_minimo']}}},
+                    {'$match': filtro_nivel()},
                     {'$count': 'total'}
                 ],
                 'sem_estoque': [
@@ -793,23 +854,26 @@ def clientes():
             'updated_at': datetime.now()
         }
 
-        # Upload de foto (se enviado)
+        # Upload de foto (se enviado) - pipeline de imagens (variantes sob demanda)
         if 'foto' in request.files:
             foto = request.files['foto']
             if foto and foto.filename:
-                # Processar foto (salvar como base64 ou URL)
-                import base64
-                foto_b64 = base64.b64encode(foto.read()).decode('utf-8')
-                cliente_data['foto_url'] = f"data:image/jpeg;base64,{foto_b64}"
+                try:
+                    cliente_data.update(campos_foto(salvar_imagem(db, foto.read(), 'foto_cliente')))
+                except ValueError as img_error:
+                    return jsonify({'success': False, 'message': str(img_error)}), 400
 
+        cliente_data.update(campos_busca('clientes', cliente_data))
         if existing:
             db.clientes.update_one({'cpf': data['cpf']}, {'$set': cliente_data})
+            indice_busca.alterado('clientes', existing['_id'])
             logger.info(f"✅ Cliente atualizado: {data['nome']} (CPF: {data['cpf']})")
         else:
             cliente_data['created_at'] = datetime.now()
             cliente_data['total_faturado'] = 0
             cliente_data['total_visitas'] = 0
-            db.clientes.insert_one(cliente_data)
+            result = db.clientes.insert_one(cliente_data)
+            indice_busca.alterado('clientes', result.inserted_id)
             logger.info(f"✅ Cliente criado: {data['nome']} (CPF: {data['cpf']})")
 
         return jsonify({'success': True, 'message': 'Cliente salvo com sucesso'})
@@ -935,6 +999,7 @@ def update_cliente(id):
             'updated_at': datetime.now()
         }
         
+        update_data.update(campos_busca('clientes', update_data))
         db.clientes.update_one({'_id': ObjectId(id)}, {'$set': update_data})
         logger.info(f"✅ Cliente atualizado: {update_data['nome']}")
 
@@ -962,15 +1027,14 @@ def buscar_clientes():
         return jsonify(cached)
     
     try:
-        regex = {'$regex': termo, '$options': 'i'}
-        clientes = list(db.clientes.find({
-            '$or': [
-                {'nome': regex},
-                {'cpf': regex},
-                {'email': regex},
-                {'telefone': regex}
-            ]
-        }).sort('nome', ASCENDING).limit(50))
+        # v7.3: Candidatos ranqueados pelo índice em memória; Mongo só hidrata os 50 primeiros
+        candidatos = indice_busca.buscar('clientes', termo, 50)
+        if candidatos is not None:
+            clientes = hidratar(db.clientes, [i for i, _ in candidatos])
+        else:
+            # Prefixo ancorado nos campos-sombra (faixa de índice, sem $options 'i')
+            filtro = consulta_prefixo('clientes', termo)
+            clientes = list(db.clientes.find(filtro).sort('nome', ASCENDING).limit(50)) if filtro else []
         
         # Adicionar informação completa formatada
         for c in clientes:
@@ -997,30 +1061,26 @@ def search_suggest():
         return jsonify({'success': True, 'suggestions': []})
 
     try:
-        regex = {'$regex': query, '$options': 'i'}
+        filtro = consulta_prefixo('clientes', query, ('nome',))
         suggestions = []
-
-        # Buscar em clientes
-        clientes = list(db.clientes.find({'nome': regex}, {'nome': 1}).limit(5))
-        for c in clientes:
-            suggestions.append({'text': c['nome'], 'type': 'cliente', 'id': str(c['_id'])})
-
-        # Buscar em produtos
-        produtos = list(db.produtos.find({'nome': regex}, {'nome': 1}).limit(5))
-        for p in produtos:
-            suggestions.append({'text': p['nome'], 'type': 'produto', 'id': str(p['_id'])})
-
-        # Buscar em profissionais
-        profissionais = list(db.profissionais.find({'nome': regex}, {'nome': 1}).limit(3))
-        for prof in profissionais:
-            suggestions.append({'text': prof['nome'], 'type': 'profissional', 'id': str(prof['_id'])})
-
-        # Buscar em serviços
-        servicos = list(db.servicos.find({'nome': regex}, {'nome': 1}).limit(5))
-        for s in servicos:
-            suggestions.append({'text': s['nome'], 'type': 'servico', 'id': str(s['_id'])})
-
-        return jsonify({'success': True, 'suggestions': suggestions[:15]})
+        do_indice = True
+
+        # v7.3: Array de prefixos em memória ordenado por popularidade - sem ida ao Mongo quando está pronto
+        for colecao, tipo, limite in SUGESTOES_POR_TIPO:
+            candidatos = indice_busca.sugerir(colecao, query, limite)
+            if candidatos is None:
+                do_indice = False
+                candidatos = [(d['_id'], d['nome']) for d in db[colecao].find(filtro, {'nome': 1}).limit(limite)] if filtro else []
+            for _id, nome in candidatos:
+                suggestions.append({'text': nome, 'type': tipo, 'id': str(_id)})
+
+        response = jsonify({'success': True, 'suggestions': suggestions[:SUGESTOES_MAX]})
+        # ETag pelo conteúdo (hash do corpo): vale entre workers e reinícios, ao
+        # contrário da versão do índice, que é um contador de cada processo
+        response.add_etag()
+        if do_indice:
+            response.headers['Cache-Control'] = f"private, max-age={SUGESTOES_MAX_AGE}"
+        return response.make_conditional(request)
 
     except Exception as e:
         logger.error(f"❌ Erro ao buscar sugestões: {e}")
@@ -1046,53 +1106,47 @@ def busca_global():
         return jsonify(cached)
     
     try:
-        regex = {'$regex': termo, '$options': 'i'}
-
         # OTIMIZAÇÃO: Usar projection para selecionar apenas campos necessários (Roadmap - Query Optimization)
+        # v7.3: Candidatos vêm do índice de trigramas em memória; o Mongo só hidrata os 10 primeiros
+        # de cada coleção (prefixo nos campos-sombra apenas enquanto o índice não está pronto)
+        # As quatro fontes rodam em paralelo, cada uma com maxTimeMS, e a resposta sai no prazo
+        # com o que terminou (partial=True se alguma ficou de fora)
+        def buscar(colecao, projection):
+            def executar(max_time_ms):
+                candidatos = indice_busca.buscar(colecao, termo, 10)
+                if candidatos is not None:
+                    return hidratar(db[colecao], [i for i, _ in candidatos], projection, max_time_ms)
+                filtro = consulta_prefixo(colecao, termo)
+                if not filtro:
+                    return []
+                return list(db[colecao].find(filtro, projection).limit(10).max_time_ms(max_time_ms))
+            return executar
+
+        fontes = {}
 
         # Buscar em clientes (projection: apenas campos essenciais para busca)
-        clientes = list(db.clientes.find({
-            '$or': [
-                {'nome': regex},
-                {'cpf': regex},
-                {'email': regex},
-                {'telefone': regex}
-            ]
-        }, {
+        fontes['clientes'] = buscar('clientes', {
             '_id': 1,
             'nome': 1,
             'cpf': 1,
             'email': 1,
             'telefone': 1,
-            'foto_url': 1
-        }).limit(10))
+            **FOTO_PROJECAO_LISTA
+        })
 
         # Buscar em profissionais (projection: apenas campos essenciais)
-        profissionais = list(db.profissionais.find({
-            '$or': [
-                {'nome': regex},
-                {'cpf': regex},
-                {'email': regex},
-                {'especialidade': regex}
-            ]
-        }, {
+        fontes['profissionais'] = buscar('profissionais', {
             '_id': 1,
             'nome': 1,
             'cpf': 1,
             'email': 1,
             'especialidade': 1,
-            'foto_url': 1,
+            **FOTO_PROJECAO_LISTA,
             'ativo': 1
-        }).limit(10))
+        })
 
         # Buscar em produtos (projection: apenas campos essenciais)
-        produtos = list(db.produtos.find({
-            '$or': [
-                {'nome': regex},
-                {'marca': regex},
-                {'sku': regex}
-            ]
-        }, {
+        fontes['produtos'] = buscar('produtos', {
             '_id': 1,
             'nome': 1,
             'marca': 1,
@@ -1100,22 +1154,29 @@ def busca_global():
             'preco': 1,
             'estoque': 1,
             'ativo': 1
-        }).limit(10))
+        })
 
         # Buscar em serviços (projection: apenas campos essenciais)
-        servicos = list(db.servicos.find({
-            '$or': [
-                {'nome': regex},
-                {'categoria': regex}
-            ]
-        }, {
+        fontes['servicos'] = buscar('servicos', {
             '_id': 1,
             'nome': 1,
             'categoria': 1,
             'preco': 1,
             'duracao': 1,
             'ativo': 1
-        }).limit(10))
+        })
+
+        resultados, pendentes = busca_federada.executar(fontes)
+        clientes = resultados.get('clientes', [])
+        profissionais = resultados.get('profissionais', [])
+        produtos = resultados.get('produtos', [])
+        servicos = resultados.get('servicos', [])
+
+        # Listas referenciam apenas a variante pequena (avatar)
+        for c in clientes:
+            aplicar_foto(c, 'clientes')
+        for prof in profissionais:
+            aplicar_foto(prof, 'profissionais')
         
         result = {
             'success': True,
@@ -1125,10 +1186,14 @@ def busca_global():
                 'produtos': convert_objectid(produtos),
                 'servicos': convert_objectid(servicos)
             },
-            'total': len(clientes) + len(profissionais) + len(produtos) + len(servicos)
+            'total': len(clientes) + len(profissionais) + len(produtos) + len(servicos),
+            'partial': bool(pendentes),
+            'pendentes': pendentes
         }
         
-        set_in_cache(cache_key, result)
+        # Resultado parcial não vai para o cache (a próxima tentativa pode completar)
+        if not pendentes:
+            set_in_cache(cache_key, result)
         return jsonify(result)
         
     except Exception as e:
@@ -1149,7 +1214,15 @@ def profissionais():
             return jsonify(cached)
         
         try:
-            profs = list(db.profissionais.find({}).sort('nome', ASCENDING).limit(500))
+            # Fotos: data URIs legados ficam no banco (apenas marcador trafega)
+            profs = list(db.profissionais.aggregate([
+                {'$sort': {'nome': ASCENDING}},
+                {'$limit': 500},
+                {'$addFields': {
+                    'foto': FOTO_PROJECAO_LISTA['foto'],
+                    'foto_url': FOTO_PROJECAO_LISTA['foto_url']
+                }}
+            ]))
 
             # Agregar métricas de avaliação para exibição rápida na lista
             avaliacoes_map = {}
@@ -1175,12 +1248,14 @@ def profissionais():
                     prof.get('assistente_tipo')
                 )
                 if assistente_info:
+                    colecao_assistente = 'profissionais' if prof.get('assistente_tipo') == 'profissional' else 'assistentes'
                     prof['assistente'] = {
                         'id': assistente_info.get('_id'),
                         'nome': assistente_info.get('nome'),
                         'tipo': assistente_info.get('tipo_origem'),
-                        'foto_url': assistente_info.get('foto_url', '')
+                        'foto_url': aplicar_foto(assistente_info, colecao_assistente)['foto_url']
                     }
+                aplicar_foto(prof, 'profissionais')
                 # Avaliações agregadas
                 stat = avaliacoes_map.get(str(prof.get('_id')))
                 if stat:
@@ -1231,15 +1306,18 @@ def profissionais():
             'created_at': datetime.now()
         }
 
-        # Upload de foto (se enviado via FormData)
+        # Upload de foto (se enviado via FormData) - pipeline de imagens
         if 'foto' in request.files:
             foto = request.files['foto']
             if foto and foto.filename:
-                import base64
-                foto_b64 = base64.b64encode(foto.read()).decode('utf-8')
-                profissional_data['foto_url'] = f"data:image/jpeg;base64,{foto_b64}"
+                try:
+                    profissional_data.update(campos_foto(salvar_imagem(db, foto.read(), 'foto_profissional')))
+                except ValueError as img_error:
+                    return jsonify({'success': False, 'message': str(img_error)}), 400
 
+        profissional_data.update(campos_busca('profissionais', profissional_data))
         result = db.profissionais.insert_one(profissional_data)
+        indice_busca.alterado('profissionais', result.inserted_id)
         inserted_id = str(result.inserted_id)
         logger.info(f"✅ Profissional cadastrado: {profissional_data['nome']} (ID: {inserted_id})")
         return jsonify({'success': True, 'message': 'Profissional cadastrado com sucesso', 'id': inserted_id})
@@ -1269,6 +1347,9 @@ def delete_profissional(id):
         logger.error(f"❌ Erro ao deletar profissional {id}: {str(e)}")
         return jsonify({'success': False, 'message': f'Erro ao deletar: {str(e)}'}), 500
 
+# Orçamentos detalhados linha a linha no card do profissional (os totais vêm da série mensal)
+PROFISSIONAL_DETALHE_ORCAMENTOS = 100
+
 @bp.route('/api/profissionais/<id>', methods=['GET', 'PUT'])
 @login_required
 def profissional_detalhes(id):
@@ -1299,6 +1380,7 @@ def profissional_detalhes(id):
             if not update_data:
                 return jsonify({'success': False, 'message': 'Nenhum dado para atualizar'}), 400
 
+            update_data.update(campos_busca('profissionais', update_data))
             result = db.profissionais.update_one(
                 {'_id': ObjectId(id)},
                 {'$set': update_data}
@@ -1325,18 +1407,19 @@ def profissional_detalhes(id):
         if not profissional:
             return jsonify({'success': False, 'message': 'Profissional nao encontrado'}), 404
 
+        # Foto referenciada por URL (variante full), nunca data URI inline
+        aplicar_foto(profissional, 'profissionais', 'full')
+
         profissional_id_str = str(profissional['_id'])
 
-        orcamentos_prof = list(db.orcamentos.find({
-            'servicos.profissional_id': profissional_id_str
-        }))
+        # Série mensal pré-agregada (um documento por mês): gráficos e totais em O(meses)
+        serie = serie_desempenho(db, profissional_id_str)
 
-        total_comissao = 0.0
-        total_comissao_assistente = 0.0
-        servicos_realizados = 0
-        orcamentos_aprovados = 0
-        desempenho_mensal = {}
-        multicomissao_detalhes = []
+        # Detalhamento por linha só dos orçamentos mais recentes (índices multikey)
+        orcamentos_prof = list(db.orcamentos.find({'$or': [
+            {'servicos.profissional_id': profissional_id_str},
+            {'profissionais_vinculados.profissional_id': profissional['_id']}
+        ]}, {'desempenho_aplicado': 0}).sort('created_at', DESCENDING).limit(PROFISSIONAL_DETALHE_ORCAMENTOS))
 
         # v7.1: Tratamento robusto de erros para evitar 500
         try:
@@ -1348,98 +1431,33 @@ def profissional_detalhes(id):
             logger.warning(f"⚠️ Erro ao buscar assistente: {e}")
             assistente_info = None
 
-        try:
-            comissao_prof_perc = float(profissional.get('comissao_perc', 0))
-        except (ValueError, TypeError):
-            comissao_prof_perc = 0.0
-
-        try:
-            comissao_assistente_padrao = float(profissional.get('comissao_assistente_perc', 0))
-        except (ValueError, TypeError):
-            comissao_assistente_padrao = 0.0
-
-        for orc in orcamentos_prof:
-            data_orc = orc.get('created_at', datetime.now())
-            mes_key = data_orc.strftime('%Y-%m') if isinstance(data_orc, datetime) else 'desconhecido'
-            if mes_key not in desempenho_mensal:
-                desempenho_mensal[mes_key] = {
-                    'mes': mes_key,
-                    'comissao_profissional': 0.0,
-                    'comissao_assistente': 0.0,
-                    'servicos': 0,
-                    'faturamento': 0.0
-                }
-
-            if orc.get('status') == 'Aprovado':
-                orcamentos_aprovados += 1
-                desempenho_mensal[mes_key]['faturamento'] += orc.get('total_final', 0)
-
-            for servico in orc.get('servicos', []):
-                if servico.get('profissional_id') != profissional_id_str:
-                    continue
-
-                quantidade = servico.get('qtd', 1) or 1
-                valor_servico = servico.get('total', 0) or 0
-                servicos_realizados += quantidade
-
-                comissao_valor = valor_servico * (comissao_prof_perc / 100)
-                total_comissao += comissao_valor
-                desempenho_mensal[mes_key]['comissao_profissional'] += comissao_valor
-                desempenho_mensal[mes_key]['servicos'] += quantidade
-
-                assistente_item = None
-                assistente_perc = servico.get('assistente_comissao_perc')
-                assistente_servico = servico.get('assistente_servico') or servico.get('nome')
-
-                # v7.1: Tratamento robusto para assistentes
-                try:
-                    if servico.get('assistente_id'):
-                        assistente_item = get_assistente_details(
-                            servico.get('assistente_id'),
-                            servico.get('assistente_tipo')
-                        )
-                        if assistente_perc is None:
-                            assistente_perc = servico.get('assistente_comissao_perc', comissao_assistente_padrao)
-                    elif assistente_info:
-                        assistente_item = assistente_info
-                        if assistente_perc is None:
-                            assistente_perc = comissao_assistente_padrao
-                except Exception as e:
-                    logger.warning(f"⚠️ Erro ao processar assistente do serviço: {e}")
-                    assistente_item = None
-
-                comissao_assistente_valor = 0.0
-                try:
-                    if assistente_item and assistente_perc:
-                        assistente_perc = float(assistente_perc)
-                        comissao_assistente_valor = comissao_valor * (assistente_perc / 100)
-                        total_comissao_assistente += comissao_assistente_valor
-                        desempenho_mensal[mes_key]['comissao_assistente'] += comissao_assistente_valor
-                except (ValueError, TypeError, KeyError) as e:
-                    logger.warning(f"⚠️ Erro ao calcular comissão assistente: {e}")
-
-                multicomissao_detalhes.append({
-                    'orcamento_id': str(orc['_id']),
-                    'orcamento_numero': orc.get('numero'),
-                    'cliente': orc.get('cliente_nome'),
-                    'status': orc.get('status'),
-                    'data': data_orc.isoformat() if isinstance(data_orc, datetime) else data_orc,
-                    'servico': servico.get('nome'),
-                    'valor_servico': valor_servico,
-                    'comissao_profissional': comissao_valor,
-                    'comissao_assistente': comissao_assistente_valor,
-                    'assistente_nome': assistente_item.get('nome') if assistente_item else None,
-                    'assistente_tipo': assistente_item.get('tipo_origem') if assistente_item else None,
-                    'descricao': f"Profissional {profissional.get('nome')} - {servico.get('nome')}" + (
-                        f" | Assistente {assistente_item.get('nome')} - {assistente_servico}" if assistente_item else ''
-                    )
-                })
-
-        desempenho_ordenado = sorted(desempenho_mensal.items())
-        grafico_labels = [item[0] for item in desempenho_ordenado]
-        grafico_dados_prof = [round(item[1]['comissao_profissional'], 2) for item in desempenho_ordenado]
-        grafico_dados_assist = [round(item[1]['comissao_assistente'], 2) for item in desempenho_ordenado]
-        grafico_servicos = [item[1]['servicos'] for item in desempenho_ordenado]
+        # Motor de comissões: participantes pré-carregados, uma passada pelas linhas
+        comissoes = calcular_comissoes(db, orcamentos_prof, profissional_id_str)
+        total_comissao = sum(mes.get('comissao_profissional', 0) for mes in serie)
+        total_comissao_assistente = sum(mes.get('comissao_assistente', 0) for mes in serie)
+        servicos_realizados = sum(mes.get('servicos', 0) for mes in serie)
+        total_orcamentos = sum(mes.get('orcamentos', 0) for mes in serie)
+        orcamentos_aprovados = sum(mes.get('orcamentos_aprovados', 0) for mes in serie)
+
+        multicomissao_detalhes = [{
+            'orcamento_id': linha['orcamento_id'],
+            'orcamento_numero': linha['orcamento_numero'],
+            'cliente': linha['cliente'],
+            'status': linha['status'],
+            'data': linha['data'].isoformat() if isinstance(linha['data'], datetime) else linha['data'],
+            'servico': linha['servico'],
+            'valor_servico': linha['valor_servico'],
+            'comissao_profissional': linha['comissao_profissional'],
+            'comissao_assistente': linha['comissao_assistente'],
+            'assistente_nome': linha['assistente_nome'],
+            'assistente_tipo': linha['assistente_tipo'],
+            'descricao': linha['descricao']
+        } for linha in comissoes['linhas']]
+
+        grafico_labels = [mes['mes'] for mes in serie]
+        grafico_dados_prof = [round(mes.get('comissao_profissional', 0), 2) for mes in serie]
+        grafico_dados_assist = [round(mes.get('comissao_assistente', 0), 2) for mes in serie]
+        grafico_servicos = [mes.get('servicos', 0) for mes in serie]
 
         avaliacoes = []
         try:
@@ -1450,13 +1468,14 @@ def profissional_detalhes(id):
             logger.debug(f"Falha ao carregar avaliacoes do profissional {id}: {avaliacao_error}")
 
         if assistente_info:
-            profissional['assistente'] = assistente_info
+            colecao_assistente = 'profissionais' if profissional.get('assistente_tipo') == 'profissional' else 'assistentes'
+            profissional['assistente'] = aplicar_foto(assistente_info, colecao_assistente)
 
         profissional['estatisticas'] = {
             'total_comissao': round(total_comissao, 2),
             'total_comissao_assistente': round(total_comissao_assistente, 2),
             'servicos_realizados': servicos_realizados,
-            'total_orcamentos': len(orcamentos_prof),
+            'total_orcamentos': total_orcamentos,
             'orcamentos_aprovados': orcamentos_aprovados,
             'comissao_media': round(total_comissao / servicos_realizados, 2) if servicos_realizados else 0
         }
@@ -1494,69 +1513,30 @@ def calcular_comissao():
         if not orcamento:
             return jsonify({'success': False, 'message': 'Orcamento nao encontrado'}), 404
 
-        comissoes = []
-        total_comissoes = 0.0
-
-        for servico in orcamento.get('servicos', []):
-            profissional_id = servico.get('profissional_id')
-            if not profissional_id:
-                continue
-
-            profissional = db.profissionais.find_one({'_id': ObjectId(profissional_id)})
-            if not profissional:
-                continue
-
-            valor_servico = servico.get('total', 0) or 0
-            comissao_perc = float(profissional.get('comissao_perc', 0))
-            comissao_valor = valor_servico * (comissao_perc / 100)
+        resultado = calcular_comissoes(db, [orcamento])
 
+        comissoes = []
+        for linha in resultado['linhas']:
             comissao_info = {
-                'profissional_id': str(profissional['_id']),
-                'profissional_nome': profissional.get('nome', ''),
-                'servico': servico.get('nome', ''),
-                'valor_servico': valor_servico,
-                'comissao_perc': comissao_perc,
-                'comissao_valor': comissao_valor
+                'profissional_id': linha['profissional_id'],
+                'profissional_nome': linha['profissional_nome'] or '',
+                'servico': linha['servico'],
+                'valor_servico': linha['valor_servico'],
+                'comissao_perc': linha['comissao_perc'],
+                'comissao_valor': linha['comissao_profissional'],
+                'descricao': linha['descricao']
             }
-
-            assistente_info = None
-            assistente_perc = servico.get('assistente_comissao_perc')
-            assistente_servico = servico.get('assistente_servico') or servico.get('nome')
-
-            if servico.get('assistente_id'):
-                assistente_info = get_assistente_details(
-                    servico.get('assistente_id'),
-                    servico.get('assistente_tipo')
-                )
-                if assistente_perc is None:
-                    assistente_perc = servico.get('assistente_comissao_perc', profissional.get('comissao_assistente_perc', 0))
-            else:
-                assistente_info = get_assistente_details(
-                    profissional.get('assistente_id'),
-                    profissional.get('assistente_tipo')
-                )
-                if assistente_perc is None:
-                    assistente_perc = profissional.get('comissao_assistente_perc', 0)
-
-            if assistente_info and assistente_perc:
-                assistente_perc = float(assistente_perc)
-                comissao_assistente_valor = comissao_valor * (assistente_perc / 100)
+            if linha['assistente_id'] and linha['assistente_perc']:
                 comissao_info['assistente'] = {
-                    'assistente_id': assistente_info.get('_id'),
-                    'assistente_nome': assistente_info.get('nome', ''),
-                    'assistente_tipo': assistente_info.get('tipo_origem'),
-                    'comissao_perc': assistente_perc,
-                    'comissao_valor': comissao_assistente_valor,
-                    'servico': assistente_servico
+                    'assistente_id': linha['assistente_id'],
+                    'assistente_nome': linha['assistente_nome'] or '',
+                    'assistente_tipo': linha['assistente_tipo'],
+                    'comissao_perc': linha['assistente_perc'],
+                    'comissao_valor': linha['comissao_assistente'],
+                    'servico': linha['assistente_servico']
                 }
-                total_comissoes += comissao_assistente_valor
-
-            comissao_info['descricao'] = f"Profissional {profissional.get('nome')} - {servico.get('nome')}"
-            if assistente_info:
-                comissao_info['descricao'] += f" | Assistente {assistente_info.get('nome', '')} - {assistente_servico}"
-
             comissoes.append(comissao_info)
-            total_comissoes += comissao_valor
+        total_comissoes = resultado['total']
 
         return jsonify({
             'success': True,
@@ -1635,44 +1615,21 @@ def upload_foto_profissional(id):
             return jsonify({'success': False, 'message': 'Arquivo sem nome'}), 400
 
         if file and allowed_file(file.filename):
-            # Ler arquivo DIRETO EM MEMÓRIA (SEM salvar em /tmp)
-            import base64
-            file_content = file.read()
-            foto_base64 = base64.b64encode(file_content).decode('utf-8')
-
-            # Determinar tipo MIME
-            filename = secure_filename(file.filename)
-            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'png'
-            mime_types = {
-                'png': 'image/png',
-                'jpg': 'image/jpeg',
-                'jpeg': 'image/jpeg',
-                'gif': 'image/gif',
-                'webp': 'image/webp'
-            }
-            mime_type = mime_types.get(ext, 'image/jpeg')
-
-            # Montar data URI
-            foto_data_uri = f"data:{mime_type};base64,{foto_base64}"
-
-            # Atualizar profissional com a foto
-            db.profissionais.update_one(
-                {'_id': ObjectId(id)},
-                {'$set': {
-                    'foto': foto_data_uri,
-                    'foto_url': foto_data_uri,
-                    'foto_atualizada_em': datetime.now()
-                }}
-            )
+            # Decodificar uma vez, remover metadados e guardar original normalizado
+            try:
+                foto = campos_foto(salvar_imagem(db, file.read(), 'foto_profissional'))
+            except ValueError as img_error:
+                return jsonify({'success': False, 'message': str(img_error)}), 400
 
-            # Limpar cache
-            # clear_cache('profissionais_list')  # Cache invalidation - opcional
+            db.profissionais.update_one({'_id': ObjectId(id)}, {'$set': foto})
+            CacheManager.invalidate('profissionais')
 
             logger.info(f"✅ Foto de perfil atualizada para profissional {id}")
             return jsonify({
                 'success': True,
                 'message': 'Foto atualizada com sucesso',
-                'foto_url': foto_data_uri[:100] + '...'  # Retorna preview truncado
+                'foto_url': foto['foto_url'],
+                'foto_thumb_url': foto['foto_thumb_url']
             })
         else:
             return jsonify({'success': False, 'message': 'Tipo de arquivo não permitido'}), 400
@@ -1757,54 +1714,6 @@ def delete_assistente(id):
         return jsonify({'success': False}), 500
 
 # --- INÍCIO DA SEÇÃO MODIFICADA ---
-class GradientHeader(Flowable):
-    """Um cabeçalho com fundo em gradiente."""
-    def __init__(self, width, text):
-        Flowable.__init__(self)
-        self.width = width
-        self.text = text
-        self.height = 1.5*cm
-
-    def draw(self):
-        c = self.canv
-        c.saveState()
-        start_color = HexColor('#7C3AED')
-        end_color = HexColor('#EC4899')
-        steps = 100
-        for i in range(steps):
-            ratio = i / float(steps)
-            r = start_color.red * (1 - ratio) + end_color.red * ratio
-            g = start_color.green * (1 - ratio) + end_color.green * ratio
-            b = start_color.blue * (1 - ratio) + end_color.blue * ratio
-            c.setFillColorRGB(r, g, b)
-            c.rect((self.width / steps) * i, 0, self.width / steps, self.height, stroke=0, fill=1)
-        c.setFont('Helvetica-Bold', 36)
-        c.setFillColor(white)
-        c.drawCentredString(self.width / 2, self.height / 2 - (0.5*cm), self.text)
-        c.restoreState()
-
-class HRFlowable(Flowable):
-    """Linha horizontal com cor customizada."""
-    def __init__(self, width, thickness=1, color=black):
-        Flowable.__init__(self)
-        self.width = width
-        self.thickness = thickness
-        self.color = color
-
-    def draw(self):
-        db = get_db()
-        self.canv.saveState()
-        self.canv.setStrokeColor(self.color)
-        self.canv.setLineWidth(self.thickness)
-        self.canv.line(0, 0, self.width, 0)
-        self.canv.restoreState()
-
-def format_date_pt_br(dt):
-    db = get_db()
-    """Formata a data para Português-BR manualmente para evitar problemas de locale."""
-    meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-    return f"{dt.day} de {meses[dt.month - 1]} de {dt.year}"
-
 @bp.route('/api/orcamento/<id>/pdf')
 @login_required
 def gerar_pdf_orcamento_singular(id):
@@ -1816,166 +1725,15 @@ def gerar_pdf_orcamento_singular(id):
         if not orcamento:
             return jsonify({'success': False, 'message': 'Orçamento não encontrado'}), 404
 
-        buffer = io.BytesIO()
-        doc_width, doc_height = A4
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=1.5*cm, bottomMargin=2.5*cm)
-
-        COLOR_PRIMARY = HexColor('#7C3AED')
-        COLOR_SECONDARY = HexColor('#6B7280')
-        COLOR_LIGHT_BG = HexColor('#F9FAFB')
-        COLOR_WHITE = HexColor('#FFFFFF')
-        
-        styles = getSampleStyleSheet()
-        styles.add(ParagraphStyle(name='MainTitle', fontName='Helvetica-Bold', fontSize=20, textColor=COLOR_PRIMARY, spaceAfter=18))
-        styles.add(ParagraphStyle(name='SubTitle', fontName='Helvetica', fontSize=10, textColor=COLOR_SECONDARY, spaceAfter=24))
-        styles.add(ParagraphStyle(name='SectionTitle', fontName='Helvetica-Bold', fontSize=10, textColor=white))
-        styles.add(ParagraphStyle(name='Body', fontName='Helvetica', fontSize=9, leading=14))
-        styles.add(ParagraphStyle(name='BodyRight', fontName='Helvetica', fontSize=9, leading=14, alignment=TA_RIGHT))
-        styles.add(ParagraphStyle(name='Clause', fontName='Helvetica', fontSize=8, leading=14, alignment=TA_JUSTIFY, leftIndent=12))
-        styles.add(ParagraphStyle(name='Signature', fontName='Helvetica', fontSize=9, alignment=TA_CENTER))
-
-        story = []
-        
-        story.append(GradientHeader(doc_width - 4*cm, "BIOMA"))
-        story.append(Spacer(1, 1.5*cm))
-        story.append(Paragraph("Contrato de Prestação de Serviços", styles['MainTitle']))
-        story.append(Paragraph(
-            "Pelo presente instrumento particular, as 'Partes' resolvem celebrar o presente 'Contrato', de acordo com as cláusulas e condições a seguir.", 
-            styles['SubTitle']
-        ))
-
-        data_contrato = orcamento.get('created_at', datetime.now())
-        info_data = [
-            [Paragraph('<b>NÚMERO DO CONTRATO</b>', styles['Body']), Paragraph(f"#{orcamento.get('numero', 'N/A')}", styles['Body'])],
-            [Paragraph('<b>DATA DE EMISSÃO</b>', styles['Body']), Paragraph(format_date_pt_br(data_contrato), styles['Body'])]
-        ]
-        story.append(Table(info_data, colWidths=[5*cm, '*'], style=[('VALIGN', (0,0), (-1,-1), 'TOP')]))
-        story.append(Spacer(1, 1*cm))
-
-        story.append(HRFlowable(doc_width - 4*cm, color=HexColor('#E5E7EB'), thickness=1))
-        story.append(Spacer(1, 1*cm))
-
-        # Fix: Garantir que nenhum valor seja None
-        contratante_details = f"""
-            <b>Nome:</b> {orcamento.get('cliente_nome') or 'N/A'}<br/>
-            <b>CPF:</b> {orcamento.get('cliente_cpf') or 'N/A'}<br/>
-            <b>Telefone:</b> {orcamento.get('cliente_telefone') or 'N/A'}<br/>
-            <b>E-mail:</b> {orcamento.get('cliente_email') or 'N/A'}
-        """
-        contratada_details = f"""
-            <b>Razão Social:</b> BIOMA UBERABA<br/>
-            <b>CNPJ:</b> 49.470.937/0001-10<br/>
-            <b>Endereço:</b> Av. Santos Dumont 3110, Santa Maria, Uberaba/MG<br/>
-            <b>Contato:</b> (34) 99235-5890
-        """
-        partes_data = [
-            [Paragraph('<b>CONTRATANTE</b>', styles['Body']), Paragraph('<b>CONTRATADA</b>', styles['Body'])],
-            [Paragraph(contratante_details, styles['Body']), Paragraph(contratada_details, styles['Body'])]
-        ]
-        partes_table = Table(partes_data, colWidths=['*', '*'], hAlign='LEFT')
-        partes_table.setStyle(TableStyle([
-            ('VALIGN', (0,0), (-1,-1), 'TOP'), ('LINEBELOW', (0,0), (-1,0), 1, COLOR_PRIMARY),
-            ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 12),
-            ('TOPPADDING', (0,0), (-1,-1), 6), ('BOTTOMPADDING', (0,0), (-1,-1), 12),
-        ]))
-        story.append(partes_table)
-        story.append(Spacer(1, 1.5*cm))
-
-        story.append(Paragraph("SERVIÇOS E PRODUTOS CONTRATADOS", styles['MainTitle']))
-        table_header = [Paragraph(c, styles['SectionTitle']) for c in ['Item', 'Descrição', 'Qtd', 'Vl. Unit.', 'Total']]
-        items_data = [table_header]
-        all_items = orcamento.get('servicos', []) + orcamento.get('produtos', [])
-        
-        table_style_commands = [
-            ('BACKGROUND', (0,0), (-1,0), COLOR_PRIMARY), ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10),
-            ('GRID', (0,0), (-1,-1), 1, COLOR_PRIMARY),
-            ('ALIGN', (2,1), (-1,-1), 'RIGHT'), # Alinha colunas numéricas à direita
-            ('LEFTPADDING', (0,0), (-1,-1), 8), ('RIGHTPADDING', (0,0), (-1,-1), 8),
-        ]
-
-        for i, item in enumerate(all_items):
-            desc = f"{item.get('nome', '')} {item.get('tamanho', '')}".strip() if 'servico' in item.get('id', '') else f"{item.get('nome', '')} {item.get('marca', '')}".strip()
-            items_data.append([
-                Paragraph(str(i+1), styles['Body']), Paragraph(desc, styles['Body']),
-                Paragraph(str(item.get('qtd', 1)), styles['BodyRight']), 
-                Paragraph(f"R$ {item.get('preco_unit', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", "."), styles['BodyRight']),
-                Paragraph(f"R$ {item.get('total', 0):,.2f}".replace(",", "X").replace(".", ",").replace("X", "."), styles['BodyRight']),
-            ])
-            # Adiciona estilo de zebra (cores alternadas)
-            if i % 2 == 0:
-                table_style_commands.append(('BACKGROUND', (0, i + 1), (-1, i + 1), COLOR_LIGHT_BG))
-            else:
-                table_style_commands.append(('BACKGROUND', (0, i + 1), (-1, i + 1), COLOR_WHITE))
-
-        items_table = Table(items_data, colWidths=[1.5*cm, '*', 1.5*cm, 3*cm, 3*cm], repeatRows=1)
-        items_table.setStyle(TableStyle(table_style_commands))
-        story.append(items_table)
-        story.append(Spacer(1, 1*cm))
-
-        subtotal = orcamento.get('subtotal', 0)
-        desconto = orcamento.get('desconto_valor', 0)
-        total = orcamento.get('total_final', 0)
-        pag_tipo = orcamento.get('pagamento', {}).get('tipo', 'Não especificado')
-        
-        valores_data = [
-            [Paragraph('Subtotal:', styles['Body']), Paragraph(f'R$ {subtotal:,.2f}'.replace(",", "X").replace(".", ",").replace("X", "."), styles['BodyRight'])],
-            [Paragraph('Desconto Global:', styles['Body']), Paragraph(f'R$ {desconto:,.2f}'.replace(",", "X").replace(".", ",").replace("X", "."), styles['BodyRight'])],
-            ['', HRFlowable(8*cm, color=COLOR_PRIMARY, thickness=1.5)],
-            [Paragraph('<b>Valor Total a Pagar:</b>', styles['Body']), Paragraph(f'<b>R$ {total:,.2f}</b>'.replace(",", "X").replace(".", ",").replace("X", "."), styles['BodyRight'])],
-            [Paragraph('Forma de Pagamento:', styles['Body']), Paragraph(pag_tipo, styles['BodyRight'])],
-        ]
-        
-        # Tabela para alinhar o bloco de valores à direita
-        container_valores = Table([[Table(valores_data, colWidths=[4*cm, 4*cm])]], colWidths=[doc_width-4*cm])
-        container_valores.setStyle(TableStyle([('ALIGN', (0,0), (0,0), 'RIGHT')]))
-        story.append(container_valores)
-        story.append(Spacer(1, 1.5*cm))
-
-        story.append(Paragraph("DISPOSIÇÕES GERAIS E CLÁUSULAS", styles['MainTitle']))
-        clausulas = [
-            "O Contrato tem por objeto a prestação de serviços acima descritos, pela Contratada à Contratante, mediante agendamento prévio. A Contratada utilizará produtos com ingredientes naturais para a saúde dos cabelos, de alta qualidade, que serão manipulados dentro das normas de higiene e limpeza exigidas pela Vigilância Sanitária.",
-            "A Contratante declara e está ciente que (i) os serviços têm caráter pessoal e são intransferíveis; (ii) só poderá alterar os Serviços contratados com a anuência da Contratada e desde que a utilização seja no prazo originalmente contratado; (iii) não tem nenhum impedimento médico e/ou alergias que impeçam de realizar os serviços contratados; (iv) escolheu os tratamentos de acordo com o seu tipo de cabelo; (v) concorda em realizar os tratamentos com a frequência indicada pela Contratada; e (vi) o resultado pretendido depende do respeito à frequência indicada pela Contratada.",
-            "Os serviços deverão ser utilizados em conformidade com o prazo de 18 (dezoito) meses e a Contratante está ciente de que não haverá prorrogação do prazo previsto para a utilização dos serviços, ou seja, ao final de 18 (dezoito) meses, o Contrato será extinto e a Contratante não terá direito ao reembolso de tratamentos não realizados no prazo contratual.",
-            "A Contratante poderá desistir dos serviços no prazo de até 90 (noventa) dias a contar da assinatura deste Contrato e, neste caso, está de acordo com a restituição do valor equivalente a 80% (oitenta por cento) dos tratamentos não realizados, no prazo de até 5 (cinco) dias úteis da desistência. Eventuais descontos ou promoções nos valores dos serviços e/ou tratamentos não serão reembolsáveis.",
-            "No caso de devolução de valor pago por cartão de crédito, o cancelamento será efetuado junto à administradora do seu cartão e o estorno poderá ocorrer em até 2 (duas) faturas posteriores de acordo com procedimentos internos da operadora do cartão de crédito, ou outro prazo definido pela administradora do cartão de crédito, ou, a exclusivo arbítrio da Contratada, mediante transferência direta do valor equivalente ao reembolso.",
-            "Na hipótese de responsabilidade civil da Contratada, independentemente da natureza do dano, fica desde já limitada a responsabilidade da Contratada ao valor máximo equivalente a 2 (duas) sessões de tratamento dos serviços.",
-            "No caso de alergias decorrentes dos produtos utilizados pela Contratada, a Contratante poderá optar pela suspensão dos serviços com a retomada após o reestabelecimento de sua saúde, ou pela concessão de crédito do valor remanescente em outros serviços junto à Contratada. A Contratada não é responsável por qualquer perda, independentemente do valor, incluindo danos diretos, indiretos, à imagem, lucros cessantes e/ou morais que se tornem exigíveis em decorrência de eventual alergia.",
-            "As Partes se comprometem a tratar apenas os dados pessoais estritamente necessários para atingir as finalidades específicas do objeto do Contrato, em cumprimento ao disposto na Lei nº 13.709/2018 (\"LGPD\") e na regulamentação aplicável.",
-            "Fica eleito o Foro da Comarca de UBERABA, Estado de MINAS GERAIS, como o competente para dirimir as dúvidas e controvérsias decorrentes do presente Contrato, com renúncia a qualquer outro, por mais privilegiado que seja.",
-            "Este Contrato poderá ser assinado e entregue eletronicamente e terá a mesma validade e efeitos de um documento original com assinaturas físicas."
-        ]
-        for i, clausula in enumerate(clausulas):
-            story.append(Paragraph(f"<b>{i+1}.</b> {clausula}", styles['Clause']))
-            story.append(Spacer(1, 0.4*cm))
-        
-        story.append(PageBreak())
-        story.append(Paragraph("ASSINATURAS", styles['MainTitle']))
-        story.append(Spacer(1, 4*cm))
-
-        # Fix: Garantir que cliente_nome nunca seja None
-        cliente_nome = orcamento.get('cliente_nome') or 'N/A'
-        assinatura_contratante = Paragraph(f"________________________________________<br/><b>CONTRATANTE</b><br/>{cliente_nome}", styles['Signature'])
-        assinatura_contratada = Paragraph("________________________________________<br/><b>CONTRATADA</b><br/>BIOMA UBERABA", styles['Signature'])
-        
-        assinaturas_table = Table([[assinatura_contratante, assinatura_contratada]], colWidths=['*', '*'])
-        story.append(assinaturas_table)
-        
-        def on_each_page(canvas, doc):
-            canvas.saveState()
-            canvas.setFont('Helvetica', 8)
-            canvas.setFillColor(COLOR_SECONDARY)
-            page_num = canvas.getPageNumber()
-            canvas.drawCentredString(doc_width/2, 1.5*cm, f"Página {page_num} | Contrato BIOMA Uberaba")
-            canvas.restoreState()
+        # v7.3: Renderizado no pool de PDFs (cache pelo conteúdo do orçamento)
+        pdf = gerar_pdf('orcamento_contrato', orcamento)
 
-        doc.build(story, onFirstPage=on_each_page, onLaterPages=on_each_page)
-        
-        buffer.seek(0)
         # Fix: Garantir que numero nunca seja None no nome do arquivo
         numero_orcamento = orcamento.get("numero") or str(orcamento.get('_id', 'sem_numero'))[-6:]
-        return send_file(buffer, mimetype='application/pdf', as_attachment=True, download_name=f'contrato_bioma_{numero_orcamento}.pdf')
+        return send_file(BytesIO(pdf), mimetype='application/pdf', as_attachment=True, download_name=f'contrato_bioma_{numero_orcamento}.pdf')
         
+    except PDFTimeout as e:
+        return jsonify({'success': False, 'message': str(e)}), 504
     except Exception as e:
         logger.error(f"❌ PDF error: {e}")
         return jsonify({'success': False, 'message': f'Erro interno ao gerar PDF: {e}'}), 500
@@ -2738,33 +2496,37 @@ def aprovar_entrada_estoque(id):
         return jsonify({'success': False}), 500
 
     try:
-        entrada = db.estoque_entradas_pendentes.find_one({'_id': ObjectId(id)})
+        # Reivindicar a entrada atomicamente: dois cliques simultâneos não somam duas vezes
+        entrada = db.estoque_entradas_pendentes.find_one_and_update(
+            {'_id': ObjectId(id), 'status': 'Pendente'},
+            {'$set': {'status': 'Aprovado', 'aprovado_em': datetime.now(), 'aprovado_por': session.get('username')}}
+        )
         if not entrada:
+            if db.estoque_entradas_pendentes.count_documents({'_id': ObjectId(id)}, limit=1):
+                return jsonify({'success': False, 'message': 'Entrada ja processada'}), 400
             return jsonify({'success': False, 'message': 'Entrada nao encontrada'}), 404
-        if entrada.get('status') != 'Pendente':
-            return jsonify({'success': False, 'message': 'Entrada ja processada'}), 400
-
-        produto = db.produtos.find_one({'_id': entrada['produto_id']})
-        if not produto:
-            return jsonify({'success': False, 'message': 'Produto nao encontrado para entrada'}), 404
-
-        novo_estoque = produto.get('estoque', 0) + int(entrada.get('quantidade', 0))
-        db.produtos.update_one({'_id': produto['_id']}, {'$set': {'estoque': novo_estoque, 'updated_at': datetime.now()}})
 
-        db.estoque_movimentacoes.insert_one({
-            'produto_id': produto['_id'],
-            'tipo': 'entrada',
-            'quantidade': int(entrada.get('quantidade', 0)),
-            'motivo': entrada.get('motivo', 'Entrada aprovada'),
-            'usuario': session.get('username', 'sistema'),
-            'data': datetime.now()
-        })
-
-        db.estoque_entradas_pendentes.update_one({
-            '_id': ObjectId(id)
-        }, {
-            '$set': {'status': 'Aprovado', 'aprovado_em': datetime.now(), 'aprovado_por': session.get('username')}
-        })
+        try:
+            movimentar_estoque(
+                db, entrada['produto_id'], 'entrada', int(entrada.get('quantidade', 0)),
+                motivo=entrada.get('motivo', 'Entrada aprovada'),
+                usuario=session.get('username', 'sistema'),
+                extras={'entrada_id': entrada['_id']}
+            )
+        except Exception as e:
+            # Qualquer falha devolve a entrada para Pendente, salvo se o saldo já foi somado
+            if movimentacao_aplicada(db, {'entrada_id': entrada['_id']}):
+                logger.warning(f"⚠️ Entrada {id} aplicada apesar do erro: {e}")
+                return jsonify({'success': True, 'message': 'Entrada aprovada e estoque atualizado'})
+            db.estoque_entradas_pendentes.update_one(
+                {'_id': entrada['_id'], 'status': 'Aprovado'},
+                {'$set': {'status': 'Pendente'}, '$unset': {'aprovado_em': '', 'aprovado_por': ''}}
+            )
+            if isinstance(e, ProdutoNaoEncontrado):
+                return jsonify({'success': False, 'message': 'Produto nao encontrado para entrada'}), 404
+            if isinstance(e, ValueError):
+                return jsonify({'success': False, 'message': str(e)}), 400
+            raise
 
         return jsonify({'success': True, 'message': 'Entrada aprovada e estoque atualizado'})
     except Exception as e:
@@ -2808,19 +2570,10 @@ def estoque_alerta():
     if db is None:
         return jsonify({'success': False, 'message': 'Erro ao conectar ao banco'}), 500
     try:
-        # Buscar TODOS os produtos primeiro
-        todos_produtos = list(db.produtos.find({}))
-
-        # Filtrar produtos onde estoque <= estoque_minimo (default 5)
-        produtos_baixos = []
-        for p in todos_produtos:
-            estoque_atual = p.get('estoque', 0) or 0
-            estoque_minimo = p.get('estoque_minimo', 5) or 5
+        # v7.3: nivel_estoque mantido a cada escrita - lê só o índice parcial dos críticos
+        produtos_baixos = list(db.produtos.find(filtro_nivel([NIVEL_CRITICO])))
 
-            if estoque_atual <= estoque_minimo:
-                produtos_baixos.append(p)
-
-        logger.info(f"📦 Alerta de estoque: {len(produtos_baixos)}/{len(todos_produtos)} produtos abaixo do mínimo")
+        logger.info(f"📦 Alerta de estoque: {len(produtos_baixos)} produtos abaixo do mínimo")
         return jsonify({'success': True, 'produtos': convert_objectid(produtos_baixos)})
 
     except Exception as e:
@@ -2835,19 +2588,17 @@ def estoque_movimentacao():
         return jsonify({'success': False}), 500
     data = request.json
     try:
-        produto = db.produtos.find_one({'_id': ObjectId(data['produto_id'])})
-        if not produto:
-            return jsonify({'success': False})
-        qtd = int(data['quantidade'])
-        tipo = data['tipo']
-        novo_estoque = produto.get('estoque', 0)
-        if tipo == 'entrada':
-            novo_estoque += qtd
-        else:
-            novo_estoque -= qtd
-        db.produtos.update_one({'_id': ObjectId(data['produto_id'])}, {'$set': {'estoque': novo_estoque}})
-        db.estoque_movimentacoes.insert_one({'produto_id': ObjectId(data['produto_id']), 'tipo': tipo, 'quantidade': qtd, 'motivo': data.get('motivo', ''), 'usuario': session.get('username'), 'data': datetime.now()})
-        return jsonify({'success': True})
+        produto, _ = movimentar_estoque(
+            db, data['produto_id'], data['tipo'], data['quantidade'],
+            motivo=data.get('motivo', ''), usuario=session.get('username')
+        )
+        return jsonify({'success': True, 'estoque_atual': produto.get('estoque', 0)})
+    except ProdutoNaoEncontrado:
+        return jsonify({'success': False})
+    except EstoqueInsuficiente as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except:
         return jsonify({'success': False}), 500
 
@@ -2956,42 +2707,21 @@ def registrar_saida_estoque():
         if not produto_id or quantidade <= 0:
             return jsonify({'success': False, 'message': 'Dados inválidos'}), 400
         
-        # Verificar se produto existe
-        produto = db.produtos.find_one({'_id': ObjectId(produto_id)})
-        if not produto:
+        # Decremento atômico e guardado (estoque >= quantidade) + movimentação
+        try:
+            produto, _ = movimentar_estoque(
+                db, produto_id, 'saida', quantidade,
+                motivo=motivo, usuario=session.get('username', 'Desconhecido')
+            )
+        except ProdutoNaoEncontrado:
             return jsonify({'success': False, 'message': 'Produto não encontrado'}), 404
-        
-        # Verificar estoque disponível
-        estoque_atual = produto.get('estoque', 0)
-        if estoque_atual < quantidade:
-            return jsonify({
-                'success': False, 
-                'message': f'Estoque insuficiente. Disponível: {estoque_atual}'
-            }), 400
-        
-        # Atualizar estoque
-        novo_estoque = estoque_atual - quantidade
-        db.produtos.update_one(
-            {'_id': ObjectId(produto_id)},
-            {'$set': {'estoque': novo_estoque, 'updated_at': datetime.now()}}
-        )
-        
-        # Registrar movimentação
-        movimentacao = {
-            'produto_id': ObjectId(produto_id),
-            'produto_nome': produto.get('nome'),
-            'tipo': 'saida',
-            'quantidade': quantidade,
-            'motivo': motivo,
-            'usuario': session.get('username', 'Desconhecido'),
-            'data': datetime.now()
-        }
-        db.estoque_movimentacoes.insert_one(movimentacao)
+        except EstoqueInsuficiente as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
         
         return jsonify({
             'success': True,
             'message': 'Saída registrada com sucesso',
-            'estoque_atual': novo_estoque
+            'estoque_atual': produto.get('estoque', 0)
         })
         
     except Exception as e:
@@ -3011,18 +2741,22 @@ def relatorio_estoque():
         data_inicio_str = request.args.get('data_inicio')
         data_fim_str = request.args.get('data_fim')
         formato = request.args.get('formato', 'json')  # json ou excel
+
+        # v7.3: Export para Excel como job em background (download pela URL do job)
+        if formato == 'excel':
+            return _enfileirar_exportacao('estoque_xlsx', {
+                'data_inicio': data_inicio_str,
+                'data_fim': data_fim_str
+            })
         
         # Total de produtos
         total_produtos = db.produtos.count_documents({})
         
-        # Valor total do estoque
-        produtos = list(db.produtos.find({}))
-        valor_total = sum(p.get('preco', 0) * p.get('estoque', 0) for p in produtos)
+        # Valor total do estoque (agregação no servidor, com cache)
+        valor_total = avaliar_estoque(db)['total']['valor_venda']
         
-        # Produtos com baixo estoque
-        baixo_estoque = db.produtos.count_documents({
-            '$expr': {'$lt': ['$estoque', '$estoque_minimo']}
-        })
+        # Produtos com baixo estoque (crítico ou atenção, mesmo classificador dos alertas)
+        baixo_estoque = db.produtos.count_documents(filtro_nivel())
         
         # Produtos sem estoque
         sem_estoque = db.produtos.count_documents({'estoque': 0})
@@ -3084,43 +2818,6 @@ def relatorio_estoque():
             }
         }
         
-        # Export para Excel
-        if formato == 'excel':
-            wb = Workbook()
-            ws = wb.active
-            ws.title = 'Relatório de Estoque'
-            
-            # Cabeçalho
-            ws.append(['RELATÓRIO DE ESTOQUE'])
-            ws.append([''])
-            ws.append(['Total de Produtos', total_produtos])
-            ws.append(['Valor Total Estoque', f'R$ {valor_total:.2f}'])
-            ws.append(['Produtos Baixo Estoque', baixo_estoque])
-            ws.append(['Produtos Sem Estoque', sem_estoque])
-            ws.append([''])
-            
-            # Produtos mais movimentados
-            ws.append(['PRODUTOS MAIS MOVIMENTADOS'])
-            ws.append(['Produto', 'Total Movimentações', 'Quantidade Total'])
-            for item in mais_movimentados:
-                ws.append([
-                    item.get('produto_nome', 'N/A'),
-                    item.get('total_movimentacoes', 0),
-                    item.get('total_quantidade', 0)
-                ])
-            
-            # Salvar em buffer
-            excel_buffer = BytesIO()
-            wb.save(excel_buffer)
-            excel_buffer.seek(0)
-            
-            return send_file(
-                excel_buffer,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=f'relatorio_estoque_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-            )
-        
         # Retorno JSON padrão
         return jsonify({
             'success': True,
@@ -3131,38 +2828,63 @@ def relatorio_estoque():
         logger.error(f"Erro ao gerar relatório: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-def normalizar_coluna(texto):
-    """Normalização extrema de nomes de colunas para máxima compatibilidade"""
-    import unicodedata
-    import re
-
-    if not texto:
-        return ''
-
-    # Converter para string
-    texto = str(texto)
-
-    # Remover acentos (NFD = Canonical Decomposition)
-    texto = unicodedata.normalize('NFD', texto)
-    texto = ''.join(char for char in texto if unicodedata.category(char) != 'Mn')
+# Pool de importações em background (criado sob demanda, um por processo)
+_import_jobs = None
+_import_jobs_lock = threading.Lock()
+
+def get_import_jobs():
+    """JobManager das importações (limites vindos do config)"""
+    global _import_jobs
+    with _import_jobs_lock:
+        if _import_jobs is None:
+            _import_jobs = JobManager(
+                'importacao',
+                max_workers=current_app.config.get('IMPORT_MAX_WORKERS', 1),
+                max_fila=current_app.config.get('IMPORT_MAX_FILA', 4),
+                notificar=broadcast_sse_event
+            )
+        return _import_jobs
 
-    # Converter para lowercase
-    texto = texto.lower()
+def _abandonar_importacao(db, job):
+    """Job de importação órfão: o lote sai de em_andamento e pode ser desfeito"""
+    lote_id = (job.get('progresso') or {}).get('import_batch_id')
+    if lote_id:
+        abandonar_lote(db, lote_id, MENSAGEM_ORFAO)
 
-    # Remover caracteres especiais, manter apenas alfanuméricos e underscores
-    texto = re.sub(r'[^a-z0-9_]', '', texto)
+ao_abandonar_job('importacao', _abandonar_importacao)
 
-    # Remover espaços/underscores duplicados
-    texto = re.sub(r'_+', '_', texto)
+def _executar_importacao(progresso, db, caminho, ext, tipo, batch_size, usuario_id=None, nome_arquivo=None,
+                         modo='inserir'):
+    """Job de importação: lê o arquivo salvo em streaming e grava em lotes"""
+    try:
+        with open(caminho, 'rb') as arquivo:
+            report = importar_linhas(
+                db, ler_linhas(arquivo, ext), tipo, batch_size,
+                progresso=lambda r: progresso(**r.progresso()),
+                usuario_id=usuario_id, arquivo=nome_arquivo, modo=modo
+            )
+    finally:
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
 
-    # Remover underscores no início/fim
-    texto = texto.strip('_')
+    # v7.0: Broadcast para todos os usuários quando importação é concluída
+    if report.sucesso > 0:
+        broadcast_sse_event('data_changed', {'section': report.tipo, 'action': 'import', 'count': report.sucesso})
+        # Se importou produtos, atualizar estoque também
+        if report.tipo == 'produtos':
+            invalidar_valorizacao()
+            broadcast_sse_event('data_changed', {'section': 'estoque', 'action': 'update'})
 
-    return texto
+    return {'message': f'{report.sucesso} importados!', **report.to_dict()}
 
 @bp.route('/api/importar', methods=['POST'])
 @login_required
 def importar():
+    """Enfileira a importação em background e retorna o job_id imediatamente"""
+    import tempfile
+
     db = get_db()
     if db is None:
         return jsonify({'success': False, 'message': 'Erro ao conectar ao banco de dados'}), 500
@@ -3175,401 +2897,108 @@ def importar():
     ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
     if ext not in ['csv', 'xlsx', 'xls']:
         return jsonify({'success': False, 'message': 'Formato de arquivo inválido'}), 400
-
-    # Criar diretório de upload se não existir
-    upload_folder = current_app.config.get('UPLOAD_FOLDER', '/tmp')
-    if not os.path.exists(upload_folder):
+    if TIPO_ALIASES.get(tipo, tipo) not in PARSERS:
+        return jsonify({'success': False, 'message': f"Importação de '{tipo}' não suportada"}), 400
+    # 'atualizar' = upsert pela chave natural (SKU/código de barras/CPF) em vez de duplicar
+    modo = request.form.get('modo', 'inserir')
+    if modo not in MODOS_IMPORTACAO:
+        return jsonify({'success': False, 'message': 'Modo de importação inválido'}), 400
+    if modo == 'atualizar' and TIPO_ALIASES.get(tipo, tipo) not in CHAVES_NATURAIS:
+        return jsonify({'success': False, 'message': f"Importação de '{tipo}' não suporta atualização"}), 400
+
+    caminho = None
+    try:
+        # Upload salvo em disco: o job roda depois que esta requisição termina
+        upload_folder = current_app.config.get('UPLOAD_FOLDER', '/tmp')
         os.makedirs(upload_folder, exist_ok=True)
+        fd, caminho = tempfile.mkstemp(prefix='import_', suffix=f'.{ext}', dir=upload_folder)
+        with os.fdopen(fd, 'wb') as destino:
+            file.save(destino)
+
+        batch_size = current_app.config.get('IMPORT_BATCH_SIZE', IMPORT_BATCH_SIZE)
+        nome_arquivo = secure_filename(file.filename)
+        job_id = get_import_jobs().submit(
+            db, _executar_importacao, db, caminho, ext, tipo, batch_size,
+            session.get('user_id'), nome_arquivo, modo,
+            descricao=f"{tipo} ({modo}): {nome_arquivo}",
+            usuario_id=session.get('user_id')
+        )
+    except JobQueueFull as e:
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+        return jsonify({'success': False, 'message': str(e)}), 429
+    except Exception as e:
+        logger.error(f"Erro ao enfileirar importação: {e}")
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+        return jsonify({'success': False, 'message': 'Erro ao processar arquivo'}), 500
 
-    filepath = None
-    try:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(upload_folder, f"{int(time())}_{filename}")
-        file.save(filepath)
-        count_success = 0
-        count_error = 0
-        rows = []
-        if ext == 'csv':
-            encodings = ['utf-8-sig', 'utf-8', 'latin-1', 'cp1252']
-            for encoding in encodings:
-                try:
-                    with open(filepath, 'r', encoding=encoding) as csvfile:
-                        rows = list(csv.DictReader(csvfile))
-                        break
-                except:
-                    continue
-        else:
-            wb = load_workbook(filepath, read_only=True, data_only=True)
-            ws = wb.active
-            headers = [str(c.value).strip().lower() if c.value else '' for c in next(ws.iter_rows(min_row=1, max_row=1))]
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                row_dict = {}
-                for i in range(len(headers)):
-                    if i < len(row) and row[i] is not None:
-                        val = row[i]
-                        if isinstance(val, str):
-                            val = val.strip()
-                        row_dict[headers[i]] = val
-                if row_dict:
-                    rows.append(row_dict)
-            wb.close()
-        if tipo == 'produtos':
-            for idx, row in enumerate(rows, 1):
-                try:
-                    r = {k.lower().strip(): v for k, v in row.items() if k and v is not None}
-                    if not r or all(not v for v in r.values()):
-                        continue
-                    nome = None
-                    for col in ['nome', 'produto', 'name']:
-                        if col in r and r[col]:
-                            nome = str(r[col]).strip()
-                            break
-                    if not nome or len(nome) < 2:
-                        count_error += 1
-                        continue
-                    marca = ''
-                    for col in ['marca', 'brand']:
-                        if col in r and r[col]:
-                            marca = str(r[col]).strip()
-                            break
-                    sku = f"PROD-{count_success+1}"
-                    for col in ['sku', 'codigo']:
-                        if col in r and r[col]:
-                            sku = str(r[col]).strip()
-                            break
-                    preco = 0.0
-                    for col in ['preco', 'preço', 'price', 'valor']:
-                        if col in r and r[col]:
-                            try:
-                                val = str(r[col]).replace('R$', '').strip()
-                                if ',' in val:
-                                    val = val.replace(',', '.')
-                                preco = float(val)
-                                break
-                            except:
-                                continue
-                    if preco <= 0:
-                        count_error += 1
-                        continue
-                    custo = 0.0
-                    for col in ['custo', 'cost']:
-                        if col in r and r[col]:
-                            try:
-                                val = str(r[col]).replace('R$', '').strip()
-                                if ',' in val:
-                                    val = val.replace(',', '.')
-                                custo = float(val)
-                                break
-                            except:
-                                continue
-                    estoque = 0
-                    for col in ['estoque', 'quantidade', 'qtd']:
-                        if col in r and r[col]:
-                            try:
-                                estoque = int(float(r[col]))
-                                break
-                            except:
-                                continue
-                    categoria = 'Produto'
-                    for col in ['categoria', 'category']:
-                        if col in r and r[col]:
-                            categoria = str(r[col]).strip().title()
-                            break
-                    # Código de barras
-                    codigo_barras = 'Sem código de barras no momento'
-                    for col in ['codigo_barras', 'código_barras', 'codigo barras', 'barcode', 'codigo de barras', 'código de barras']:
-                        if col in r and r[col]:
-                            codigo_barras = str(r[col]).strip()
-                            break
-                    db.produtos.insert_one({'nome': nome, 'marca': marca, 'sku': sku, 'preco': preco, 'custo': custo, 'estoque': estoque, 'estoque_minimo': 5, 'categoria': categoria, 'codigo_barras': codigo_barras, 'ativo': True, 'created_at': datetime.now()})
-                    count_success += 1
-                except:
-                    count_error += 1
-        elif tipo == 'servicos':
-            # Importação de serviços com NORMALIZAÇÃO EXTREMA
-            logger.info(f"🔄 Importando {len(rows)} linhas de serviços com normalização extrema...")
-
-            for idx, row in enumerate(rows, 1):
-                try:
-                    # NORMALIZAÇÃO EXTREMA: remover acentos, caracteres especiais, etc
-                    r = {normalizar_coluna(k): v for k, v in row.items() if k and v is not None}
-
-                    if not r or all(not v for v in r.values()):
-                        logger.debug(f"Linha {idx}: linha vazia, pulando")
-                        continue
-
-                    logger.debug(f"📋 Linha {idx}: Colunas detectadas: {list(r.keys())}")
-
-                    # Nome do serviço - NORMALIZADO
-                    nome = None
-                    nome_cols = [normalizar_coluna(x) for x in ['nome', 'servico', 'serviço', 'name', 'service']]
-                    for col in nome_cols:
-                        if col in r and r[col]:
-                            nome = str(r[col]).strip()
-                            logger.debug(f"  ✓ Nome encontrado na coluna '{col}': {nome}")
-                            break
-
-                    if not nome or len(nome) < 2:
-                        logger.warning(f"❌ Linha {idx}: nome do serviço inválido ou ausente - Colunas: {list(r.keys())}")
-                        count_error += 1
-                        continue
-
-                    # Categoria - NORMALIZADO
-                    categoria = 'Serviço'
-                    cat_cols = [normalizar_coluna(x) for x in ['categoria', 'category', 'tipo', 'type']]
-                    for col in cat_cols:
-                        if col in r and r[col]:
-                            categoria = str(r[col]).strip().title()
-                            logger.debug(f"  ✓ Categoria encontrada: {categoria}")
-                            break
-
-                    # Duração (em minutos) - NORMALIZADO
-                    duracao = 60  # Padrão: 60 minutos
-                    dur_cols = [normalizar_coluna(x) for x in ['duracao', 'duração', 'tempo', 'duration', 'minutos', 'minutes', 'min']]
-                    for col in dur_cols:
-                        if col in r and r[col]:
-                            try:
-                                duracao = int(float(r[col]))
-                                logger.debug(f"  ✓ Duração encontrada: {duracao} min")
-                                break
-                            except:
-                                continue
-
-                    # Preços por tamanho - DETECÇÃO MELHORADA v7.2
-                    # IMPORTANTE: Ordem importa! Mais específicos primeiro (extra_longo ANTES de longo)
-                    from collections import OrderedDict
-                    tamanhos_patterns = OrderedDict([
-                        ('extra_longo', ['extralongo', 'extra_longo', 'extralong', 'extra_long', 'extralarge', 'extra_large', 'muitolongo']),
-                        ('kids', ['kids', 'crianca', 'infantil', 'child', 'kid', 'bebe']),
-                        ('masculino', ['masculino', 'male', 'homem', 'masc', 'barba', 'beard']),
-                        ('curto', ['curto', 'short', 'pequeno', 'mini', 'small']),
-                        ('medio', ['medio', 'medium', 'media', 'normal']),
-                        ('longo', ['longo', 'long', 'grande', 'large', 'big']),
-                    ])
-
-                    # Letras únicas para tamanhos (P, M, G, etc) - busca EXATA
-                    tamanhos_letras = {
-                        'curto': ['p', 's'],
-                        'medio': ['m'],
-                        'longo': ['g', 'l'],
-                        'extra_longo': ['gg', 'xl', 'xxl']
-                    }
-
-                    tamanhos_precos = {}
-
-                    # Buscar por colunas normalizadas - DETECÇÃO MELHORADA v7.0
-                    logger.info(f"  🔍 Linha {idx} - Iniciando detecção de tamanhos...")
-                    logger.info(f"  📋 Colunas disponíveis: {list(r.keys())}")
-
-                    for coluna_normalizada, valor in r.items():
-                        if not valor:
-                            continue
-
-                        tamanho_detectado = None
-                        metodo_deteccao = None
-
-                        # ORDEM CORRIGIDA v7.2: Padrão textual PRIMEIRO para evitar falsos positivos
-
-                        # 1. Verificar se a coluna é EXATAMENTE uma letra (p, m, g, etc)
-                        if len(coluna_normalizada) <= 3:  # Colunas curtas como 'p', 'm', 'g', 'gg', 'xl'
-                            for tam, letras in tamanhos_letras.items():
-                                if coluna_normalizada in letras:
-                                    tamanho_detectado = tam
-                                    metodo_deteccao = f"letra exata '{coluna_normalizada}'"
-                                    break
-
-                        # 2. PADRÃO TEXTUAL (ANTES de "termina com" para evitar "kids" -> "curto")
-                        if not tamanho_detectado:
-                            for tam, patterns in tamanhos_patterns.items():
-                                for pattern in patterns:
-                                    pattern_norm = normalizar_coluna(pattern)
-                                    # v7.2: Buscar padrão NA coluna (ordem do OrderedDict garante extra_longo antes de longo)
-                                    # v7.3.1: Lógica mantida - ordem extra_longo > longo evita conflitos
-                                    if pattern_norm in coluna_normalizada:
-                                        tamanho_detectado = tam
-                                        metodo_deteccao = f"padrão '{pattern}'"
-                                        break
-                                if tamanho_detectado:
-                                    break
-
-                        # 3. TERMINA COM (ÚLTIMA PRIORIDADE para evitar falsos positivos)
-                        if not tamanho_detectado and len(coluna_normalizada) > 1:
-                            ultima_letra = coluna_normalizada[-1]
-                            if ultima_letra in ['p', 's']:
-                                tamanho_detectado = 'curto'
-                                metodo_deteccao = f"termina com '{ultima_letra}'"
-                            elif ultima_letra == 'm':
-                                tamanho_detectado = 'medio'
-                                metodo_deteccao = f"termina com '{ultima_letra}'"
-                            elif ultima_letra in ['g', 'l']:
-                                tamanho_detectado = 'longo'
-                                metodo_deteccao = f"termina com '{ultima_letra}'"
-
-                            # Verificar se termina com GG/XL
-                            if not tamanho_detectado and len(coluna_normalizada) >= 2:
-                                ultimas_duas = coluna_normalizada[-2:]
-                                if ultimas_duas in ['gg', 'xl']:
-                                    tamanho_detectado = 'extra_longo'
-                                    metodo_deteccao = f"termina com '{ultimas_duas}'"
-
-                        # Se detectou um tamanho, extrair o preço (REMOVIDO o check "not in tamanhos_precos" para pegar TODOS)
-                        if tamanho_detectado:
-                            try:
-                                val = str(valor).replace('R$', '').replace('$', '').strip()
-                                if ',' in val:
-                                    val = val.replace(',', '.')
-                                preco = float(val)
-                                if preco > 0:
-                                    # Permitir sobrescrever se encontrar preço maior
-                                    if tamanho_detectado not in tamanhos_precos or preco > tamanhos_precos[tamanho_detectado]:
-                                        tamanhos_precos[tamanho_detectado] = preco
-                                        logger.debug(f"  ✓ Preço {tamanho_detectado} encontrado: R$ {preco:.2f} (coluna: '{coluna_normalizada}', método: {metodo_deteccao})")
-                            except Exception as e:
-                                logger.debug(f"  ⚠ Erro ao converter preço da coluna '{coluna_normalizada}': {e}")
-
-                    # Log de resumo da detecção
-                    logger.info(f"  📊 Linha {idx} - Tamanhos detectados: {list(tamanhos_precos.keys())}")
-                    for tam_key, preco_val in tamanhos_precos.items():
-                        logger.info(f"    ✓ {tam_key}: R$ {preco_val:.2f}")
-
-                    # Se não há nenhum preço válido, tentar preço único
-                    if not tamanhos_precos:
-                        # Tentar importar com preço único - NORMALIZADO
-                        preco_unico = 0.0
-                        preco_cols = [normalizar_coluna(x) for x in ['preco', 'preço', 'price', 'valor', 'value', 'cost']]
-                        for col in preco_cols:
-                            if col in r and r[col]:
-                                try:
-                                    val = str(r[col]).replace('R$', '').replace('$', '').strip()
-                                    if ',' in val:
-                                        val = val.replace(',', '.')
-                                    preco_unico = float(val)
-                                    logger.debug(f"  ✓ Preço único encontrado: R$ {preco_unico:.2f}")
-                                    break
-                                except:
-                                    continue
-
-                        if preco_unico > 0:
-                            # v7.3.3: Serviço com preço único = criar com tamanho "Único"
-                            # Sistema dinâmico: apenas quando há colunas de tamanho detecta automaticamente
-                            sku = f"{nome.upper().replace(' ', '-')}-UNICO"
-                            db.servicos.insert_one({
-                                'nome': nome,
-                                'sku': sku,
-                                'tamanho': 'Único',  # Tamanho padrão quando não há colunas específicas
-                                'preco': preco_unico,
-                                'categoria': categoria,
-                                'duracao': duracao,
-                                'ativo': True,
-                                'created_at': datetime.now()
-                            })
-                            logger.info(f"✅ Linha {idx}: '{nome}' importado com tamanho 'Único' - R$ {preco_unico:.2f}")
-                            count_success += 1
-                        else:
-                            logger.warning(f"❌ Linha {idx}: '{nome}' sem preços válidos - Colunas: {list(r.keys())}")
-                            count_error += 1
-                        continue
-                    
-                    # Criar um serviço para cada tamanho com preço definido
-                    tamanhos_labels = {
-                        'kids': 'Kids',
-                        'masculino': 'Masculino',
-                        'curto': 'Curto',
-                        'medio': 'Médio',
-                        'longo': 'Longo',
-                        'extra_longo': 'Extra Longo'
-                    }
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'na_fila',
+        'status_url': f'/api/importar/{job_id}'
+    }), 202
 
-                    logger.info(f"✅ Linha {idx}: '{nome}' com {len(tamanhos_precos)} tamanhos detectados")
-                    for tamanho_key, preco in tamanhos_precos.items():
-                        tamanho_label = tamanhos_labels.get(tamanho_key, tamanho_key.title())
-                        sku = f"{nome.upper().replace(' ', '-')}-{tamanho_label.upper().replace(' ', '-')}"
+@bp.route('/api/importar/<job_id>', methods=['GET'])
+@login_required
+def status_importacao(job_id):
+    """Status/progresso de uma importação em background"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Erro ao conectar ao banco de dados'}), 500
 
-                        db.servicos.insert_one({
-                            'nome': nome,
-                            'sku': sku,
-                            'tamanho': tamanho_label,
-                            'preco': preco,
-                            'categoria': categoria,
-                            'duracao': duracao,
-                            'ativo': True,
-                            'created_at': datetime.now()
-                        })
-                        logger.debug(f"  ➕ Criado: {nome} - {tamanho_label} - R$ {preco:.2f}")
-
-                    count_success += 1
-                except Exception as e:
-                    logger.error(f"❌ Erro na linha {idx}: {str(e)}")
-                    count_error += 1
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
-
-        # v7.0: Broadcast para todos os usuários quando importação é concluída
-        if count_success > 0:
-            broadcast_sse_event('data_changed', {'section': tipo, 'action': 'import', 'count': count_success})
-            # Se importou produtos, atualizar estoque também
-            if tipo == 'produtos':
-                broadcast_sse_event('data_changed', {'section': 'estoque', 'action': 'update'})
+    try:
+        job = obter_job(db, job_id, categoria='importacao')
+        if not job:
+            return jsonify({'success': False, 'message': 'Importação não encontrada'}), 404
 
-        return jsonify({'success': True, 'message': f'{count_success} importados!', 'count_success': count_success, 'count_error': count_error})
+        job['job_id'] = job.pop('_id')
+        job.pop('expire_at', None)
+        return jsonify({'success': True, 'job': convert_objectid(job)})
     except Exception as e:
-        logger.error(f"Erro na importação: {e}")
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
-        return jsonify({'success': False, 'message': 'Erro ao processar arquivo'}), 500
+        logger.error(f"Erro ao consultar importação {job_id}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 @bp.route('/api/importar/desfazer', methods=['POST'])
 @login_required
 def desfazer_importacao():
-    """Desfaz a última importação removendo os registros mais recentes."""
+    """Desfaz uma importação removendo exatamente os documentos do seu lote (import_batch_id)."""
     db = get_db()
     if db is None:
         return jsonify({'success': False, 'message': 'Erro ao conectar ao banco de dados'}), 500
 
     try:
-        data = request.get_json()
+        data = request.get_json() or {}
+        lote_id = data.get('import_batch_id')
         tipo = data.get('tipo')
-        timestamp = data.get('timestamp')
-        count = data.get('count', 0)
 
-        if not tipo or not timestamp:
+        if not lote_id and not tipo:
             return jsonify({'success': False, 'message': 'Dados inválidos'}), 400
 
-        # Converter timestamp para datetime
-        import_date = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-
-        # Determinar a coleção correta
-        collection_map = {
-            'produtos': db.produtos,
-            'servicos': db.servicos,
-            'clientes': db.clientes,
-            'profissionais': db.profissionais
-        }
-
-        collection = collection_map.get(tipo)
-        if not collection:
-            return jsonify({'success': False, 'message': 'Tipo inválido'}), 400
-
-        # Deletar registros criados após (ou próximo a) o timestamp da importação
-        # Consideramos uma margem de 5 minutos para garantir que pegamos apenas os registros da importação
-        time_margin = timedelta(minutes=5)
-        query = {
-            'created_at': {
-                '$gte': import_date - time_margin,
-                '$lte': import_date + time_margin
-            }
-        }
+        # Sem import_batch_id (clientes antigos): último lote desfazível do tipo
+        lote = obter_lote(db, lote_id, tipo)
+        if not lote or lote.get('tipo') not in COLECOES_IMPORTAVEIS:
+            return jsonify({'success': False, 'message': 'Importação não encontrada'}), 404
+        if lote.get('status') == 'desfeita':
+            return jsonify({'success': False, 'message': 'Esta importação já foi desfeita'}), 409
+        if lote.get('status') in ('em_andamento', 'desfazendo'):
+            return jsonify({'success': False, 'message': 'Importação ainda em processamento'}), 409
 
-        # Deletar os registros
-        result = collection.delete_many(query)
-        deleted_count = result.deleted_count
+        deleted_count = desfazer_lote(db, lote)
+        tipo = lote['tipo']
 
-        logger.info(f"Desfazer importação: {deleted_count} registros de {tipo} removidos")
+        if deleted_count > 0:
+            broadcast_sse_event('data_changed', {'section': tipo, 'action': 'undo_import', 'count': deleted_count})
+            if tipo == 'produtos':
+                invalidar_valorizacao()
+                broadcast_sse_event('data_changed', {'section': 'estoque', 'action': 'update'})
 
         return jsonify({
             'success': True,
             'message': f'{deleted_count} registros de {tipo} foram removidos',
-            'deleted': deleted_count
+            'deleted': deleted_count,
+            'import_batch_id': str(lote['_id'])
         })
 
     except Exception as e:
@@ -3694,7 +3123,7 @@ def relatorio_completo():
         
         # === ESTATÍSTICAS GERAIS ===
         total_clientes = db.clientes.count_documents({})
-        total_produtos = db.produtos.count_documents({'ativo': True})
+        total_produtos = db.produtos.count_documents({'status': 'Ativo'})
         total_servicos = db.servicos.count_documents({'ativo': True})
         total_profissionais = db.profissionais.count_documents({'ativo': True})
         
@@ -3727,12 +3156,13 @@ def relatorio_completo():
         ticket_medio = faturamento_total / orcamentos_aprovados_count if orcamentos_aprovados_count > 0 else 0
         
         # === ESTOQUE ===
-        produtos = list(db.produtos.find({'ativo': True}))
-        estoque_total_valor_custo = sum(p.get('estoque', 0) * p.get('custo', 0) for p in produtos)
-        estoque_total_valor_venda = sum(p.get('estoque', 0) * p.get('preco', 0) for p in produtos)
-        produtos_zerados = len([p for p in produtos if p.get('estoque', 0) == 0])
-        produtos_baixo_estoque = len([p for p in produtos if p.get('estoque', 0) <= p.get('estoque_minimo', 5) and p.get('estoque', 0) > 0])
-        produtos_criticos = len([p for p in produtos if p.get('estoque', 0) == 0])
+        valorizacao = avaliar_estoque(db, {'status': 'Ativo'})['total']
+        estoque_total_valor_custo = valorizacao['valor_custo']
+        estoque_total_valor_venda = valorizacao['valor_venda']
+        produtos_zerados = valorizacao['zerados']
+        # v7.3: mesmo classificador dos alertas (nivel_estoque, índices parciais)
+        produtos_baixo_estoque = db.produtos.count_documents({'status': 'Ativo', **filtro_nivel()})
+        produtos_criticos = db.produtos.count_documents({'status': 'Ativo', **filtro_nivel([NIVEL_CRITICO])})
         
         # === CLIENTES ===
         novos_clientes = db.clientes.count_documents({
@@ -4062,7 +3492,8 @@ def init_db():
         tamanhos = ['Kids', 'Masculino', 'Curto', 'Médio', 'Longo', 'Extra Longo']
         for nome, cat, precos in services:
             for tam, preco in zip(tamanhos, precos):
-                db.servicos.insert_one({'nome': nome, 'sku': f"{nome.upper()}-{tam.upper()}", 'tamanho': tam, 'preco': preco, 'categoria': cat, 'duracao': 60, 'ativo': True, 'created_at': datetime.now()})
+                servico = {'nome': nome, 'sku': f"{nome.upper()}-{tam.upper()}", 'tamanho': tam, 'preco': preco, 'categoria': cat, 'duracao': 60, 'ativo': True, 'created_at': datetime.now()}
+                db.servicos.insert_one({**servico, **campos_busca('servicos', servico)})
         logger.info(f"✅ {len(services) * 6} service SKUs created")
     try:
         # ==================== STRATEGIC INDEXING FOR PERFORMANCE ====================
@@ -4138,6 +3569,10 @@ def internal_error(e):
 @login_required
 def upload_logo():
     """Upload de logo da empresa (armazenado como base64, SEM arquivos externos)"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
     try:
         if 'logo' not in request.files:
             return jsonify({'success': False, 'message': 'Nenhum arquivo enviado'}), 400
@@ -4151,34 +3586,28 @@ def upload_logo():
         if file and allowed_file(file.filename):
             import base64
 
-            # Ler arquivo em memória (SEM salvar em /tmp)
-            file_content = file.read()
-            foto_base64 = base64.b64encode(file_content).decode('utf-8')
-
-            # Determinar tipo MIME
-            ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'png'
-            mime_types = {
-                'png': 'image/png',
-                'jpg': 'image/jpeg',
-                'jpeg': 'image/jpeg',
-                'gif': 'image/gif',
-                'webp': 'image/webp'
-            }
-            mime_type = mime_types.get(ext, 'image/jpeg')
+            # Pipeline de imagens: decodificado uma vez, sem metadados, lado máximo limitado
+            try:
+                imagem = salvar_imagem(db, file.read(), f'logo_{tipo}')
+            except ValueError as img_error:
+                return jsonify({'success': False, 'message': str(img_error)}), 400
 
-            # Montar data URI (armazenado diretamente no MongoDB)
-            data_uri = f"data:{mime_type};base64,{foto_base64}"
+            mime_type = 'image/webp'
+            data_uri = f"data:{mime_type};base64,{base64.b64encode(imagem['master']).decode('utf-8')}"
 
-            # Salvar referência no banco COM data URI
+            # Salvar referência no banco COM data URI (já normalizado)
             db.uploads.insert_one({
                 'tipo': f'logo_{tipo}',
                 'filename': secure_filename(file.filename),
-                'data_uri': data_uri,  # Armazena base64 diretamente
+                'imagem_id': imagem['_id'],
+                'data_uri': data_uri,
                 'mime_type': mime_type,
                 'data_upload': datetime.now()
             })
 
-            logger.info(f"✅ Logo {tipo} salvo como base64 no MongoDB (SEM arquivos externos)")
+            invalidar_logo(tipo)
+
+            logger.info(f"✅ Logo {tipo} salvo no MongoDB ({len(imagem['master']) // 1024}KB)")
 
             return jsonify({
                 'success': True,
@@ -4202,16 +3631,35 @@ def upload_imagem():
 # 2. Obter Logo Configurado
 @bp.route('/api/config/logo', methods=['GET'])
 def get_logo():
+    """
+    Servir o logo configurado como bytes crus com ETag (cacheável pelo navegador)
+
+    Query params:
+        tipo: principal (padrão) ou login
+        v: hash do conteúdo (URL versionada → cache imutável)
+        formato: 'json' retorna apenas a URL versionada (compatibilidade)
+    """
     db = get_db()
-    """Obter Data URI do logo configurado (sem arquivos externos)"""
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
     try:
         tipo = request.args.get('tipo', 'principal')
-        logo = db.uploads.find_one({'tipo': f'logo_{tipo}'}, sort=[('data_upload', DESCENDING)])
+        logo = obter_logo(db, tipo)
 
-        if logo:
-            # Retorna data_uri em vez de url de arquivo
-            return jsonify({'success': True, 'url': logo.get('data_uri')})
-        return jsonify({'success': True, 'url': None})
+        if request.args.get('formato') == 'json':
+            url = f"/api/config/logo?tipo={urllib.parse.quote(tipo)}&v={logo[2]}" if logo else None
+            return jsonify({'success': True, 'url': url})
+
+        if logo is None:
+            return jsonify({'success': False, 'message': 'Logo não configurado'}), 404
+
+        conteudo, mime_type, etag = logo
+        return resposta_imagem(
+            conteudo, mime_type, etag,
+            publico=True,
+            imutavel=request.args.get('v') == etag
+        )
     except Exception as e:
         logger.error(f"Erro ao obter logo: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -4242,29 +3690,94 @@ def uploaded_file(filename):
         logger.error(f"Erro ao buscar upload: {e}")
         return jsonify({'success': False, 'message': 'Arquivo não encontrado'}), 404
 
-# 4. Upload de Foto de Profissional (via form data)
-@bp.route('/api/upload/foto-profissional', methods=['POST'])
+# 3.1. Servir Variantes de Imagem (avatar/card/full geradas sob demanda)
+@bp.route('/api/imagens/<imagem_id>/<variante>', methods=['GET'])
 @login_required
-def upload_foto_profissional_form():
-    """Upload de foto de perfil de profissional via form data (armazenado como base64, SEM arquivos externos)"""
+def servir_imagem(imagem_id, variante):
+    """Servir variante redimensionada (bytes crus + ETag, cache imutável)"""
     db = get_db()
     if db is None:
-        logger.error("❌ Database offline em upload foto")
         return jsonify({'success': False, 'message': 'Database offline'}), 500
 
+    if variante not in IMAGE_VARIANTS:
+        return jsonify({'success': False, 'message': 'Variante inválida'}), 404
+
     try:
-        logger.info(f"📤 Upload foto - Files: {list(request.files.keys())}, Form: {list(request.form.keys())}")
+        aceita_webp = 'image/webp' in request.headers.get('Accept', '')
+        resultado = obter_variante(db, imagem_id, variante, aceita_webp)
+        if resultado is None:
+            return jsonify({'success': False, 'message': 'Imagem não encontrada'}), 404
 
-        if 'foto' not in request.files:
-            logger.warning("⚠️ Nenhum arquivo 'foto' encontrado")
-            return jsonify({'success': False, 'message': 'Nenhum arquivo enviado'}), 400
+        conteudo, mime_type, etag = resultado
+        return resposta_imagem(conteudo, mime_type, etag)
+    except Exception as e:
+        logger.error(f"Erro ao servir imagem {imagem_id}/{variante}: {e}")
+        return jsonify({'success': False, 'message': 'Imagem não encontrada'}), 404
 
-        file = request.files['foto']
-        profissional_id = request.form.get('profissional_id')
+# 3.2. Migração Sob Demanda de Fotos Legadas (data URI → pipeline de imagens)
+@bp.route('/api/imagens/legado/<colecao>/<doc_id>/<variante>', methods=['GET'])
+@login_required
+def migrar_foto_legada(colecao, doc_id, variante):
+    """Converter foto em data URI no primeiro acesso e redirecionar para a variante"""
+    from flask import redirect
 
-        if not profissional_id:
-            logger.warning("⚠️ profissional_id não fornecido")
-            return jsonify({'success': False, 'message': 'ID do profissional não fornecido'}), 400
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    if colecao not in COLECOES_COM_FOTO or variante not in IMAGE_VARIANTS:
+        return jsonify({'success': False, 'message': 'Recurso inválido'}), 404
+
+    try:
+        projection = {'foto': 1, 'foto_url': 1, 'foto_id': 1, 'foto_versao': 1}
+        doc = db[colecao].find_one({'_id': ObjectId(doc_id)}, projection)
+        if not doc and colecao == 'assistentes':
+            # Assistente legado pode estar cadastrado como profissional
+            colecao = 'profissionais'
+            doc = db[colecao].find_one({'_id': ObjectId(doc_id)}, projection)
+        if not doc:
+            return jsonify({'success': False, 'message': 'Registro não encontrado'}), 404
+
+        if not doc.get('foto_id'):
+            raw = data_uri_para_bytes(doc.get('foto_url')) or data_uri_para_bytes(doc.get('foto'))
+            if raw is None:
+                return jsonify({'success': False, 'message': 'Foto não encontrada'}), 404
+
+            foto = campos_foto(salvar_imagem(db, raw, f'foto_{colecao}'))
+            db[colecao].update_one({'_id': doc['_id']}, {'$set': foto})
+            doc.update(foto)
+            logger.info(f"🖼️ Foto legada migrada: {colecao}/{doc_id}")
+
+        return redirect(url_imagem(doc['foto_id'], variante, doc.get('foto_versao')))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erro ao migrar foto legada {colecao}/{doc_id}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# 4. Upload de Foto de Profissional (via form data)
+@bp.route('/api/upload/foto-profissional', methods=['POST'])
+@login_required
+def upload_foto_profissional_form():
+    """Upload de foto de perfil de profissional via form data (armazenado como base64, SEM arquivos externos)"""
+    db = get_db()
+    if db is None:
+        logger.error("❌ Database offline em upload foto")
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    try:
+        logger.info(f"📤 Upload foto - Files: {list(request.files.keys())}, Form: {list(request.form.keys())}")
+
+        if 'foto' not in request.files:
+            logger.warning("⚠️ Nenhum arquivo 'foto' encontrado")
+            return jsonify({'success': False, 'message': 'Nenhum arquivo enviado'}), 400
+
+        file = request.files['foto']
+        profissional_id = request.form.get('profissional_id')
+
+        if not profissional_id:
+            logger.warning("⚠️ profissional_id não fornecido")
+            return jsonify({'success': False, 'message': 'ID do profissional não fornecido'}), 400
 
         if file.filename == '':
             logger.warning("⚠️ Arquivo com nome vazio")
@@ -4276,52 +3789,32 @@ def upload_foto_profissional_form():
             return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
         if file and allowed_file_check(file.filename):
-            import base64
-
-            # Ler arquivo em memória (SEM salvar em /tmp)
-            file_content = file.read()
-            foto_base64 = base64.b64encode(file_content).decode('utf-8')
-
-            # Determinar tipo MIME
-            ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'png'
-            mime_types = {
-                'png': 'image/png',
-                'jpg': 'image/jpeg',
-                'jpeg': 'image/jpeg',
-                'gif': 'image/gif',
-                'webp': 'image/webp'
-            }
-            mime_type = mime_types.get(ext, 'image/jpeg')
+            # Pipeline de imagens: original normalizado + variantes sob demanda
+            try:
+                imagem = salvar_imagem(db, file.read(), 'foto_profissional')
+            except ValueError as img_error:
+                return jsonify({'success': False, 'message': str(img_error)}), 400
 
-            # Montar data URI (armazenado diretamente no MongoDB)
-            data_uri = f"data:{mime_type};base64,{foto_base64}"
+            foto = campos_foto(imagem)
+            db.profissionais.update_one({'_id': ObjectId(profissional_id)}, {'$set': foto})
 
-            # Atualizar profissional com a foto (Data URI em vez de URL de arquivo)
-            db.profissionais.update_one(
-                {'_id': ObjectId(profissional_id)},
-                {'$set': {
-                    'foto': data_uri,
-                    'foto_url': data_uri,
-                    'foto_atualizada_em': datetime.now()
-                }}
-            )
-
-            # Salvar referência no banco COM data URI
+            # Referência do upload (bytes ficam apenas em `imagens`)
             db.uploads.insert_one({
                 'tipo': 'foto_profissional',
                 'profissional_id': ObjectId(profissional_id),
                 'filename': secure_filename(file.filename),
-                'data_uri': data_uri,  # Armazena base64 diretamente
-                'mime_type': mime_type,
+                'imagem_id': imagem['_id'],
                 'data_upload': datetime.now()
             })
+            CacheManager.invalidate('profissionais')
 
-            logger.info(f"✅ Foto de profissional {profissional_id} salva como base64 no MongoDB (SEM arquivos externos)")
+            logger.info(f"✅ Foto de profissional {profissional_id} salva (imagem {imagem['_id']})")
 
             return jsonify({
                 'success': True,
                 'message': 'Foto enviada com sucesso',
-                'url': data_uri  # Retorna Data URI diretamente
+                'url': foto['foto_url'],
+                'foto_thumb_url': foto['foto_thumb_url']
             })
 
         return jsonify({'success': False, 'message': 'Tipo de arquivo não permitido'}), 400
@@ -4396,54 +3889,54 @@ def calcular_comissoes_orcamento():
         if not orcamento:
             return jsonify({'success': False, 'message': 'Orçamento não encontrado'}), 404
         
-        # Buscar dados do profissional
-        profissional = db.profissionais.find_one({'_id': ObjectId(orcamento.get('profissional_id'))})
-        if not profissional:
+        # Motor de comissões (mesmas regras das demais rotas)
+        calculo = calcular_comissoes(db, [orcamento])
+        por_profissional = calculo['por_profissional']
+        if not por_profissional:
             return jsonify({'success': False, 'message': 'Profissional não encontrado'}), 404
         
-        # Calcular comissão do profissional
-        valor_total = orcamento.get('total', 0)
-        comissao_perc = profissional.get('comissao_perc', 10)
-        comissao_profissional = valor_total * (comissao_perc / 100)
+        # Profissional principal: o do orçamento ou o de maior comissão
+        principal_id = str(orcamento.get('profissional_id') or '')
+        if principal_id not in por_profissional:
+            principal_id = max(por_profissional, key=lambda pid: por_profissional[pid]['comissao_profissional'])
+        principal = por_profissional[principal_id]
+        profissional = calculo['participantes'].profissional(principal_id) or {}
+        linhas_principal = [linha for linha in calculo['linhas'] if linha['profissional_id'] == principal_id]
         
+        comissao_profissional = principal['comissao_profissional']
         resultado = {
             'orcamento_id': str(orcamento_id),
-            'valor_total': valor_total,
+            'valor_total': principal['faturamento'],
             'profissional': {
-                'id': str(profissional['_id']),
-                'nome': profissional.get('nome'),
-                'foto': profissional.get('foto'),
-                'comissao_percentual': comissao_perc,
+                'id': principal_id,
+                'nome': profissional.get('nome') or linhas_principal[0]['profissional_nome'],
+                'foto': profissional.get('foto_url'),
+                'comissao_percentual': linhas_principal[0]['comissao_perc'],
                 'comissao_valor': round(comissao_profissional, 2)
-            }
+            },
+            'profissionais': [{
+                'id': pid,
+                'comissao_valor': round(totais['comissao_profissional'], 2),
+                'comissao_assistente': round(totais['comissao_assistente'], 2)
+            } for pid, totais in por_profissional.items()],
+            'total_comissoes': round(calculo['total'], 2)
         }
         
-        # Calcular comissão do assistente (10% da comissão do profissional)
-        assistentes = profissional.get('assistentes', [])
-        if assistentes:
-            assistente_principal = assistentes[0]
-            assistente_id = assistente_principal.get('_id') if isinstance(assistente_principal, dict) else assistente_principal
-            
-            assistente_doc = db.assistentes.find_one({'_id': ObjectId(assistente_id)})
-            if assistente_doc:
-                comissao_assistente = comissao_profissional * 0.1  # 10% da comissão do profissional
-                resultado['assistente'] = {
-                    'id': str(assistente_doc['_id']),
-                    'nome': assistente_doc.get('nome'),
-                    'foto': assistente_doc.get('foto'),
-                    'comissao_percentual': 10,
-                    'comissao_valor': round(comissao_assistente, 2)
-                }
-                resultado['total_comissoes'] = round(comissao_profissional + comissao_assistente, 2)
-            else:
-                resultado['total_comissoes'] = round(comissao_profissional, 2)
-        else:
-            resultado['total_comissoes'] = round(comissao_profissional, 2)
+        linha_assistente = next((linha for linha in linhas_principal if linha['assistente_id']), None)
+        if linha_assistente:
+            assistente_doc = calculo['participantes'].assistente(linha_assistente['assistente_id']) or {}
+            resultado['assistente'] = {
+                'id': linha_assistente['assistente_id'],
+                'nome': linha_assistente['assistente_nome'],
+                'foto': assistente_doc.get('foto_url'),
+                'comissao_percentual': linha_assistente['assistente_perc'],
+                'comissao_valor': round(principal['comissao_assistente'], 2)
+            }
         
         # Salvar no histórico
         db.comissoes_historico.insert_one({
             'orcamento_id': ObjectId(orcamento_id),
-            'profissional_id': ObjectId(profissional['_id']),
+            'profissional_id': ObjectId(principal_id),
             'profissional_comissao': resultado['profissional']['comissao_valor'],
             'assistente_id': ObjectId(resultado['assistente']['id']) if 'assistente' in resultado else None,
             'assistente_comissao': resultado.get('assistente', {}).get('comissao_valor', 0),
@@ -4554,32 +4047,38 @@ def aprovar_entrada_produto(id):
     db = get_db()
     """Aprova entrada de produto e atualiza estoque"""
     try:
-        entrada = db.estoque_pendencias.find_one({'_id': ObjectId(id)})
-        if not entrada:
-            return jsonify({'success': False, 'message': 'Entrada não encontrada'}), 404
-        
-        # Atualizar status da entrada
-        db.estoque_pendencias.update_one(
-            {'_id': ObjectId(id)},
+        # Reivindicar a pendência atomicamente: só 'pendente' (aprovação dupla não
+        # soma duas vezes e entrada rejeitada não volta a somar)
+        entrada = db.estoque_pendencias.find_one_and_update(
+            {'_id': ObjectId(id), 'status': 'pendente'},
             {'$set': {'status': 'aprovado', 'data_processamento': datetime.now()}}
         )
+        if not entrada:
+            atual = db.estoque_pendencias.find_one({'_id': ObjectId(id)}, {'status': 1})
+            if atual:
+                return jsonify({'success': False, 'message': f"Entrada já processada ({atual.get('status')})"}), 400
+            return jsonify({'success': False, 'message': 'Entrada não encontrada'}), 404
         
-        # Atualizar estoque do produto
-        db.produtos.update_one(
-            {'_id': entrada['produto_id']},
-            {'$inc': {'estoque': entrada['quantidade']}}
-        )
-        
-        # Registrar movimentação
-        db.estoque_movimentacoes.insert_one({
-            'produto_id': entrada['produto_id'],
-            'produto_nome': entrada['produto_nome'],
-            'tipo': 'entrada',
-            'quantidade': entrada['quantidade'],
-            'motivo': f"Aprovação: {entrada.get('motivo', '')}",
-            'usuario': session.get('user', {}).get('name'),
-            'data': datetime.now()
-        })
+        # Atualizar estoque do produto + registrar movimentação
+        try:
+            movimentar_estoque(
+                db, entrada['produto_id'], 'entrada', entrada['quantidade'],
+                motivo=f"Aprovação: {entrada.get('motivo', '')}",
+                usuario=session.get('user', {}).get('name'),
+                extras={'produto_nome': entrada.get('produto_nome'), 'entrada_id': entrada['_id']}
+            )
+        except Exception as e:
+            # Qualquer falha devolve a pendência ao status anterior, salvo se o saldo já foi somado
+            if movimentacao_aplicada(db, {'entrada_id': entrada['_id']}):
+                logger.warning(f"⚠️ Entrada {id} aplicada apesar do erro: {e}")
+                return jsonify({'success': True, 'message': 'Entrada aprovada e estoque atualizado'})
+            db.estoque_pendencias.update_one(
+                {'_id': entrada['_id'], 'status': 'aprovado'},
+                {'$set': {'status': 'pendente', 'data_processamento': None}}
+            )
+            if isinstance(e, (ProdutoNaoEncontrado, ValueError)):
+                return jsonify({'success': False, 'message': str(e)}), 404 if isinstance(e, ProdutoNaoEncontrado) else 400
+            raise
         
         return jsonify({'success': True, 'message': 'Entrada aprovada e estoque atualizado'})
     except Exception as e:
@@ -4593,10 +4092,16 @@ def rejeitar_entrada_produto(id):
     db = get_db()
     """Rejeita entrada de produto"""
     try:
-        db.estoque_pendencias.update_one(
-            {'_id': ObjectId(id)},
+        # Só pendências: entrada aprovada já somou ao estoque e não pode virar rejeitada
+        result = db.estoque_pendencias.update_one(
+            {'_id': ObjectId(id), 'status': 'pendente'},
             {'$set': {'status': 'rejeitado', 'data_processamento': datetime.now()}}
         )
+        if not result.matched_count:
+            atual = db.estoque_pendencias.find_one({'_id': ObjectId(id)}, {'status': 1})
+            if atual:
+                return jsonify({'success': False, 'message': f"Entrada já processada ({atual.get('status')})"}), 400
+            return jsonify({'success': False, 'message': 'Entrada não encontrada'}), 404
         
         return jsonify({'success': True, 'message': 'Entrada rejeitada'})
     except Exception as e:
@@ -5151,95 +4656,181 @@ def relatorio_taxa_conversao():
         logger.error(f"Erro ao gerar relatório de taxa de conversão: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@bp.route('/api/relatorios/exportar-pdf', methods=['POST'])
+# Pool de exportações de relatórios em background (criado sob demanda, um por processo)
+_report_jobs = None
+_report_jobs_lock = threading.Lock()
+
+def get_report_jobs():
+    """JobManager das exportações (limites vindos do config)"""
+    global _report_jobs
+    with _report_jobs_lock:
+        if _report_jobs is None:
+            _report_jobs = JobManager(
+                'relatorio',
+                max_workers=current_app.config.get('REPORT_MAX_WORKERS', 2),
+                max_fila=current_app.config.get('REPORT_MAX_FILA', 8),
+                notificar=broadcast_sse_event
+            )
+        return _report_jobs
+
+def _resposta_exportacao(job, reaproveitado=False):
+    """JSON padrão de um job de exportação (status + URLs)"""
+    job_id = job['_id']
+    dados = {
+        'success': True,
+        'job_id': job_id,
+        'tipo': job.get('tipo'),
+        'status': job.get('status'),
+        'progresso': job.get('progresso') or {},
+        # Segundos sem atualização, medidos no servidor (relógio do navegador pode divergir)
+        'parado_s': round((datetime.now() - job['updated_at']).total_seconds()) if job.get('updated_at') else 0,
+        'reaproveitado': reaproveitado,
+        'status_url': f'/api/relatorios/exportacoes/{job_id}',
+        'download_url': f'/api/relatorios/exportacoes/{job_id}/download'
+    }
+    if job.get('status') == 'concluido':
+        dados['resultado'] = job.get('resultado')
+    elif job.get('status') == 'erro':
+        dados['erro'] = job.get('erro')
+    return dados
+
+def _enfileirar_exportacao(tipo, params):
+    """Validar perfil, enfileirar (ou reaproveitar) e responder 202/200"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    config_relatorio = RELATORIOS.get(tipo)
+    if config_relatorio is None:
+        return jsonify({'success': False, 'message': f"Relatório '{tipo}' não suportado"}), 400
+    perfis = config_relatorio['perfis']
+    if perfis and session.get('tipo_acesso', 'Profissional') not in perfis:
+        return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+
+    try:
+        job, reaproveitado = exportar(db, get_report_jobs(), tipo, params, usuario_id=session.get('user_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+
+    pronto = job.get('status') == 'concluido'
+    return jsonify(convert_objectid(_resposta_exportacao(job, reaproveitado))), 200 if pronto else 202
+
+@bp.route('/api/relatorios/exportacoes', methods=['POST'])
 @login_required
-@permission_required('Admin', 'Gestão')
-def exportar_relatorio_pdf_com_grafico():
-    """
-    (Ponto 3) NOVO ENDPOINT: Recebe imagens base64 dos gráficos e as insere em um PDF.
-    """
+def criar_exportacao():
+    """Enfileirar exportação de relatório: {tipo, params} -> job_id (SSE job_progress ao concluir)"""
+    try:
+        data = request.get_json() or {}
+        return _enfileirar_exportacao(data.get('tipo'), data.get('params') or {})
+    except Exception as e:
+        logger.error(f"Erro ao enfileirar exportação: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/relatorios/exportacoes/<job_id>', methods=['GET'])
+@login_required
+def status_exportacao(job_id):
+    """Status/progresso de uma exportação"""
     db = get_db()
     if db is None:
-        return jsonify({'success': False}), 500
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
 
     try:
-        from reportlab.lib import colors
-        from reportlab.lib.pagesizes import A4
-        from reportlab.lib.units import cm
-        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib.utils import ImageReader
-        from reportlab.lib.colors import HexColor
-        import base64
-        import io
+        job = obter_job(db, job_id, categoria='relatorio')
+        if not job:
+            return jsonify({'success': False, 'message': 'Exportação não encontrada'}), 404
+        return jsonify(convert_objectid(_resposta_exportacao(job)))
+    except Exception as e:
+        logger.error(f"Erro ao consultar exportação {job_id}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
-        data = request.json
-        data_inicio = data.get('data_inicio', (datetime.now() - timedelta(days=30)).strftime('%d/%m/%Y'))
-        data_fim = data.get('data_fim', datetime.now().strftime('%d/%m/%Y'))
-
-        # Imagens dos gráficos (base64)
-        img_vendas_mes = data.get('img_vendas_mes')  # Gráfico 1
-        img_top_servicos = data.get('img_top_servicos')  # Gráfico 2
-
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm,
-                              topMargin=1.5*cm, bottomMargin=2.5*cm)
-        elements = []
-
-        # Configurar estilos
-        styles = getSampleStyleSheet()
-        COLOR_PRIMARY = HexColor('#7C3AED')
-        styles.add(ParagraphStyle(name='MainTitle', fontName='Helvetica-Bold',
-                                 fontSize=20, textColor=COLOR_PRIMARY, spaceAfter=18, alignment=1))
-        styles.add(ParagraphStyle(name='SectionTitle', fontName='Helvetica-Bold',
-                                 fontSize=14, textColor=COLOR_PRIMARY, spaceAfter=10))
-
-        # Título
-        elements.append(Paragraph("RELATÓRIO FINANCEIRO", styles['MainTitle']))
-        elements.append(Paragraph(f"Período: {data_inicio} a {data_fim}", styles['Normal']))
-        elements.append(Spacer(1, 1*cm))
-
-        # Função para adicionar imagem base64
-        def add_base64_image(img_data_uri):
-            if not img_data_uri or ',' not in img_data_uri:
-                return Paragraph("Erro: Imagem do gráfico indisponível.", styles['Normal'])
-
-            img_data = base64.b64decode(img_data_uri.split(',')[1])
-            img_file = io.BytesIO(img_data)
-            img = ImageReader(img_file)
-
-            # Redimensionar para caber na página
-            width, height = img.getSize()
-            max_width = A4[0] - 4*cm  # Largura da página menos margens
-            if width > max_width:
-                ratio = max_width / width
-                height = height * ratio
-                width = max_width
-
-            return Image(img_file, width=width, height=height)
-
-        # Adicionar Gráfico 1 (Vendas por Mês)
-        if img_vendas_mes:
-            elements.append(Paragraph("Vendas por Mês", styles['SectionTitle']))
-            elements.append(add_base64_image(img_vendas_mes))
-            elements.append(Spacer(1, 1*cm))
-
-        # Adicionar Gráfico 2 (Top Serviços)
-        if img_top_servicos:
-            elements.append(Paragraph("Top Serviços (Faturamento)", styles['SectionTitle']))
-            elements.append(add_base64_image(img_top_servicos))
-            elements.append(Spacer(1, 1*cm))
-
-        doc.build(elements)
-        buffer.seek(0)
+@bp.route('/api/relatorios/exportacoes/<job_id>/download', methods=['GET'])
+@login_required
+def download_exportacao(job_id):
+    """Arquivo gerado (Range/If-None-Match tratados pelo send_file)"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    try:
+        job = obter_job(db, job_id, categoria='relatorio')
+        if not job:
+            return jsonify({'success': False, 'message': 'Exportação não encontrada'}), 404
+        perfis = RELATORIOS.get(job.get('tipo'), {}).get('perfis')
+        if perfis and session.get('tipo_acesso', 'Profissional') not in perfis:
+            return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+        if job.get('status') != 'concluido':
+            return jsonify({'success': False, 'message': 'Exportação ainda não concluída', 'status': job.get('status')}), 409
+
+        caminho = artefato_disponivel(job)
+        if caminho is None:
+            return jsonify({'success': False, 'message': 'Arquivo expirado. Gere a exportação novamente.'}), 410
 
         return send_file(
-            buffer,
-            mimetype='application/pdf',
+            caminho,
+            mimetype=job['resultado']['mimetype'],
             as_attachment=True,
-            download_name=f"relatorio_financeiro_{datetime.now().strftime('%Y%m%d')}.pdf"
+            download_name=nome_download(job),
+            conditional=True,
+            max_age=int(EXPORT_TTL.total_seconds())
         )
+    except Exception as e:
+        logger.error(f"Erro ao baixar exportação {job_id}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
+@bp.route('/api/exportar/<tipo>', methods=['GET'])
+@login_required
+def exportar_planilha_rota(tipo):
+    """
+    Planilha completa (produtos, clientes, movimentacoes, despesas, comissoes)
+    v7.3: Cursor em lotes -> write_only/CSV em arquivo temporário -> send_file,
+    com memória constante. Query string: formato=xlsx|csv e filtros do tipo.
+    """
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    config_planilha = PLANILHAS.get(tipo)
+    if config_planilha is None:
+        return jsonify({'success': False, 'message': f"Planilha '{tipo}' não suportada"}), 400
+    perfis = config_planilha['perfis']
+    if perfis and session.get('tipo_acesso', 'Profissional') not in perfis:
+        return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+
+    try:
+        params = request.args.to_dict()
+        formato = params.pop('formato', 'xlsx')
+        usuario = {'user_id': session.get('user_id'), 'tipo_acesso': session.get('tipo_acesso', 'Profissional')}
+        arquivo, nome, mimetype = exportar_planilha(db, tipo, params, formato, usuario)
+        return send_file(arquivo, mimetype=mimetype, as_attachment=True, download_name=nome)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erro ao exportar planilha {tipo}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/estoque/exportar', methods=['GET'])
+@login_required
+def exportar_estoque():
+    """Planilha do estoque (botão Exportar da aba Estoque)"""
+    return exportar_planilha_rota('produtos')
+
+@bp.route('/api/relatorios/exportar-pdf', methods=['POST'])
+@login_required
+@permission_required('Admin', 'Gestão')
+def exportar_relatorio_pdf_com_grafico():
+    """
+    (Ponto 3) PDF financeiro com gráficos.
+    v7.3: Enfileirado como exportação em background - os gráficos são desenhados no
+    servidor, imagens base64 enviadas por clientes antigos são ignoradas.
+    """
+    try:
+        data = request.get_json() or {}
+        return _enfileirar_exportacao('financeiro_pdf', {
+            'data_inicio': data.get('data_inicio'),
+            'data_fim': data.get('data_fim')
+        })
     except Exception as e:
         logger.error(f"Erro ao gerar PDF com gráficos: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -5268,10 +4859,12 @@ def editar_servico(id):
         if not update_data:
             return jsonify({'success': False, 'message': 'Nenhum dado para atualizar'}), 400
         
+        update_data.update(campos_busca('servicos', update_data))
         result = db.servicos.update_one(
             {'_id': ObjectId(id)},
             {'$set': update_data}
         )
+        indice_busca.alterado('servicos', ObjectId(id))
         
         if result.modified_count > 0:
             return jsonify({'success': True, 'message': 'Serviço atualizado com sucesso'})
@@ -5280,6 +4873,34 @@ def editar_servico(id):
         logger.error(f"Erro ao editar serviço: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def _atualizar_produto(db, id, update_data, novo_estoque=None):
+    """
+    Gravar a edição de um produto; o saldo informado vira movimentação de ajuste
+
+    Returns:
+        False se o produto não existe
+
+    Raises:
+        EstoqueInsuficiente: saída concorrente deixou o saldo abaixo do ajuste
+    """
+    produto_id = ObjectId(id)
+    if update_data:
+        update_data.update(campos_busca('produtos', update_data))
+        if not db.produtos.update_one({'_id': produto_id}, {'$set': update_data}).matched_count:
+            return False
+    if novo_estoque is not None:
+        try:
+            ajustar_estoque(
+                db, produto_id, novo_estoque,
+                motivo='Edição do produto', usuario=session.get('username')
+            )
+        except ProdutoNaoEncontrado:
+            return False
+    if 'estoque_minimo' in update_data:
+        atualizar_niveis_estoque(db, {'_id': produto_id})
+    invalidar_valorizacao()
+    return True
+
 # 14. Editar Produto
 @bp.route('/api/produtos/<id>/editar', methods=['PUT'])
 @login_required
@@ -5296,8 +4917,10 @@ def editar_produto(id):
             update_data['marca'] = data['marca']
         if 'preco' in data:
             update_data['preco'] = float(data['preco'])
+        novo_estoque = None
         if 'estoque' in data:
-            update_data['estoque'] = int(data.get('estoque') or 0)
+            # v7.3: saldo só muda por movimentação (ajuste), nunca por $set
+            novo_estoque = int(data.get('estoque') or 0)
         if 'estoque_minimo' in data:
             update_data['estoque_minimo'] = int(data['estoque_minimo'])
         if 'sku' in data:
@@ -5313,18 +4936,16 @@ def editar_produto(id):
             update_data['ativo'] = bool(data['ativo'])
             update_data['status'] = 'Ativo' if data['ativo'] else 'Inativo'
 
-        if not update_data:
+        if not update_data and novo_estoque is None:
             return jsonify({'success': False, 'message': 'Nenhum dado para atualizar'}), 400
 
-        result = db.produtos.update_one(
-            {'_id': ObjectId(id)},
-            {'$set': update_data}
-        )
-
         # Aceitar tanto modificações quanto quando não há mudanças
-        if result.matched_count > 0:
-            return jsonify({'success': True, 'message': 'Produto atualizado com sucesso'})
-        return jsonify({'success': False, 'message': 'Produto não encontrado'}), 404
+        if not _atualizar_produto(db, id, update_data, novo_estoque):
+            return jsonify({'success': False, 'message': 'Produto não encontrado'}), 404
+        indice_busca.alterado('produtos', ObjectId(id))
+        return jsonify({'success': True, 'message': 'Produto atualizado com sucesso'})
+    except EstoqueInsuficiente as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         logger.error(f"Erro ao editar produto: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -5698,79 +5319,24 @@ def resumo_pdf_cliente(id):
     db = get_db()
     """Gera PDF completo com todos os dados do cliente"""
     try:
-        cliente = db.clientes.find_one({'_id': ObjectId(id)})
+        cliente = db.clientes.find_one(
+            {'_id': ObjectId(id)},
+            {'nome': 1, 'cpf': 1, 'telefone': 1, 'email': 1, 'anamnese': 1, 'prontuario': 1}
+        )
         if not cliente:
             return jsonify({'success': False, 'message': 'Cliente não encontrado'}), 404
         
-        # Criar PDF em memória
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-        
-        # Título
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=HexColor('#7C3AED'),
-            spaceAfter=30,
-            alignment=TA_CENTER
-        )
-        elements.append(Paragraph('RESUMO DO CLIENTE', title_style))
-        elements.append(Spacer(1, 20))
-        
-        # Dados pessoais
-        elements.append(Paragraph('<b>DADOS PESSOAIS</b>', styles['Heading2']))
-        dados = [
-            ['Nome:', cliente.get('nome', '-')],
-            ['CPF:', cliente.get('cpf', '-')],
-            ['Telefone:', cliente.get('telefone', '-')],
-            ['Email:', cliente.get('email', '-')],
-        ]
-        t = Table(dados, colWidths=[4*cm, 12*cm])
-        t.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#F3F4F6')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
-        ]))
-        elements.append(t)
-        elements.append(Spacer(1, 20))
-        
-        # Anamnese
-        anamnese = cliente.get('anamnese', {})
-        if anamnese:
-            elements.append(Paragraph('<b>ANAMNESE</b>', styles['Heading2']))
-            for key, value in anamnese.items():
-                elements.append(Paragraph(f'<b>{key}:</b> {value}', styles['Normal']))
-            elements.append(Spacer(1, 20))
-        
-        # Prontuário
-        prontuario = cliente.get('prontuario', [])
-        if prontuario:
-            elements.append(Paragraph('<b>PRONTUÁRIO</b>', styles['Heading2']))
-            for registro in prontuario:
-                elements.append(Paragraph(
-                    f"<b>Data:</b> {registro.get('data', '-')} | "
-                    f"<b>Procedimento:</b> {registro.get('procedimento', '-')}<br/>"
-                    f"<b>Observações:</b> {registro.get('observacoes', '-')}",
-                    styles['Normal']
-                ))
-                elements.append(Spacer(1, 10))
-        
-        doc.build(elements)
-        buffer.seek(0)
+        # v7.3: Renderizado no pool de PDFs (cache pelo conteúdo do cliente)
+        pdf = gerar_pdf('resumo_cliente', cliente)
         
         return send_file(
-            buffer,
+            BytesIO(pdf),
             mimetype='application/pdf',
             as_attachment=True,
             download_name=f'cliente_{cliente.get("nome", "resumo")}.pdf'
         )
+    except PDFTimeout as e:
+        return jsonify({'success': False, 'message': str(e)}), 504
     except Exception as e:
         logger.error(f"Erro ao gerar PDF: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -6111,92 +5677,25 @@ def gerar_pdf_prontuario(cpf, id):
         if not prontuario:
             return jsonify({'success': False, 'message': 'Prontuário não encontrado'}), 404
 
-        cliente = db.clientes.find_one({'cpf': cpf})
+        cliente = db.clientes.find_one(
+            {'cpf': cpf},
+            {'nome': 1, 'cpf': 1, 'telefone': 1, 'email': 1, 'data_nascimento': 1}
+        )
         if not cliente:
             return jsonify({'success': False, 'message': 'Cliente não encontrado'}), 404
 
-        # Criar buffer para o PDF
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-
-        # Título
-        title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER)
-        elements.append(Paragraph("PRONTUÁRIO DE ATENDIMENTO", title_style))
-        elements.append(Spacer(1, 0.3*cm))
-
-        # Dados do cliente
-        elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
-        cliente_data = [
-            ['Nome:', cliente.get('nome', 'N/A')],
-            ['CPF:', cliente.get('cpf', 'N/A')],
-            ['Telefone:', cliente.get('telefone', 'N/A')],
-            ['Email:', cliente.get('email', 'N/A')],
-            ['Data Nasc.:', cliente.get('data_nascimento', 'N/A')]
-        ]
-        cliente_table = Table(cliente_data, colWidths=[4*cm, 12*cm])
-        cliente_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#f0f0f0')),
-            ('GRID', (0, 0), (-1, -1), 0.5, black),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ]))
-        elements.append(cliente_table)
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Dados do atendimento
-        elements.append(Paragraph('<b>DADOS DO ATENDIMENTO</b>', styles['Heading2']))
-        data_atendimento = prontuario.get('data_atendimento')
-        if isinstance(data_atendimento, datetime):
-            data_atendimento = data_atendimento.strftime('%d/%m/%Y %H:%M')
-
-        atendimento_data = [
-            ['Data:', str(data_atendimento) if data_atendimento else 'N/A'],
-            ['Profissional:', prontuario.get('profissional', 'N/A')],
-            ['Procedimento:', prontuario.get('procedimento', 'N/A')],
-            ['Próxima Sessão:', prontuario.get('proxima_sessao', 'N/A')]
-        ]
-        atendimento_table = Table(atendimento_data, colWidths=[4*cm, 12*cm])
-        atendimento_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#e3f2fd')),
-            ('GRID', (0, 0), (-1, -1), 0.5, black),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ]))
-        elements.append(atendimento_table)
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Produtos utilizados
-        if prontuario.get('produtos_utilizados'):
-            elements.append(Paragraph('<b>PRODUTOS UTILIZADOS</b>', styles['Heading3']))
-            produtos_list = prontuario['produtos_utilizados']
-            if isinstance(produtos_list, list):
-                for produto in produtos_list:
-                    elements.append(Paragraph(f"• {produto}", styles['Normal']))
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Observações
-        if prontuario.get('observacoes'):
-            elements.append(Paragraph('<b>OBSERVAÇÕES</b>', styles['Heading3']))
-            elements.append(Paragraph(prontuario['observacoes'], styles['Normal']))
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Rodapé
-        elements.append(Spacer(1, 1*cm))
-        footer_style = ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, alignment=TA_CENTER)
-        elements.append(Paragraph('Este documento é confidencial e destinado exclusivamente ao cliente.', footer_style))
-        elements.append(Paragraph(f'Gerado em: {datetime.now().strftime("%d/%m/%Y às %H:%M")}', footer_style))
-
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        # v7.3: Renderizado no pool de PDFs
+        pdf = gerar_pdf('prontuario', {'prontuario': prontuario, 'cliente': cliente})
 
         return send_file(
-            buffer,
+            BytesIO(pdf),
             mimetype='application/pdf',
             as_attachment=True,
             download_name=f"prontuario_{cliente.get('nome', 'cliente')}_{id}.pdf"
         )
 
+    except PDFTimeout as e:
+        return jsonify({'success': False, 'message': str(e)}), 504
     except Exception as e:
         logger.error(f"Erro ao gerar PDF de prontuário: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -6211,63 +5710,47 @@ def gerar_pdf_historico_completo(cpf):
         return jsonify({'success': False}), 500
 
     try:
-        cliente = db.clientes.find_one({'cpf': cpf})
+        cliente = db.clientes.find_one({'cpf': cpf}, {'nome': 1})
         if not cliente:
             return jsonify({'success': False, 'message': 'Cliente não encontrado'}), 404
 
-        prontuarios = list(db.prontuarios.find({'cliente_cpf': cpf}).sort('data_atendimento', DESCENDING))
-        orcamentos = list(db.orcamentos.find({'cliente_cpf': cpf, 'status': 'Aprovado'}).sort('created_at', DESCENDING))
-
-        # Criar buffer para o PDF
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-
-        # Título
-        title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER)
-        elements.append(Paragraph(f"HISTÓRICO COMPLETO - {cliente.get('nome', 'Cliente')}", title_style))
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Estatísticas
-        total_atendimentos = len(prontuarios)
-        total_faturado = sum(o.get('total_final', 0) for o in orcamentos)
-
-        estatisticas_data = [
-            ['Total de Atendimentos:', str(total_atendimentos)],
-            ['Total Faturado:', f"R$ {total_faturado:.2f}"],
-            ['Última Visita:', prontuarios[0].get('data_atendimento').strftime('%d/%m/%Y') if prontuarios and isinstance(prontuarios[0].get('data_atendimento'), datetime) else 'N/A']
-        ]
-        estatisticas_table = Table(estatisticas_data, colWidths=[8*cm, 8*cm])
-        estatisticas_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, -1), HexColor('#e8f5e9')),
-            ('GRID', (0, 0), (-1, -1), 0.5, black),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        filtro = {'cliente_cpf': cpf}
+        faturamento = list(db.orcamentos.aggregate([
+            {'$match': {'cliente_cpf': cpf, 'status': 'Aprovado'}},
+            {'$group': {'_id': None, 'total': {'$sum': '$total_final'}}}
         ]))
-        elements.append(estatisticas_table)
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Histórico de prontuários
-        if prontuarios:
-            elements.append(Paragraph('<b>HISTÓRICO DE ATENDIMENTOS</b>', styles['Heading2']))
-            for prontuario in prontuarios[:10]:  # Limitar aos 10 mais recentes
-                data_atend = prontuario.get('data_atendimento')
-                if isinstance(data_atend, datetime):
-                    data_atend = data_atend.strftime('%d/%m/%Y')
-
-                elements.append(Paragraph(f"<b>{data_atend}</b> - {prontuario.get('procedimento', 'Procedimento não especificado')}", styles['Normal']))
-                if prontuario.get('profissional'):
-                    elements.append(Paragraph(f"Profissional: {prontuario.get('profissional')}", styles['Normal']))
-                if prontuario.get('observacoes'):
-                    elements.append(Paragraph(f"Obs: {prontuario.get('observacoes')[:150]}...", styles['Normal']))
-                elements.append(Spacer(1, 0.2*cm))
-
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        ultimo = db.prontuarios.find_one(filtro, {'data_atendimento': 1}, sort=[('data_atendimento', DESCENDING)])
+        resumo = {
+            'total_atendimentos': db.prontuarios.count_documents(filtro),
+            'total_faturado': faturamento[0]['total'] if faturamento else 0,
+            'ultima_visita': ultimo.get('data_atendimento') if ultimo else None,
+        }
+
+        # v7.3: Só os metadados dos documentos escaneados - o data_uri nunca sai do banco
+        documentos = next(db.clientes.aggregate([
+            {'$match': {'_id': cliente['_id']}},
+            {'$project': {'documentos': {'$map': {
+                'input': {'$ifNull': ['$documentos_anamnese', []]},
+                'in': {'filename': '$$this.filename', 'data_upload': '$$this.data_upload'}
+            }}}}
+        ]), {}).get('documentos', [])
+
+        # v7.3: Cursores lidos sob demanda enquanto as páginas são montadas (memória limitada)
+        arquivo = arquivo_historico(
+            cliente, resumo, documentos,
+            anamneses=db.anamneses.find(
+                filtro, {'data_cadastro': 1, 'versao': 1, 'respostas': 1, 'observacoes': 1}
+            ).sort('data_cadastro', DESCENDING).batch_size(HISTORICO_CURSOR_LOTE),
+            prontuarios=db.prontuarios.find(
+                filtro, {'data_atendimento': 1, 'procedimento': 1, 'profissional': 1, 'observacoes': 1}
+            ).sort('data_atendimento', DESCENDING).batch_size(HISTORICO_CURSOR_LOTE),
+            orcamentos=db.orcamentos.find(
+                {'cliente_cpf': cpf, 'status': 'Aprovado'}, {'numero': 1, 'created_at': 1, 'total_final': 1}
+            ).sort('created_at', DESCENDING).batch_size(HISTORICO_CURSOR_LOTE),
+        )
 
         return send_file(
-            buffer,
+            arquivo,
             mimetype='application/pdf',
             as_attachment=True,
             download_name=f"historico_completo_{cliente.get('nome', 'cliente')}.pdf"
@@ -6342,7 +5825,7 @@ def handle_orcamentos():
     try:
         if request.method == 'GET':
             # Listar orçamentos
-            orcamentos = list(db.orcamentos.find().sort('created_at', DESCENDING).limit(100))
+            orcamentos = list(db.orcamentos.find({}, {'desempenho_aplicado': 0}).sort('created_at', DESCENDING).limit(100))
             for orc in orcamentos:
                 orc['_id'] = str(orc['_id'])
                 if 'created_at' in orc and isinstance(orc['created_at'], datetime):
@@ -6375,6 +5858,7 @@ def handle_orcamentos():
             proximo_numero = (ultimo_orc.get('numero', 0) + 1) if ultimo_orc else 1
             
             orcamento = {
+                '_id': ObjectId(),
                 'numero': proximo_numero,
                 'cliente_cpf': data.get('cliente_cpf'),
                 'cliente_nome': data.get('cliente_nome'),
@@ -6387,8 +5871,8 @@ def handle_orcamentos():
                 'total_produtos': data.get('total_produtos', 0),
                 'desconto_perc': data.get('desconto_perc', 0),
                 'desconto_valor': data.get('desconto_valor', 0),
+                'desconto_global': data.get('desconto_global', 0),
                 'total_final': data.get('total_final', 0),
-                'total_comissoes': sum(p.get('comissao_valor', 0) for p in profissionais_vinculados),
                 'forma_pagamento': data.get('forma_pagamento'),
                 'observacoes': data.get('observacoes', ''),
                 'status': data.get('status', 'Pendente'),
@@ -6396,28 +5880,20 @@ def handle_orcamentos():
                 'created_by': session.get('username')
             }
             
+            # Comissões calculadas no servidor (motor único)
+            calculo = calcular_comissoes(db, [orcamento])
+            orcamento['total_comissoes'] = round(calculo['total'], 2)
+            orcamento['desempenho_aplicado'] = contribuicao_desempenho(calculo, orcamento)
+            
             result = db.orcamentos.insert_one(orcamento)
+            registrar_comissoes(db, orcamento, calculo)
+            aplicar_desempenho(db, orcamento.pop('desempenho_aplicado'))
             orcamento['_id'] = str(result.inserted_id)
 
             # Update cliente denormalized fields for performance
             if orcamento.get('cliente_cpf'):
                 update_cliente_denormalized_fields(orcamento['cliente_cpf'])
 
-            # Registrar comissões no histórico
-            if profissionais_vinculados:
-                for prof in profissionais_vinculados:
-                    db.comissoes_historico.insert_one({
-                        'orcamento_id': result.inserted_id,
-                        'profissional_id': prof.get('profissional_id'),
-                        'nome': prof.get('nome'),
-                        'tipo': prof.get('tipo'),
-                        'comissao_perc': prof.get('comissao_perc'),
-                        'comissao_valor': prof.get('comissao_valor'),
-                        'valor_base': data.get('total_servicos', 0),
-                        'status_orcamento': orcamento['status'],
-                        'data_registro': datetime.now()
-                    })
-            
             logger.info(f"✅ Orçamento #{proximo_numero} criado com {len(profissionais_vinculados)} profissionais")
             return jsonify({'success': True, 'orcamento': orcamento, 'numero': proximo_numero})
             
@@ -6435,7 +5911,7 @@ def handle_orcamento_by_id(id):
     
     try:
         if request.method == 'GET':
-            orcamento = db.orcamentos.find_one({'_id': ObjectId(id)})
+            orcamento = db.orcamentos.find_one({'_id': ObjectId(id)}, {'desempenho_aplicado': 0})
             if not orcamento:
                 return jsonify({'success': False, 'message': 'Orçamento não encontrado'}), 404
             
@@ -6470,8 +5946,8 @@ def handle_orcamento_by_id(id):
                 'total_produtos': data.get('total_produtos', 0),
                 'desconto_perc': data.get('desconto_perc', 0),
                 'desconto_valor': data.get('desconto_valor', 0),
+                'desconto_global': data.get('desconto_global', 0),
                 'total_final': data.get('total_final', 0),
-                'total_comissoes': sum(p.get('comissao_valor', 0) for p in profissionais_vinculados),
                 'forma_pagamento': data.get('forma_pagamento'),
                 'observacoes': data.get('observacoes', ''),
                 'status': data.get('status', 'Pendente'),
@@ -6479,38 +5955,45 @@ def handle_orcamento_by_id(id):
                 'updated_by': session.get('username')
             }
             
-            db.orcamentos.update_one({'_id': ObjectId(id)}, {'$set': update_data})
+            atual = db.orcamentos.find_one({'_id': ObjectId(id)}, {'numero': 1, 'created_at': 1})
+            if not atual:
+                return jsonify({'success': False, 'message': 'Orçamento não encontrado'}), 404
+            
+            # Comissões recalculadas no servidor (motor único)
+            orcamento = {**atual, **update_data}
+            calculo = calcular_comissoes(db, [orcamento])
+            update_data['total_comissoes'] = round(calculo['total'], 2)
+            update_data['desempenho_aplicado'] = contribuicao_desempenho(calculo, orcamento)
+            
+            # Troca atômica da parcela aplicada: a série recebe só a diferença
+            anterior = db.orcamentos.find_one_and_update(
+                {'_id': ObjectId(id)},
+                {'$set': update_data},
+                projection={'desempenho_aplicado': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            registrar_comissoes(db, orcamento, calculo)
+            if anterior is not None:
+                aplicar_desempenho(db, update_data['desempenho_aplicado'], anterior.get('desempenho_aplicado'))
 
             # Update cliente denormalized fields for performance
             if update_data.get('cliente_cpf'):
                 update_cliente_denormalized_fields(update_data['cliente_cpf'])
 
-            # Atualizar histórico de comissões
-            db.comissoes_historico.delete_many({'orcamento_id': ObjectId(id)})
-            if profissionais_vinculados:
-                for prof in profissionais_vinculados:
-                    db.comissoes_historico.insert_one({
-                        'orcamento_id': ObjectId(id),
-                        'profissional_id': prof.get('profissional_id'),
-                        'nome': prof.get('nome'),
-                        'tipo': prof.get('tipo'),
-                        'comissao_perc': prof.get('comissao_perc'),
-                        'comissao_valor': prof.get('comissao_valor'),
-                        'valor_base': data.get('total_servicos', 0),
-                        'status_orcamento': update_data['status'],
-                        'data_registro': datetime.now()
-                    })
-            
             logger.info(f"✅ Orçamento {id} atualizado")
             return jsonify({'success': True, 'message': 'Orçamento atualizado com sucesso'})
         
         elif request.method == 'DELETE':
             # Get cliente_cpf before deleting for denormalized field update
-            orcamento = db.orcamentos.find_one({'_id': ObjectId(id)}, {'cliente_cpf': 1})
+            orcamento = db.orcamentos.find_one_and_delete(
+                {'_id': ObjectId(id)},
+                projection={'cliente_cpf': 1, 'desempenho_aplicado': 1}
+            )
             cliente_cpf = orcamento.get('cliente_cpf') if orcamento else None
 
-            db.orcamentos.delete_one({'_id': ObjectId(id)})
             db.comissoes_historico.delete_many({'orcamento_id': ObjectId(id)})
+            if orcamento:
+                aplicar_desempenho(db, antigo=orcamento.get('desempenho_aplicado'))
 
             # Update cliente denormalized fields after deletion
             if cliente_cpf:
@@ -6537,112 +6020,18 @@ def gerar_pdf_orcamento(id):
         if not orcamento:
             return jsonify({'success': False, 'message': 'Orçamento não encontrado'}), 404
 
-        # Criar buffer para o PDF
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-
-        # Título
-        title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER)
-        elements.append(Paragraph(f"ORÇAMENTO #{orcamento.get('numero', str(orcamento['_id'])[-6:])}", title_style))
-        elements.append(Spacer(1, 0.3*cm))
-
-        # Informações do cliente
-        elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
-        cliente_data = [
-            ['Nome:', orcamento.get('cliente_nome', 'N/A')],
-            ['CPF:', orcamento.get('cliente_cpf', 'N/A')],
-            ['Telefone:', orcamento.get('cliente_telefone', 'N/A')],
-            ['Email:', orcamento.get('cliente_email', 'N/A')],
-            ['Data:', orcamento.get('created_at', datetime.now()).strftime('%d/%m/%Y') if isinstance(orcamento.get('created_at'), datetime) else 'N/A']
-        ]
-        cliente_table = Table(cliente_data, colWidths=[4*cm, 12*cm])
-        cliente_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#f0f0f0')),
-            ('GRID', (0, 0), (-1, -1), 0.5, black),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ]))
-        elements.append(cliente_table)
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Serviços
-        if orcamento.get('servicos'):
-            elements.append(Paragraph('<b>SERVIÇOS</b>', styles['Heading2']))
-            servicos_data = [['Descrição', 'Quantidade', 'Valor Unit.', 'Total']]
-            for srv in orcamento['servicos']:
-                servicos_data.append([
-                    srv.get('nome', 'N/A'),
-                    str(srv.get('quantidade', 1)),
-                    f"R$ {srv.get('preco', 0):.2f}",
-                    f"R$ {srv.get('total', 0):.2f}"
-                ])
-            servicos_table = Table(servicos_data, colWidths=[8*cm, 2*cm, 3*cm, 3*cm])
-            servicos_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#4CAF50')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), white),
-                ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                ('GRID', (0, 0), (-1, -1), 0.5, black),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ]))
-            elements.append(servicos_table)
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Produtos
-        if orcamento.get('produtos'):
-            elements.append(Paragraph('<b>PRODUTOS</b>', styles['Heading2']))
-            produtos_data = [['Descrição', 'Quantidade', 'Valor Unit.', 'Total']]
-            for prd in orcamento['produtos']:
-                produtos_data.append([
-                    prd.get('nome', 'N/A'),
-                    str(prd.get('quantidade', 1)),
-                    f"R$ {prd.get('preco', 0):.2f}",
-                    f"R$ {prd.get('total', 0):.2f}"
-                ])
-            produtos_table = Table(produtos_data, colWidths=[8*cm, 2*cm, 3*cm, 3*cm])
-            produtos_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#2196F3')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), white),
-                ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                ('GRID', (0, 0), (-1, -1), 0.5, black),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ]))
-            elements.append(produtos_table)
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Totais
-        totais_data = [
-            ['Subtotal Serviços:', f"R$ {orcamento.get('total_servicos', 0):.2f}"],
-            ['Subtotal Produtos:', f"R$ {orcamento.get('total_produtos', 0):.2f}"],
-            ['Desconto:', f"R$ {orcamento.get('desconto_valor', 0):.2f}"],
-            ['<b>TOTAL FINAL:</b>', f"<b>R$ {orcamento.get('total_final', 0):.2f}</b>"]
-        ]
-        totais_table = Table(totais_data, colWidths=[12*cm, 4*cm])
-        totais_table.setStyle(TableStyle([
-            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, -1), (-1, -1), 14),
-            ('BACKGROUND', (0, -1), (-1, -1), HexColor('#FFD700')),
-        ]))
-        elements.append(totais_table)
-
-        # Observações
-        if orcamento.get('observacoes'):
-            elements.append(Spacer(1, 0.5*cm))
-            elements.append(Paragraph('<b>OBSERVAÇÕES:</b>', styles['Heading3']))
-            elements.append(Paragraph(orcamento['observacoes'], styles['Normal']))
-
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        # v7.3: Renderizado no pool de PDFs (cache pelo conteúdo do orçamento)
+        pdf = gerar_pdf('orcamento', orcamento)
 
         return send_file(
-            buffer,
+            BytesIO(pdf),
             mimetype='application/pdf',
             as_attachment=True,
             download_name=f"orcamento_{orcamento.get('numero', id)}.pdf"
         )
 
+    except PDFTimeout as e:
+        return jsonify({'success': False, 'message': str(e)}), 504
     except Exception as e:
         logger.error(f"Erro ao gerar PDF de orçamento: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -7023,154 +6412,18 @@ def gerar_pdf_contrato(id):
         if not contrato:
             return jsonify({'success': False, 'message': 'Contrato não encontrado'}), 404
 
-        # Criar buffer para o PDF
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-        styles = getSampleStyleSheet()
-
-        # Título
-        title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER)
-        elements.append(Paragraph(f"CONTRATO #{contrato.get('numero', str(contrato['_id'])[-6:])}", title_style))
-        elements.append(Spacer(1, 0.3*cm))
-
-        # Status
-        status_style = ParagraphStyle('Status', parent=styles['Normal'], alignment=TA_CENTER, fontSize=10)
-        status_color = HexColor('#4CAF50') if contrato.get('status') == 'Aprovado' else HexColor('#FF9800')
-        elements.append(Paragraph(f'<font color="{status_color}"><b>STATUS: {contrato.get("status", "N/A")}</b></font>', status_style))
-        elements.append(Spacer(1, 0.3*cm))
-
-        # Informações do cliente
-        elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
-        cliente_data = [
-            ['Nome:', contrato.get('cliente_nome', 'N/A')],
-            ['CPF:', contrato.get('cliente_cpf', 'N/A')],
-            ['Telefone:', contrato.get('cliente_telefone', 'N/A')],
-            ['Email:', contrato.get('cliente_email', 'N/A')],
-            ['Data Contrato:', contrato.get('created_at', datetime.now()).strftime('%d/%m/%Y') if isinstance(contrato.get('created_at'), datetime) else 'N/A'],
-            ['Forma Pagamento:', contrato.get('forma_pagamento', 'N/A')]
-        ]
-        cliente_table = Table(cliente_data, colWidths=[4*cm, 12*cm])
-        cliente_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#f0f0f0')),
-            ('GRID', (0, 0), (-1, -1), 0.5, black),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ]))
-        elements.append(cliente_table)
-        elements.append(Spacer(1, 0.5*cm))
-
-        # Serviços contratados
-        if contrato.get('servicos'):
-            elements.append(Paragraph('<b>SERVIÇOS CONTRATADOS</b>', styles['Heading2']))
-            servicos_data = [['Descrição', 'Profissional', 'Qtd', 'Valor Unit.', 'Total']]
-            for srv in contrato['servicos']:
-                servicos_data.append([
-                    srv.get('nome', 'N/A'),
-                    srv.get('profissional_nome', '-'),
-                    str(srv.get('quantidade', 1)),
-                    f"R$ {srv.get('preco', 0):.2f}",
-                    f"R$ {srv.get('total', 0):.2f}"
-                ])
-            servicos_table = Table(servicos_data, colWidths=[6*cm, 4*cm, 1.5*cm, 2.5*cm, 2*cm])
-            servicos_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#4CAF50')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), white),
-                ('ALIGN', (2, 0), (-1, -1), 'CENTER'),
-                ('GRID', (0, 0), (-1, -1), 0.5, black),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ]))
-            elements.append(servicos_table)
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Produtos
-        if contrato.get('produtos'):
-            elements.append(Paragraph('<b>PRODUTOS</b>', styles['Heading2']))
-            produtos_data = [['Descrição', 'Quantidade', 'Valor Unit.', 'Total']]
-            for prd in contrato['produtos']:
-                produtos_data.append([
-                    prd.get('nome', 'N/A'),
-                    str(prd.get('quantidade', 1)),
-                    f"R$ {prd.get('preco', 0):.2f}",
-                    f"R$ {prd.get('total', 0):.2f}"
-                ])
-            produtos_table = Table(produtos_data, colWidths=[8*cm, 2*cm, 3*cm, 3*cm])
-            produtos_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#2196F3')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), white),
-                ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                ('GRID', (0, 0), (-1, -1), 0.5, black),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ]))
-            elements.append(produtos_table)
-            elements.append(Spacer(1, 0.3*cm))
-
-        # Totais
-        totais_data = [
-            ['Subtotal Serviços:', f"R$ {contrato.get('total_servicos', 0):.2f}"],
-            ['Subtotal Produtos:', f"R$ {contrato.get('total_produtos', 0):.2f}"],
-            ['Desconto:', f"R$ {contrato.get('desconto_valor', 0):.2f}"],
-            ['<b>TOTAL DO CONTRATO:</b>', f"<b>R$ {contrato.get('total_final', 0):.2f}</b>"]
-        ]
-        totais_table = Table(totais_data, colWidths=[12*cm, 4*cm])
-        totais_table.setStyle(TableStyle([
-            ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, -1), (-1, -1), 14),
-            ('BACKGROUND', (0, -1), (-1, -1), HexColor('#FFD700')),
-        ]))
-        elements.append(totais_table)
-
-        # Observações
-        if contrato.get('observacoes'):
-            elements.append(Spacer(1, 0.5*cm))
-            elements.append(Paragraph('<b>OBSERVAÇÕES:</b>', styles['Heading3']))
-            elements.append(Paragraph(contrato['observacoes'], styles['Normal']))
-
-        # Termos e condições
-        elements.append(Spacer(1, 1*cm))
-        elements.append(Paragraph('<b>TERMOS E CONDIÇÕES</b>', styles['Heading3']))
-        termos = """Este contrato estabelece os serviços e produtos acordados entre as partes.
-        O cliente declara estar ciente dos valores e condições apresentados.
-        A BIOMA se compromete a prestar os serviços com excelência e profissionalismo."""
-        elements.append(Paragraph(termos, styles['Normal']))
-
-        # Assinaturas na MESMA PÁGINA das cláusulas (v7.0)
-        elements.append(Spacer(1, 1.5*cm))
-
-        # Criar tabela de assinaturas (duas colunas lado a lado)
-        data_assinatura = datetime.now().strftime('%d/%m/%Y')
-        cidade = "Uberaba/MG"
-
-        assinaturas_data = [
-            [f'{cidade}, {data_assinatura}', ''],
-            ['', ''],
-            ['_' * 40, '_' * 40],
-            ['<b>BIOMA Uberaba</b>', f'<b>{contrato.get("cliente_nome", "CLIENTE")}</b>'],
-            ['CNPJ: __.___.___/____-__', f'CPF: {contrato.get("cliente_cpf", "___.___.___-__")}']
-        ]
-
-        assinaturas_table = Table(assinaturas_data, colWidths=[8*cm, 8*cm])
-        assinaturas_table.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('FONTNAME', (0, 3), (-1, 3), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('TOPPADDING', (0, 2), (-1, 2), 0),
-            ('BOTTOMPADDING', (0, 2), (-1, 2), 2),
-        ]))
-        elements.append(assinaturas_table)
-
-        # Gerar PDF
-        doc.build(elements)
-        buffer.seek(0)
+        # v7.3: Renderizado no pool de PDFs (cache pelo conteúdo do contrato)
+        pdf = gerar_pdf('contrato', contrato)
 
         return send_file(
-            buffer,
+            BytesIO(pdf),
             mimetype='application/pdf',
             as_attachment=True,
             download_name=f"contrato_{contrato.get('numero', id)}.pdf"
         )
 
+    except PDFTimeout as e:
+        return jsonify({'success': False, 'message': str(e)}), 504
     except Exception as e:
         logger.error(f"Erro ao gerar PDF de contrato: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -7691,21 +6944,22 @@ def financeiro_comissoes():
                 }
 
             orcamentos = list(db.orcamentos.find(query_orc))
+            calculo = calcular_comissoes(db, orcamentos, profissional_id)
+            datas = {linha['orcamento_id']: linha['data'] for linha in calculo['linhas']}
             comissoes_lista = []
 
-            for orc in orcamentos:
-                for prof in orc.get('profissionais_vinculados', []):
-                    if not profissional_id or str(prof.get('profissional_id')) == profissional_id:
-                        comissoes_lista.append({
-                            'profissional_id': str(prof.get('profissional_id', '')),
-                            'profissional_nome': prof.get('nome', 'N/A'),
-                            'comissao_percentual': prof.get('comissao_percentual', 0),
-                            'comissao_valor': prof.get('comissao_valor', 0),
-                            'orcamento_id': str(orc['_id']),
-                            'cliente_nome': orc.get('cliente_nome', 'N/A'),
-                            'data': orc.get('created_at', datetime.now()).strftime('%Y-%m-%d') if isinstance(orc.get('created_at'), datetime) else 'N/A',
-                            'status': 'Aprovado'
-                        })
+            for registro in registros_historico(calculo):
+                data_orc = datas.get(str(registro['orcamento_id']))
+                comissoes_lista.append({
+                    'profissional_id': str(registro['profissional_id']),
+                    'profissional_nome': registro['profissional_nome'] or 'N/A',
+                    'comissao_percentual': registro['comissao_perc'],
+                    'comissao_valor': registro['comissao_valor'],
+                    'orcamento_id': str(registro['orcamento_id']),
+                    'cliente_nome': registro['cliente_nome'] or 'N/A',
+                    'data': data_orc.strftime('%Y-%m-%d') if isinstance(data_orc, datetime) else 'N/A',
+                    'status': 'Aprovado'
+                })
 
             total = sum(c.get('comissao_valor', 0) for c in comissoes_lista)
 
@@ -7727,8 +6981,8 @@ def financeiro_comissoes():
             comissoes_lista.append({
                 '_id': str(com['_id']),
                 'profissional_id': str(com.get('profissional_id', '')),
-                'profissional_nome': com.get('profissional_nome', 'N/A'),
-                'comissao_percentual': com.get('comissao_percentual', 0),
+                'profissional_nome': com.get('profissional_nome') or com.get('nome') or 'N/A',
+                'comissao_percentual': com.get('comissao_percentual', com.get('comissao_perc', 0)),
                 'comissao_valor': valor,
                 'orcamento_id': str(com.get('orcamento_id', '')),
                 'cliente_nome': com.get('cliente_nome', 'N/A'),
@@ -7781,21 +7035,9 @@ def get_comissoes_profissional(id):
         # Buscar histórico de comissões
         comissoes = list(db.comissoes_historico.find(query).sort('data_registro', DESCENDING))
         
-        # Calcular estatísticas
-        total_comissoes = sum(c.get('comissao_valor', 0) for c in comissoes)
-        total_orcamentos = len(set(str(c.get('orcamento_id')) for c in comissoes))
-        media_comissao = total_comissoes / total_orcamentos if total_orcamentos > 0 else 0
-        
-        # Agrupar por mês
-        comissoes_por_mes = {}
-        for comissao in comissoes:
-            data = comissao.get('data_registro')
-            if data and isinstance(data, datetime):
-                mes_ano = data.strftime('%Y-%m')
-                if mes_ano not in comissoes_por_mes:
-                    comissoes_por_mes[mes_ano] = {'valor': 0, 'quantidade': 0}
-                comissoes_por_mes[mes_ano]['valor'] += comissao.get('comissao_valor', 0)
-                comissoes_por_mes[mes_ano]['quantidade'] += 1
+        # Calcular estatísticas (mesmo resumo do motor de comissões)
+        resumo = resumo_historico(comissoes)
+        total_comissoes = resumo['total_comissoes']
         
         # Converter para formato de resposta
         for c in comissoes:
@@ -7818,9 +7060,9 @@ def get_comissoes_profissional(id):
             },
             'estatisticas': {
                 'total_comissoes': round(total_comissoes, 2),
-                'total_orcamentos': total_orcamentos,
-                'media_comissao': round(media_comissao, 2),
-                'comissoes_por_mes': comissoes_por_mes
+                'total_orcamentos': resumo['total_orcamentos'],
+                'media_comissao': round(resumo['media_comissao'], 2),
+                'comissoes_por_mes': resumo['comissoes_por_mes']
             },
             'historico': comissoes
         }
@@ -7892,15 +7134,13 @@ def buscar_produtos():
         if not termo or len(termo) < 2:
             return jsonify({'success': True, 'produtos': []})
 
-        regex = {'$regex': termo, '$options': 'i'}
-
-        produtos = list(db.produtos.find({
-            '$or': [
-                {'nome': regex},
-                {'marca': regex},
-                {'sku': regex}
-            ]
-        }).sort('nome', ASCENDING).limit(20))
+        # v7.3: Índice em memória (contém, ranqueado) ou prefixo ancorado nos campos-sombra
+        candidatos = indice_busca.buscar('produtos', termo, 20)
+        if candidatos is not None:
+            produtos = hidratar(db.produtos, [i for i, _ in candidatos])
+        else:
+            filtro = consulta_prefixo('produtos', termo)
+            produtos = list(db.produtos.find(filtro).sort('nome', ASCENDING).limit(20)) if filtro else []
 
         resultado = []
         for p in produtos:
@@ -7964,50 +7204,43 @@ def produtos_baixo_estoque():
     db = get_db()
     """Retorna produtos com estoque baixo e estatísticas"""
     try:
-        # Buscar todos os produtos ativos
-        produtos = list(db.produtos.find({'status': 'Ativo'}))
+        # v7.3: apenas produtos fora do nível normal (índices parciais em nivel_estoque)
+        produtos = db.produtos.find(
+            {'status': 'Ativo', **filtro_nivel()},
+            {'nome': 1, 'marca': 1, 'estoque': 1, 'estoque_minimo': 1, 'preco': 1, 'nivel_estoque': 1}
+        )
         
         criticos = []
         atencao = []
-        normais = []
         
         for p in produtos:
             estoque_atual = int(p.get('estoque', 0))
             estoque_minimo = int(p.get('estoque_minimo', 0))
             
-            diferenca = estoque_atual - estoque_minimo
-            
             produto_formatado = {
                 'id': str(p['_id']),
                 'nome': p.get('nome', 'Sem nome'),
                 'marca': p.get('marca', 'Sem marca'),
                 'estoque_atual': estoque_atual,
                 'estoque_minimo': estoque_minimo,
-                'diferenca': diferenca,
-                'preco': float(p.get('preco', 0))
+                'diferenca': estoque_atual - estoque_minimo,
+                'preco': float(p.get('preco', 0)),
+                'nivel': NIVEL_LABELS[p['nivel_estoque']]
             }
-            
-            # Classificar por nível de estoque
-            if estoque_atual <= estoque_minimo:
-                produto_formatado['nivel'] = 'Crítico'
-                criticos.append(produto_formatado)
-            elif estoque_atual < estoque_minimo * 1.5:
-                produto_formatado['nivel'] = 'Atenção'
-                atencao.append(produto_formatado)
-            else:
-                produto_formatado['nivel'] = 'Normal'
-                normais.append(produto_formatado)
+            (criticos if p['nivel_estoque'] == NIVEL_CRITICO else atencao).append(produto_formatado)
+        
+        normais = db.produtos.count_documents({'status': 'Ativo'}) - len(criticos) - len(atencao)
         
         resultado = {
             'estatisticas': {
                 'criticos': len(criticos),
                 'atencao': len(atencao),
-                'normais': len(normais)
+                'normais': normais
             },
             'produtos': criticos + atencao  # Retorna apenas os que precisam atenção
         }
         
-        logger.info(f"⚠️ Estoque - Críticos: {len(criticos)}, Atenção: {len(atencao)}, Normais: {len(normais)}")
+        logger.info(f"⚠️ Estoque - Críticos: {len(criticos)}, Atenção: {len(atencao)}, Normais: {normais}")
         return jsonify({'success': True, 'data': resultado})
         
     except Exception as e:
@@ -8025,6 +7258,7 @@ def produto_detalhes(id):
         """Deleta um produto"""
         try:
             result = db.produtos.delete_one({'_id': ObjectId(id)})
+            invalidar_valorizacao()
 
             if result.deleted_count > 0:
                 logger.info(f"✅ Produto {id} deletado com sucesso")
@@ -8066,9 +7300,11 @@ def produto_detalhes(id):
             update_data['marca'] = data['marca']
         if 'preco' in data:
             update_data['preco'] = float(data['preco'])
+        novo_estoque = None
         if 'estoque' in data:
             # Garante que o valor não seja None nem string vazia antes de converter para int
-            update_data['estoque'] = int(data.get('estoque') or 0)
+            # v7.3: saldo só muda por movimentação (ajuste), nunca por $set
+            novo_estoque = int(data.get('estoque') or 0)
         if 'estoque_minimo' in data:
             update_data['estoque_minimo'] = int(data['estoque_minimo'])
         if 'status' in data:
@@ -8086,25 +7322,22 @@ def produto_detalhes(id):
         if 'codigo_barras' in data:
             update_data['codigo_barras'] = data['codigo_barras']
 
-        if not update_data:
+        if not update_data and novo_estoque is None:
             return jsonify({'success': False, 'message': 'Nenhum dado para atualizar'}), 400
 
-        result = db.produtos.update_one(
-            {'_id': ObjectId(id)},
-            {'$set': update_data}
-        )
-
         # Aceitar tanto modificações quanto quando não há mudanças (matched_count > 0)
-        if result.matched_count > 0:
+        if _atualizar_produto(db, id, update_data, novo_estoque):
             logger.info(f"✅ Produto {id} atualizado: {update_data}")
             # v7.0: Broadcast
             broadcast_sse_event('data_changed', {'section': 'produtos', 'action': 'update', 'id': id})
-            if 'estoque' in update_data or 'estoque_minimo' in update_data:
+            if novo_estoque is not None or 'estoque_minimo' in update_data:
                 broadcast_sse_event('data_changed', {'section': 'estoque', 'action': 'update'})
             return jsonify({'success': True, 'message': 'Produto atualizado com sucesso'})
 
         return jsonify({'success': False, 'message': 'Produto não encontrado'}), 404
 
+    except EstoqueInsuficiente as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         logger.error(f"❌ Erro ao atualizar produto: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -8116,23 +7349,20 @@ def produto_detalhes(id):
 @login_required
 def buscar_servicos():
     db = get_db()
-    """Busca serviços por termo (nome, categoria, tipo)"""
+    """Busca serviços por termo (nome, categoria, tipo, descrição)"""
     try:
         termo = request.args.get('termo', '').strip()
 
         if not termo or len(termo) < 2:
             return jsonify({'success': True, 'servicos': []})
 
-        regex = {'$regex': termo, '$options': 'i'}
-
-        servicos = list(db.servicos.find({
-            '$or': [
-                {'nome': regex},
-                {'categoria': regex},
-                {'tipo': regex},
-                {'descricao': regex}
-            ]
-        }).sort('nome', ASCENDING).limit(20))
+        # v7.3: Índice em memória (contém, ranqueado) ou prefixo ancorado nos campos-sombra
+        candidatos = indice_busca.buscar('servicos', termo, 20)
+        if candidatos is not None:
+            servicos = hidratar(db.servicos, [i for i, _ in candidatos])
+        else:
+            filtro = consulta_prefixo('servicos', termo)
+            servicos = list(db.servicos.find(filtro).sort('nome', ASCENDING).limit(20)) if filtro else []
 
         resultado = []
         for s in servicos:
@@ -8267,6 +7497,7 @@ def atualizar_servico(id):
         if not update_data:
             return jsonify({'success': False, 'message': 'Nenhum dado para atualizar'}), 400
         
+        update_data.update(campos_busca('servicos', update_data))
         result = db.servicos.update_one(
             {'_id': ObjectId(id)},
             {'$set': update_data}
@@ -8323,6 +7554,7 @@ def deletar_todos_servicos():
     try:
         count_antes = db.servicos.count_documents({})
         result = db.servicos.delete_many({})
+        indice_busca.alterado('servicos')
 
         logger.warning(f"🗑️ TODOS os serviços deletados: {result.deleted_count} registros removidos")
         return jsonify({
@@ -8344,6 +7576,8 @@ def deletar_todos_produtos():
     try:
         count_antes = db.produtos.count_documents({})
         result = db.produtos.delete_many({})
+        invalidar_valorizacao()
+        indice_busca.alterado('produtos')
 
         logger.warning(f"🗑️ TODOS os produtos deletados: {result.deleted_count} registros removidos")
         return jsonify({
@@ -8370,6 +7604,7 @@ def toggle_todos_produtos():
             {},
             {'$set': {'ativo': ativo}}
         )
+        invalidar_valorizacao()
 
         logger.info(f"✅ {result.modified_count} produtos {'ativados' if ativo else 'desativados'}")
         return jsonify({
@@ -8395,7 +7630,7 @@ def estoque_visao_geral():
         produtos = list(db.produtos.find({'status': 'Ativo'}))
         
         total_produtos = len(produtos)
-        valor_total_estoque = 0
+        valor_total_estoque = avaliar_estoque(db, {'status': 'Ativo'})['total']['valor_venda']
         alertas_estoque = 0
         
         produtos_formatados = []
@@ -8406,20 +7641,11 @@ def estoque_visao_geral():
             preco = float(p.get('preco', 0))
             valor_total = estoque_atual * preco
             
-            valor_total_estoque += valor_total
-            
-            # Verificar alertas
-            if estoque_atual <= estoque_minimo * 1.5:
+            # Nível mantido em cada escrita de saldo (classificador único)
+            nivel = p.get('nivel_estoque') or classificar_nivel(estoque_atual, estoque_minimo)
+            if nivel != NIVEL_NORMAL:
                 alertas_estoque += 1
             
-            # Determinar status
-            if estoque_atual <= estoque_minimo:
-                nivel = 'Crítico'
-            elif estoque_atual < estoque_minimo * 1.5:
-                nivel = 'Baixo'
-            else:
-                nivel = 'Normal'
-            
             produtos_formatados.append({
                 'id': str(p['_id']),
                 'nome': p.get('nome', 'Sem nome'),
@@ -8428,7 +7654,7 @@ def estoque_visao_geral():
                 'estoque_minimo': estoque_minimo,
                 'preco_unitario': preco,
                 'valor_total': round(valor_total, 2),
-                'nivel': nivel
+                'nivel': NIVEL_LABELS[nivel]
             })
         
         # Buscar movimentações do mês atual
@@ -8461,17 +7687,18 @@ def estoque_alertas():
     db = get_db()
     """Retorna alertas de estoque e últimas movimentações"""
     try:
-        # Buscar produtos ativos
-        produtos = list(db.produtos.find({'status': 'Ativo'}))
+        # v7.3: apenas produtos fora do nível normal (índices parciais em nivel_estoque)
+        produtos = db.produtos.find(
+            {'status': 'Ativo', **filtro_nivel()},
+            {'nome': 1, 'marca': 1, 'estoque': 1, 'estoque_minimo': 1, 'nivel_estoque': 1}
+        )
         
         criticos = []
         atencao = []
-        normais = []
         
         for p in produtos:
             estoque_atual = int(p.get('estoque', 0))
             estoque_minimo = int(p.get('estoque_minimo', 0))
-            diferenca = estoque_atual - estoque_minimo
             
             produto_info = {
                 'id': str(p['_id']),
@@ -8479,35 +7706,41 @@ def estoque_alertas():
                 'marca': p.get('marca', 'Sem marca'),
                 'estoque_atual': estoque_atual,
                 'estoque_minimo': estoque_minimo,
-                'diferenca': diferenca
+                'diferenca': estoque_atual - estoque_minimo,
+                'nivel': NIVEL_LABELS[p['nivel_estoque']]
             }
-            
-            if estoque_atual <= estoque_minimo:
-                produto_info['nivel'] = 'Crítico'
-                criticos.append(produto_info)
-            elif estoque_atual < estoque_minimo * 1.5:
-                produto_info['nivel'] = 'Atenção'
-                atencao.append(produto_info)
-            else:
-                normais.append(produto_info)
+            (criticos if p['nivel_estoque'] == NIVEL_CRITICO else atencao).append(produto_info)
+        
+        normais = db.produtos.count_documents({'status': 'Ativo'}) - len(criticos) - len(atencao)
         
         # Buscar últimas 10 movimentações
         movimentacoes = list(db.estoque_movimentacoes.find().sort('data', DESCENDING).limit(10))
         
+        # Nomes de produtos e responsáveis em uma consulta por coleção ($in, só o nome)
+        def _ids(campo):
+            return list({ObjectId(m[campo]) for m in movimentacoes if ObjectId.is_valid(m.get(campo))})
+        
+        produto_ids = _ids('produto_id')
+        nomes_produtos = {
+            str(p['_id']): p.get('nome', 'Desconhecido')
+            for p in db.produtos.find({'_id': {'$in': produto_ids}}, {'nome': 1})
+        } if produto_ids else {}
+        responsavel_ids = _ids('responsavel_id')
+        nomes_responsaveis = {}
+        if responsavel_ids:
+            # Profissional tem precedência sobre assistente com o mesmo _id
+            for colecao in (db.assistentes, db.profissionais):
+                nomes_responsaveis.update(
+                    (str(r['_id']), r.get('nome', 'Desconhecido'))
+                    for r in colecao.find({'_id': {'$in': responsavel_ids}}, {'nome': 1})
+                )
+        
         movimentacoes_formatadas = []
         for m in movimentacoes:
-            # Buscar nome do produto
-            produto = db.produtos.find_one({'_id': ObjectId(m['produto_id'])})
-            produto_nome = produto.get('nome', 'Desconhecido') if produto else 'Desconhecido'
-            
-            # Buscar nome do responsável
+            produto_nome = nomes_produtos.get(str(m.get('produto_id')), 'Desconhecido')
             responsavel_nome = 'Sistema'
             if m.get('responsavel_id'):
-                responsavel = db.profissionais.find_one({'_id': ObjectId(m['responsavel_id'])})
-                if not responsavel:
-                    responsavel = db.assistentes.find_one({'_id': ObjectId(m['responsavel_id'])})
-                if responsavel:
-                    responsavel_nome = responsavel.get('nome', 'Desconhecido')
+                responsavel_nome = nomes_responsaveis.get(str(m['responsavel_id']), responsavel_nome)
             
             movimentacoes_formatadas.append({
                 'id': str(m['_id']),
@@ -8523,7 +7756,7 @@ def estoque_alertas():
             'estatisticas': {
                 'criticos': len(criticos),
                 'atencao': len(atencao),
-                'normais': len(normais)
+                'normais': normais
             },
             'produtos_baixo': criticos + atencao,
             'ultimas_movimentacoes': movimentacoes_formatadas
@@ -8537,14 +7770,154 @@ def estoque_alertas():
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+# Pool da previsão de reposição (um recálculo por vez, sem fila)
+_previsao_jobs = None
+_previsao_jobs_lock = threading.Lock()
+
+def get_previsao_jobs():
+    """JobManager do recálculo da previsão de reposição"""
+    global _previsao_jobs
+    with _previsao_jobs_lock:
+        if _previsao_jobs is None:
+            _previsao_jobs = JobManager('previsao', max_workers=1, max_fila=0, notificar=broadcast_sse_event)
+        return _previsao_jobs
+
+def _executar_previsao(progresso, db):
+    """Job da previsão: dobra os dias novos na EWMA de consumo"""
+    return atualizar_previsao(db, progresso)
+
+def _agendar_previsao(db, usuario_id=None):
+    """Enfileirar atualizar_previsao (None se já houver um recálculo em andamento)"""
+    # Mesma cadência diária (virada do dia/cron): o snapshot do ledger vai junto
+    _agendar_snapshot_estoque(db)
+    try:
+        return get_previsao_jobs().submit(
+            db, _executar_previsao, db,
+            descricao='Previsão de reposição', usuario_id=usuario_id
+        )
+    except JobQueueFull:
+        return None
+
+# Pool dos snapshots do ledger (um por vez; chave_unica vale entre workers)
+_snapshot_jobs = None
+_snapshot_jobs_lock = threading.Lock()
+
+def get_snapshot_jobs():
+    """JobManager dos snapshots de estoque"""
+    global _snapshot_jobs
+    with _snapshot_jobs_lock:
+        if _snapshot_jobs is None:
+            _snapshot_jobs = JobManager('estoque_snapshot', max_workers=1, max_fila=0)
+        return _snapshot_jobs
+
+def _agendar_snapshot_estoque(db):
+    """Enfileirar o snapshot se o último estiver vencido (a consulta não espera por ele)"""
+    if not snapshot_pendente(db):
+        return None
+    try:
+        return get_snapshot_jobs().submit(
+            db, job_snapshot_estoque, db,
+            descricao='Snapshot de estoque', chave_unica='diario'
+        )
+    except (JobQueueFull, JobDuplicado):
+        return None
+
+@bp.route('/api/estoque/previsao', methods=['GET'])
+@login_required
+def estoque_previsao():
+    """
+    Previsão de reposição (campos pré-calculados no produto)
+
+    Query params:
+        repor: 1 para só os produtos com estoque <= ponto_de_reposicao
+        limite: máximo de produtos (padrão 200)
+    """
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    try:
+        # Virada do dia: dobra os dias novos em background e responde com os valores atuais
+        job_id = None
+        if previsao_desatualizada(db):
+            job_id = _agendar_previsao(db, session.get('user_id'))
+
+        filtro = {'status': 'Ativo', 'dias_de_cobertura': {'$type': 'number'}}
+        if request.args.get('repor') in ('1', 'true'):
+            filtro['$expr'] = {'$lte': ['$estoque', '$ponto_de_reposicao']}
+        limite = min(request.args.get('limite', 200, type=int), 1000)
+
+        produtos = db.produtos.find(filtro, {
+            'nome': 1, 'marca': 1, 'estoque': 1, 'estoque_minimo': 1,
+            'consumo_diario': 1, 'dias_de_cobertura': 1, 'ponto_de_reposicao': 1
+        }).sort('dias_de_cobertura', ASCENDING).limit(limite)
+
+        resultado = []
+        for p in produtos:
+            estoque = int(p.get('estoque', 0) or 0)
+            ponto = int(p.get('ponto_de_reposicao') or 0)
+            resultado.append({
+                'id': str(p['_id']),
+                'nome': p.get('nome', 'Sem nome'),
+                'marca': p.get('marca', 'Sem marca'),
+                'estoque_atual': estoque,
+                'estoque_minimo': p.get('estoque_minimo', 0),
+                'consumo_diario': round(p.get('consumo_diario') or 0, 2),
+                'dias_de_cobertura': p.get('dias_de_cobertura'),
+                'ponto_de_reposicao': ponto,
+                'repor': estoque <= ponto,
+                'sugestao_compra': max(ponto - estoque, 0)
+            })
+
+        sem_consumo = db.produtos.count_documents({
+            'status': 'Ativo',
+            '$or': [{'consumo_diario': {'$exists': False}}, {'consumo_diario': {'$lt': CONSUMO_MINIMO}}]
+        })
+
+        return jsonify({
+            'success': True,
+            'produtos': resultado,
+            'total': len(resultado),
+            'sem_consumo': sem_consumo,
+            'atualizando': job_id is not None,
+            'job_id': job_id
+        })
+    except Exception as e:
+        logger.error(f"❌ Erro ao buscar previsão de reposição: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/estoque/previsao/recalcular', methods=['POST'])
+@login_required
+@permission_required('Admin', 'Gestão')
+def recalcular_previsao():
+    """Disparar o recálculo incremental (ex.: cron noturno)"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
+    job_id = _agendar_previsao(db, session.get('user_id'))
+    if job_id is None:
+        return jsonify({'success': False, 'message': 'Recálculo da previsão já em andamento'}), 429
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'na_fila'}), 202
+
+
 @bp.route('/api/estoque/relatorio', methods=['GET'])
 @login_required
 def gerar_relatorio_estoque():
     """Gera relatório de estoque personalizado"""
+    db = get_db()
+    if db is None:
+        return jsonify({'success': False, 'message': 'Database offline'}), 500
+
     try:
         tipo = request.args.get('tipo', 'movimentacoes')
         data_inicio = request.args.get('data_inicio')
         data_fim = request.args.get('data_fim')
+        # v7.3: posição histórica (posicao/valorizado) - fim do dia informado
+        as_of = request.args.get('as_of')
+        if as_of:
+            as_of = datetime.strptime(as_of, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+            _agendar_snapshot_estoque(db)
         
         # Converter datas
         if data_inicio:
@@ -8615,8 +7988,11 @@ def gerar_relatorio_estoque():
             }
             
         elif tipo == 'posicao':
-            # Relatório de posição de estoque
-            produtos = list(db.produtos.find({'status': 'Ativo'}))
+            # Relatório de posição de estoque (atual ou na data as_of via ledger)
+            if as_of:
+                produtos = posicao_estoque(db, as_of, {'status': 'Ativo'})
+            else:
+                produtos = list(db.produtos.find({'status': 'Ativo'}))
             
             produtos_formatados = []
             for p in produtos:
@@ -8625,51 +8001,65 @@ def gerar_relatorio_estoque():
                     'marca': p.get('marca', 'Sem marca'),
                     'estoque_atual': int(p.get('estoque', 0)),
                     'estoque_minimo': int(p.get('estoque_minimo', 0)),
-                    'status': 'Normal' if int(p.get('estoque', 0)) > int(p.get('estoque_minimo', 0)) * 1.5 else ('Baixo' if int(p.get('estoque', 0)) > int(p.get('estoque_minimo', 0)) else 'Crítico')
+                    # Classificado na hora: com as_of o saldo é o histórico, não o atual
+                    'status': NIVEL_LABELS[classificar_nivel(p.get('estoque', 0), p.get('estoque_minimo', 0))]
                 })
             
             resultado = {
                 'tipo': 'posicao',
-                'data': datetime.now().strftime('%d/%m/%Y %H:%M'),
+                'data': (as_of or datetime.now()).strftime('%d/%m/%Y %H:%M'),
                 'total_produtos': len(produtos),
                 'produtos': produtos_formatados
             }
             
         elif tipo == 'valorizado':
-            # Relatório de estoque valorizado
-            produtos = list(db.produtos.find({'status': 'Ativo'}))
-            
-            valor_total = 0
-            produtos_formatados = []
-            
-            for p in produtos:
-                estoque = int(p.get('estoque', 0))
-                preco = float(p.get('preco', 0))
-                valor = estoque * preco
-                valor_total += valor
-                
-                produtos_formatados.append({
-                    'nome': p.get('nome', 'Sem nome'),
-                    'marca': p.get('marca', 'Sem marca'),
-                    'estoque': estoque,
-                    'preco_unitario': preco,
-                    'valor_total': round(valor, 2)
-                })
+            # Relatório de estoque valorizado (preços do snapshot quando as_of)
+            # top: opcional, só os N produtos de maior valor (0 = todos)
+            top = request.args.get('top', 0, type=int)
+            if as_of:
+                produtos = posicao_estoque(db, as_of, {'status': 'Ativo'})
+                for p in produtos:
+                    p['valor_venda'] = int(p.get('estoque', 0)) * float(p.get('preco', 0))
+                produtos.sort(key=lambda x: x['valor_venda'], reverse=True)
+                total_produtos = len(produtos)
+                valor_total = sum(p['valor_venda'] for p in produtos)
+                por_categoria = None
+                if top:
+                    produtos = produtos[:top]
+            else:
+                valorizacao = avaliar_estoque(db, {'status': 'Ativo'}, top=top)
+                produtos = valorizacao['itens']
+                total_produtos = valorizacao['total']['produtos']
+                valor_total = valorizacao['total']['valor_venda']
+                por_categoria = [
+                    {**c, 'valor_venda': round(c['valor_venda'], 2), 'valor_custo': round(c['valor_custo'], 2)}
+                    for c in valorizacao['por_categoria']
+                ]
             
-            # Ordenar por valor total
-            produtos_formatados.sort(key=lambda x: x['valor_total'], reverse=True)
+            produtos_formatados = [{
+                'nome': p.get('nome', 'Sem nome'),
+                'marca': p.get('marca', 'Sem marca'),
+                'estoque': int(p.get('estoque', 0)),
+                'preco_unitario': float(p.get('preco', 0)),
+                'valor_total': round(p['valor_venda'], 2)
+            } for p in produtos]
             
             resultado = {
                 'tipo': 'valorizado',
-                'data': datetime.now().strftime('%d/%m/%Y %H:%M'),
+                'data': (as_of or datetime.now()).strftime('%d/%m/%Y %H:%M'),
                 'valor_total_estoque': round(valor_total, 2),
-                'total_produtos': len(produtos),
+                'total_produtos': total_produtos,
                 'produtos': produtos_formatados
             }
+            if por_categoria is not None:
+                resultado['por_categoria'] = por_categoria
             
         elif tipo == 'criticos':
-            # Relatório de produtos críticos
-            produtos = list(db.produtos.find({'status': 'Ativo'}))
+            # Relatório de produtos críticos (índices parciais em nivel_estoque)
+            produtos = db.produtos.find(
+                {'status': 'Ativo', **filtro_nivel()},
+                {'nome': 1, 'marca': 1, 'estoque': 1, 'estoque_minimo': 1, 'nivel_estoque': 1}
+            )
             
             criticos = []
             atencao = []
@@ -8678,24 +8068,14 @@ def gerar_relatorio_estoque():
                 estoque_atual = int(p.get('estoque', 0))
                 estoque_minimo = int(p.get('estoque_minimo', 0))
                 
-                if estoque_atual <= estoque_minimo:
-                    criticos.append({
-                        'nome': p.get('nome', 'Sem nome'),
-                        'marca': p.get('marca', 'Sem marca'),
-                        'estoque_atual': estoque_atual,
-                        'estoque_minimo': estoque_minimo,
-                        'diferenca': estoque_atual - estoque_minimo,
-                        'nivel': 'Crítico'
-                    })
-                elif estoque_atual < estoque_minimo * 1.5:
-                    atencao.append({
-                        'nome': p.get('nome', 'Sem nome'),
-                        'marca': p.get('marca', 'Sem marca'),
-                        'estoque_atual': estoque_atual,
-                        'estoque_minimo': estoque_minimo,
-                        'diferenca': estoque_atual - estoque_minimo,
-                        'nivel': 'Atenção'
-                    })
+                (criticos if p['nivel_estoque'] == NIVEL_CRITICO else atencao).append({
+                    'nome': p.get('nome', 'Sem nome'),
+                    'marca': p.get('marca', 'Sem marca'),
+                    'estoque_atual': estoque_atual,
+                    'estoque_minimo': estoque_minimo,
+                    'diferenca': estoque_atual - estoque_minimo,
+                    'nivel': NIVEL_LABELS[p['nivel_estoque']]
+                })
             
             resultado = {
                 'tipo': 'criticos',
@@ -8758,6 +8138,7 @@ def admin_reset_database():
         for collection_name in collections_to_reset:
             count = db[collection_name].count_documents({})
             result = db[collection_name].delete_many({})
+            indice_busca.alterado(collection_name)
             reset_count[collection_name] = count
 
         logger.warning(f"🗑️ BANCO DE DADOS RESETADO por {user.get('username')}")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Pipeline de Assets do index.html
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+O index.html (~1.1MB) é renderizado UMA vez por deploy. Os blocos <style> e
+<script> inline grandes são extraídos para arquivos com hash no nome
+(cache imutável + irmãos .gz/.br pré-comprimidos) e o shell HTML restante
+fica em memória, já comprimido, servido com ETag.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from flask import Response, render_template, request, send_file
+
+try:
+    import brotli
+except ImportError:  # Brotli é opcional: sem ele servimos apenas .gz
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+BUILD_URL_PREFIX = '/static/build'
+
+# Blocos pequenos (ex.: script anti-FOUC do tema) continuam inline
+INLINE_MAX_BYTES = 2048
+
+ASSET_MAX_AGE = 31536000  # 1 ano (nome do arquivo muda a cada conteúdo)
+
+ASSET_MIMETYPES = {
+    'js': 'application/javascript; charset=utf-8',
+    'css': 'text/css; charset=utf-8',
+}
+
+_ABERTURA_RE = re.compile(r'<(script|style)\b([^>]*)>', re.IGNORECASE)
+_FECHAMENTO_RE = {
+    'script': re.compile(r'</script\s*>', re.IGNORECASE),
+    'style': re.compile(r'</style\s*>', re.IGNORECASE),
+}
+ASSET_NOME_RE = re.compile(r'^index\.[0-9a-f]{12}\.(js|css)$')
+
+# Estado do build (preenchido por build_index)
+index_shell = None
+build_dir = None
+
+
+def _comprimir(dados):
+    """Versões pré-comprimidas (gzip sempre, brotli se disponível)"""
+    return {
+        'gzip': gzip.compress(dados, compresslevel=9, mtime=0),
+        'br': brotli.compress(dados, quality=11) if brotli else None,
+    }
+
+
+def _gravar(destino, dados):
+    """Escrita atômica (workers sem preload podem buildar em paralelo)"""
+    temporario = f"{destino}.{os.getpid()}.tmp"
+    with open(temporario, 'wb') as f:
+        f.write(dados)
+    os.replace(temporario, destino)
+
+
+def _gravar_asset(pasta, texto, ext):
+    """Gravar asset com fingerprint no nome e irmãos .gz/.br"""
+    dados = texto.encode('utf-8')
+    nome = f"index.{hashlib.sha256(dados).hexdigest()[:12]}.{ext}"
+    destino = os.path.join(pasta, nome)
+
+    if not os.path.exists(destino):
+        comprimidos = _comprimir(dados)
+        _gravar(destino + '.gz', comprimidos['gzip'])
+        if comprimidos['br'] is not None:
+            _gravar(destino + '.br', comprimidos['br'])
+        _gravar(destino, dados)
+
+    return nome
+
+
+def extrair_assets(html, pasta):
+    """
+    Extrair <style>/<script> inline grandes para arquivos estáticos
+
+    A ordem dos blocos é preservada (scripts externos síncronos executam na
+    mesma sequência dos inline), portanto o comportamento da página não muda.
+    Blocos dentro de <script> (ex.: <style> em template strings) são ignorados.
+    """
+    partes = []
+    posicao = 0
+
+    while True:
+        abertura = _ABERTURA_RE.search(html, posicao)
+        if not abertura:
+            partes.append(html[posicao:])
+            break
+
+        tag, attrs = abertura.group(1).lower(), abertura.group(2)
+        fechamento = _FECHAMENTO_RE[tag].search(html, abertura.end())
+        if not fechamento:
+            partes.append(html[posicao:])
+            break
+
+        conteudo = html[abertura.end():fechamento.start()]
+        extrair = not attrs.strip() and len(conteudo.encode('utf-8')) > INLINE_MAX_BYTES
+
+        if not extrair:
+            partes.append(html[posicao:fechamento.end()])
+        else:
+            partes.append(html[posicao:abertura.start()])
+            if tag == 'script':
+                nome = _gravar_asset(pasta, conteudo, 'js')
+                partes.append(f'<script src="{BUILD_URL_PREFIX}/{nome}"></script>')
+            else:
+                nome = _gravar_asset(pasta, conteudo, 'css')
+                partes.append(f'<link rel="stylesheet" href="{BUILD_URL_PREFIX}/{nome}">')
+
+        posicao = fechamento.end()
+
+    return ''.join(partes)
+
+
+def _pasta_build(app):
+    """static/build quando gravável; senão diretório temporário (ex.: Vercel)"""
+    candidatas = [
+        os.path.join(app.static_folder, 'build'),
+        os.path.join(tempfile.gettempdir(), 'bioma-build'),
+    ]
+    for pasta in candidatas:
+        try:
+            os.makedirs(pasta, exist_ok=True)
+            if os.access(pasta, os.W_OK):
+                return pasta
+        except OSError:
+            continue
+    return None
+
+
+def build_index(app):
+    """
+    Renderizar index.html uma vez por deploy e manter o shell em memória
+
+    Em caso de falha a rota index continua renderizando o template por request.
+    """
+    global index_shell, build_dir
+
+    try:
+        pasta = _pasta_build(app)
+        if pasta is None:
+            logger.warning("⚠️ Sem diretório gravável para assets - index.html sem pré-compilação")
+            return None
+
+        fonte = app.jinja_loader.get_source(app.jinja_env, 'index.html')[0]
+        versao = hashlib.sha256(fonte.encode('utf-8')).hexdigest()[:12]
+
+        with app.app_context():
+            html = render_template('index.html', cache_buster=versao)
+
+        shell = extrair_assets(html, pasta).encode('utf-8')
+        comprimidos = _comprimir(shell)
+
+        index_shell = {
+            'identity': shell,
+            'gzip': comprimidos['gzip'],
+            'br': comprimidos['br'],
+            'etag': hashlib.sha256(shell).hexdigest()[:16],
+            'versao': versao,
+        }
+        build_dir = pasta
+
+        logger.info(
+            f"📦 index.html pré-compilado (build {versao}): {len(html.encode('utf-8')) // 1024}KB → "
+            f"shell {len(shell) // 1024}KB ({len(comprimidos['gzip']) // 1024}KB gzip)"
+        )
+        return index_shell
+    except Exception as e:
+        logger.error(f"❌ Falha ao pré-compilar index.html: {e}")
+        index_shell = None
+        return None
+
+
+def _codificacao_aceita(disponiveis):
+    """Escolher br > gzip > identity conforme Accept-Encoding"""
+    aceitas = request.headers.get('Accept-Encoding', '').lower()
+    if 'br' in aceitas and disponiveis.get('br'):
+        return 'br'
+    if 'gzip' in aceitas and disponiveis.get('gzip'):
+        return 'gzip'
+    return 'identity'
+
+
+def resposta_shell():
+    """Response do shell HTML em memória (revalidação barata via ETag/304)"""
+    codificacao = _codificacao_aceita(index_shell)
+
+    response = Response(index_shell[codificacao], mimetype='text/html')
+    if codificacao != 'identity':
+        response.headers['Content-Encoding'] = codificacao
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{index_shell['etag']}-{codificacao}")
+    return response.make_conditional(request)
+
+
+def resposta_asset(nome):
+    """Servir asset do build (pré-comprimido quando o cliente aceita)"""
+    if build_dir is None or not ASSET_NOME_RE.match(nome):
+        return None
+
+    caminho = os.path.join(build_dir, nome)
+    if not os.path.exists(caminho):
+        return None
+
+    disponiveis = {
+        'br': os.path.exists(caminho + '.br'),
+        'gzip': os.path.exists(caminho + '.gz'),
+    }
+    codificacao = _codificacao_aceita(disponiveis)
+    arquivo = {'br': caminho + '.br', 'gzip': caminho + '.gz'}.get(codificacao, caminho)
+
+    response = send_file(
+        arquivo,
+        mimetype=ASSET_MIMETYPES[nome.rsplit('.', 1)[1]],
+        conditional=True,
+        etag=True,
+        max_age=ASSET_MAX_AGE
+    )
+    if codificacao != 'identity':
+        response.headers['Content-Encoding'] = codificacao
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
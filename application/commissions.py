@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Motor de Comissões
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Cálculo único de comissões de profissionais e assistentes para um lote de
+orçamentos. Profissionais e assistentes referenciados são carregados antes,
+com consultas $in (nada de find_one por linha), e cada linha é calculada
+uma vez só.
+
+Regras:
+    - linha de serviço com profissional_id: comissão = total da linha x comissao_perc
+    - assistente da linha (assistente_id) ou, na falta, o assistente padrão
+      do profissional: comissão = comissão do profissional x percentual do
+      assistente (assistente_comissao_perc da linha ou comissao_assistente_perc)
+    - profissionais_vinculados ao orçamento sem linhas próprias: comissao_perc
+      do vínculo sobre o total do orçamento (com desconto)
+"""
+
+import logging
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Campos necessários ao cálculo (fotos legadas em data URI ficam de fora)
+PARTICIPANTE_PROJECAO = {
+    'nome': 1, 'comissao_perc': 1, 'comissao_assistente_perc': 1,
+    'assistente_id': 1, 'assistente_tipo': 1, 'tipo_origem': 1, 'foto_url': 1
+}
+
+MES_DESCONHECIDO = 'desconhecido'
+
+# Série mensal por profissional (coleção desempenho_profissionais)
+DESEMPENHO_CAMPOS = ('servicos', 'faturamento', 'comissao_profissional', 'comissao_assistente',
+                     'orcamentos', 'orcamentos_aprovados')
+
+# Documento em db.config que marca a inclusão dos orçamentos legados
+DESEMPENHO_CHAVE = 'desempenho_profissionais'
+DESEMPENHO_VERSAO = 1
+DESEMPENHO_LOTE = 500
+
+
+def _percentual(valor):
+    try:
+        return float(valor or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _object_ids(ids):
+    convertidos = []
+    for valor in ids:
+        try:
+            convertidos.append(ObjectId(valor))
+        except Exception:
+            continue
+    return convertidos
+
+
+def _buscar(colecao, ids):
+    ids = _object_ids(ids)
+    if not ids:
+        return {}
+    return {str(doc['_id']): doc for doc in colecao.find({'_id': {'$in': ids}}, PARTICIPANTE_PROJECAO)}
+
+
+def _mes(data):
+    return data.strftime('%Y-%m') if isinstance(data, datetime) else MES_DESCONHECIDO
+
+
+def base_orcamento(orcamento):
+    """Total do orçamento para vínculos (total_final ou itens menos desconto)"""
+    total_final = _percentual(orcamento.get('total_final'))
+    if total_final > 0:
+        return total_final
+    subtotal = sum(_percentual(item.get('total')) for item in orcamento.get('servicos', []))
+    subtotal += sum(_percentual(item.get('total')) for item in orcamento.get('produtos', []))
+    desconto = _percentual(orcamento.get('desconto_perc') or orcamento.get('desconto_global'))
+    return subtotal - subtotal * desconto / 100
+
+
+class Participantes:
+    """Profissionais e assistentes de um lote de orçamentos (pré-carregados)"""
+
+    def __init__(self, db, orcamentos):
+        prof_ids, assist_ids = set(), set()
+        for orc in orcamentos:
+            for servico in orc.get('servicos', []):
+                if servico.get('profissional_id'):
+                    prof_ids.add(str(servico['profissional_id']))
+                if servico.get('assistente_id'):
+                    tipo = servico.get('assistente_tipo')
+                    (prof_ids if tipo == 'profissional' else assist_ids).add(str(servico['assistente_id']))
+                    if tipo is None:
+                        prof_ids.add(str(servico['assistente_id']))
+            for vinculo in orc.get('profissionais_vinculados', []):
+                if vinculo.get('profissional_id'):
+                    prof_ids.add(str(vinculo['profissional_id']))
+
+        self.profissionais = _buscar(db.profissionais, prof_ids)
+
+        # Assistentes padrão dos profissionais carregados
+        faltantes = set()
+        for prof in self.profissionais.values():
+            if prof.get('assistente_id'):
+                tipo = prof.get('assistente_tipo')
+                (faltantes if tipo == 'profissional' else assist_ids).add(str(prof['assistente_id']))
+                if tipo is None:
+                    faltantes.add(str(prof['assistente_id']))
+
+        self.assistentes = _buscar(db.assistentes, assist_ids)
+
+        # Só quando o assistente padrão é outro profissional ainda não carregado
+        faltantes -= set(self.profissionais) | set(self.assistentes)
+        if faltantes:
+            self.profissionais.update(_buscar(db.profissionais, faltantes))
+
+    def profissional(self, profissional_id):
+        return self.profissionais.get(str(profissional_id)) if profissional_id else None
+
+    def assistente(self, assistente_id, assistente_tipo=None):
+        """Mesma precedência de get_assistente_details, sem ir ao banco"""
+        if not assistente_id:
+            return None
+        assistente_id = str(assistente_id)
+        if assistente_tipo == 'profissional':
+            return self.profissionais.get(assistente_id)
+        if assistente_tipo == 'assistente':
+            return self.assistentes.get(assistente_id)
+        return self.assistentes.get(assistente_id) or self.profissionais.get(assistente_id)
+
+
+def _linha_servico(servico, prof, participantes):
+    valor_servico = _percentual(servico.get('total'))
+    comissao_perc = _percentual(prof.get('comissao_perc'))
+    comissao_valor = valor_servico * comissao_perc / 100
+
+    assistente_perc = servico.get('assistente_comissao_perc')
+    if servico.get('assistente_id'):
+        assistente = participantes.assistente(servico['assistente_id'], servico.get('assistente_tipo'))
+    else:
+        assistente = participantes.assistente(prof.get('assistente_id'), prof.get('assistente_tipo'))
+    if assistente_perc is None:
+        assistente_perc = prof.get('comissao_assistente_perc', 0)
+    assistente_perc = _percentual(assistente_perc) if assistente else 0.0
+    assistente_servico = servico.get('assistente_servico') or servico.get('nome')
+
+    descricao = f"Profissional {prof.get('nome')} - {servico.get('nome')}"
+    if assistente:
+        descricao += f" | Assistente {assistente.get('nome', '')} - {assistente_servico}"
+
+    return {
+        'origem': 'servico',
+        'profissional_nome': prof.get('nome'),
+        'servico': servico.get('nome', ''),
+        'quantidade': servico.get('qtd', 1) or 1,
+        'valor_servico': valor_servico,
+        'comissao_perc': comissao_perc,
+        'comissao_profissional': comissao_valor,
+        'assistente_id': str(assistente['_id']) if assistente else None,
+        'assistente_nome': assistente.get('nome') if assistente else None,
+        'assistente_tipo': assistente.get('tipo_origem') if assistente else None,
+        'assistente_perc': assistente_perc,
+        'assistente_servico': assistente_servico if assistente else None,
+        'comissao_assistente': comissao_valor * assistente_perc / 100,
+        'descricao': descricao
+    }
+
+
+def _linha_vinculo(orc, vinculo, prof):
+    valor_base = base_orcamento(orc)
+    comissao_perc = _percentual(vinculo.get('comissao_perc', (prof or {}).get('comissao_perc')))
+    nome = vinculo.get('nome') or (prof or {}).get('nome')
+    return {
+        'origem': 'vinculo',
+        'profissional_nome': nome,
+        'servico': 'Orçamento completo',
+        'quantidade': 0,
+        'valor_servico': valor_base,
+        'comissao_perc': comissao_perc,
+        'comissao_profissional': valor_base * comissao_perc / 100,
+        'assistente_id': None,
+        'assistente_nome': None,
+        'assistente_tipo': None,
+        'assistente_perc': 0.0,
+        'assistente_servico': None,
+        'comissao_assistente': 0.0,
+        'descricao': f"{vinculo.get('tipo') or 'Profissional'} {nome} - orçamento #{orc.get('numero')}"
+    }
+
+
+def _novo_acumulado():
+    return {'comissao_profissional': 0.0, 'comissao_assistente': 0.0, 'servicos': 0, 'faturamento': 0.0,
+            'orcamentos': set()}
+
+
+def calcular_comissoes(db, orcamentos, profissional_id=None):
+    """
+    Comissões de um lote de orçamentos em uma passada
+
+    Args:
+        orcamentos: lista de documentos de orçamento
+        profissional_id: se informado, só as linhas desse profissional
+
+    Returns:
+        dict com 'linhas', 'por_profissional' {id: totais}, 'por_mes'
+        {id: {'AAAA-MM': totais}}, 'total_profissional', 'total_assistente',
+        'total' e 'participantes'
+    """
+    orcamentos = list(orcamentos)
+    return _calcular(Participantes(db, orcamentos), orcamentos, profissional_id)
+
+
+def _calcular(participantes, orcamentos, profissional_id=None):
+    filtro = str(profissional_id) if profissional_id else None
+
+    linhas = []
+    por_profissional = {}
+    por_mes = {}
+
+    for orc in orcamentos:
+        data = orc.get('created_at')
+        mes = _mes(data)
+        cabecalho = {
+            'orcamento_id': str(orc.get('_id')),
+            'orcamento_numero': orc.get('numero'),
+            'cliente': orc.get('cliente_nome'),
+            'status': orc.get('status'),
+            'data': data,
+            'mes': mes
+        }
+
+        itens = []
+        com_linhas = set()
+        for servico in orc.get('servicos', []):
+            pid = str(servico.get('profissional_id') or '')
+            prof = participantes.profissional(pid)
+            if not prof:
+                continue
+            com_linhas.add(pid)
+            if filtro and pid != filtro:
+                continue
+            itens.append((pid, _linha_servico(servico, prof, participantes)))
+
+        for vinculo in orc.get('profissionais_vinculados', []):
+            pid = str(vinculo.get('profissional_id') or '')
+            if not pid or pid in com_linhas or (filtro and pid != filtro):
+                continue
+            itens.append((pid, _linha_vinculo(orc, vinculo, participantes.profissional(pid))))
+
+        for pid, linha in itens:
+            linha.update(cabecalho)
+            linha['profissional_id'] = pid
+            linhas.append(linha)
+
+            for acumulado in (
+                por_profissional.setdefault(pid, _novo_acumulado()),
+                por_mes.setdefault(pid, {}).setdefault(mes, _novo_acumulado())
+            ):
+                acumulado['comissao_profissional'] += linha['comissao_profissional']
+                acumulado['comissao_assistente'] += linha['comissao_assistente']
+                acumulado['servicos'] += linha['quantidade']
+                acumulado['faturamento'] += linha['valor_servico']
+                acumulado['orcamentos'].add(linha['orcamento_id'])
+
+    for acumulado in por_profissional.values():
+        acumulado['orcamentos'] = len(acumulado['orcamentos'])
+    for meses in por_mes.values():
+        for acumulado in meses.values():
+            acumulado['orcamentos'] = len(acumulado['orcamentos'])
+
+    total_profissional = sum(linha['comissao_profissional'] for linha in linhas)
+    total_assistente = sum(linha['comissao_assistente'] for linha in linhas)
+    return {
+        'linhas': linhas,
+        'por_profissional': por_profissional,
+        'por_mes': por_mes,
+        'total_profissional': total_profissional,
+        'total_assistente': total_assistente,
+        'total': total_profissional + total_assistente,
+        'participantes': participantes
+    }
+
+
+def registros_historico(resultado, agora=None):
+    """
+    Documentos de comissoes_historico: um por orçamento e beneficiário
+    (profissionais e assistentes)
+    """
+    agora = agora or datetime.now()
+    registros = {}
+
+    def acumular(orcamento_id, beneficiario_id, nome, tipo, perc, valor, base, linha):
+        chave = (orcamento_id, beneficiario_id)
+        if chave not in registros:
+            registros[chave] = {
+                'orcamento_id': ObjectId(orcamento_id) if ObjectId.is_valid(orcamento_id) else orcamento_id,
+                'orcamento_numero': linha['orcamento_numero'],
+                'profissional_id': ObjectId(beneficiario_id) if ObjectId.is_valid(beneficiario_id) else beneficiario_id,
+                'nome': nome,
+                'profissional_nome': nome,
+                'tipo': tipo,
+                'comissao_perc': perc,
+                'comissao_valor': 0.0,
+                'valor_base': 0.0,
+                'cliente_nome': linha['cliente'],
+                'status_orcamento': linha['status'],
+                'data_registro': agora
+            }
+        registros[chave]['comissao_valor'] += valor
+        registros[chave]['valor_base'] += base
+
+    for linha in resultado['linhas']:
+        acumular(linha['orcamento_id'], linha['profissional_id'], linha['profissional_nome'], 'profissional',
+                 linha['comissao_perc'], linha['comissao_profissional'], linha['valor_servico'], linha)
+        if linha['assistente_id'] and linha['comissao_assistente']:
+            acumular(linha['orcamento_id'], linha['assistente_id'], linha['assistente_nome'], 'assistente',
+                     linha['assistente_perc'], linha['comissao_assistente'], linha['comissao_profissional'], linha)
+
+    for registro in registros.values():
+        registro['comissao_valor'] = round(registro['comissao_valor'], 2)
+        registro['valor_base'] = round(registro['valor_base'], 2)
+    return list(registros.values())
+
+
+def registrar_comissoes(db, orcamento, resultado=None):
+    """
+    (Re)gravar o histórico de comissões de um orçamento
+
+    Args:
+        resultado: calcular_comissoes já feito para [orcamento] (evita recálculo)
+
+    Returns:
+        resultado de calcular_comissoes
+    """
+    resultado = resultado or calcular_comissoes(db, [orcamento])
+    db.comissoes_historico.delete_many({'orcamento_id': orcamento['_id']})
+    registros = registros_historico(resultado)
+    if registros:
+        db.comissoes_historico.insert_many(registros)
+    return resultado
+
+
+def resumo_historico(registros):
+    """Totais e série mensal de registros de comissoes_historico"""
+    total = sum(_percentual(r.get('comissao_valor')) for r in registros)
+    orcamentos = len({str(r.get('orcamento_id')) for r in registros})
+    por_mes = {}
+    for registro in registros:
+        data = registro.get('data_registro')
+        if not isinstance(data, datetime):
+            continue
+        mes = por_mes.setdefault(_mes(data), {'valor': 0, 'quantidade': 0})
+        mes['valor'] += _percentual(registro.get('comissao_valor'))
+        mes['quantidade'] += 1
+    return {
+        'total_comissoes': total,
+        'total_orcamentos': orcamentos,
+        'media_comissao': total / orcamentos if orcamentos else 0,
+        'comissoes_por_mes': por_mes
+    }
+
+
+# ==================== DESEMPENHO MENSAL ====================
+
+def contribuicao_desempenho(resultado, orcamento):
+    """
+    Parcela de um orçamento na série mensal de cada profissional
+
+    Gravada no próprio orçamento (desempenho_aplicado) para que a próxima
+    escrita aplique só a diferença.
+    """
+    aprovado = orcamento.get('status') == 'Aprovado'
+    contribuicao = []
+    for pid, meses in resultado['por_mes'].items():
+        for mes, totais in meses.items():
+            contribuicao.append({
+                'profissional_id': pid,
+                'mes': mes,
+                'servicos': totais['servicos'],
+                'faturamento': round(totais['faturamento'], 2),
+                'comissao_profissional': round(totais['comissao_profissional'], 2),
+                'comissao_assistente': round(totais['comissao_assistente'], 2),
+                'orcamentos': totais['orcamentos'],
+                'orcamentos_aprovados': totais['orcamentos'] if aprovado else 0
+            })
+    return contribuicao
+
+
+def aplicar_desempenho(db, novo=None, antigo=None):
+    """$inc de (novo - antigo) nos documentos mensais de desempenho_profissionais"""
+    deltas = {}
+    for sinal, contribuicao in ((1, novo or []), (-1, antigo or [])):
+        for item in contribuicao:
+            delta = deltas.setdefault((item['profissional_id'], item['mes']), dict.fromkeys(DESEMPENHO_CAMPOS, 0))
+            for campo in DESEMPENHO_CAMPOS:
+                delta[campo] += sinal * item.get(campo, 0)
+
+    agora = datetime.now()
+    operacoes = []
+    for (pid, mes), delta in deltas.items():
+        incrementos = {campo: round(valor, 2) for campo, valor in delta.items() if round(valor, 2)}
+        if incrementos:
+            operacoes.append(UpdateOne(
+                {'profissional_id': pid, 'mes': mes},
+                {'$inc': incrementos, '$set': {'updated_at': agora}},
+                upsert=True
+            ))
+    if operacoes:
+        db.desempenho_profissionais.bulk_write(operacoes, ordered=False)
+
+
+def garantir_desempenho(db):
+    """
+    Incluir na série os orçamentos anteriores a ela (uma vez por banco)
+
+    Cada orçamento é marcado com desempenho_aplicado só se ainda não tiver
+    o campo, então workers em paralelo ou escritas simultâneas não contam
+    o mesmo orçamento duas vezes.
+    """
+    if db.config.find_one({'key': DESEMPENHO_CHAVE, 'versao': DESEMPENHO_VERSAO}):
+        return 0
+
+    pendentes = {'desempenho_aplicado': {'$exists': False}}
+    total = 0
+    lote = []
+
+    def processar(orcamentos):
+        aplicados = 0
+        participantes = Participantes(db, orcamentos)
+        for orc in orcamentos:
+            contribuicao = contribuicao_desempenho(_calcular(participantes, [orc]), orc)
+            marcado = db.orcamentos.update_one(
+                {'_id': orc['_id'], **pendentes},
+                {'$set': {'desempenho_aplicado': contribuicao}}
+            )
+            if marcado.modified_count:
+                aplicar_desempenho(db, contribuicao)
+                aplicados += 1
+        return aplicados
+
+    for orc in db.orcamentos.find(pendentes, {'servicos': 1, 'produtos': 1, 'profissionais_vinculados': 1,
+                                              'status': 1, 'created_at': 1, 'numero': 1, 'cliente_nome': 1,
+                                              'total_final': 1, 'desconto_perc': 1, 'desconto_global': 1}):
+        lote.append(orc)
+        if len(lote) >= DESEMPENHO_LOTE:
+            total += processar(lote)
+            lote = []
+    if lote:
+        total += processar(lote)
+
+    db.config.update_one(
+        {'key': DESEMPENHO_CHAVE},
+        {'$set': {'versao': DESEMPENHO_VERSAO, 'updated_at': datetime.now()}},
+        upsert=True
+    )
+    logger.info(f"📊 Desempenho mensal de profissionais: {total} orçamentos incluídos")
+    return total
+
+
+def serie_desempenho(db, profissional_id):
+    """Série mensal de um profissional (um documento por mês, ordenada)"""
+    return list(db.desempenho_profissionais.find(
+        {'profissional_id': str(profissional_id), 'orcamentos': {'$gt': 0}},
+        {'_id': 0, 'updated_at': 0}
+    ).sort('mes', 1))
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Exportação de Planilhas (XLSX/CSV) em Streaming
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Toda planilha baixada passa por aqui: as linhas saem de cursores do Mongo em
+lotes (projeção só com as colunas exportadas) e vão direto para um Workbook
+write_only ou para o csv.writer, gravados num arquivo temporário. A memória
+fica constante, independente do tamanho da coleção exportada.
+"""
+
+import csv
+import io
+import logging
+import tempfile
+from datetime import datetime, date
+
+from bson import ObjectId
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.utils import get_column_letter
+
+logger = logging.getLogger(__name__)
+
+# Documentos trazidos do Mongo por round-trip
+PLANILHA_CURSOR_LOTE = 500
+
+# Arquivo em memória até esse tamanho, depois vai para disco
+PLANILHA_SPOOL_MAX_BYTES = 2 * 1024 * 1024
+
+MIMETYPE_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+FORMATOS = {
+    'xlsx': MIMETYPE_XLSX,
+    'csv': 'text/csv',
+}
+
+FORMATO_MOEDA = '"R$" #,##0.00'
+FORMATO_DATA = 'DD/MM/YYYY'
+FORMATO_DATA_HORA = 'DD/MM/YYYY HH:MM'
+
+# Início de texto que planilhas interpretam como fórmula (CSV/formula injection)
+PREFIXOS_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+_FONTE_CABECALHO = Font(color='FFFFFF', bold=True)
+_FUNDO_CABECALHO = PatternFill(start_color='7C3AED', end_color='7C3AED', fill_type='solid')
+_ALINHAMENTO_CABECALHO = Alignment(horizontal='center', vertical='center')
+
+
+# ==================== ESCRITA ====================
+
+def _texto(valor):
+    """Valor de célula sem tipo especial (ObjectId, endereço em dict, listas)"""
+    if valor is None:
+        return ''
+    if isinstance(valor, bool):
+        return 'Sim' if valor else 'Não'
+    if isinstance(valor, ObjectId):
+        return str(valor)
+    if isinstance(valor, dict):
+        return ', '.join(str(v) for v in valor.values() if v not in (None, ''))
+    if isinstance(valor, (list, tuple)):
+        return ', '.join(_texto(v) for v in valor)
+    return valor
+
+
+def _data(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor
+    if isinstance(valor, str) and valor:
+        try:
+            return datetime.fromisoformat(valor.replace('Z', ''))
+        except ValueError:
+            return valor
+    return None
+
+
+def _numero(valor):
+    """Número de célula; texto legado aceita formato brasileiro ('10,5', 'R$ 1.234,56')"""
+    if isinstance(valor, str):
+        valor = valor.replace('R$', '').strip()
+        if ',' in valor:
+            valor = valor.replace('.', '').replace(',', '.')
+    try:
+        return round(float(valor or 0), 2)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _texto_seguro(valor):
+    """
+    _texto sem fórmula: texto começando com = + - @ TAB CR seria executado pelo
+    Excel/LibreOffice (ex.: cliente cadastrado como '=HYPERLINK(...)')
+    """
+    valor = _texto(valor)
+    if isinstance(valor, str) and valor.startswith(PREFIXOS_FORMULA):
+        return "'" + valor
+    return valor
+
+
+def _valor(doc, campo):
+    """Campo do documento (aceita caminho com ponto para subdocumentos)"""
+    valor = doc
+    for parte in campo.split('.'):
+        if not isinstance(valor, dict):
+            return None
+        valor = valor.get(parte)
+    return valor
+
+
+def _numero_celula(valor):
+    """Quantidade como veio (int/float), texto legado convertido por _numero"""
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return valor
+    return _numero(valor)
+
+
+def _celula_texto(ws, valor):
+    """Texto no XLSX: o openpyxl grava '=...' como fórmula, então o tipo é forçado para string"""
+    valor = _texto(valor)
+    if isinstance(valor, str) and valor.startswith(PREFIXOS_FORMULA):
+        celula = WriteOnlyCell(ws, value=valor)
+        celula.data_type = 's'
+        return celula
+    return valor
+
+
+def _celulas_xlsx(ws, colunas, doc):
+    linha = []
+    for campo, _rotulo, tipo in colunas:
+        valor = _valor(doc, campo)
+        if tipo == 'moeda':
+            celula = WriteOnlyCell(ws, value=_numero(valor))
+            celula.number_format = FORMATO_MOEDA
+        elif tipo in ('data', 'data_hora'):
+            valor = _data(valor)
+            if isinstance(valor, (datetime, date)):
+                celula = WriteOnlyCell(ws, value=valor)
+                celula.number_format = FORMATO_DATA if tipo == 'data' else FORMATO_DATA_HORA
+            else:
+                celula = _celula_texto(ws, valor)
+        elif tipo == 'numero':
+            celula = _numero_celula(valor)
+        else:
+            celula = _celula_texto(ws, valor)
+        linha.append(celula)
+    return linha
+
+
+def _celulas_csv(colunas, doc):
+    linha = []
+    for campo, _rotulo, tipo in colunas:
+        valor = _valor(doc, campo)
+        if tipo == 'moeda':
+            linha.append(f"{_numero(valor):.2f}".replace('.', ','))
+        elif tipo in ('data', 'data_hora'):
+            valor = _data(valor)
+            if isinstance(valor, (datetime, date)):
+                valor = valor.strftime('%d/%m/%Y' if tipo == 'data' else '%d/%m/%Y %H:%M')
+            linha.append(_texto_seguro(valor))
+        elif tipo == 'numero':
+            numero = _numero_celula(valor)
+            linha.append(str(numero).replace('.', ',') if isinstance(numero, float) else numero)
+        else:
+            linha.append(_texto_seguro(valor))
+    return linha
+
+
+def _escrever_xlsx(destino, abas):
+    wb = Workbook(write_only=True)
+    total = 0
+    for titulo, colunas, linhas in abas:
+        # Nome de aba: até 31 caracteres e sem caracteres reservados
+        ws = wb.create_sheet(''.join(c for c in titulo if c not in '[]:*?/\\')[:31])
+        for indice, (_campo, rotulo, tipo) in enumerate(colunas, start=1):
+            largura = 14 if tipo in ('moeda', 'numero', 'data') else max(18, min(len(rotulo) + 4, 40))
+            ws.column_dimensions[get_column_letter(indice)].width = largura
+        ws.freeze_panes = 'A2'
+
+        cabecalho = []
+        for _campo, rotulo, _tipo in colunas:
+            celula = WriteOnlyCell(ws, value=rotulo)
+            celula.font = _FONTE_CABECALHO
+            celula.fill = _FUNDO_CABECALHO
+            celula.alignment = _ALINHAMENTO_CABECALHO
+            cabecalho.append(celula)
+        ws.append(cabecalho)
+
+        for doc in linhas:
+            ws.append(_celulas_xlsx(ws, colunas, doc))
+            total += 1
+    wb.save(destino)
+    return total
+
+
+def _escrever_csv(destino, colunas, linhas):
+    # ; e BOM: o Excel em pt-BR abre direto com acentos e colunas separadas
+    texto = io.TextIOWrapper(destino, encoding='utf-8-sig', newline='')
+    escritor = csv.writer(texto, delimiter=';')
+    escritor.writerow([rotulo for _campo, rotulo, _tipo in colunas])
+    total = 0
+    for doc in linhas:
+        escritor.writerow(_celulas_csv(colunas, doc))
+        total += 1
+    texto.flush()
+    texto.detach()
+    return total
+
+
+def escrever_planilha(destino, abas, formato='xlsx'):
+    """
+    Gravar as abas em `destino` (caminho ou arquivo binário) consumindo as linhas
+    uma a uma
+
+    Args:
+        abas: [(titulo, colunas, linhas)] - colunas são (campo, rótulo, tipo) com
+              tipo None, 'moeda', 'numero', 'data' ou 'data_hora'; linhas é
+              qualquer iterável de dicts (cursor do Mongo, gerador...)
+        formato: 'xlsx' ou 'csv' (CSV aceita uma única aba)
+
+    Returns:
+        int: total de linhas gravadas
+    """
+    if formato == 'csv':
+        if len(abas) != 1:
+            raise ValueError('CSV aceita uma única aba')
+        _titulo, colunas, linhas = abas[0]
+        if isinstance(destino, str):
+            with open(destino, 'wb') as arquivo:
+                return _escrever_csv(arquivo, colunas, linhas)
+        return _escrever_csv(destino, colunas, linhas)
+    return _escrever_xlsx(destino, abas)
+
+
+# ==================== CONSULTAS ====================
+
+def _periodo(params):
+    """Filtro de data a partir de data_inicio/data_fim (YYYY-MM-DD ou ISO)"""
+    filtro = {}
+    for campo, operador in (('data_inicio', '$gte'), ('data_fim', '$lte')):
+        valor = params.get(campo)
+        if not valor:
+            continue
+        try:
+            data = datetime.fromisoformat(str(valor).replace('Z', ''))
+        except ValueError:
+            raise ValueError(f"Data inválida em {campo}: {valor}")
+        if operador == '$lte' and len(str(valor)) == 10:
+            data = data.replace(hour=23, minute=59, second=59)
+        filtro[operador] = data
+    return filtro
+
+
+def _object_id(valor, campo):
+    if not ObjectId.is_valid(valor or ''):
+        raise ValueError(f"{campo} inválido: {valor}")
+    return ObjectId(valor)
+
+
+def _find(colecao, filtro, colunas, ordem):
+    """Cursor projetado só com as colunas exportadas, em lotes"""
+    projecao = {campo.split('.')[0]: 1 for campo, _rotulo, _tipo in colunas}
+    return colecao.find(filtro, projecao).sort(ordem).batch_size(PLANILHA_CURSOR_LOTE)
+
+
+COLUNAS_PRODUTOS = [
+    ('nome', 'Nome do Produto', None),
+    ('marca', 'Marca', None),
+    ('sku', 'SKU', None),
+    ('categoria', 'Categoria', None),
+    ('preco', 'Preço', 'moeda'),
+    ('custo', 'Custo', 'moeda'),
+    ('estoque', 'Estoque', 'numero'),
+    ('estoque_minimo', 'Estoque Mínimo', 'numero'),
+    ('status', 'Status', None),
+]
+
+COLUNAS_CLIENTES = [
+    ('nome', 'Nome', None),
+    ('cpf', 'CPF', None),
+    ('telefone', 'Telefone', None),
+    ('email', 'E-mail', None),
+    ('data_nascimento', 'Data Nascimento', 'data'),
+    ('endereco', 'Endereço', None),
+    ('total_gasto', 'Total Gasto', 'moeda'),
+    ('ultima_visita', 'Última Visita', 'data'),
+]
+
+COLUNAS_MOVIMENTACOES = [
+    ('data', 'Data', 'data_hora'),
+    ('produto_nome', 'Produto', None),
+    ('tipo', 'Tipo', None),
+    ('quantidade', 'Quantidade', 'numero'),
+    ('motivo', 'Motivo', None),
+    ('usuario', 'Usuário', None),
+    ('status', 'Status', None),
+]
+
+COLUNAS_DESPESAS = [
+    ('data', 'Data', 'data'),
+    ('descricao', 'Descrição', None),
+    ('categoria', 'Categoria', None),
+    ('valor', 'Valor', 'moeda'),
+    ('forma_pagamento', 'Forma de Pagamento', None),
+    ('observacoes', 'Observações', None),
+    ('created_by', 'Registrado por', None),
+]
+
+COLUNAS_COMISSOES = [
+    ('data_registro', 'Data', 'data'),
+    ('orcamento_numero', 'Orçamento', None),
+    ('profissional_nome', 'Profissional', None),
+    ('tipo', 'Tipo', None),
+    ('cliente_nome', 'Cliente', None),
+    ('valor_base', 'Valor Base', 'moeda'),
+    ('comissao_perc', 'Comissão %', 'numero'),
+    ('comissao_valor', 'Valor Comissão', 'moeda'),
+    ('status_orcamento', 'Status', None),
+]
+
+
+def _consulta_produtos(db, params, usuario):
+    filtro = {}
+    if params.get('categoria'):
+        filtro['categoria'] = params['categoria']
+    return _find(db.produtos, filtro, COLUNAS_PRODUTOS, [('nome', 1)])
+
+
+def _consulta_clientes(db, params, usuario):
+    return _find(db.clientes, {}, COLUNAS_CLIENTES, [('nome', 1)])
+
+
+def _consulta_movimentacoes(db, params, usuario):
+    filtro = {}
+    periodo = _periodo(params)
+    if periodo:
+        filtro['data'] = periodo
+    if params.get('tipo'):
+        filtro['tipo'] = params['tipo']
+    if params.get('produto_id'):
+        filtro['produto_id'] = _object_id(params['produto_id'], 'produto_id')
+
+    # Nome do produto no próprio servidor (sem um find_one por movimentação)
+    return db.estoque_movimentacoes.aggregate([
+        {'$match': filtro},
+        {'$sort': {'data': -1}},
+        {'$lookup': {
+            'from': 'produtos',
+            'localField': 'produto_id',
+            'foreignField': '_id',
+            'as': 'produto'
+        }},
+        {'$project': {
+            'data': 1, 'tipo': 1, 'quantidade': 1, 'motivo': 1, 'usuario': 1, 'status': 1,
+            'produto_nome': {'$ifNull': [{'$arrayElemAt': ['$produto.nome', 0]}, 'N/A']}
+        }}
+    ], batchSize=PLANILHA_CURSOR_LOTE)
+
+
+def _consulta_despesas(db, params, usuario):
+    filtro = {}
+    periodo = _periodo(params)
+    if periodo:
+        filtro['data'] = periodo
+    if params.get('categoria'):
+        filtro['categoria'] = params['categoria']
+    return _find(db.despesas, filtro, COLUNAS_DESPESAS, [('data', -1)])
+
+
+def _consulta_comissoes(db, params, usuario):
+    filtro = {}
+    periodo = _periodo(params)
+    if periodo:
+        filtro['data_registro'] = periodo
+
+    profissional_id = params.get('profissional_id')
+    # RBAC: Profissional só exporta as próprias comissões
+    if usuario.get('tipo_acesso', 'Profissional') == 'Profissional':
+        prof_doc = db.profissionais.find_one({'user_id': usuario.get('user_id')}, {'_id': 1})
+        profissional_id = str(prof_doc['_id']) if prof_doc else None
+        if profissional_id is None:
+            filtro['_id'] = None  # planilha só com cabeçalho
+    if profissional_id:
+        filtro['profissional_id'] = _object_id(profissional_id, 'profissional_id')
+    return _find(db.comissoes_historico, filtro, COLUNAS_COMISSOES, [('data_registro', -1)])
+
+
+# tipo -> consulta, colunas e perfis autorizados (None = qualquer usuário logado)
+PLANILHAS = {
+    'produtos': {
+        'consulta': _consulta_produtos,
+        'colunas': COLUNAS_PRODUTOS,
+        'titulo': 'Produtos',
+        'nome': 'produtos_bioma',
+        'perfis': None,
+    },
+    'clientes': {
+        'consulta': _consulta_clientes,
+        'colunas': COLUNAS_CLIENTES,
+        'titulo': 'Clientes',
+        'nome': 'clientes_bioma',
+        'perfis': None,
+    },
+    'movimentacoes': {
+        'consulta': _consulta_movimentacoes,
+        'colunas': COLUNAS_MOVIMENTACOES,
+        'titulo': 'Movimentações de Estoque',
+        'nome': 'movimentacoes_estoque_bioma',
+        'perfis': None,
+    },
+    'despesas': {
+        'consulta': _consulta_despesas,
+        'colunas': COLUNAS_DESPESAS,
+        'titulo': 'Despesas',
+        'nome': 'despesas_bioma',
+        'perfis': ('Admin', 'Gestão'),
+    },
+    'comissoes': {
+        'consulta': _consulta_comissoes,
+        'colunas': COLUNAS_COMISSOES,
+        'titulo': 'Comissões',
+        'nome': 'comissoes_bioma',
+        'perfis': None,
+    },
+}
+
+
+def exportar_planilha(db, tipo, params, formato='xlsx', usuario=None):
+    """
+    Gerar a planilha num arquivo temporário (em disco acima de PLANILHA_SPOOL_MAX_BYTES)
+
+    Args:
+        usuario: {'user_id', 'tipo_acesso'} da sessão (filtros por perfil)
+
+    Returns:
+        (arquivo, nome_download, mimetype) - arquivo posicionado no início,
+        pronto para o send_file (fechado por ele ao fim da resposta)
+
+    Raises:
+        ValueError: tipo/formato desconhecido ou parâmetro inválido
+    """
+    config = PLANILHAS.get(tipo)
+    if config is None:
+        raise ValueError(f"Planilha '{tipo}' não suportada")
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato '{formato}' não suportado (use xlsx ou csv)")
+
+    linhas = config['consulta'](db, params or {}, usuario or {})
+    arquivo = tempfile.SpooledTemporaryFile(max_size=PLANILHA_SPOOL_MAX_BYTES)
+    try:
+        total = escrever_planilha(arquivo, [(config['titulo'], config['colunas'], linhas)], formato)
+    except Exception:
+        arquivo.close()
+        raise
+    arquivo.seek(0)
+
+    logger.info(f"📊 Planilha {tipo}.{formato} exportada: {total} linhas")
+    nome = f"{config['nome']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}"
+    return arquivo, nome, FORMATOS[formato]
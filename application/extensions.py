@@ -21,6 +21,9 @@ from functools import wraps
 import hashlib
 import json
 
+from application.instrumentation import registrar_cache
+from application.mongo_monitor import MonitorMongo
+
 # Cache com TTL por chave
 request_cache = {}
 
@@ -34,10 +37,12 @@ class CacheManager:
             data, timestamp, cache_ttl = request_cache[key]
             if time() - timestamp < cache_ttl:
                 logger.debug(f"Cache HIT: {key} (age: {int(time() - timestamp)}s)")
+                registrar_cache(True)
                 return data
             else:
                 del request_cache[key]
                 logger.debug(f"Cache EXPIRED: {key}")
+        registrar_cache(False)
         return None
 
     @staticmethod
@@ -104,7 +109,9 @@ def init_db(app):
             socketTimeoutMS=app.config['MONGO_TIMEOUT'],
             maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
             minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
-            maxIdleTimeMS=30000
+            maxIdleTimeMS=30000,
+            # v7.3: tempo por requisição, log de comandos lentos e detector de N+1
+            event_listeners=[MonitorMongo(app.config['MONGO_LENTA_MS'], app.config['MONGO_N1_LIMITE'])]
         )
 
         # Ping para testar conexão
@@ -163,18 +170,47 @@ def create_strategic_indexes():
         db.orcamentos.create_index([("created_at", -1)], background=True)  # Ordenação
         db.orcamentos.create_index([("status", 1), ("created_at", -1)], background=True)  # Compound
         db.orcamentos.create_index([("cliente_id", 1), ("created_at", -1)], background=True)
+        # Multikey: orçamentos de um profissional (card do profissional, comissões)
+        db.orcamentos.create_index([("servicos.profissional_id", 1), ("created_at", -1)], background=True)
+        db.orcamentos.create_index([("profissionais_vinculados.profissional_id", 1), ("created_at", -1)], background=True)
+
+        # Série mensal de desempenho por profissional
+        db.desempenho_profissionais.create_index([("profissional_id", 1), ("mes", 1)], unique=True, background=True)
 
         # Índices para PRODUTOS/ESTOQUE (busca + estoque baixo) v7.3 OTIMIZADO
         db.produtos.create_index([("status", 1)], background=True)  # CRÍTICO - muito usado
         db.produtos.create_index([("nome", 1)], background=True)
         db.produtos.create_index([("sku", 1)], background=True)
+        db.produtos.create_index([("codigo_barras", 1)], background=True)  # Chave do upsert de importação
         db.produtos.create_index([("estoque", 1)], background=True)  # Para alertas (estoque baixo)
         db.produtos.create_index([("estoque_atual", 1)], background=True)  # Fallback
         db.produtos.create_index([("categoria", 1), ("estoque", 1)], background=True)
+        # Alertas: índices parciais só com os produtos fora do nível normal
+        # (padrões de chave distintos: MongoDB < 7.0 não aceita dois índices que diferem só no filtro)
+        db.produtos.create_index(
+            [("nivel_estoque", 1), ("status", 1)],
+            partialFilterExpression={"nivel_estoque": "critico"},
+            name="nivel_estoque_critico_idx",
+            background=True
+        )
+        db.produtos.create_index(
+            [("status", 1), ("nivel_estoque", 1)],
+            partialFilterExpression={"nivel_estoque": "atencao"},
+            name="nivel_estoque_atencao_idx",
+            background=True
+        )
+        # Previsão de reposição: produtos com consumo, menor cobertura primeiro
+        db.produtos.create_index(
+            [("status", 1), ("dias_de_cobertura", 1)],
+            partialFilterExpression={"dias_de_cobertura": {"$type": "number"}},
+            name="dias_de_cobertura_idx",
+            background=True
+        )
 
         # Índices para SERVICOS v7.3
         db.servicos.create_index([("categoria", 1)], background=True)
         db.servicos.create_index([("nome", 1)], background=True)
+        db.servicos.create_index([("sku", 1)], background=True)  # Chave do upsert de importação
 
         # Índices para PROFISSIONAIS v7.3
         db.profissionais.create_index([("ativo", 1)], background=True)
@@ -183,11 +219,43 @@ def create_strategic_indexes():
         # Índices para MOVIMENTAÇÕES DE ESTOQUE
         db.estoque_movimentacoes.create_index([("tipo", 1), ("created_at", -1)], background=True)
         db.estoque_movimentacoes.create_index([("produto_id", 1), ("created_at", -1)], background=True)
+        db.estoque_movimentacoes.create_index([("status", 1), ("data", 1)], sparse=True, background=True)  # Outbox pendente
+        db.estoque_movimentacoes.create_index([("data", 1)], background=True)  # Delta do ledger
+        db.estoque_snapshots.create_index([("data", 1), ("produto_id", 1)], unique=True, background=True)
 
         # Índices para FINANCEIRO
         db.despesas.create_index([("data_vencimento", -1)], background=True)
         db.despesas.create_index([("status", 1), ("data_vencimento", -1)], background=True)
 
+        # Índices para IMAGENS (deduplicação por hash do original normalizado)
+        # Único: dois uploads simultâneos da mesma foto não criam dois documentos
+        try:
+            if 'hash_1' in db.imagens.index_information():
+                db.imagens.drop_index('hash_1')  # versão anterior, não única
+            db.imagens.create_index([("hash", 1)], unique=True, background=True, name="hash_unique_idx")
+        except Exception as idx_error:
+            # Duplicatas antigas impedem o índice único: mantém o simples
+            logger.warning(f"⚠️ Índice único de hash das imagens não criado: {idx_error}")
+            db.imagens.create_index([("hash", 1)], background=True)
+
+        # Índices para JOBS em background (listagem + expiração automática)
+        db.jobs.create_index([("categoria", 1), ("created_at", -1)], background=True)
+        db.jobs.create_index([("expire_at", 1)], expireAfterSeconds=0, background=True)
+        db.jobs.create_index([("status", 1), ("updated_at", 1)], background=True)  # Recolhimento de órfãos
+        db.jobs.create_index("chave_ativa", unique=True, sparse=True, background=True)  # Um job ativo por chave
+        db.jobs.create_index([("categoria", 1), ("chave", 1), ("created_at", -1)], sparse=True, background=True)  # Exportações idênticas
+
+        # Índices para IMPORTAÇÕES (desfazer remove exatamente os documentos do lote)
+        for colecao in ('produtos', 'servicos', 'clientes', 'profissionais'):
+            db[colecao].create_index([("import_batch_id", 1)], sparse=True, background=True)
+        db.importacoes.create_index([("tipo", 1), ("created_at", -1)], background=True)
+
+        # Índices para BUSCA por prefixo ancorado nos campos-sombra (nome_busca, cpf_busca...)
+        from application.search import CAMPOS_SOMBRA
+        for colecao, campos in CAMPOS_SOMBRA.items():
+            for campo in campos:
+                db[colecao].create_index([(f"{campo}_busca", 1)], background=True)
+
         # Índices para AUDITORIA (temporal)
         db.auditoria.create_index([("timestamp", -1)], background=True)
         db.auditoria.create_index([("usuario_id", 1), ("timestamp", -1)], background=True)
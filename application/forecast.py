@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Previsão de Reposição de Estoque
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Velocidade de consumo de cada produto = média móvel exponencial (EWMA) da
+saída diária registrada em `estoque_movimentacoes`. O cálculo é incremental:
+cada execução dobra na média só os dias desde a anterior, pois
+
+    ewma(t + k) = (1 - α)^k · ewma(t) + Σ α · (1 - α)^(k - 1 - d) · saída(d)
+
+e a soma é feita por uma única agregação sobre todos os produtos (só as
+movimentações novas são lidas). Os resultados ficam no próprio produto:
+consumo_diario, dias_de_cobertura e ponto_de_reposicao.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from application.stock import TIPOS_ENTRADA
+
+logger = logging.getLogger(__name__)
+
+# Meia-vida aproximada da média: α = 2 / (N + 1) com N dias
+PREVISAO_JANELA_DIAS = 30
+PREVISAO_ALFA = 2 / (PREVISAO_JANELA_DIAS + 1)
+
+# Histórico lido na primeira execução (depois, só os dias novos)
+PREVISAO_HISTORICO_INICIAL = timedelta(days=90)
+
+# Ponto de reposição = consumo diário x (prazo de entrega + segurança)
+PRAZO_REPOSICAO_DIAS = 7
+ESTOQUE_SEGURANCA_DIAS = 3
+
+# Abaixo disso o produto é considerado sem consumo (cobertura indefinida)
+CONSUMO_MINIMO = 0.01
+
+# Lote do bulk_write das contribuições
+PREVISAO_LOTE = 1000
+
+# Documento de estado em db.config (último dia incluído na média)
+ESTADO_CHAVE = 'previsao_consumo'
+
+DIA_MS = 86400000
+
+
+def _inicio_do_dia(data):
+    return data.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _expr_saida():
+    """Quantidade consumida pela movimentação (entradas contam 0)"""
+    quantidade = {'$convert': {'input': '$quantidade', 'to': 'double', 'onError': 0, 'onNull': 0}}
+    return {'$cond': [
+        {'$in': [{'$toLower': {'$ifNull': ['$tipo', '']}}, list(TIPOS_ENTRADA)]},
+        0,
+        {'$abs': quantidade}
+    ]}
+
+
+def _expr_decaimento(ate):
+    """(1 - α)^(dias desde consumo_ate): produtos novos (sem consumo_ate) não decaem"""
+    dias = {'$divide': [{'$subtract': [ate, {'$ifNull': ['$consumo_ate', ate]}]}, DIA_MS]}
+    return {'$pow': [1 - PREVISAO_ALFA, dias]}
+
+
+def contribuicoes_consumo(db, inicio, fim):
+    """
+    Parcela de cada produto na EWMA para os dias [inicio, fim)
+
+    Returns:
+        dict {produto_id: Σ α · (1 - α)^(k - 1 - d) · saída(d)}
+    """
+    dias = (fim - inicio).days
+    dia = {'$floor': {'$divide': [{'$subtract': ['$data', inicio]}, DIA_MS]}}
+    peso = {'$multiply': [PREVISAO_ALFA, {'$pow': [1 - PREVISAO_ALFA, {'$subtract': [dias - 1, dia]}]}]}
+    pipeline = [
+        {'$match': {'data': {'$gte': inicio, '$lt': fim}, 'status': {'$ne': 'pendente'}}},
+        {'$group': {'_id': '$produto_id', 'contribuicao': {'$sum': {'$multiply': [peso, _expr_saida()]}}}},
+        {'$match': {'contribuicao': {'$gt': 0}}}
+    ]
+    return {d['_id']: d['contribuicao'] for d in db.estoque_movimentacoes.aggregate(pipeline)}
+
+
+def recalcular_cobertura(db, filtro=None):
+    """
+    Recalcular dias_de_cobertura e ponto_de_reposicao a partir de consumo_diario
+
+    Um update_many com pipeline (o cálculo acontece no servidor).
+    """
+    consumo = {'$ifNull': ['$consumo_diario', 0]}
+    estoque = {'$convert': {'input': '$estoque', 'to': 'double', 'onError': 0, 'onNull': 0}}
+    prazo = {'$add': [{'$ifNull': ['$prazo_reposicao_dias', PRAZO_REPOSICAO_DIAS]}, ESTOQUE_SEGURANCA_DIAS]}
+    result = db.produtos.update_many(filtro or {}, [{'$set': {
+        'dias_de_cobertura': {'$cond': [
+            {'$gte': [consumo, CONSUMO_MINIMO]},
+            {'$round': [{'$divide': [{'$max': [estoque, 0]}, consumo]}, 1]},
+            None
+        ]},
+        'ponto_de_reposicao': {'$ceil': {'$multiply': [consumo, prazo]}},
+    }}])
+    return result.modified_count
+
+
+def atualizar_previsao(db, progresso=None, agora=None):
+    """
+    Dobrar na EWMA os dias completos desde a última execução
+
+    Idempotente: cada produto guarda consumo_ate (o dia até onde a média já
+    inclui as saídas) e só é alterado se ainda não chegou a hoje, então
+    execuções repetidas ou simultâneas (vários workers) não contam em dobro.
+
+    Returns:
+        dict com o resumo da execução
+    """
+    hoje = _inicio_do_dia(agora or datetime.now())
+    estado = db.config.find_one({'key': ESTADO_CHAVE}) or {}
+    inicio = estado.get('processado_ate') or hoje - PREVISAO_HISTORICO_INICIAL
+
+    if inicio >= hoje:
+        return {'dias': 0, 'produtos_com_consumo': 0, 'processado_ate': hoje.isoformat()}
+
+    contribuicoes = contribuicoes_consumo(db, inicio, hoje)
+    if progresso:
+        progresso(etapa='consumo', produtos=len(contribuicoes))
+
+    pendentes = {'consumo_ate': {'$ne': hoje}}
+    decaimento = {'$multiply': [{'$ifNull': ['$consumo_diario', 0]}, _expr_decaimento(hoje)]}
+
+    operacoes = []
+    for produto_id, contribuicao in contribuicoes.items():
+        operacoes.append(UpdateOne(
+            {'_id': produto_id, **pendentes},
+            [{'$set': {'consumo_diario': {'$add': [decaimento, contribuicao]}, 'consumo_ate': hoje}}]
+        ))
+        if len(operacoes) >= PREVISAO_LOTE:
+            db.produtos.bulk_write(operacoes, ordered=False)
+            operacoes = []
+    if operacoes:
+        db.produtos.bulk_write(operacoes, ordered=False)
+
+    # Produtos sem saída no período: só decaem
+    db.produtos.update_many(pendentes, [{'$set': {'consumo_diario': decaimento, 'consumo_ate': hoje}}])
+    recalcular_cobertura(db)
+
+    db.config.update_one(
+        {'key': ESTADO_CHAVE},
+        {'$set': {'processado_ate': hoje, 'updated_at': datetime.now()}},
+        upsert=True
+    )
+
+    resumo = {'dias': (hoje - inicio).days, 'produtos_com_consumo': len(contribuicoes), 'processado_ate': hoje.isoformat()}
+    logger.info(f"📈 Previsão de reposição: {resumo['dias']} dia(s), {resumo['produtos_com_consumo']} produtos com consumo")
+    return resumo
+
+
+def previsao_desatualizada(db, agora=None):
+    """True se ainda há dias completos fora da EWMA"""
+    estado = db.config.find_one({'key': ESTADO_CHAVE}, {'processado_ate': 1}) or {}
+    processado_ate = estado.get('processado_ate')
+    return processado_ate is None or processado_ate < _inicio_do_dia(agora or datetime.now())
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Pipeline de Imagens (fotos de perfil e logos)
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Upload decodificado UMA vez, metadados removidos (EXIF/GPS/ICC) e variantes
+redimensionadas (avatar, card, full) geradas sob demanda e cacheadas.
+Listas referenciam apenas URLs curtas em vez de data URIs de vários MB.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
+
+from bson import Binary, ObjectId
+from flask import Response, request
+from PIL import Image, ImageOps
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Lado máximo (px) de cada variante
+IMAGE_VARIANTS = {
+    'avatar': 96,
+    'card': 320,
+    'full': 1280,
+}
+
+# Original normalizado guardado no banco (base para gerar as variantes)
+MASTER_MAX_SIDE = IMAGE_VARIANTS['full']
+
+# Coleções cujos documentos possuem foto_url/foto
+COLECOES_COM_FOTO = {'profissionais', 'clientes', 'assistentes'}
+
+# Orçamento de memória do cache de variantes (por processo)
+VARIANT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+MIME_TYPES = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+
+class _VariantCache:
+    """Cache LRU de variantes limitado por bytes (thread-safe)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._itens.get(key)
+            if item is not None:
+                self._itens.move_to_end(key)
+            return item
+
+    def set(self, key, item):
+        tamanho = len(item[0])
+        if tamanho > self.max_bytes:
+            return
+        with self._lock:
+            antigo = self._itens.pop(key, None)
+            if antigo is not None:
+                self._bytes -= len(antigo[0])
+            self._itens[key] = item
+            self._bytes += tamanho
+            while self._bytes > self.max_bytes:
+                _, removido = self._itens.popitem(last=False)
+                self._bytes -= len(removido[0])
+
+
+variant_cache = _VariantCache(VARIANT_CACHE_MAX_BYTES)
+
+
+def _tem_alpha(img):
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def _decodificar(raw):
+    """Decodificar bytes em imagem normalizada (orientação aplicada, sem metadados)"""
+    try:
+        img = Image.open(BytesIO(raw))
+        # JPEG: decodificar já em escala reduzida (muito mais rápido para fotos de câmera)
+        img.draft('RGB', (MASTER_MAX_SIDE, MASTER_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ValueError(f'Imagem inválida: {e}')
+
+    img = img.convert('RGBA' if _tem_alpha(img) else 'RGB')
+    img.thumbnail((MASTER_MAX_SIDE, MASTER_MAX_SIDE), Image.LANCZOS)
+    # Descartar EXIF, GPS, ICC e comentários
+    img.info = {}
+    return img
+
+
+def _codificar(img, formato, qualidade=82):
+    """Codificar imagem no formato pedido sem metadados"""
+    buffer = BytesIO()
+    if formato == 'jpeg':
+        if img.mode == 'RGBA':
+            fundo = Image.new('RGB', img.size, (255, 255, 255))
+            fundo.paste(img, mask=img.split()[-1])
+            img = fundo
+        img.save(buffer, 'JPEG', quality=qualidade, optimize=True, progressive=True)
+    elif formato == 'png':
+        img.save(buffer, 'PNG', optimize=True)
+    else:
+        img.save(buffer, 'WEBP', quality=qualidade, method=4)
+    return buffer.getvalue()
+
+
+def preparar_imagem(raw):
+    """
+    Decodificar upload uma única vez e gerar o original normalizado
+
+    Returns:
+        dict com 'master' (WebP), 'hash', 'largura', 'altura' e 'tem_alpha'
+    """
+    img = _decodificar(raw)
+    master = _codificar(img, 'webp', qualidade=90)
+    return {
+        'master': master,
+        'hash': hashlib.sha1(master).hexdigest()[:16],
+        'largura': img.width,
+        'altura': img.height,
+        'tem_alpha': img.mode == 'RGBA',
+    }
+
+
+def salvar_imagem(db, raw, tipo):
+    """
+    Processar upload e salvar na coleção `imagens` (deduplicado por hash)
+
+    Returns:
+        dict com '_id', 'hash', 'largura', 'altura', 'tem_alpha' e 'master'
+    """
+    dados = preparar_imagem(raw)
+    existente = db.imagens.find_one({'hash': dados['hash']}, {'_id': 1})
+    if existente:
+        dados['_id'] = existente['_id']
+        return dados
+
+    documento = {
+        'tipo': tipo,
+        'hash': dados['hash'],
+        'master': Binary(dados['master']),
+        'largura': dados['largura'],
+        'altura': dados['altura'],
+        'tem_alpha': dados['tem_alpha'],
+        'bytes_original': len(raw),
+        'variantes': {},
+        'created_at': datetime.now()
+    }
+    try:
+        dados['_id'] = db.imagens.insert_one(documento).inserted_id
+    except DuplicateKeyError:
+        # Upload simultâneo da mesma imagem venceu a corrida (índice único em hash)
+        dados['_id'] = db.imagens.find_one({'hash': dados['hash']}, {'_id': 1})['_id']
+        return dados
+    logger.info(
+        f"🖼️ Imagem {dados['_id']} salva: {len(raw) // 1024}KB → {len(dados['master']) // 1024}KB "
+        f"({dados['largura']}x{dados['altura']})"
+    )
+    return dados
+
+
+def url_imagem(imagem_id, variante='card', versao=None):
+    """URL curta (e imutável quando versionada) de uma variante"""
+    url = f"/api/imagens/{imagem_id}/{variante}"
+    return f"{url}?v={versao}" if versao else url
+
+
+def campos_foto(imagem):
+    """Campos a gravar no documento dono da foto (profissional, cliente...)"""
+    imagem_id = str(imagem['_id'])
+    url_card = url_imagem(imagem_id, 'card', imagem['hash'])
+    return {
+        'foto_id': imagem_id,
+        'foto_versao': imagem['hash'],
+        'foto': url_card,
+        'foto_url': url_card,
+        'foto_thumb_url': url_imagem(imagem_id, 'avatar', imagem['hash']),
+        'foto_atualizada_em': datetime.now()
+    }
+
+
+def data_uri_para_bytes(data_uri):
+    """Extrair bytes de um data URI legado (None se não for data URI válido)"""
+    if not isinstance(data_uri, str) or not data_uri.startswith('data:') or ',' not in data_uri:
+        return None
+    try:
+        return base64.b64decode(data_uri.split(',', 1)[1])
+    except (binascii.Error, ValueError):
+        return None
+
+
+def marcador_data_uri(campo):
+    """
+    Expressão de projeção que troca data URIs pelo marcador 'data:'
+
+    Permite que listas saibam que existe foto legada sem trafegar os MB do base64.
+    """
+    return {'$cond': [
+        {'$eq': [{'$substrCP': [{'$ifNull': [f'${campo}', '']}, 0, 5]}, 'data:']},
+        'data:',
+        f'${campo}'
+    ]}
+
+
+# Projeção para listas/buscas (requer MongoDB 4.4+ para expressões em find)
+FOTO_PROJECAO_LISTA = {
+    'foto_id': 1,
+    'foto_versao': 1,
+    'foto': marcador_data_uri('foto'),
+    'foto_url': marcador_data_uri('foto_url'),
+}
+
+
+def aplicar_foto(doc, colecao, variante='avatar'):
+    """
+    Reescrever foto/foto_url do documento para a URL da variante pedida (in-place)
+
+    Fotos legadas (data URI) apontam para a rota de migração sob demanda.
+    """
+    if not doc:
+        return doc
+
+    atual = doc.get('foto_url') or doc.get('foto') or ''
+    if doc.get('foto_id'):
+        url = url_imagem(doc['foto_id'], variante, doc.get('foto_versao'))
+    elif isinstance(atual, str) and atual.startswith('data:') and doc.get('_id'):
+        url = f"/api/imagens/legado/{colecao}/{doc['_id']}/{variante}"
+    else:
+        url = atual
+
+    doc['foto'] = url
+    doc['foto_url'] = url
+    return doc
+
+
+def obter_variante(db, imagem_id, variante, aceita_webp):
+    """
+    Obter bytes de uma variante: cache em memória → banco → geração sob demanda
+
+    Returns:
+        (conteudo, mime_type, etag) ou None se a imagem não existir
+    """
+    chave = (str(imagem_id), variante, aceita_webp)
+    item = variant_cache.get(chave)
+    if item is not None:
+        return item
+
+    # Uma ida ao banco: metadados + variante no formato certo; o original só
+    # vem quando a variante ainda não foi gerada
+    if aceita_webp:
+        formato_expr = 'webp'
+        variante_expr = f'$variantes.{variante}_webp'
+    else:
+        formato_expr = {'$cond': ['$tem_alpha', 'png', 'jpeg']}
+        variante_expr = {'$cond': ['$tem_alpha', f'$variantes.{variante}_png', f'$variantes.{variante}_jpeg']}
+    oid = ObjectId(imagem_id)
+    meta = next(db.imagens.aggregate([
+        {'$match': {'_id': oid}},
+        {'$project': {
+            'hash': 1,
+            'formato': formato_expr,
+            'conteudo': variante_expr,
+            'master': {'$cond': [{'$eq': [{'$ifNull': [variante_expr, None]}, None]}, '$master', None]},
+        }}
+    ]), None)
+    if not meta:
+        return None
+
+    formato = meta['formato']
+    etag = f"{meta['hash']}-{variante}-{formato}"
+    conteudo = meta.get('conteudo')
+
+    if conteudo is None:
+        img = Image.open(BytesIO(meta['master']))
+        lado = IMAGE_VARIANTS[variante]
+        if max(img.size) > lado:
+            img.thumbnail((lado, lado), Image.LANCZOS)
+        conteudo = _codificar(img, formato)
+        db.imagens.update_one({'_id': oid}, {'$set': {f"variantes.{variante}_{formato}": Binary(conteudo)}})
+        logger.debug(f"🖼️ Variante {variante}/{formato} gerada para {imagem_id} ({len(conteudo)} bytes)")
+
+    item = (bytes(conteudo), MIME_TYPES[formato], etag)
+    variant_cache.set(chave, item)
+    return item
+
+
+def obter_logo(db, tipo, ttl=300):
+    """
+    Logo atual do tipo ('principal', 'login'...) decodificado em bytes
+
+    Cacheado em memória por tipo (invalidado em upload_logo); o TTL limita a
+    defasagem entre workers do gunicorn.
+
+    Returns:
+        (conteudo, mime_type, etag) ou None se não houver logo configurado
+    """
+    from application.extensions import CacheManager
+
+    cache_key = f"logo:{tipo}"
+    cached = CacheManager.get(cache_key, ttl)
+    if cached is not None:
+        return cached['logo']
+
+    item = None
+    logo = db.uploads.find_one(
+        {'tipo': f'logo_{tipo}'},
+        {'data_uri': 1, 'mime_type': 1},
+        sort=[('data_upload', -1)]
+    )
+    conteudo = data_uri_para_bytes(logo.get('data_uri')) if logo else None
+    if conteudo:
+        mime_type = logo.get('mime_type') or logo['data_uri'][5:].split(';', 1)[0] or 'image/png'
+        item = (conteudo, mime_type, hashlib.sha1(conteudo).hexdigest()[:16])
+
+    CacheManager.set(cache_key, {'logo': item}, ttl)
+    return item
+
+
+def invalidar_logo(tipo=None):
+    """Invalidar cache de logo (de um tipo ou de todos)"""
+    from application.extensions import CacheManager
+    CacheManager.invalidate(f"logo:{tipo}" if tipo else "logo:")
+
+
+def resposta_imagem(conteudo, mime_type, etag, publico=False, imutavel=True, max_age=31536000):
+    """
+    Response com bytes crus e ETag (304 quando o ETag confere)
+
+    URLs versionadas (hash na query) usam cache imutável; as demais são
+    revalidadas a cada uso, o que custa apenas um 304.
+    """
+    response = Response(conteudo, mimetype=mime_type)
+    response.set_etag(etag)
+    escopo = 'public' if publico else 'private'
+    if imutavel:
+        response.headers['Cache-Control'] = f"{escopo}, max-age={max_age}, immutable"
+    else:
+        response.headers['Cache-Control'] = f"{escopo}, no-cache"
+    response.headers['Vary'] = 'Accept'
+    return response.make_conditional(request)
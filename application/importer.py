@@ -0,0 +1,935 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Motor de Importação de Planilhas (CSV/XLSX)
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Linhas lidas em streaming direto do upload (XLSX em modo read_only), gravadas
+em lotes com insert_many(ordered=False) e contabilizadas linha a linha.
+Um único log de resumo por importação (nada de log por linha).
+"""
+
+import codecs
+import csv
+import hashlib
+import io
+import json
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from time import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from openpyxl import load_workbook
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from application.stock import classificar_nivel
+
+logger = logging.getLogger(__name__)
+
+# Tamanho padrão do lote de escrita (sobrescrito por IMPORT_BATCH_SIZE no config)
+IMPORT_BATCH_SIZE = 500
+
+# Quantidade máxima de erros detalhados devolvidos no relatório
+MAX_ERROS_DETALHADOS = 200
+
+# Bytes inspecionados para detectar o encoding do CSV
+CSV_SNIFF_BYTES = 64 * 1024
+
+# Documentos removidos por delete_many ao desfazer uma importação
+UNDO_CHUNK_SIZE = 1000
+
+# Coleções que recebem importações (e portanto import_batch_id)
+COLECOES_IMPORTAVEIS = ('produtos', 'servicos', 'clientes', 'profissionais')
+
+# Modos de importação: inserir sempre ou atualizar pela chave natural (upsert)
+MODOS_IMPORTACAO = ('inserir', 'atualizar')
+
+# Chave natural por tipo (primeiro campo preenchido identifica o documento)
+CHAVES_NATURAIS = {
+    'produtos': ('sku', 'codigo_barras'),
+    'servicos': ('sku',),
+    'clientes': ('cpf',),
+}
+
+# Campos gravados apenas na criação (estoque é mantido pelas movimentações,
+# ativo/estoque_minimo são ajustados manualmente no sistema)
+CAMPOS_SOMENTE_INSERCAO = ('created_at', 'import_batch_id', 'ativo', 'estoque', 'estoque_minimo', 'nivel_estoque')
+
+# Chave interna com os campos que o parser preencheu por padrão (coluna ausente
+# ou vazia): no modo 'atualizar' eles vão para $setOnInsert e não sobrescrevem
+# o que já está no documento (planilha só com sku/nome/preço não apaga a marca)
+CAMPO_PADROES = '_padroes'
+
+# Valores que não identificam um documento
+SKU_GERADO_RE = re.compile(r'^PROD-\d+$')
+CODIGO_BARRAS_PADRAO = 'Sem código de barras no momento'
+
+# Aliases de tipo enviados pelo frontend
+TIPO_ALIASES = {
+    'estoque': 'produtos',
+}
+
+
+class LinhaInvalida(Exception):
+    """Linha rejeitada pela validação (motivo vai para o relatório)"""
+
+
+def remover_acentos(texto):
+    """Remove acentos (NFD = Canonical Decomposition, descarta as marcas)"""
+    texto = unicodedata.normalize('NFD', texto)
+    return ''.join(char for char in texto if unicodedata.category(char) != 'Mn')
+
+
+@lru_cache(maxsize=4096)
+def normalizar_coluna(texto):
+    """
+    Normalização extrema de nomes de colunas para máxima compatibilidade
+
+    Memoizada: cabeçalhos se repetem em todas as linhas de uma planilha.
+    """
+    if not texto:
+        return ''
+
+    # Converter para string
+    texto = str(texto)
+
+    # Remover acentos
+    texto = remover_acentos(texto)
+
+    # Converter para lowercase
+    texto = texto.lower()
+
+    # Remover caracteres especiais, manter apenas alfanuméricos e underscores
+    texto = re.sub(r'[^a-z0-9_]', '', texto)
+
+    # Remover espaços/underscores duplicados
+    texto = re.sub(r'_+', '_', texto)
+
+    # Remover underscores no início/fim
+    texto = texto.strip('_')
+
+    return texto
+
+
+def parse_preco(valor):
+    """Converter 'R$ 1.234,50' / '35,00' / 35 em float (ValueError se inválido)"""
+    val = str(valor).replace('R$', '').replace('$', '').strip()
+    if ',' in val:
+        val = val.replace(',', '.')
+    return float(val)
+
+
+# ==================== LEITURA EM STREAMING ====================
+
+def _detectar_encoding(stream):
+    """UTF-8 (com ou sem BOM) quando o início do arquivo é UTF-8 válido; senão latin-1"""
+    inicio = stream.read(CSV_SNIFF_BYTES)
+    stream.seek(0)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(inicio, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def _ler_csv(stream):
+    encoding = _detectar_encoding(stream)
+    texto = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    try:
+        for row in csv.DictReader(texto):
+            yield row
+    finally:
+        texto.detach()
+
+
+def _ler_xlsx(stream):
+    wb = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        linhas = wb.active.iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+        headers = [str(c).strip().lower() if c else '' for c in cabecalho]
+        for row in linhas:
+            row_dict = {}
+            for i, val in enumerate(row[:len(headers)]):
+                if val is None:
+                    continue
+                if isinstance(val, str):
+                    val = val.strip()
+                row_dict[headers[i]] = val
+            yield row_dict
+    finally:
+        wb.close()
+
+
+def ler_linhas(stream, ext):
+    """Gerador de linhas (dict cabeçalho → valor) lidas sob demanda do arquivo"""
+    if ext == 'csv':
+        return _ler_csv(stream)
+    return _ler_xlsx(stream)
+
+
+# ==================== PARSERS POR TIPO ====================
+
+def _primeiro(r, colunas):
+    for col in colunas:
+        if col in r and r[col]:
+            return r[col]
+    return None
+
+
+def parse_produto(row, contexto):
+    """Linha de planilha → documento de produto"""
+    r = {k.lower().strip(): v for k, v in row.items() if k and v is not None}
+    if not r or all(not v for v in r.values()):
+        return None
+
+    nome = _primeiro(r, ['nome', 'produto', 'name'])
+    nome = str(nome).strip() if nome else None
+    if not nome or len(nome) < 2:
+        raise LinhaInvalida('nome do produto inválido ou ausente')
+
+    marca = _primeiro(r, ['marca', 'brand'])
+
+    preco = 0.0
+    for col in ['preco', 'preço', 'price', 'valor']:
+        if col in r and r[col]:
+            try:
+                preco = parse_preco(r[col])
+                break
+            except ValueError:
+                continue
+    if preco <= 0:
+        raise LinhaInvalida(f"'{nome}' sem preço válido")
+
+    custo = None
+    for col in ['custo', 'cost']:
+        if col in r and r[col]:
+            try:
+                custo = parse_preco(r[col])
+                break
+            except ValueError:
+                continue
+
+    estoque = 0
+    for col in ['estoque', 'quantidade', 'qtd']:
+        if col in r and r[col]:
+            try:
+                estoque = int(float(r[col]))
+                break
+            except (ValueError, TypeError):
+                continue
+
+    categoria = _primeiro(r, ['categoria', 'category'])
+    sku = _primeiro(r, ['sku', 'codigo'])
+    codigo_barras = _primeiro(r, [
+        'codigo_barras', 'código_barras', 'codigo barras', 'barcode', 'codigo de barras', 'código de barras'
+    ])
+
+    contexto['validas'] = contexto.get('validas', 0) + 1
+    padroes = [campo for campo, valor in (
+        ('marca', marca), ('sku', sku), ('custo', custo), ('categoria', categoria), ('codigo_barras', codigo_barras)
+    ) if valor is None or valor == '']
+    return [{
+        CAMPO_PADROES: padroes,
+        'nome': nome,
+        'marca': str(marca).strip() if marca else '',
+        'sku': str(sku).strip() if sku else f"PROD-{contexto['validas']}",
+        'preco': preco,
+        'custo': custo or 0.0,
+        'estoque': estoque,
+        'estoque_minimo': 5,
+        'nivel_estoque': classificar_nivel(estoque, 5),
+        'categoria': str(categoria).strip().title() if categoria else 'Produto',
+        'codigo_barras': str(codigo_barras).strip() if codigo_barras else CODIGO_BARRAS_PADRAO,
+        'ativo': True,
+        'created_at': datetime.now()
+    }]
+
+
+# Colunas aceitas por campo do serviço (prioridade na ordem), já normalizadas
+SERVICO_COLUNAS = {
+    campo: tuple(dict.fromkeys(normalizar_coluna(c) for c in colunas))
+    for campo, colunas in {
+        'nome': ['nome', 'servico', 'serviço', 'name', 'service'],
+        'categoria': ['categoria', 'category', 'tipo', 'type'],
+        'duracao': ['duracao', 'duração', 'tempo', 'duration', 'minutos', 'minutes', 'min'],
+        'preco': ['preco', 'preço', 'price', 'valor', 'value', 'cost'],
+    }.items()
+}
+
+# Preços por tamanho - DETECÇÃO MELHORADA v7.2
+# IMPORTANTE: Ordem importa! Mais específicos primeiro (extra_longo ANTES de longo)
+TAMANHOS_PATTERNS = OrderedDict(
+    (tam, tuple(normalizar_coluna(p) for p in patterns))
+    for tam, patterns in [
+        ('extra_longo', ['extralongo', 'extra_longo', 'extralong', 'extra_long', 'extralarge', 'extra_large', 'muitolongo']),
+        ('kids', ['kids', 'crianca', 'infantil', 'child', 'kid', 'bebe']),
+        ('masculino', ['masculino', 'male', 'homem', 'masc', 'barba', 'beard']),
+        ('curto', ['curto', 'short', 'pequeno', 'mini', 'small']),
+        ('medio', ['medio', 'medium', 'media', 'normal']),
+        ('longo', ['longo', 'long', 'grande', 'large', 'big']),
+    ]
+)
+
+# Letras únicas para tamanhos (P, M, G, etc) - busca EXATA
+TAMANHOS_LETRAS = {
+    'curto': ['p', 's'],
+    'medio': ['m'],
+    'longo': ['g', 'l'],
+    'extra_longo': ['gg', 'xl', 'xxl']
+}
+
+TAMANHOS_LABELS = {
+    'kids': 'Kids',
+    'masculino': 'Masculino',
+    'curto': 'Curto',
+    'medio': 'Médio',
+    'longo': 'Longo',
+    'extra_longo': 'Extra Longo',
+    'unico': 'Único'
+}
+
+
+def detectar_tamanho(coluna_normalizada):
+    """
+    Tamanho (curto, medio, kids...) representado por uma coluna já normalizada
+
+    Returns:
+        (tamanho, metodo) ou (None, None)
+    """
+    # 1. Verificar se a coluna é EXATAMENTE uma letra (p, m, g, etc)
+    if len(coluna_normalizada) <= 3:
+        for tam, letras in TAMANHOS_LETRAS.items():
+            if coluna_normalizada in letras:
+                return tam, 'letra exata'
+
+    # 2. PADRÃO TEXTUAL (ANTES de "termina com" para evitar "kids" -> "curto")
+    for tam, patterns in TAMANHOS_PATTERNS.items():
+        for pattern in patterns:
+            if pattern in coluna_normalizada:
+                return tam, 'padrao textual'
+
+    # 3. TERMINA COM (ÚLTIMA PRIORIDADE para evitar falsos positivos)
+    if len(coluna_normalizada) > 1:
+        # GG/XL antes da última letra (senão "preco_gg" cairia em longo)
+        if coluna_normalizada[-2:] in ['gg', 'xl']:
+            return 'extra_longo', 'termina com'
+
+        ultima_letra = coluna_normalizada[-1]
+        if ultima_letra in ['p', 's']:
+            return 'curto', 'termina com'
+        if ultima_letra == 'm':
+            return 'medio', 'termina com'
+        if ultima_letra in ['g', 'l']:
+            return 'longo', 'termina com'
+
+    return None, None
+
+
+class MapeamentoColunas:
+    """
+    Resolução cabeçalho → (coluna normalizada, tamanho) feita uma vez por arquivo
+
+    Cada cabeçalho distinto é analisado na primeira vez que aparece; as linhas
+    seguintes só fazem consultas em dict. A resolução é por cabeçalho (e não
+    por conjunto de chaves) porque linhas de XLSX omitem células vazias.
+    """
+
+    def __init__(self):
+        self.colunas = {}
+
+    def resolver(self, cabecalho):
+        resolvido = self.colunas.get(cabecalho)
+        if resolvido is None:
+            normalizada = normalizar_coluna(cabecalho)
+            resolvido = (normalizada, detectar_tamanho(normalizada)[0])
+            self.colunas[cabecalho] = resolvido
+        return resolvido
+
+    def aplicar(self, row):
+        """
+        Linha → (r, tamanhos): valores por coluna normalizada e colunas de preço
+
+        tamanhos preserva a ordem das colunas (define a ordem dos documentos).
+        """
+        r = {}
+        tamanhos = {}
+        for k, v in row.items():
+            if not k or v is None:
+                continue
+            normalizada, tamanho = self.resolver(k)
+            r[normalizada] = v
+            if tamanho:
+                tamanhos[normalizada] = tamanho
+        return r, tamanhos
+
+
+def parse_servico(row, contexto):
+    """Linha de planilha → um documento de serviço por tamanho com preço"""
+    mapeamento = contexto.get('mapeamento')
+    if mapeamento is None:
+        mapeamento = contexto['mapeamento'] = MapeamentoColunas()
+
+    # NORMALIZAÇÃO EXTREMA: remover acentos, caracteres especiais, etc
+    r, colunas_tamanho = mapeamento.aplicar(row)
+    if not r or all(not v for v in r.values()):
+        return None
+
+    # Nome do serviço - NORMALIZADO
+    nome = _primeiro(r, SERVICO_COLUNAS['nome'])
+    nome = str(nome).strip() if nome else None
+
+    if not nome or len(nome) < 2:
+        raise LinhaInvalida(f"nome do serviço inválido ou ausente (colunas: {list(r.keys())})")
+
+    # Categoria - NORMALIZADO
+    categoria = _primeiro(r, SERVICO_COLUNAS['categoria'])
+    categoria = str(categoria).strip().title() if categoria else None
+
+    # Duração (em minutos) - NORMALIZADO
+    duracao = None
+    for col in SERVICO_COLUNAS['duracao']:
+        if col in r and r[col]:
+            try:
+                duracao = int(float(r[col]))
+                break
+            except (ValueError, TypeError):
+                continue
+    padroes = [campo for campo, valor in (('categoria', categoria), ('duracao', duracao)) if valor is None]
+    if duracao is None:
+        duracao = 60  # Padrão: 60 minutos
+    categoria = categoria or 'Serviço'
+
+    tamanhos_precos = {}
+
+    for coluna_normalizada, tamanho_detectado in colunas_tamanho.items():
+        valor = r[coluna_normalizada]
+        if not valor:
+            continue
+        try:
+            preco = parse_preco(valor)
+        except ValueError:
+            continue
+        # Permitir sobrescrever se encontrar preço maior
+        if preco > 0 and (tamanho_detectado not in tamanhos_precos or preco > tamanhos_precos[tamanho_detectado]):
+            tamanhos_precos[tamanho_detectado] = preco
+
+    # Se não há nenhum preço válido, tentar preço único
+    if not tamanhos_precos:
+        preco_unico = 0.0
+        for col in SERVICO_COLUNAS['preco']:
+            if col in r and r[col]:
+                try:
+                    preco_unico = parse_preco(r[col])
+                    break
+                except ValueError:
+                    continue
+
+        if preco_unico <= 0:
+            raise LinhaInvalida(f"'{nome}' sem preços válidos (colunas: {list(r.keys())})")
+
+        # v7.3.3: Serviço com preço único = criar com tamanho "Único"
+        tamanhos_precos = {'unico': preco_unico}
+
+    documentos = []
+    for tamanho_key, preco in tamanhos_precos.items():
+        tamanho_label = TAMANHOS_LABELS.get(tamanho_key, tamanho_key.title())
+        sku_sufixo = 'UNICO' if tamanho_key == 'unico' else tamanho_label.upper().replace(' ', '-')
+        documentos.append({
+            CAMPO_PADROES: padroes,
+            'nome': nome,
+            'sku': f"{nome.upper().replace(' ', '-')}-{sku_sufixo}",
+            'tamanho': tamanho_label,
+            'preco': preco,
+            'categoria': categoria,
+            'duracao': duracao,
+            'ativo': True,
+            'created_at': datetime.now()
+        })
+    return documentos
+
+
+def parse_cliente(row, contexto):
+    """Linha de planilha → documento de cliente (CPF obrigatório, índice único)"""
+    r = {k.lower().strip(): v for k, v in row.items() if k and v is not None}
+    if not r or all(not v for v in r.values()):
+        return None
+
+    nome = _primeiro(r, ['nome', 'cliente', 'name'])
+    nome = str(nome).strip() if nome else None
+    if not nome or len(nome) < 2:
+        raise LinhaInvalida('nome do cliente inválido ou ausente')
+
+    cpf = _primeiro(r, ['cpf', 'documento'])
+    if not cpf:
+        raise LinhaInvalida(f"'{nome}' sem CPF")
+
+    def texto(colunas):
+        valor = _primeiro(r, colunas)
+        return str(valor).strip() if valor else ''
+
+    doc = {
+        'nome': nome,
+        'cpf': str(cpf).strip(),
+        'email': texto(['email', 'e-mail']),
+        'telefone': texto(['telefone', 'celular', 'whatsapp']),
+        'genero': texto(['genero', 'gênero', 'sexo']),
+        'data_nascimento': texto(['data_nascimento', 'nascimento']),
+        'endereco': texto(['endereco', 'endereço']),
+        'created_at': datetime.now()
+    }
+    doc[CAMPO_PADROES] = [campo for campo, valor in doc.items() if valor == '']
+    return [doc]
+
+
+PARSERS = {
+    'produtos': parse_produto,
+    'servicos': parse_servico,
+    'clientes': parse_cliente,
+}
+
+
+def chave_natural(tipo, doc):
+    """
+    Filtro que identifica o documento pela chave natural do tipo
+
+    Returns:
+        dict {campo: valor} ou None quando a linha não tem chave utilizável
+        (SKU gerado automaticamente e código de barras padrão não contam)
+    """
+    for campo in CHAVES_NATURAIS.get(tipo, ()):
+        valor = doc.get(campo)
+        if not valor:
+            continue
+        if campo == 'sku' and tipo == 'produtos' and SKU_GERADO_RE.match(str(valor)):
+            continue
+        if campo == 'codigo_barras' and valor == CODIGO_BARRAS_PADRAO:
+            continue
+        return {campo: valor}
+    return None
+
+
+def hash_conteudo(campos):
+    """Hash estável do conteúdo importado (detecta linhas sem alteração)"""
+    serializado = json.dumps(campos, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(serializado.encode('utf-8')).hexdigest()[:16]
+
+
+# ==================== ESCRITA EM LOTES ====================
+
+class ImportReport:
+    """Contabilidade da importação (linhas, documentos, erros e vazão)"""
+
+    def __init__(self, tipo, lote_id=None):
+        self.tipo = tipo
+        self.lote_id = lote_id
+        self.linhas = 0
+        self.sucesso = 0
+        self.erro = 0
+        self.ignoradas = 0
+        self.documentos = 0
+        self.inseridos = 0
+        self.atualizados = 0
+        self.inalterados = 0
+        self.erros = []
+        self.inicio = time()
+
+    def registrar_erro(self, linha, motivo):
+        self.erro += 1
+        if len(self.erros) < MAX_ERROS_DETALHADOS:
+            self.erros.append(f"Linha {linha}: {motivo}")
+
+    @property
+    def duracao(self):
+        return time() - self.inicio
+
+    @property
+    def linhas_por_segundo(self):
+        return round(self.linhas / self.duracao, 1) if self.duracao > 0 else 0.0
+
+    def progresso(self):
+        """Resumo compacto para publicação de progresso"""
+        return {
+            'import_batch_id': str(self.lote_id) if self.lote_id else None,
+            'linhas': self.linhas,
+            'sucesso': self.sucesso,
+            'erro': self.erro,
+            'documentos': self.documentos,
+            'inalterados': self.inalterados,
+            'linhas_por_segundo': self.linhas_por_segundo
+        }
+
+    def to_dict(self):
+        return {
+            'tipo': self.tipo,
+            'import_batch_id': str(self.lote_id) if self.lote_id else None,
+            'linhas': self.linhas,
+            'count_success': self.sucesso,
+            'count_error': self.erro,
+            'ignoradas': self.ignoradas,
+            'documentos': self.documentos,
+            'inseridos': self.inseridos,
+            'atualizados': self.atualizados,
+            'inalterados': self.inalterados,
+            'errors': self.erros,
+            'importados': self.sucesso,
+            'erros': self.erro,
+            'duracao_s': round(self.duracao, 2),
+            'linhas_por_segundo': self.linhas_por_segundo
+        }
+
+
+class BulkInserter:
+    """
+    Acumula documentos e grava em lotes com insert_many(ordered=False)
+
+    carimbo: campos aplicados a todos os documentos (ex.: import_batch_id)
+    """
+
+    def __init__(self, collection, report, batch_size=IMPORT_BATCH_SIZE, ao_gravar=None, carimbo=None):
+        self.collection = collection
+        self.report = report
+        self.batch_size = max(1, int(batch_size))
+        self.ao_gravar = ao_gravar
+        self.carimbo = carimbo or {}
+        self._docs = []
+        self._linhas = []
+
+    def add(self, linha, documentos):
+        for doc in documentos:
+            # Inserção grava o documento inteiro, padrões inclusive
+            doc.pop(CAMPO_PADROES, None)
+            doc.update(self.carimbo)
+        # Documentos de uma mesma linha sempre caem no mesmo lote
+        self._docs.extend(documentos)
+        self._linhas.extend([linha] * len(documentos))
+        if len(self._docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._docs:
+            return
+
+        falhas = {}
+        try:
+            result = self.collection.insert_many(self._docs, ordered=False)
+            inseridos = len(result.inserted_ids)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            for err in write_errors:
+                falhas.setdefault(self._linhas[err['index']], err.get('errmsg', 'erro de escrita'))
+            inseridos = e.details.get('nInserted', len(self._docs) - len(write_errors))
+
+        for linha in dict.fromkeys(self._linhas):
+            if linha in falhas:
+                self.report.registrar_erro(linha, falhas[linha])
+            else:
+                self.report.sucesso += 1
+
+        self.report.documentos += inseridos
+        self.report.inseridos += inseridos
+        self._docs = []
+        self._linhas = []
+
+        if self.ao_gravar is not None:
+            self.ao_gravar(self.report)
+
+
+class BulkUpserter(BulkInserter):
+    """
+    Modo 'atualizar': upsert em lote pela chave natural (SKU, código de barras, CPF)
+
+    Os hashes de conteúdo já gravados são buscados com UMA consulta $in por
+    lote; só vão para o bulk_write as linhas novas ou alteradas. Campos de
+    CAMPOS_SOMENTE_INSERCAO (inclusive import_batch_id) usam $setOnInsert, então
+    desfazer a importação remove apenas os documentos que ela criou. Campos que
+    o parser preencheu por padrão (CAMPO_PADROES) também: $set leva só o que
+    a planilha trouxe.
+    """
+
+    def __init__(self, collection, report, tipo, batch_size=IMPORT_BATCH_SIZE, ao_gravar=None, carimbo=None):
+        super().__init__(collection, report, batch_size, ao_gravar, carimbo)
+        self.tipo = tipo
+        self._pendentes = {}
+
+    def add(self, linha, documentos):
+        chaves = [chave_natural(self.tipo, doc) for doc in documentos]
+        if any(chave is None for chave in chaves):
+            campos = '/'.join(CHAVES_NATURAIS.get(self.tipo, ()))
+            self.report.registrar_erro(linha, f"sem chave para atualizar ({campos})")
+            return
+
+        if self.carimbo:
+            for doc in documentos:
+                doc.update(self.carimbo)
+        # Mesma chave repetida na planilha: prevalece a última linha
+        for chave, doc in zip(chaves, documentos):
+            self._pendentes[next(iter(chave.items()))] = (linha, doc)
+        self._linhas.append(linha)
+        if len(self._pendentes) >= self.batch_size:
+            self.flush()
+
+    def _hashes_existentes(self):
+        por_campo = {}
+        for campo, valor in self._pendentes:
+            por_campo.setdefault(campo, []).append(valor)
+
+        filtro = {'$or': [{campo: {'$in': valores}} for campo, valores in por_campo.items()]}
+        projecao = {campo: 1 for campo in por_campo}
+        projecao['import_hash'] = 1
+
+        existentes = {}
+        for doc in self.collection.find(filtro, projecao):
+            for campo in por_campo:
+                if doc.get(campo) is not None:
+                    existentes.setdefault((campo, doc[campo]), doc.get('import_hash'))
+        return existentes
+
+    def flush(self):
+        if not self._pendentes:
+            return
+
+        existentes = self._hashes_existentes()
+        operacoes = []
+        linhas_operacoes = []
+        agora = datetime.now()
+
+        for (campo, valor), (linha, doc) in self._pendentes.items():
+            padroes = doc.pop(CAMPO_PADROES, ())
+            somente_insercao = {k: doc.pop(k) for k in CAMPOS_SOMENTE_INSERCAO if k in doc}
+            # Padrão do parser só na criação, junto com o campo-sombra de busca dele
+            for padrao in padroes:
+                for chave in (padrao, f'{padrao}_busca'):
+                    if chave in doc:
+                        somente_insercao[chave] = doc.pop(chave)
+            if 'busca_versao' in doc and any(f'{padrao}_busca' in somente_insercao for padrao in padroes):
+                # Documento legado pode não ter o campo-sombra que ficou de fora
+                somente_insercao['busca_versao'] = doc.pop('busca_versao')
+            conteudo_hash = hash_conteudo(doc)
+            if existentes.get((campo, valor)) == conteudo_hash:
+                self.report.inalterados += 1
+                continue
+
+            operacoes.append(UpdateOne(
+                {campo: valor},
+                {
+                    '$set': {**doc, 'import_hash': conteudo_hash, 'updated_at': agora},
+                    '$setOnInsert': somente_insercao
+                },
+                upsert=True
+            ))
+            linhas_operacoes.append(linha)
+
+        falhas = {}
+        inseridos = atualizados = 0
+        if operacoes:
+            try:
+                result = self.collection.bulk_write(operacoes, ordered=False)
+                inseridos, atualizados = result.upserted_count, result.modified_count
+            except BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    falhas.setdefault(linhas_operacoes[err['index']], err.get('errmsg', 'erro de escrita'))
+                inseridos = e.details.get('nUpserted', 0)
+                atualizados = e.details.get('nModified', 0)
+
+        for linha in dict.fromkeys(self._linhas):
+            if linha in falhas:
+                self.report.registrar_erro(linha, falhas[linha])
+            else:
+                self.report.sucesso += 1
+
+        self.report.inseridos += inseridos
+        self.report.atualizados += atualizados
+        self.report.documentos += inseridos + atualizados
+        self._pendentes = {}
+        self._linhas = []
+
+        if self.ao_gravar is not None:
+            self.ao_gravar(self.report)
+
+
+def registrar_lote(db, tipo, usuario_id=None, arquivo=None, modo='inserir'):
+    """
+    Abrir o registro de uma importação na coleção `importacoes`
+
+    Returns:
+        ObjectId do lote (gravado como import_batch_id em cada documento)
+    """
+    agora = datetime.now()
+    return db.importacoes.insert_one({
+        'tipo': tipo,
+        'modo': modo,
+        'arquivo': arquivo,
+        'usuario_id': usuario_id,
+        'status': 'em_andamento',
+        'created_at': agora,
+        'updated_at': agora
+    }).inserted_id
+
+
+def finalizar_lote(db, report, status='concluida', erro=None):
+    """Gravar totais e status final no registro do lote"""
+    campos = {
+        'status': status,
+        'linhas': report.linhas,
+        'sucesso': report.sucesso,
+        'erro': report.erro,
+        'ignoradas': report.ignoradas,
+        'documentos': report.documentos,
+        'inseridos': report.inseridos,
+        'atualizados': report.atualizados,
+        'inalterados': report.inalterados,
+        'duracao_s': round(report.duracao, 2),
+        'finished_at': datetime.now(),
+        'updated_at': datetime.now()
+    }
+    if erro:
+        campos['mensagem_erro'] = erro
+    db.importacoes.update_one({'_id': report.lote_id}, {'$set': campos})
+
+
+def abandonar_lote(db, lote_id, motivo):
+    """Lote de uma importação interrompida (worker reciclado) vira 'erro' e pode ser desfeito"""
+    try:
+        lote_id = ObjectId(str(lote_id))
+    except InvalidId:
+        return False
+    agora = datetime.now()
+    return db.importacoes.update_one(
+        {'_id': lote_id, 'status': 'em_andamento'},
+        {'$set': {'status': 'erro', 'mensagem_erro': motivo, 'finished_at': agora, 'updated_at': agora}}
+    ).modified_count > 0
+
+
+def obter_lote(db, lote_id=None, tipo=None):
+    """
+    Registro de um lote pelo id ou, sem id, o último lote desfazível do tipo
+
+    Returns:
+        documento do lote ou None
+    """
+    if lote_id:
+        try:
+            return db.importacoes.find_one({'_id': ObjectId(str(lote_id))})
+        except InvalidId:
+            return None
+    if tipo:
+        return db.importacoes.find_one(
+            {'tipo': TIPO_ALIASES.get(tipo, tipo), 'status': {'$in': ['concluida', 'erro']}},
+            sort=[('created_at', -1)]
+        )
+    return None
+
+
+def desfazer_lote(db, lote, chunk_size=UNDO_CHUNK_SIZE):
+    """
+    Remover exatamente os documentos do lote (consulta indexada por import_batch_id)
+
+    A remoção é feita em blocos de chunk_size para não segurar locks nem
+    estourar o tempo de uma única operação em importações grandes.
+
+    Returns:
+        quantidade de documentos removidos
+    """
+    collection = db[lote['tipo']]
+    filtro = {'import_batch_id': lote['_id']}
+    db.importacoes.update_one({'_id': lote['_id']}, {'$set': {'status': 'desfazendo', 'updated_at': datetime.now()}})
+
+    removidos = 0
+    while True:
+        ids = [doc['_id'] for doc in collection.find(filtro, {'_id': 1}).limit(chunk_size)]
+        if not ids:
+            break
+        removidos += collection.delete_many({'_id': {'$in': ids}, **filtro}).deleted_count
+
+    agora = datetime.now()
+    db.importacoes.update_one({'_id': lote['_id']}, {'$set': {
+        'status': 'desfeita',
+        'documentos_removidos': removidos,
+        'desfeita_em': agora,
+        'updated_at': agora
+    }})
+    logger.info(f"↩️ Importação {lote['_id']} ({lote['tipo']}) desfeita: {removidos} documentos removidos")
+    return removidos
+
+
+def importar_linhas(db, linhas, tipo, batch_size=IMPORT_BATCH_SIZE, progresso=None,
+                    usuario_id=None, arquivo=None, modo='inserir'):
+    """
+    Importar linhas (iterável) para a coleção do tipo
+
+    Cada importação é registrada em `importacoes` e todos os documentos
+    criados recebem o import_batch_id correspondente (usado para desfazer).
+    modo='atualizar' faz upsert pela chave natural (ver BulkUpserter): reimportar
+    a mesma planilha não duplica nada e só grava as linhas alteradas.
+    progresso(report), quando informado, é chamado após cada lote gravado.
+
+    Returns:
+        ImportReport com totais e erros por linha (numeração da planilha,
+        cabeçalho = linha 1)
+    """
+    tipo = TIPO_ALIASES.get(tipo, tipo)
+    parser = PARSERS.get(tipo)
+    if parser is None:
+        raise ValueError(f"Importação de '{tipo}' não suportada")
+    if modo not in MODOS_IMPORTACAO:
+        raise ValueError(f"Modo de importação inválido: {modo}")
+    if modo == 'atualizar' and tipo not in CHAVES_NATURAIS:
+        raise ValueError(f"Importação de '{tipo}' não suporta atualização")
+
+    # Import tardio: search depende de remover_acentos deste módulo
+    from application.search import campos_busca
+
+    report = ImportReport(tipo, registrar_lote(db, tipo, usuario_id, arquivo, modo))
+    carimbo = {'import_batch_id': report.lote_id}
+    if progresso is not None:
+        # Job passa a apontar para o lote antes da primeira gravação (recolhimento de órfãos)
+        progresso(report)
+    if modo == 'atualizar':
+        writer = BulkUpserter(db[tipo], report, tipo, batch_size, ao_gravar=progresso, carimbo=carimbo)
+    else:
+        writer = BulkInserter(db[tipo], report, batch_size, ao_gravar=progresso, carimbo=carimbo)
+    contexto = {}
+
+    try:
+        for linha, row in enumerate(linhas, 2):
+            report.linhas += 1
+            try:
+                documentos = parser(row, contexto)
+            except LinhaInvalida as e:
+                report.registrar_erro(linha, str(e))
+                continue
+            except Exception as e:
+                report.registrar_erro(linha, f"erro inesperado: {e}")
+                continue
+
+            if not documentos:
+                report.ignoradas += 1
+                continue
+            for doc in documentos:
+                doc.update(campos_busca(tipo, doc))
+            writer.add(linha, documentos)
+
+        writer.flush()
+    except Exception as e:
+        # Documentos já gravados continuam vinculados ao lote (podem ser desfeitos)
+        finalizar_lote(db, report, 'erro', str(e))
+        raise
+
+    finalizar_lote(db, report)
+
+    logger.info(
+        f"📥 Importação {tipo}/{modo} ({report.lote_id}): {report.linhas} linhas, {report.sucesso} ok, "
+        f"{report.erro} erros, {report.ignoradas} vazias, {report.inseridos} inseridos, "
+        f"{report.atualizados} atualizados, {report.inalterados} inalterados em "
+        f"{report.duracao:.1f}s ({report.linhas_por_segundo} linhas/s)"
+    )
+    return report
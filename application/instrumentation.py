@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Instrumentação por Rota
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Para cada endpoint: tempo total, tempo e número de comandos no MongoDB, bytes da
+resposta antes/depois da compressão e acertos/falhas de cache. Os números vão
+para histogramas em memória (por processo - cada worker do gunicorn tem os
+seus), exportados em JSON ou no formato texto do Prometheus, e cada resposta
+leva o cabeçalho Server-Timing para inspeção no DevTools do navegador.
+
+Uma fração das requisições (MONGO_AMOSTRAGEM) é amostrada: o monitor de
+comandos (application.mongo_monitor) guarda forma, duração e documentos de cada
+comando, e o resumo por requisição alimenta o contador de N+1 por endpoint;
+requisições amostradas com N+1 logam o resumo (formas mais caras) ao terminar.
+"""
+
+import logging
+import random
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+# Limites superiores (ms) dos baldes dos histogramas de tempo
+BALDES_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Endpoint de requisições sem rota (404, método não permitido)
+SEM_ROTA = '<sem_rota>'
+
+# Formas mais caras listadas no resumo de uma requisição amostrada
+RESUMO_MAX_FORMAS = 5
+
+# Fração de requisições com detalhamento por comando (init_instrumentacao)
+_amostragem = 0.0
+
+
+class MedicaoRequisicao:
+    """Acumulador da requisição em andamento (preenchido pelo listener e pelo cache)"""
+
+    __slots__ = ('inicio', 'endpoint', 'mongo_ms', 'mongo_comandos', 'cache_hits', 'cache_misses', 'bytes_brutos',
+                 'amostrada', 'formas', 'docs_retornados', 'suspeitas_n1', '_lock')
+
+    def __init__(self, amostrada=False, endpoint=None):
+        self.inicio = perf_counter()
+        # Para logs de threads sem contexto de requisição (busca federada)
+        self.endpoint = endpoint
+        # Fontes da busca federada somam em paralelo na mesma medição
+        self._lock = threading.Lock()
+        self.mongo_ms = 0.0
+        self.mongo_comandos = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_brutos = None
+        self.amostrada = amostrada
+        # forma do comando -> [quantidade, ms, documentos] (só em requisições amostradas)
+        self.formas = {}
+        self.docs_retornados = 0
+        self.suspeitas_n1 = set()
+
+    def registrar_comando(self, forma, duracao_ms, docs):
+        """Acumular um comando da requisição amostrada; retorna as repetições da forma"""
+        with self._lock:
+            estatistica = self.formas.get(forma)
+            if estatistica is None:
+                estatistica = self.formas[forma] = [0, 0.0, 0]
+            estatistica[0] += 1
+            estatistica[1] += duracao_ms
+            estatistica[2] += docs
+            self.docs_retornados += docs
+            return estatistica[0]
+
+    def resumo_mongo(self):
+        """Resumo dos comandos da requisição (formas só quando amostrada)"""
+        resumo = {
+            'comandos': self.mongo_comandos,
+            'mongo_ms': round(self.mongo_ms, 2),
+            'amostrada': self.amostrada,
+        }
+        if self.amostrada:
+            mais_caras = sorted(self.formas.items(), key=lambda item: item[1][1], reverse=True)
+            resumo['docs_retornados'] = self.docs_retornados
+            resumo['formas'] = [
+                {'forma': forma, 'quantidade': qtd, 'ms': round(ms, 2), 'docs': docs}
+                for forma, (qtd, ms, docs) in mais_caras[:RESUMO_MAX_FORMAS]
+            ]
+            resumo['n_mais_1'] = sorted(self.suspeitas_n1)
+        return resumo
+
+
+# ContextVar em vez de flask.g: o monitor do pymongo e o cache são chamados fora
+# do contexto de app (threads de jobs), onde simplesmente não há medição ativa.
+# Threads que trabalham para a requisição (busca federada) recebem uma cópia do
+# contexto (contextvars.copy_context) e somam na mesma medição.
+_medicao = ContextVar('bioma_medicao', default=None)
+
+
+def medicao_atual():
+    """Acumulador da requisição corrente (None fora de requisição)"""
+    return _medicao.get()
+
+
+def registrar_cache(hit):
+    medicao = _medicao.get()
+    if medicao is not None:
+        with medicao._lock:
+            if hit:
+                medicao.cache_hits += 1
+            else:
+                medicao.cache_misses += 1
+
+
+def registrar_mongo(duracao_ms):
+    medicao = _medicao.get()
+    if medicao is not None:
+        with medicao._lock:
+            medicao.mongo_ms += duracao_ms
+            medicao.mongo_comandos += 1
+
+
+# ==================== HISTOGRAMAS ====================
+
+class Histograma:
+    """Contagem por balde (BALDES_MS + infinito), soma e total"""
+
+    __slots__ = ('baldes', 'soma', 'total')
+
+    def __init__(self):
+        self.baldes = [0] * (len(BALDES_MS) + 1)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.baldes[bisect_left(BALDES_MS, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def percentil(self, p):
+        """Estimativa pelo limite superior do balde que contém o percentil"""
+        if not self.total:
+            return 0
+        alvo = p * self.total
+        acumulado = 0
+        for limite, contagem in zip(BALDES_MS + (float('inf'),), self.baldes):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return limite
+        return float('inf')
+
+    def resumo(self):
+        return {
+            'total': self.total,
+            'media_ms': round(self.soma / self.total, 2) if self.total else 0,
+            'p50_ms': _limite_json(self.percentil(0.5)),
+            'p95_ms': _limite_json(self.percentil(0.95)),
+            'p99_ms': _limite_json(self.percentil(0.99)),
+            'baldes': dict(zip([str(b) for b in BALDES_MS] + ['+Inf'], self.baldes)),
+        }
+
+
+def _limite_json(limite):
+    # Acima do último balde não há limite finito (JSON não aceita Infinity)
+    return '+Inf' if limite == float('inf') else limite
+
+
+class MetricasEndpoint:
+    __slots__ = ('tempo', 'mongo', 'mongo_comandos', 'bytes_brutos', 'bytes_enviados',
+                 'cache_hits', 'cache_misses', 'erros', 'amostras', 'docs_amostrados',
+                 'n_mais_1', 'n_mais_1_exemplo')
+
+    def __init__(self):
+        self.tempo = Histograma()
+        self.mongo = Histograma()
+        self.mongo_comandos = 0
+        self.bytes_brutos = 0
+        self.bytes_enviados = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.erros = 0
+        self.amostras = 0
+        self.docs_amostrados = 0
+        self.n_mais_1 = 0
+        self.n_mais_1_exemplo = None
+
+
+class RegistroMetricas:
+    """Métricas por endpoint do processo (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def registrar(self, endpoint, medicao, total_ms, bytes_enviados, status):
+        with self._lock:
+            metricas = self._endpoints.get(endpoint)
+            if metricas is None:
+                metricas = self._endpoints[endpoint] = MetricasEndpoint()
+            metricas.tempo.observar(total_ms)
+            metricas.mongo.observar(medicao.mongo_ms)
+            metricas.mongo_comandos += medicao.mongo_comandos
+            metricas.bytes_brutos += medicao.bytes_brutos or 0
+            metricas.bytes_enviados += bytes_enviados or 0
+            metricas.cache_hits += medicao.cache_hits
+            metricas.cache_misses += medicao.cache_misses
+            if status >= 500:
+                metricas.erros += 1
+            if medicao.amostrada:
+                metricas.amostras += 1
+                metricas.docs_amostrados += medicao.docs_retornados
+                if medicao.suspeitas_n1:
+                    metricas.n_mais_1 += 1
+                    metricas.n_mais_1_exemplo = min(medicao.suspeitas_n1)
+
+    def limpar(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def resumo(self):
+        """Dict por endpoint, do mais lento (p95) para o mais rápido"""
+        with self._lock:
+            endpoints = {
+                nome: {
+                    'tempo': m.tempo.resumo(),
+                    'mongo': m.mongo.resumo(),
+                    'mongo_comandos': m.mongo_comandos,
+                    'mongo_comandos_media': round(m.mongo_comandos / m.tempo.total, 2) if m.tempo.total else 0,
+                    'bytes_brutos': m.bytes_brutos,
+                    'bytes_enviados': m.bytes_enviados,
+                    'cache_hits': m.cache_hits,
+                    'cache_misses': m.cache_misses,
+                    'erros': m.erros,
+                    'amostras': m.amostras,
+                    'docs_media_amostras': round(m.docs_amostrados / m.amostras, 1) if m.amostras else 0,
+                    'n_mais_1': m.n_mais_1,
+                    'n_mais_1_exemplo': m.n_mais_1_exemplo,
+                }
+                for nome, m in self._endpoints.items()
+            }
+        return dict(sorted(endpoints.items(), key=lambda item: float(item[1]['tempo']['p95_ms']), reverse=True))
+
+    def prometheus(self):
+        """Formato texto de exposição do Prometheus"""
+        linhas = []
+        with self._lock:
+            itens = list(self._endpoints.items())
+
+            def histograma(nome, ajuda, atributo):
+                linhas.append(f'# HELP {nome} {ajuda}')
+                linhas.append(f'# TYPE {nome} histogram')
+                for endpoint, m in itens:
+                    h = getattr(m, atributo)
+                    acumulado = 0
+                    for limite, contagem in zip([str(b) for b in BALDES_MS] + ['+Inf'], h.baldes):
+                        acumulado += contagem
+                        linhas.append(f'{nome}_bucket{{endpoint="{endpoint}",le="{limite}"}} {acumulado}')
+                    linhas.append(f'{nome}_sum{{endpoint="{endpoint}"}} {h.soma:.3f}')
+                    linhas.append(f'{nome}_count{{endpoint="{endpoint}"}} {h.total}')
+
+            def contador(nome, ajuda, valores):
+                linhas.append(f'# HELP {nome} {ajuda}')
+                linhas.append(f'# TYPE {nome} counter')
+                for rotulos, valor in valores:
+                    linhas.append(f'{nome}{{{rotulos}}} {valor}')
+
+            histograma('bioma_http_duracao_ms', 'Tempo total da requisição', 'tempo')
+            histograma('bioma_mongo_duracao_ms', 'Tempo em comandos do MongoDB por requisição', 'mongo')
+            contador('bioma_mongo_comandos_total', 'Comandos enviados ao MongoDB',
+                     [(f'endpoint="{e}"', m.mongo_comandos) for e, m in itens])
+            contador('bioma_http_bytes_total', 'Bytes da resposta antes/depois da compressão',
+                     [(f'endpoint="{e}",fase="{fase}"', valor) for e, m in itens
+                      for fase, valor in (('bruto', m.bytes_brutos), ('enviado', m.bytes_enviados))])
+            contador('bioma_cache_total', 'Consultas ao cache',
+                     [(f'endpoint="{e}",resultado="{resultado}"', valor) for e, m in itens
+                      for resultado, valor in (('hit', m.cache_hits), ('miss', m.cache_misses))])
+            contador('bioma_http_erros_total', 'Respostas 5xx',
+                     [(f'endpoint="{e}"', m.erros) for e, m in itens])
+            contador('bioma_mongo_n_mais_1_total', 'Requisições amostradas com provável N+1',
+                     [(f'endpoint="{e}"', m.n_mais_1) for e, m in itens])
+        return '\n'.join(linhas) + '\n'
+
+
+metricas_rotas = RegistroMetricas()
+
+
+# ==================== HOOKS DO FLASK ====================
+
+def _tamanho(response):
+    """Bytes do corpo (None para respostas em streaming sem Content-Length)"""
+    if response.content_length is not None:
+        return response.content_length
+    if response.is_streamed:
+        return None
+    return len(response.get_data())
+
+
+def _iniciar():
+    amostrada = _amostragem > 0 and random.random() < _amostragem
+    request.environ['bioma.medicao_token'] = _medicao.set(MedicaoRequisicao(amostrada, request.endpoint))
+
+
+def _medir_bruto(response):
+    # Roda antes do Compress: tamanho original do corpo
+    medicao = _medicao.get()
+    if medicao is not None:
+        medicao.bytes_brutos = _tamanho(response)
+    return response
+
+
+def _finalizar(response):
+    # Roda depois do Compress: tamanho enviado, tempo total e Server-Timing
+    medicao = _medicao.get()
+    if medicao is None:
+        return response
+    total_ms = (perf_counter() - medicao.inicio) * 1000
+    metricas_rotas.registrar(request.endpoint or SEM_ROTA, medicao, total_ms, _tamanho(response),
+                             response.status_code)
+
+    timing = [
+        f'app;dur={total_ms:.1f}',
+        f'db;dur={medicao.mongo_ms:.1f};desc="{medicao.mongo_comandos} comandos"',
+    ]
+    if medicao.cache_hits or medicao.cache_misses:
+        timing.append(f'cache;desc="hit={medicao.cache_hits} miss={medicao.cache_misses}"')
+    if medicao.amostrada:
+        timing.append(f'docs;desc="{medicao.docs_retornados} documentos"')
+        if medicao.suspeitas_n1:
+            timing.append(f'n1;desc="{len(medicao.suspeitas_n1)} forma(s) repetida(s)"')
+            # Quadro completo da requisição com N+1: total e formas mais caras
+            logger.warning(f"🔁 Resumo MongoDB de {request.endpoint or SEM_ROTA} "
+                           f"({total_ms:.0f}ms): {medicao.resumo_mongo()}")
+    response.headers.add('Server-Timing', ', '.join(timing))
+    return response
+
+
+def _encerrar(exc):
+    token = request.environ.pop('bioma.medicao_token', None)
+    if token is not None:
+        _medicao.reset(token)
+
+
+def init_instrumentacao(app):
+    """
+    Registrar a instrumentação - chamar ANTES do Compress(app)
+
+    O Flask executa os after_request na ordem inversa do registro: _finalizar,
+    registrado aqui, roda depois da compressão; o tamanho bruto é medido por
+    medir_resposta_bruta, registrado logo após o Compress.
+    """
+    global _amostragem
+    if not app.config.get('INSTRUMENTACAO_ATIVA', True):
+        logger.info("📏 Instrumentação por rota desativada")
+        return False
+    _amostragem = app.config.get('MONGO_AMOSTRAGEM', 0.0)
+    app.before_request(_iniciar)
+    app.after_request(_finalizar)
+    app.teardown_request(_encerrar)
+    return True
+
+
+def medir_resposta_bruta(app):
+    """Registrar a medição do corpo antes da compressão - chamar DEPOIS do Compress(app)"""
+    if app.config.get('INSTRUMENTACAO_ATIVA', True):
+        app.after_request(_medir_bruto)
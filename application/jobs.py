@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Jobs em Background (importações, exportações...)
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Trabalhos longos saem do ciclo request/response (evita o GUNICORN_TIMEOUT)
+e rodam num pool de threads pequeno e limitado, para não disputar CPU com
+as requisições interativas. O estado de cada job fica na coleção `jobs`
+(visível por todos os workers) e o progresso é publicado via SSE.
+
+Um job vive no processo que o enfileirou: se o worker for reciclado
+(max_requests, timeout, deploy) ele se perde. Por isso cada processo renova
+updated_at dos seus jobs a cada JOB_HEARTBEAT (além do progresso) e jobs na
+fila/processando sem renovação há mais de JOB_LEASE são marcados como 'erro'
+por recolher_jobs_orfaos() - chamado pelo heartbeat e na leitura do status.
+"""
+
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import sleep, time
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Tempo de retenção dos registros de jobs finalizados (índice TTL em expire_at)
+JOB_RETENCAO = timedelta(days=7)
+
+# Renovação do updated_at dos jobs vivos do processo
+JOB_HEARTBEAT = timedelta(seconds=30)
+
+# Sem renovação há mais que isso = job órfão (worker morreu)
+JOB_LEASE = timedelta(minutes=2)
+
+MENSAGEM_ORFAO = 'Processamento interrompido (servidor reiniciado). Tente novamente.'
+
+# categoria -> callback(db, job) executado ao recolher um job órfão
+_ao_abandonar = {}
+
+
+class JobQueueFull(Exception):
+    """Fila de jobs cheia (o cliente deve tentar novamente mais tarde)"""
+
+
+class JobDuplicado(Exception):
+    """Já existe job na fila/processando com a mesma chave_unica (job = documento dele)"""
+
+    def __init__(self, job):
+        super().__init__('Job idêntico já em andamento')
+        self.job = job
+
+
+class JobManager:
+    """
+    Pool limitado de jobs de uma categoria
+
+    Args:
+        categoria: 'importacao', 'relatorio'...
+        max_workers: jobs executando simultaneamente (por processo)
+        max_fila: jobs aguardando além dos que estão executando
+        notificar: callback(event_type, data) - normalmente broadcast_sse_event
+        pausa: segundos cedidos às requisições interativas a cada progresso
+    """
+
+    def __init__(self, categoria, max_workers=1, max_fila=4, notificar=None, pausa=0.01):
+        self.categoria = categoria
+        self.max_workers = max(1, int(max_workers))
+        self.max_fila = max(0, int(max_fila))
+        self.notificar = notificar
+        self.pausa = pausa
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix=f"job-{categoria}"
+        )
+        self._pendentes = 0
+        self._lock = threading.Lock()
+        # job_id -> db dos jobs na fila/processando neste processo (renovados pelo heartbeat)
+        self._vivos = {}
+        self._heartbeat = None
+
+    def submit(self, db, func, *args, descricao=None, usuario_id=None, campos=None, chave_unica=None, **kwargs):
+        """
+        Enfileirar func(progresso, *args, **kwargs) e retornar o job_id
+
+        func recebe um callback progresso(**campos) e deve retornar um dict
+        (resultado) serializável. `campos` são gravados no documento do job.
+        Com `chave_unica`, o índice único em chave_ativa garante um só job
+        na fila/processando por chave, mesmo entre workers.
+
+        Raises:
+            JobQueueFull: limite de jobs do processo atingido
+            JobDuplicado: chave_unica já reservada por outro job ativo
+        """
+        with self._lock:
+            if self._pendentes >= self.max_workers + self.max_fila:
+                raise JobQueueFull(f"Muitos jobs de {self.categoria} em andamento. Tente novamente em instantes.")
+            self._pendentes += 1
+
+        job_id = uuid.uuid4().hex
+        agora = datetime.now()
+        documento = {
+            '_id': job_id,
+            'categoria': self.categoria,
+            'descricao': descricao,
+            'usuario_id': usuario_id,
+            'status': 'na_fila',
+            'progresso': {},
+            'created_at': agora,
+            'updated_at': agora,
+            **(campos or {})
+        }
+        if chave_unica:
+            documento['chave_ativa'] = f"{self.categoria}:{chave_unica}"
+        try:
+            db.jobs.insert_one(documento)
+        except DuplicateKeyError:
+            with self._lock:
+                self._pendentes -= 1
+            raise JobDuplicado(db.jobs.find_one({'chave_ativa': documento['chave_ativa']}))
+        except Exception:
+            with self._lock:
+                self._pendentes -= 1
+            raise
+
+        with self._lock:
+            self._vivos[job_id] = db
+        self._iniciar_heartbeat()
+        try:
+            self._executor.submit(self._executar, db, job_id, func, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pendentes -= 1
+                self._vivos.pop(job_id, None)
+            raise
+
+        logger.info(f"🧵 Job {self.categoria} {job_id} enfileirado ({descricao})")
+        return job_id
+
+    def _iniciar_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(
+                target=self._renovar, name=f'job-{self.categoria}-heartbeat', daemon=True
+            )
+            self._heartbeat.start()
+
+    def _renovar(self):
+        """Renovar os jobs vivos do processo e recolher os órfãos (de qualquer worker)"""
+        while True:
+            sleep(JOB_HEARTBEAT.total_seconds())
+            with self._lock:
+                vivos = dict(self._vivos)
+            por_db = {}
+            for job_id, db in vivos.items():
+                por_db.setdefault(id(db), (db, []))[1].append(job_id)
+            for db, ids in por_db.values():
+                try:
+                    db.jobs.update_many(
+                        {'_id': {'$in': ids}, 'status': {'$in': ['na_fila', 'processando']}},
+                        {'$set': {'updated_at': datetime.now()}}
+                    )
+                    recolher_jobs_orfaos(db, self.categoria)
+                except Exception as e:
+                    logger.warning(f"⚠️ Falha no heartbeat dos jobs de {self.categoria}: {e}")
+
+    def _publicar(self, job_id, status, progresso=None, **extra):
+        if self.notificar is None:
+            return
+        try:
+            self.notificar('job_progress', {
+                'job_id': job_id,
+                'categoria': self.categoria,
+                'status': status,
+                'progresso': progresso or {},
+                **extra
+            })
+        except Exception as e:
+            logger.debug(f"Falha ao publicar progresso do job {job_id}: {e}")
+
+    def _executar(self, db, job_id, func, args, kwargs):
+        inicio = time()
+
+        def progresso(**campos):
+            db.jobs.update_one({'_id': job_id}, {'$set': {
+                'progresso': campos,
+                'updated_at': datetime.now()
+            }})
+            self._publicar(job_id, 'processando', campos)
+            if self.pausa:
+                sleep(self.pausa)
+
+        # Tudo dentro do try: se até a marcação de 'processando' falhar, o contador
+        # e o heartbeat são liberados e a chave_ativa não fica presa a um job morto
+        try:
+            db.jobs.update_one({'_id': job_id}, {'$set': {
+                'status': 'processando',
+                'started_at': datetime.now(),
+                'updated_at': datetime.now()
+            }})
+            self._publicar(job_id, 'processando')
+            resultado = func(progresso, *args, **kwargs)
+            status, campos = 'concluido', {'resultado': resultado}
+        except Exception as e:
+            logger.error(f"❌ Job {self.categoria} {job_id} falhou: {e}")
+            status, campos = 'erro', {'erro': str(e)}
+        finally:
+            with self._lock:
+                self._pendentes -= 1
+                self._vivos.pop(job_id, None)
+
+        agora = datetime.now()
+        try:
+            db.jobs.update_one({'_id': job_id}, {'$set': {
+                'status': status,
+                'finished_at': agora,
+                'updated_at': agora,
+                'expire_at': agora + JOB_RETENCAO,
+                'duracao_s': round(time() - inicio, 2),
+                **campos
+            }, '$unset': {'chave_ativa': ''}})
+        except Exception as e:
+            # Fora de _vivos o heartbeat não renova mais: recolher_jobs_orfaos
+            # marca 'erro' e libera a chave_ativa depois de JOB_LEASE
+            logger.error(f"❌ Falha ao gravar o fim do job {self.categoria} {job_id}: {e}")
+        self._publicar(job_id, status, **campos)
+        logger.info(f"🧵 Job {self.categoria} {job_id} {status} em {time() - inicio:.1f}s")
+
+
+def ao_abandonar_job(categoria, callback):
+    """Registrar callback(db, job) para limpar o estado de um job órfão da categoria"""
+    _ao_abandonar[categoria] = callback
+
+
+def _orfao(job, agora):
+    return (
+        job.get('status') in ('na_fila', 'processando')
+        and job.get('updated_at') is not None
+        and job['updated_at'] < agora - JOB_LEASE
+    )
+
+
+def _abandonar(db, job, agora):
+    """Marcar um job órfão como erro (só se ninguém o renovou nesse meio tempo)"""
+    marcado = db.jobs.update_one(
+        {'_id': job['_id'], 'status': job['status'], 'updated_at': job['updated_at']},
+        {'$set': {
+            'status': 'erro',
+            'erro': MENSAGEM_ORFAO,
+            'finished_at': agora,
+            'updated_at': agora,
+            'expire_at': agora + JOB_RETENCAO
+        }, '$unset': {'chave_ativa': ''}}
+    ).modified_count
+    if not marcado:
+        return False
+    logger.warning(f"🧟 Job {job.get('categoria')} {job['_id']} órfão marcado como erro")
+    callback = _ao_abandonar.get(job.get('categoria'))
+    if callback is not None:
+        try:
+            callback(db, job)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao limpar job órfão {job['_id']}: {e}")
+    return True
+
+
+def recolher_jobs_orfaos(db, categoria=None):
+    """
+    Marcar como erro os jobs na fila/processando sem heartbeat há mais de JOB_LEASE
+
+    Returns:
+        quantidade de jobs recolhidos
+    """
+    agora = datetime.now()
+    filtro = {'status': {'$in': ['na_fila', 'processando']}, 'updated_at': {'$lt': agora - JOB_LEASE}}
+    if categoria:
+        filtro['categoria'] = categoria
+    return sum(1 for job in db.jobs.find(filtro) if _abandonar(db, job, agora))
+
+
+def job_ativo(db, categoria, chave_unica):
+    """Job na fila/processando que reservou a chave (None se livre ou órfão recolhido)"""
+    job = db.jobs.find_one({'chave_ativa': f"{categoria}:{chave_unica}"})
+    if job is not None and _orfao(job, datetime.now()):
+        _abandonar(db, job, datetime.now())
+        return None
+    return job
+
+
+def obter_job(db, job_id, categoria=None):
+    """Documento do job (None se não existir); órfãos já voltam como 'erro'"""
+    filtro = {'_id': job_id}
+    if categoria:
+        filtro['categoria'] = categoria
+    job = db.jobs.find_one(filtro)
+    if job is not None and _orfao(job, datetime.now()):
+        _abandonar(db, job, datetime.now())
+        job = db.jobs.find_one(filtro)
+    return job
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Monitoramento de Comandos do MongoDB
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+CommandListener do pymongo registrado no MongoClient (init_db). Todo comando
+soma tempo e contagem na medição da requisição (application.instrumentation);
+comandos acima de MONGO_LENTA_MS são logados com a forma do filtro (valores
+trocados por '?'). Nas requisições amostradas o listener guarda também forma,
+duração e documentos devolvidos de cada comando e sinaliza como provável N+1
+quando a mesma forma de `find` se repete mais de MONGO_N1_LIMITE vezes.
+"""
+
+import json
+import logging
+
+from flask import has_request_context, request
+from pymongo import monitoring
+
+from application.instrumentation import medicao_atual, registrar_mongo
+
+logger = logging.getLogger(__name__)
+
+# Comandos de controle (handshake, sessões) não entram no log de lentidão
+COMANDOS_IGNORADOS = {'hello', 'ismaster', 'isMaster', 'ping', 'endSessions', 'saslStart', 'saslContinue'}
+
+
+def forma_filtro(valor):
+    """Estrutura do filtro sem os valores: {'_id': {'$in': ['?']}}"""
+    if isinstance(valor, dict):
+        return {chave: forma_filtro(v) for chave, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        # $and/$or trazem filtros; $in/$nin trazem valores (tamanho não muda a forma)
+        formas = [forma_filtro(v) for v in valor if isinstance(v, dict)]
+        return formas or ['?']
+    return '?'
+
+
+def _forma_pipeline(pipeline):
+    estagios = []
+    for estagio in pipeline or []:
+        for operador, argumento in estagio.items():
+            estagios.append({operador: forma_filtro(argumento)} if operador == '$match' else operador)
+    return estagios
+
+
+def forma_comando(nome, comando):
+    """'find produtos {"_id": "?"}' - chave de agrupamento e texto do log"""
+    colecao = comando.get('collection') if nome == 'getMore' else comando.get(nome)
+    if nome == 'find':
+        detalhe = forma_filtro(comando.get('filter') or {})
+    elif nome == 'aggregate':
+        detalhe = _forma_pipeline(comando.get('pipeline'))
+    elif nome in ('count', 'findAndModify'):
+        detalhe = forma_filtro(comando.get('query') or {})
+    elif nome == 'distinct':
+        detalhe = {'key': comando.get('key'), 'query': forma_filtro(comando.get('query') or {})}
+    elif nome in ('update', 'delete'):
+        itens = comando.get('updates' if nome == 'update' else 'deletes') or [{}]
+        detalhe = forma_filtro(itens[0].get('q') or {})
+    else:
+        detalhe = None
+    if detalhe is None:
+        return f"{nome} {colecao}"
+    return f"{nome} {colecao} {json.dumps(detalhe, ensure_ascii=False, sort_keys=True, default=str)}"
+
+
+def _docs_retornados(nome, resposta):
+    if not resposta:
+        return 0
+    cursor = resposta.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if nome == 'findAndModify':
+        return 1 if resposta.get('value') else 0
+    return 0
+
+
+def _origem(medicao):
+    """Endpoint do comando - threads da busca federada não têm contexto de requisição, só a medição"""
+    if has_request_context():
+        return request.endpoint
+    return medicao.endpoint if medicao is not None else None
+
+
+class MonitorMongo(monitoring.CommandListener):
+    """
+    Listener de comandos: tempo por requisição, log de lentos e detector de N+1
+
+    Args:
+        lenta_ms: comandos a partir dessa duração vão para o log com a forma do filtro
+        limite_n1: mais que isso de `find` com a mesma forma na requisição = N+1
+    """
+
+    def __init__(self, lenta_ms=100, limite_n1=10):
+        self.lenta_ms = lenta_ms
+        self.limite_n1 = limite_n1
+        # Comando em andamento por (conexão, request_id) - a forma só é calculada
+        # quando o comando for lento ou a requisição estiver amostrada
+        self._em_andamento = {}
+
+    def started(self, event):
+        self._em_andamento[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event):
+        self._concluir(event, event.reply)
+
+    def failed(self, event):
+        self._concluir(event, None)
+
+    def _concluir(self, event, resposta):
+        comando = self._em_andamento.pop((event.connection_id, event.request_id), None)
+        duracao_ms = event.duration_micros / 1000
+        registrar_mongo(duracao_ms)
+
+        medicao = medicao_atual()
+        amostrada = medicao is not None and medicao.amostrada
+        lenta = duracao_ms >= self.lenta_ms and event.command_name not in COMANDOS_IGNORADOS
+        if not (lenta or amostrada) or comando is None:
+            return
+
+        forma = forma_comando(event.command_name, comando)
+        origem = _origem(medicao)
+        if lenta:
+            logger.warning(f"🐢 MongoDB lento{f' em {origem}' if origem else ''} ({duracao_ms:.0f}ms): {forma}")
+        if not amostrada:
+            return
+
+        repeticoes = medicao.registrar_comando(forma, duracao_ms, _docs_retornados(event.command_name, resposta))
+        if event.command_name == 'find' and repeticoes == self.limite_n1 + 1:
+            medicao.suspeitas_n1.add(forma)
+            logger.warning(f"🔁 Provável N+1 em {origem or '?'}: mais de {self.limite_n1}x {forma}")
@@ -0,0 +1,1022 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Renderização de PDFs (orçamentos, contratos e prontuários)
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+As rotas buscam os dados no MongoDB e chamam gerar_pdf(tipo, dados): o ReportLab
+roda num pool de processos, fora da thread da requisição. O pool é por worker
+do gunicorn: são workers x PDF_WORKERS processos (~37MB de RSS cada), por isso
+o padrão é 1 e 'auto' respeita afinidade/cota de CPU do container.
+Folhas de estilo e flowables fixos (cabeçalho, cláusulas) são montados uma vez por
+processo. O resultado fica num cache por hash do conteúdo - baixar de novo um
+orçamento que não mudou custa só uma consulta ao cache.
+O histórico completo é a exceção: montado em fluxo a partir dos cursores, direto
+para um arquivo temporário (memória limitada independente do tamanho).
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
+from functools import lru_cache
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from xml.sax.saxutils import escape
+
+from reportlab.graphics.charts.barcharts import HorizontalBarChart, VerticalBarChart
+from reportlab.graphics.shapes import Drawing
+from reportlab.lib.colors import HexColor, black, white
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_RIGHT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import cm
+from reportlab.platypus import Flowable, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from application.instrumentation import registrar_cache
+
+logger = logging.getLogger(__name__)
+
+# Teto de processos do pool por worker do gunicorn (cada um ~37MB de RSS)
+PDF_WORKERS_MAX = 4
+
+
+def _cpus_disponiveis():
+    """CPUs que o processo pode usar: afinidade e cota do cgroup (v2 ou v1), não os núcleos do host"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    for arquivo_cota, arquivo_periodo in (
+        ('/sys/fs/cgroup/cpu.max', None),
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+    ):
+        try:
+            with open(arquivo_cota) as f:
+                valores = f.read().split()
+            if arquivo_periodo:
+                with open(arquivo_periodo) as f:
+                    valores.append(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        cota, periodo = valores[0], valores[1] if len(valores) > 1 else '100000'
+        if cota not in ('max', '-1') and int(periodo) > 0:
+            cpus = min(cpus, max(1, int(cota) // int(periodo)))
+        break
+    return max(1, cpus)
+
+
+def _pdf_workers(valor):
+    """PDF_WORKERS: inteiro (0 = renderizar na requisição) ou 'auto'; sempre limitado por CPUs e PDF_WORKERS_MAX"""
+    limite = min(_cpus_disponiveis(), PDF_WORKERS_MAX)
+    if str(valor).strip().lower() == 'auto':
+        return limite
+    return max(0, min(int(valor), limite))
+
+
+# Processos renderizando em paralelo, por worker do gunicorn (0 = na própria thread da requisição)
+PDF_WORKERS = _pdf_workers(os.getenv('PDF_WORKERS', '1'))
+
+# Tempo máximo aguardando um PDF do pool
+PDF_TIMEOUT_S = 60
+
+# Orçamento de memória do cache de PDFs prontos (por processo)
+PDF_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Incrementar ao mudar o layout de qualquer documento (invalida o cache)
+PDF_VERSAO = 1
+
+# Documentos que imprimem a data de geração: a chave inclui o dia
+TIPOS_DATADOS = {'contrato', 'prontuario'}
+
+# Histórico completo: flowables puxados por vez (~1 página) e documentos lidos por lote do cursor
+HISTORICO_LOTE_FLOWABLES = 40
+HISTORICO_CURSOR_LOTE = 100
+
+# Acima disso o PDF em montagem sai da memória para um arquivo em disco
+PDF_SPOOL_MAX_BYTES = 2 * 1024 * 1024
+
+COR_PRIMARIA = HexColor('#7C3AED')
+COR_SECUNDARIA = HexColor('#6B7280')
+COR_FUNDO_CLARO = HexColor('#F9FAFB')
+COR_BRANCA = HexColor('#FFFFFF')
+
+CLAUSULAS_CONTRATO = [
+    "O Contrato tem por objeto a prestação de serviços acima descritos, pela Contratada à Contratante, mediante agendamento prévio. A Contratada utilizará produtos com ingredientes naturais para a saúde dos cabelos, de alta qualidade, que serão manipulados dentro das normas de higiene e limpeza exigidas pela Vigilância Sanitária.",
+    "A Contratante declara e está ciente que (i) os serviços têm caráter pessoal e são intransferíveis; (ii) só poderá alterar os Serviços contratados com a anuência da Contratada e desde que a utilização seja no prazo originalmente contratado; (iii) não tem nenhum impedimento médico e/ou alergias que impeçam de realizar os serviços contratados; (iv) escolheu os tratamentos de acordo com o seu tipo de cabelo; (v) concorda em realizar os tratamentos com a frequência indicada pela Contratada; e (vi) o resultado pretendido depende do respeito à frequência indicada pela Contratada.",
+    "Os serviços deverão ser utilizados em conformidade com o prazo de 18 (dezoito) meses e a Contratante está ciente de que não haverá prorrogação do prazo previsto para a utilização dos serviços, ou seja, ao final de 18 (dezoito) meses, o Contrato será extinto e a Contratante não terá direito ao reembolso de tratamentos não realizados no prazo contratual.",
+    "A Contratante poderá desistir dos serviços no prazo de até 90 (noventa) dias a contar da assinatura deste Contrato e, neste caso, está de acordo com a restituição do valor equivalente a 80% (oitenta por cento) dos tratamentos não realizados, no prazo de até 5 (cinco) dias úteis da desistência. Eventuais descontos ou promoções nos valores dos serviços e/ou tratamentos não serão reembolsáveis.",
+    "No caso de devolução de valor pago por cartão de crédito, o cancelamento será efetuado junto à administradora do seu cartão e o estorno poderá ocorrer em até 2 (duas) faturas posteriores de acordo com procedimentos internos da operadora do cartão de crédito, ou outro prazo definido pela administradora do cartão de crédito, ou, a exclusivo arbítrio da Contratada, mediante transferência direta do valor equivalente ao reembolso.",
+    "Na hipótese de responsabilidade civil da Contratada, independentemente da natureza do dano, fica desde já limitada a responsabilidade da Contratada ao valor máximo equivalente a 2 (duas) sessões de tratamento dos serviços.",
+    "No caso de alergias decorrentes dos produtos utilizados pela Contratada, a Contratante poderá optar pela suspensão dos serviços com a retomada após o reestabelecimento de sua saúde, ou pela concessão de crédito do valor remanescente em outros serviços junto à Contratada. A Contratada não é responsável por qualquer perda, independentemente do valor, incluindo danos diretos, indiretos, à imagem, lucros cessantes e/ou morais que se tornem exigíveis em decorrência de eventual alergia.",
+    "As Partes se comprometem a tratar apenas os dados pessoais estritamente necessários para atingir as finalidades específicas do objeto do Contrato, em cumprimento ao disposto na Lei nº 13.709/2018 (\"LGPD\") e na regulamentação aplicável.",
+    "Fica eleito o Foro da Comarca de UBERABA, Estado de MINAS GERAIS, como o competente para dirimir as dúvidas e controvérsias decorrentes do presente Contrato, com renúncia a qualquer outro, por mais privilegiado que seja.",
+    "Este Contrato poderá ser assinado e entregue eletronicamente e terá a mesma validade e efeitos de um documento original com assinaturas físicas."
+]
+
+
+class GradientHeader(Flowable):
+    """Um cabeçalho com fundo em gradiente."""
+    def __init__(self, width, text):
+        Flowable.__init__(self)
+        self.width = width
+        self.text = text
+        self.height = 1.5*cm
+        # Faixas do gradiente calculadas uma vez (o flowable é reaproveitado)
+        inicio = HexColor('#7C3AED')
+        fim = HexColor('#EC4899')
+        steps = 100
+        self.faixas = []
+        for i in range(steps):
+            ratio = i / float(steps)
+            self.faixas.append((
+                (self.width / steps) * i,
+                inicio.red * (1 - ratio) + fim.red * ratio,
+                inicio.green * (1 - ratio) + fim.green * ratio,
+                inicio.blue * (1 - ratio) + fim.blue * ratio,
+            ))
+
+    def draw(self):
+        c = self.canv
+        c.saveState()
+        largura = self.width / len(self.faixas)
+        for x, r, g, b in self.faixas:
+            c.setFillColorRGB(r, g, b)
+            c.rect(x, 0, largura, self.height, stroke=0, fill=1)
+        c.setFont('Helvetica-Bold', 36)
+        c.setFillColor(white)
+        c.drawCentredString(self.width / 2, self.height / 2 - (0.5*cm), self.text)
+        c.restoreState()
+
+
+class HRFlowable(Flowable):
+    """Linha horizontal com cor customizada."""
+    def __init__(self, width, thickness=1, color=black):
+        Flowable.__init__(self)
+        self.width = width
+        self.thickness = thickness
+        self.color = color
+
+    def draw(self):
+        self.canv.saveState()
+        self.canv.setStrokeColor(self.color)
+        self.canv.setLineWidth(self.thickness)
+        self.canv.line(0, 0, self.width, 0)
+        self.canv.restoreState()
+
+
+def format_date_pt_br(dt):
+    """Formata a data para Português-BR manualmente para evitar problemas de locale."""
+    meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
+    return f"{dt.day} de {meses[dt.month - 1]} de {dt.year}"
+
+
+def _brl(valor):
+    """R$ 1.234,56"""
+    return f"R$ {valor or 0:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+# ==================== RECURSOS POR PROCESSO ====================
+
+@lru_cache(maxsize=1)
+def _estilos():
+    """Folha de estilos com os estilos próprios dos documentos (uma vez por processo)"""
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name='MainTitle', fontName='Helvetica-Bold', fontSize=20, textColor=COR_PRIMARIA, spaceAfter=18))
+    styles.add(ParagraphStyle(name='SubTitle', fontName='Helvetica', fontSize=10, textColor=COR_SECUNDARIA, spaceAfter=24))
+    styles.add(ParagraphStyle(name='SectionTitle', fontName='Helvetica-Bold', fontSize=10, textColor=white))
+    styles.add(ParagraphStyle(name='Body', fontName='Helvetica', fontSize=9, leading=14))
+    styles.add(ParagraphStyle(name='BodyRight', fontName='Helvetica', fontSize=9, leading=14, alignment=TA_RIGHT))
+    styles.add(ParagraphStyle(name='Clause', fontName='Helvetica', fontSize=8, leading=14, alignment=TA_JUSTIFY, leftIndent=12))
+    styles.add(ParagraphStyle(name='Signature', fontName='Helvetica', fontSize=9, alignment=TA_CENTER))
+    styles.add(ParagraphStyle('CenteredTitle', parent=styles['Heading1'], alignment=TA_CENTER))
+    styles.add(ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=24, textColor=COR_PRIMARIA, spaceAfter=30, alignment=TA_CENTER))
+    styles.add(ParagraphStyle('Status', parent=styles['Normal'], alignment=TA_CENTER, fontSize=10))
+    styles.add(ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, alignment=TA_CENTER))
+    styles.add(ParagraphStyle(name='ReportTitle', fontName='Helvetica-Bold', fontSize=20, textColor=COR_PRIMARIA, spaceAfter=18, alignment=TA_CENTER))
+    styles.add(ParagraphStyle(name='ReportSection', fontName='Helvetica-Bold', fontSize=14, textColor=COR_PRIMARIA, spaceAfter=10))
+    return styles
+
+
+@lru_cache(maxsize=1)
+def _estaticos():
+    """Flowables que não dependem do documento (parse do markup feito uma vez por processo)"""
+    styles = _estilos()
+    largura = A4[0] - 4*cm
+    clausulas = []
+    for i, clausula in enumerate(CLAUSULAS_CONTRATO):
+        clausulas.append(Paragraph(f"<b>{i+1}.</b> {clausula}", styles['Clause']))
+        clausulas.append(Spacer(1, 0.4*cm))
+    return {
+        'cabecalho': GradientHeader(largura, "BIOMA"),
+        'subtitulo_contrato': Paragraph(
+            "Pelo presente instrumento particular, as 'Partes' resolvem celebrar o presente 'Contrato', de acordo com as cláusulas e condições a seguir.",
+            styles['SubTitle']
+        ),
+        'clausulas': clausulas,
+        'assinatura_contratada': Paragraph("________________________________________<br/><b>CONTRATADA</b><br/>BIOMA UBERABA", styles['Signature']),
+    }
+
+
+def _estatico(nome):
+    """Cópia rasa de um flowable fixo (wrap/split gravam estado na instância)"""
+    item = _estaticos()[nome]
+    if isinstance(item, list):
+        return [copy.copy(f) for f in item]
+    return copy.copy(item)
+
+
+def _inicializar_worker():
+    """Initializer do pool: aquecer estilos e flowables antes da primeira requisição"""
+    _estilos()
+    _estaticos()
+
+
+# ==================== DOCUMENTOS ====================
+
+def _tabela_chave_valor(linhas, cor_rotulo):
+    tabela = Table(linhas, colWidths=[4*cm, 12*cm])
+    tabela.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), HexColor(cor_rotulo)),
+        ('GRID', (0, 0), (-1, -1), 0.5, black),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ]))
+    return tabela
+
+
+def _tabela_itens(linhas, col_widths, cor_cabecalho, col_centro=1):
+    tabela = Table(linhas, colWidths=col_widths)
+    tabela.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), HexColor(cor_cabecalho)),
+        ('TEXTCOLOR', (0, 0), (-1, 0), white),
+        ('ALIGN', (col_centro, 0), (-1, -1), 'CENTER'),
+        ('GRID', (0, 0), (-1, -1), 0.5, black),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ]))
+    return tabela
+
+
+def _tabela_totais(orcamento, rotulo_total):
+    totais_data = [
+        ['Subtotal Serviços:', f"R$ {orcamento.get('total_servicos', 0):.2f}"],
+        ['Subtotal Produtos:', f"R$ {orcamento.get('total_produtos', 0):.2f}"],
+        ['Desconto:', f"R$ {orcamento.get('desconto_valor', 0):.2f}"],
+        [f'<b>{rotulo_total}:</b>', f"<b>R$ {orcamento.get('total_final', 0):.2f}</b>"]
+    ]
+    tabela = Table(totais_data, colWidths=[12*cm, 4*cm])
+    tabela.setStyle(TableStyle([
+        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, -1), (-1, -1), 14),
+        ('BACKGROUND', (0, -1), (-1, -1), HexColor('#FFD700')),
+    ]))
+    return tabela
+
+
+def _linhas_produtos(produtos):
+    linhas = [['Descrição', 'Quantidade', 'Valor Unit.', 'Total']]
+    for prd in produtos:
+        linhas.append([
+            prd.get('nome', 'N/A'),
+            str(prd.get('quantidade', 1)),
+            f"R$ {prd.get('preco', 0):.2f}",
+            f"R$ {prd.get('total', 0):.2f}"
+        ])
+    return linhas
+
+
+def _data_curta(valor):
+    return valor.strftime('%d/%m/%Y') if isinstance(valor, datetime) else 'N/A'
+
+
+def _pdf_orcamento_contrato(orcamento, buffer):
+    """Orçamento no layout de contrato (cláusulas + página de assinaturas)"""
+    doc_width, doc_height = A4
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=1.5*cm, bottomMargin=2.5*cm)
+    styles = _estilos()
+
+    story = []
+
+    story.append(_estatico('cabecalho'))
+    story.append(Spacer(1, 1.5*cm))
+    story.append(Paragraph("Contrato de Prestação de Serviços", styles['MainTitle']))
+    story.append(_estatico('subtitulo_contrato'))
+
+    data_contrato = orcamento.get('created_at') or datetime.now()
+    info_data = [
+        [Paragraph('<b>NÚMERO DO CONTRATO</b>', styles['Body']), Paragraph(f"#{orcamento.get('numero', 'N/A')}", styles['Body'])],
+        [Paragraph('<b>DATA DE EMISSÃO</b>', styles['Body']), Paragraph(format_date_pt_br(data_contrato), styles['Body'])]
+    ]
+    story.append(Table(info_data, colWidths=[5*cm, '*'], style=[('VALIGN', (0,0), (-1,-1), 'TOP')]))
+    story.append(Spacer(1, 1*cm))
+
+    story.append(HRFlowable(doc_width - 4*cm, color=HexColor('#E5E7EB'), thickness=1))
+    story.append(Spacer(1, 1*cm))
+
+    # Fix: Garantir que nenhum valor seja None
+    contratante_details = f"""
+        <b>Nome:</b> {orcamento.get('cliente_nome') or 'N/A'}<br/>
+        <b>CPF:</b> {orcamento.get('cliente_cpf') or 'N/A'}<br/>
+        <b>Telefone:</b> {orcamento.get('cliente_telefone') or 'N/A'}<br/>
+        <b>E-mail:</b> {orcamento.get('cliente_email') or 'N/A'}
+    """
+    contratada_details = """
+        <b>Razão Social:</b> BIOMA UBERABA<br/>
+        <b>CNPJ:</b> 49.470.937/0001-10<br/>
+        <b>Endereço:</b> Av. Santos Dumont 3110, Santa Maria, Uberaba/MG<br/>
+        <b>Contato:</b> (34) 99235-5890
+    """
+    partes_data = [
+        [Paragraph('<b>CONTRATANTE</b>', styles['Body']), Paragraph('<b>CONTRATADA</b>', styles['Body'])],
+        [Paragraph(contratante_details, styles['Body']), Paragraph(contratada_details, styles['Body'])]
+    ]
+    partes_table = Table(partes_data, colWidths=['*', '*'], hAlign='LEFT')
+    partes_table.setStyle(TableStyle([
+        ('VALIGN', (0,0), (-1,-1), 'TOP'), ('LINEBELOW', (0,0), (-1,0), 1, COR_PRIMARIA),
+        ('LEFTPADDING', (0,0), (-1,-1), 0), ('RIGHTPADDING', (0,0), (-1,-1), 12),
+        ('TOPPADDING', (0,0), (-1,-1), 6), ('BOTTOMPADDING', (0,0), (-1,-1), 12),
+    ]))
+    story.append(partes_table)
+    story.append(Spacer(1, 1.5*cm))
+
+    story.append(Paragraph("SERVIÇOS E PRODUTOS CONTRATADOS", styles['MainTitle']))
+    table_header = [Paragraph(c, styles['SectionTitle']) for c in ['Item', 'Descrição', 'Qtd', 'Vl. Unit.', 'Total']]
+    items_data = [table_header]
+    all_items = orcamento.get('servicos', []) + orcamento.get('produtos', [])
+
+    table_style_commands = [
+        ('BACKGROUND', (0,0), (-1,0), COR_PRIMARIA), ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+        ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10),
+        ('GRID', (0,0), (-1,-1), 1, COR_PRIMARIA),
+        ('ALIGN', (2,1), (-1,-1), 'RIGHT'), # Alinha colunas numéricas à direita
+        ('LEFTPADDING', (0,0), (-1,-1), 8), ('RIGHTPADDING', (0,0), (-1,-1), 8),
+    ]
+
+    for i, item in enumerate(all_items):
+        desc = f"{item.get('nome', '')} {item.get('tamanho', '')}".strip() if 'servico' in item.get('id', '') else f"{item.get('nome', '')} {item.get('marca', '')}".strip()
+        items_data.append([
+            Paragraph(str(i+1), styles['Body']), Paragraph(desc, styles['Body']),
+            Paragraph(str(item.get('qtd', 1)), styles['BodyRight']),
+            Paragraph(_brl(item.get('preco_unit', 0)), styles['BodyRight']),
+            Paragraph(_brl(item.get('total', 0)), styles['BodyRight']),
+        ])
+        # Adiciona estilo de zebra (cores alternadas)
+        cor = COR_FUNDO_CLARO if i % 2 == 0 else COR_BRANCA
+        table_style_commands.append(('BACKGROUND', (0, i + 1), (-1, i + 1), cor))
+
+    items_table = Table(items_data, colWidths=[1.5*cm, '*', 1.5*cm, 3*cm, 3*cm], repeatRows=1)
+    items_table.setStyle(TableStyle(table_style_commands))
+    story.append(items_table)
+    story.append(Spacer(1, 1*cm))
+
+    pag_tipo = (orcamento.get('pagamento') or {}).get('tipo', 'Não especificado')
+
+    valores_data = [
+        [Paragraph('Subtotal:', styles['Body']), Paragraph(_brl(orcamento.get('subtotal', 0)), styles['BodyRight'])],
+        [Paragraph('Desconto Global:', styles['Body']), Paragraph(_brl(orcamento.get('desconto_valor', 0)), styles['BodyRight'])],
+        ['', HRFlowable(8*cm, color=COR_PRIMARIA, thickness=1.5)],
+        [Paragraph('<b>Valor Total a Pagar:</b>', styles['Body']), Paragraph(f"<b>{_brl(orcamento.get('total_final', 0))}</b>", styles['BodyRight'])],
+        [Paragraph('Forma de Pagamento:', styles['Body']), Paragraph(pag_tipo, styles['BodyRight'])],
+    ]
+
+    # Tabela para alinhar o bloco de valores à direita
+    container_valores = Table([[Table(valores_data, colWidths=[4*cm, 4*cm])]], colWidths=[doc_width-4*cm])
+    container_valores.setStyle(TableStyle([('ALIGN', (0,0), (0,0), 'RIGHT')]))
+    story.append(container_valores)
+    story.append(Spacer(1, 1.5*cm))
+
+    story.append(Paragraph("DISPOSIÇÕES GERAIS E CLÁUSULAS", styles['MainTitle']))
+    story.extend(_estatico('clausulas'))
+
+    story.append(PageBreak())
+    story.append(Paragraph("ASSINATURAS", styles['MainTitle']))
+    story.append(Spacer(1, 4*cm))
+
+    # Fix: Garantir que cliente_nome nunca seja None
+    cliente_nome = orcamento.get('cliente_nome') or 'N/A'
+    assinatura_contratante = Paragraph(f"________________________________________<br/><b>CONTRATANTE</b><br/>{cliente_nome}", styles['Signature'])
+
+    assinaturas_table = Table([[assinatura_contratante, _estatico('assinatura_contratada')]], colWidths=['*', '*'])
+    story.append(assinaturas_table)
+
+    def on_each_page(canvas, doc):
+        canvas.saveState()
+        canvas.setFont('Helvetica', 8)
+        canvas.setFillColor(COR_SECUNDARIA)
+        page_num = canvas.getPageNumber()
+        canvas.drawCentredString(doc_width/2, 1.5*cm, f"Página {page_num} | Contrato BIOMA Uberaba")
+        canvas.restoreState()
+
+    doc.build(story, onFirstPage=on_each_page, onLaterPages=on_each_page)
+
+
+def _pdf_orcamento(orcamento, buffer):
+    """Orçamento para impressão (Diretriz #3)"""
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = _estilos()
+    elements = []
+
+    elements.append(Paragraph(f"ORÇAMENTO #{orcamento.get('numero', str(orcamento['_id'])[-6:])}", styles['CenteredTitle']))
+    elements.append(Spacer(1, 0.3*cm))
+
+    elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
+    elements.append(_tabela_chave_valor([
+        ['Nome:', orcamento.get('cliente_nome', 'N/A')],
+        ['CPF:', orcamento.get('cliente_cpf', 'N/A')],
+        ['Telefone:', orcamento.get('cliente_telefone', 'N/A')],
+        ['Email:', orcamento.get('cliente_email', 'N/A')],
+        ['Data:', _data_curta(orcamento.get('created_at'))]
+    ], '#f0f0f0'))
+    elements.append(Spacer(1, 0.5*cm))
+
+    if orcamento.get('servicos'):
+        elements.append(Paragraph('<b>SERVIÇOS</b>', styles['Heading2']))
+        servicos_data = [['Descrição', 'Quantidade', 'Valor Unit.', 'Total']]
+        for srv in orcamento['servicos']:
+            servicos_data.append([
+                srv.get('nome', 'N/A'),
+                str(srv.get('quantidade', 1)),
+                f"R$ {srv.get('preco', 0):.2f}",
+                f"R$ {srv.get('total', 0):.2f}"
+            ])
+        elements.append(_tabela_itens(servicos_data, [8*cm, 2*cm, 3*cm, 3*cm], '#4CAF50'))
+        elements.append(Spacer(1, 0.3*cm))
+
+    if orcamento.get('produtos'):
+        elements.append(Paragraph('<b>PRODUTOS</b>', styles['Heading2']))
+        elements.append(_tabela_itens(_linhas_produtos(orcamento['produtos']), [8*cm, 2*cm, 3*cm, 3*cm], '#2196F3'))
+        elements.append(Spacer(1, 0.3*cm))
+
+    elements.append(_tabela_totais(orcamento, 'TOTAL FINAL'))
+
+    if orcamento.get('observacoes'):
+        elements.append(Spacer(1, 0.5*cm))
+        elements.append(Paragraph('<b>OBSERVAÇÕES:</b>', styles['Heading3']))
+        elements.append(Paragraph(orcamento['observacoes'], styles['Normal']))
+
+    doc.build(elements)
+
+
+def _pdf_contrato(contrato, buffer):
+    """Contrato para impressão (Diretriz #4)"""
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = _estilos()
+    elements = []
+
+    elements.append(Paragraph(f"CONTRATO #{contrato.get('numero', str(contrato['_id'])[-6:])}", styles['CenteredTitle']))
+    elements.append(Spacer(1, 0.3*cm))
+
+    status_color = HexColor('#4CAF50') if contrato.get('status') == 'Aprovado' else HexColor('#FF9800')
+    elements.append(Paragraph(f'<font color="{status_color}"><b>STATUS: {contrato.get("status", "N/A")}</b></font>', styles['Status']))
+    elements.append(Spacer(1, 0.3*cm))
+
+    elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
+    elements.append(_tabela_chave_valor([
+        ['Nome:', contrato.get('cliente_nome', 'N/A')],
+        ['CPF:', contrato.get('cliente_cpf', 'N/A')],
+        ['Telefone:', contrato.get('cliente_telefone', 'N/A')],
+        ['Email:', contrato.get('cliente_email', 'N/A')],
+        ['Data Contrato:', _data_curta(contrato.get('created_at'))],
+        ['Forma Pagamento:', contrato.get('forma_pagamento', 'N/A')]
+    ], '#f0f0f0'))
+    elements.append(Spacer(1, 0.5*cm))
+
+    if contrato.get('servicos'):
+        elements.append(Paragraph('<b>SERVIÇOS CONTRATADOS</b>', styles['Heading2']))
+        servicos_data = [['Descrição', 'Profissional', 'Qtd', 'Valor Unit.', 'Total']]
+        for srv in contrato['servicos']:
+            servicos_data.append([
+                srv.get('nome', 'N/A'),
+                srv.get('profissional_nome', '-'),
+                str(srv.get('quantidade', 1)),
+                f"R$ {srv.get('preco', 0):.2f}",
+                f"R$ {srv.get('total', 0):.2f}"
+            ])
+        elements.append(_tabela_itens(servicos_data, [6*cm, 4*cm, 1.5*cm, 2.5*cm, 2*cm], '#4CAF50', col_centro=2))
+        elements.append(Spacer(1, 0.3*cm))
+
+    if contrato.get('produtos'):
+        elements.append(Paragraph('<b>PRODUTOS</b>', styles['Heading2']))
+        elements.append(_tabela_itens(_linhas_produtos(contrato['produtos']), [8*cm, 2*cm, 3*cm, 3*cm], '#2196F3'))
+        elements.append(Spacer(1, 0.3*cm))
+
+    elements.append(_tabela_totais(contrato, 'TOTAL DO CONTRATO'))
+
+    if contrato.get('observacoes'):
+        elements.append(Spacer(1, 0.5*cm))
+        elements.append(Paragraph('<b>OBSERVAÇÕES:</b>', styles['Heading3']))
+        elements.append(Paragraph(contrato['observacoes'], styles['Normal']))
+
+    # Termos e condições
+    elements.append(Spacer(1, 1*cm))
+    elements.append(Paragraph('<b>TERMOS E CONDIÇÕES</b>', styles['Heading3']))
+    termos = """Este contrato estabelece os serviços e produtos acordados entre as partes.
+    O cliente declara estar ciente dos valores e condições apresentados.
+    A BIOMA se compromete a prestar os serviços com excelência e profissionalismo."""
+    elements.append(Paragraph(termos, styles['Normal']))
+
+    # Assinaturas na MESMA PÁGINA das cláusulas (v7.0)
+    elements.append(Spacer(1, 1.5*cm))
+
+    data_assinatura = datetime.now().strftime('%d/%m/%Y')
+    cidade = "Uberaba/MG"
+
+    assinaturas_data = [
+        [f'{cidade}, {data_assinatura}', ''],
+        ['', ''],
+        ['_' * 40, '_' * 40],
+        ['<b>BIOMA Uberaba</b>', f'<b>{contrato.get("cliente_nome", "CLIENTE")}</b>'],
+        ['CNPJ: __.___.___/____-__', f'CPF: {contrato.get("cliente_cpf", "___.___.___-__")}']
+    ]
+
+    assinaturas_table = Table(assinaturas_data, colWidths=[8*cm, 8*cm])
+    assinaturas_table.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('FONTNAME', (0, 3), (-1, 3), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('TOPPADDING', (0, 2), (-1, 2), 0),
+        ('BOTTOMPADDING', (0, 2), (-1, 2), 2),
+    ]))
+    elements.append(assinaturas_table)
+
+    doc.build(elements)
+
+
+def _pdf_prontuario(dados, buffer):
+    """Prontuário de atendimento para impressão (Diretriz #21)"""
+    prontuario, cliente = dados['prontuario'], dados['cliente']
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = _estilos()
+    elements = []
+
+    elements.append(Paragraph("PRONTUÁRIO DE ATENDIMENTO", styles['CenteredTitle']))
+    elements.append(Spacer(1, 0.3*cm))
+
+    elements.append(Paragraph('<b>DADOS DO CLIENTE</b>', styles['Heading2']))
+    elements.append(_tabela_chave_valor([
+        ['Nome:', cliente.get('nome', 'N/A')],
+        ['CPF:', cliente.get('cpf', 'N/A')],
+        ['Telefone:', cliente.get('telefone', 'N/A')],
+        ['Email:', cliente.get('email', 'N/A')],
+        ['Data Nasc.:', cliente.get('data_nascimento', 'N/A')]
+    ], '#f0f0f0'))
+    elements.append(Spacer(1, 0.5*cm))
+
+    elements.append(Paragraph('<b>DADOS DO ATENDIMENTO</b>', styles['Heading2']))
+    data_atendimento = prontuario.get('data_atendimento')
+    if isinstance(data_atendimento, datetime):
+        data_atendimento = data_atendimento.strftime('%d/%m/%Y %H:%M')
+    elements.append(_tabela_chave_valor([
+        ['Data:', str(data_atendimento) if data_atendimento else 'N/A'],
+        ['Profissional:', prontuario.get('profissional', 'N/A')],
+        ['Procedimento:', prontuario.get('procedimento', 'N/A')],
+        ['Próxima Sessão:', prontuario.get('proxima_sessao', 'N/A')]
+    ], '#e3f2fd'))
+    elements.append(Spacer(1, 0.5*cm))
+
+    if prontuario.get('produtos_utilizados'):
+        elements.append(Paragraph('<b>PRODUTOS UTILIZADOS</b>', styles['Heading3']))
+        produtos_list = prontuario['produtos_utilizados']
+        if isinstance(produtos_list, list):
+            for produto in produtos_list:
+                elements.append(Paragraph(f"• {produto}", styles['Normal']))
+        elements.append(Spacer(1, 0.3*cm))
+
+    if prontuario.get('observacoes'):
+        elements.append(Paragraph('<b>OBSERVAÇÕES</b>', styles['Heading3']))
+        elements.append(Paragraph(prontuario['observacoes'], styles['Normal']))
+        elements.append(Spacer(1, 0.3*cm))
+
+    # Rodapé
+    elements.append(Spacer(1, 1*cm))
+    elements.append(Paragraph('Este documento é confidencial e destinado exclusivamente ao cliente.', styles['Footer']))
+    elements.append(Paragraph(f'Gerado em: {datetime.now().strftime("%d/%m/%Y às %H:%M")}', styles['Footer']))
+
+    doc.build(elements)
+
+
+class _FlowablesSobDemanda(list):
+    """
+    Lista consumida pelo doc.build a partir do início: quando fica curta, puxa o
+    próximo lote do gerador. Só os flowables da página corrente ficam em memória.
+    """
+
+    def __init__(self, gerador, lote):
+        super().__init__()
+        self._gerador = gerador
+        self._lote = lote
+        self._esgotado = False
+
+    def _encher(self):
+        while not self._esgotado and list.__len__(self) < self._lote:
+            try:
+                self.append(next(self._gerador))
+            except StopIteration:
+                self._esgotado = True
+
+    def __len__(self):
+        self._encher()
+        return list.__len__(self)
+
+    def __getitem__(self, indice):
+        self._encher()
+        return list.__getitem__(self, indice)
+
+
+def _texto(valor, limite=None):
+    """Texto do usuário escapado para o markup do Paragraph"""
+    texto = str(valor) if valor is not None else ''
+    if limite and len(texto) > limite:
+        texto = texto[:limite] + '...'
+    return escape(texto)
+
+
+def _data_historico(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime('%d/%m/%Y')
+    return _texto(valor) if valor else 'N/A'
+
+
+def _flowables_historico(cliente, resumo, documentos, anamneses, prontuarios, orcamentos):
+    """Gerador do histórico: cada cursor só é lido quando a seção chega à página"""
+    styles = _estilos()
+
+    yield Paragraph(f"HISTÓRICO COMPLETO - {_texto(cliente.get('nome', 'Cliente'))}", styles['CenteredTitle'])
+    yield Spacer(1, 0.5*cm)
+
+    estatisticas_table = Table([
+        ['Total de Atendimentos:', str(resumo['total_atendimentos'])],
+        ['Total Faturado:', f"R$ {resumo['total_faturado']:.2f}"],
+        ['Última Visita:', _data_curta(resumo.get('ultima_visita'))]
+    ], colWidths=[8*cm, 8*cm])
+    estatisticas_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), HexColor('#e8f5e9')),
+        ('GRID', (0, 0), (-1, -1), 0.5, black),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ]))
+    yield estatisticas_table
+    yield Spacer(1, 0.5*cm)
+
+    primeiro = True
+    for prontuario in prontuarios:
+        if primeiro:
+            yield Paragraph('<b>HISTÓRICO DE ATENDIMENTOS</b>', styles['Heading2'])
+            primeiro = False
+        yield Paragraph(
+            f"<b>{_data_historico(prontuario.get('data_atendimento'))}</b> - "
+            f"{_texto(prontuario.get('procedimento', 'Procedimento não especificado'))}",
+            styles['Normal']
+        )
+        if prontuario.get('profissional'):
+            yield Paragraph(f"Profissional: {_texto(prontuario.get('profissional'))}", styles['Normal'])
+        if prontuario.get('observacoes'):
+            yield Paragraph(f"Obs: {_texto(prontuario.get('observacoes'), 150)}", styles['Normal'])
+        yield Spacer(1, 0.2*cm)
+
+    primeiro = True
+    for anamnese in anamneses:
+        if primeiro:
+            yield Spacer(1, 0.3*cm)
+            yield Paragraph('<b>ANAMNESES</b>', styles['Heading2'])
+            primeiro = False
+        versao = f" (versão {anamnese['versao']})" if anamnese.get('versao') else ''
+        yield Paragraph(f"<b>{_data_historico(anamnese.get('data_cadastro'))}</b>{versao}", styles['Normal'])
+        for pergunta, resposta in (anamnese.get('respostas') or {}).items():
+            if resposta not in (None, '', []):
+                yield Paragraph(f"{_texto(pergunta)}: {_texto(resposta, 150)}", styles['Normal'])
+        if anamnese.get('observacoes'):
+            yield Paragraph(f"Obs: {_texto(anamnese.get('observacoes'), 150)}", styles['Normal'])
+        yield Spacer(1, 0.2*cm)
+
+    if documentos:
+        yield Spacer(1, 0.3*cm)
+        yield Paragraph('<b>DOCUMENTOS DE ANAMNESE FÍSICA</b>', styles['Heading2'])
+        for documento in documentos:
+            yield Paragraph(
+                f"{_texto(documento.get('filename') or 'Documento')} - enviado em "
+                f"{_texto(str(documento.get('data_upload') or 'N/A')[:10])}",
+                styles['Normal']
+            )
+
+    primeiro = True
+    for orcamento in orcamentos:
+        if primeiro:
+            yield Spacer(1, 0.3*cm)
+            yield Paragraph('<b>ORÇAMENTOS APROVADOS</b>', styles['Heading2'])
+            primeiro = False
+        numero = orcamento.get('numero') or str(orcamento['_id'])[-6:]
+        yield Paragraph(
+            f"<b>#{_texto(numero)}</b> - {_data_historico(orcamento.get('created_at'))} - "
+            f"R$ {orcamento.get('total_final') or 0:.2f}",
+            styles['Normal']
+        )
+
+
+def arquivo_historico(cliente, resumo, documentos, anamneses, prontuarios, orcamentos):
+    """
+    Histórico completo do cliente (Diretriz #21) em arquivo temporário
+
+    anamneses/prontuarios/orcamentos são iteráveis preguiçosos (cursores): os
+    flowables são gerados lote a lote conforme as páginas são montadas, e o PDF
+    vai para um SpooledTemporaryFile (disco acima de PDF_SPOOL_MAX_BYTES). Roda na
+    thread da requisição - cursores não atravessam o pool de processos.
+
+    Returns:
+        arquivo posicionado no início (quem envia fecha)
+    """
+    arquivo = SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+    try:
+        doc = SimpleDocTemplate(arquivo, pagesize=A4)
+        doc.build(_FlowablesSobDemanda(
+            _flowables_historico(cliente, resumo, documentos, anamneses, prontuarios, orcamentos),
+            HISTORICO_LOTE_FLOWABLES
+        ))
+        arquivo.seek(0)
+        return arquivo
+    except Exception:
+        arquivo.close()
+        raise
+
+
+def _pdf_resumo_cliente(cliente, buffer):
+    """Resumo com dados pessoais, anamnese e prontuário do cliente"""
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = _estilos()
+    elements = []
+
+    elements.append(Paragraph('RESUMO DO CLIENTE', styles['CustomTitle']))
+    elements.append(Spacer(1, 20))
+
+    elements.append(Paragraph('<b>DADOS PESSOAIS</b>', styles['Heading2']))
+    t = Table([
+        ['Nome:', cliente.get('nome', '-')],
+        ['CPF:', cliente.get('cpf', '-')],
+        ['Telefone:', cliente.get('telefone', '-')],
+        ['Email:', cliente.get('email', '-')],
+    ], colWidths=[4*cm, 12*cm])
+    t.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), HexColor('#F3F4F6')),
+        ('TEXTCOLOR', (0, 0), (-1, -1), black),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
+    ]))
+    elements.append(t)
+    elements.append(Spacer(1, 20))
+
+    anamnese = cliente.get('anamnese', {})
+    if anamnese:
+        elements.append(Paragraph('<b>ANAMNESE</b>', styles['Heading2']))
+        for key, value in anamnese.items():
+            elements.append(Paragraph(f'<b>{key}:</b> {value}', styles['Normal']))
+        elements.append(Spacer(1, 20))
+
+    prontuario = cliente.get('prontuario', [])
+    if prontuario:
+        elements.append(Paragraph('<b>PRONTUÁRIO</b>', styles['Heading2']))
+        for registro in prontuario:
+            elements.append(Paragraph(
+                f"<b>Data:</b> {registro.get('data', '-')} | "
+                f"<b>Procedimento:</b> {registro.get('procedimento', '-')}<br/>"
+                f"<b>Observações:</b> {registro.get('observacoes', '-')}",
+                styles['Normal']
+            ))
+            elements.append(Spacer(1, 10))
+
+    doc.build(elements)
+
+
+def _grafico_barras(rotulos, valores, cor, horizontal=False):
+    """Gráfico de barras vetorial (desenhado no servidor, sem imagem do navegador)"""
+    largura = A4[0] - 4*cm
+    if horizontal:
+        # Maior valor no topo: o eixo de categorias começa de baixo
+        rotulos, valores = list(reversed(rotulos)), list(reversed(valores))
+        altura = max(4*cm, 0.7*cm * len(valores) + 1.5*cm)
+        grafico = HorizontalBarChart()
+        grafico.x, grafico.y = 4.5*cm, 0.8*cm
+        rotulos = [r if len(r) <= 28 else r[:27] + '…' for r in rotulos]
+    else:
+        altura = 7*cm
+        grafico = VerticalBarChart()
+        grafico.x, grafico.y = 1.8*cm, 1.2*cm
+        grafico.categoryAxis.labels.angle = 30
+        grafico.categoryAxis.labels.boxAnchor = 'ne'
+    grafico.width = largura - grafico.x - 0.3*cm
+    grafico.height = altura - grafico.y - 0.3*cm
+    grafico.data = [valores]
+    grafico.categoryAxis.categoryNames = rotulos
+    grafico.categoryAxis.labels.fontSize = 7
+    grafico.valueAxis.labels.fontSize = 7
+    grafico.valueAxis.valueMin = 0
+    grafico.bars[0].fillColor = HexColor(cor)
+    grafico.bars[0].strokeColor = None
+
+    desenho = Drawing(largura, altura)
+    desenho.add(grafico)
+    return desenho
+
+
+def escrever_relatorio_financeiro(destino, periodo, vendas_mes, servicos_top):
+    """
+    Relatório financeiro com gráficos (vendas por mês e top serviços)
+
+    Args:
+        destino: caminho ou arquivo binário
+        periodo: texto do período ('01/01/2025 a 31/01/2025')
+        vendas_mes: [{'mes_ano', 'total_vendas', 'faturamento'}]
+        servicos_top: [{'nome', 'quantidade', 'faturamento'}]
+    """
+    doc = SimpleDocTemplate(destino, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm,
+                            topMargin=1.5*cm, bottomMargin=2.5*cm)
+    styles = _estilos()
+    elements = []
+
+    elements.append(Paragraph("RELATÓRIO FINANCEIRO", styles['ReportTitle']))
+    elements.append(Paragraph(f"Período: {_texto(periodo)}", styles['Normal']))
+    elements.append(Spacer(1, 1*cm))
+
+    secoes = [
+        ("Vendas por Mês", vendas_mes, 'mes_ano', ['Mês', 'Vendas', 'Faturamento'], 'total_vendas', '#7C3AED', False),
+        ("Top Serviços (Faturamento)", servicos_top, 'nome', ['Serviço', 'Execuções', 'Faturamento'], 'quantidade', '#F59E0B', True),
+    ]
+    for titulo, linhas, campo_rotulo, cabecalho, campo_qtd, cor, horizontal in secoes:
+        elements.append(Paragraph(titulo, styles['ReportSection']))
+        if not linhas:
+            elements.append(Paragraph("Sem dados no período.", styles['Normal']))
+            elements.append(Spacer(1, 1*cm))
+            continue
+        elements.append(_grafico_barras(
+            [str(l.get(campo_rotulo) or 'N/A') for l in linhas],
+            [float(l.get('faturamento') or 0) for l in linhas],
+            cor, horizontal
+        ))
+        elements.append(Spacer(1, 0.4*cm))
+        tabela = [cabecalho] + [
+            [str(l.get(campo_rotulo) or 'N/A')[:50], str(l.get(campo_qtd) or 0), _brl(l.get('faturamento'))]
+            for l in linhas
+        ]
+        elements.append(_tabela_itens(tabela, [9*cm, 3*cm, 4*cm], cor))
+        elements.append(Spacer(1, 1*cm))
+
+    doc.build(elements)
+
+
+RENDERIZADORES = {
+    'orcamento_contrato': _pdf_orcamento_contrato,
+    'orcamento': _pdf_orcamento,
+    'contrato': _pdf_contrato,
+    'prontuario': _pdf_prontuario,
+    'resumo_cliente': _pdf_resumo_cliente,
+}
+
+
+def renderizar(tipo, dados):
+    """Montar o PDF e devolver os bytes (executa dentro do worker)"""
+    buffer = BytesIO()
+    RENDERIZADORES[tipo](dados, buffer)
+    return buffer.getvalue()
+
+
+# ==================== CACHE E POOL ====================
+
+class PDFTimeout(Exception):
+    """PDF não ficou pronto em PDF_TIMEOUT_S (pool ocupado) - a rota responde 504"""
+
+
+class _CachePDF:
+    """Cache LRU de PDFs prontos limitado por bytes (thread-safe)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            pdf = self._itens.get(chave)
+            if pdf is not None:
+                self._itens.move_to_end(chave)
+            return pdf
+
+    def set(self, chave, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            antigo = self._itens.pop(chave, None)
+            if antigo is not None:
+                self._bytes -= len(antigo)
+            self._itens[chave] = pdf
+            self._bytes += len(pdf)
+            while self._bytes > self.max_bytes:
+                _, removido = self._itens.popitem(last=False)
+                self._bytes -= len(removido)
+
+
+pdf_cache = _CachePDF(PDF_CACHE_MAX_BYTES)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def chave_pdf(tipo, dados):
+    """
+    Hash do conteúdo do documento
+
+    Cobre _id + updated_at e também edições que não atualizam updated_at
+    (ex.: cliente renomeado refletindo no orçamento).
+    """
+    h = hashlib.sha1(f'{PDF_VERSAO}:{tipo}:'.encode())
+    if tipo in TIPOS_DATADOS:
+        h.update(date.today().isoformat().encode())
+    h.update(json.dumps(dados, sort_keys=True, default=str, ensure_ascii=False).encode())
+    return f'{tipo}:{h.hexdigest()}'
+
+
+def _contexto():
+    """
+    Processos a partir de um forkserver limpo: nada de herdar threads/sockets do
+    MongoClient do processo web. Só este módulo é pré-carregado - o __main__
+    (run.py cria o app) fica de fora.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+def _obter_pool():
+    global _pool
+    if PDF_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=_contexto(),
+                initializer=_inicializar_worker
+            )
+            logger.info(f"🖨️ Pool de PDFs iniciado com {PDF_WORKERS} processos")
+        return _pool
+
+
+def _descartar_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def gerar_pdf(tipo, dados):
+    """
+    Bytes do PDF `tipo` para `dados` (documento já lido do MongoDB)
+
+    Consulta o cache antes de renderizar. Sem pool disponível (processo
+    quebrado, ambiente sem fork/spawn) o PDF é montado na própria thread.
+
+    Raises:
+        PDFTimeout: o pool não entregou em PDF_TIMEOUT_S
+    """
+    chave = chave_pdf(tipo, dados)
+    pdf = pdf_cache.get(chave)
+    registrar_cache(pdf is not None)
+    if pdf is not None:
+        return pdf
+
+    try:
+        pool = _obter_pool()
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Pool de PDFs indisponível, renderizando na requisição: {e}")
+        pool = None
+
+    if pool is None:
+        pdf = renderizar(tipo, dados)
+    else:
+        futuro = pool.submit(renderizar, tipo, dados)
+        try:
+            pdf = futuro.result(timeout=PDF_TIMEOUT_S)
+        except FuturesTimeoutError:
+            # Ainda na fila sai dela; já renderizando termina e é descartado
+            futuro.cancel()
+            logger.warning(f"⏱️ PDF {tipo} não ficou pronto em {PDF_TIMEOUT_S}s")
+            raise PDFTimeout(f'PDF não ficou pronto em {PDF_TIMEOUT_S}s. Tente novamente.')
+        except BrokenProcessPool as e:
+            logger.warning(f"⚠️ Pool de PDFs quebrado, recriando: {e}")
+            _descartar_pool(pool)
+            pdf = renderizar(tipo, dados)
+
+    pdf_cache.set(chave, pdf)
+    return pdf
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Exportação de Relatórios em Background
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Exportações (PDF/XLSX) saem da requisição: exportar() cria um job na categoria
+'relatorio', o worker grava o arquivo em EXPORT_DIR e o navegador recebe a
+conclusão via SSE (job_progress) com a URL de download (com suporte a Range).
+Parâmetros idênticos caem na mesma chave: enquanto o arquivo estiver válido
+(EXPORT_TTL) o job existente é reaproveitado em vez de gerar outro, e a chave
+é reservada atomicamente (chave_unica do JobManager) enquanto o job roda.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from time import time
+
+from application.exports import (
+    MIMETYPE_XLSX, COLUNAS_PRODUTOS, PLANILHA_CURSOR_LOTE, escrever_planilha
+)
+from application.jobs import JobDuplicado, job_ativo
+from application.pdf import escrever_relatorio_financeiro
+from application.stock import avaliar_estoque, filtro_nivel
+
+logger = logging.getLogger(__name__)
+
+# Diretório local dos arquivos gerados (compartilhado pelos workers da instância)
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'bioma_exports'))
+
+# Validade de um arquivo gerado (download e reaproveitamento por parâmetros iguais)
+EXPORT_TTL = timedelta(minutes=30)
+
+# Limite de itens no ranking de serviços do relatório financeiro
+SERVICOS_TOP_LIMITE = 10
+
+
+def _periodo(params):
+    """Filtro de created_at/data a partir de data_inicio/data_fim (YYYY-MM-DD)"""
+    filtro = {}
+    if params.get('data_inicio'):
+        filtro['$gte'] = datetime.strptime(params['data_inicio'], '%Y-%m-%d')
+    if params.get('data_fim'):
+        filtro['$lte'] = datetime.strptime(params['data_fim'], '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+    return filtro
+
+
+def _texto_periodo(params):
+    def br(valor):
+        return datetime.strptime(valor, '%Y-%m-%d').strftime('%d/%m/%Y') if valor else None
+    inicio, fim = br(params.get('data_inicio')), br(params.get('data_fim'))
+    if not inicio and not fim:
+        return 'Todo o período'
+    return f"{inicio or 'início'} a {fim or 'hoje'}"
+
+
+# ==================== GERADORES ====================
+
+def _relatorio_financeiro_pdf(db, params, destino, progresso):
+    """Vendas por mês e top serviços com gráficos desenhados no servidor"""
+    match = {'status': 'Aprovado'}
+    periodo = _periodo(params)
+    if periodo:
+        match['created_at'] = periodo
+
+    vendas_mes = list(db.orcamentos.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {'ano': {'$year': '$created_at'}, 'mes': {'$month': '$created_at'}},
+            'total_vendas': {'$sum': 1},
+            'faturamento': {'$sum': '$total_final'}
+        }},
+        {'$sort': {'_id.ano': 1, '_id.mes': 1}}
+    ]))
+    for v in vendas_mes:
+        v['mes_ano'] = f"{v['_id']['mes']}/{v['_id']['ano']}"
+    progresso(etapa='vendas_mes', meses=len(vendas_mes))
+
+    servicos_top = list(db.orcamentos.aggregate([
+        {'$match': match},
+        {'$unwind': '$servicos'},
+        {'$match': {'servicos.id': {'$nin': [None, '']}}},
+        {'$group': {
+            '_id': '$servicos.id',
+            'nome': {'$first': '$servicos.nome'},
+            'quantidade': {'$sum': {'$ifNull': ['$servicos.qtd', 1]}},
+            'faturamento': {'$sum': {'$ifNull': ['$servicos.total', 0]}}
+        }},
+        {'$sort': {'faturamento': -1}},
+        {'$limit': SERVICOS_TOP_LIMITE}
+    ]))
+    progresso(etapa='servicos_top', servicos=len(servicos_top))
+
+    escrever_relatorio_financeiro(destino, _texto_periodo(params), vendas_mes, servicos_top)
+
+
+def _relatorio_estoque_xlsx(db, params, destino, progresso):
+    """Resumo do estoque, produtos mais movimentados no período e lista completa"""
+    total_produtos = db.produtos.count_documents({})
+    valor_total = avaliar_estoque(db)['total']['valor_venda']
+    baixo_estoque = db.produtos.count_documents(filtro_nivel())
+    sem_estoque = db.produtos.count_documents({'estoque': 0})
+    progresso(etapa='resumo')
+
+    periodo = _periodo(params) or {'$gte': datetime.now() - timedelta(days=30)}
+    mais_movimentados = list(db.estoque_movimentacoes.aggregate([
+        {'$match': {'data': periodo}},
+        {'$group': {
+            '_id': '$produto_id',
+            'total_movimentacoes': {'$sum': 1},
+            'total_quantidade': {'$sum': '$quantidade'}
+        }},
+        {'$sort': {'total_movimentacoes': -1}},
+        {'$limit': 5}
+    ]))
+    nomes = {
+        p['_id']: p.get('nome')
+        for p in db.produtos.find({'_id': {'$in': [m['_id'] for m in mais_movimentados]}}, {'nome': 1})
+    }
+    progresso(etapa='movimentacoes')
+
+    resumo = [
+        {'indicador': 'Total de Produtos', 'valor': total_produtos},
+        {'indicador': 'Valor Total Estoque', 'valor': f'R$ {valor_total:.2f}'},
+        {'indicador': 'Produtos Baixo Estoque', 'valor': baixo_estoque},
+        {'indicador': 'Produtos Sem Estoque', 'valor': sem_estoque},
+    ]
+    movimentados = (
+        {'produto': nomes.get(item['_id'], 'N/A'), **item}
+        for item in mais_movimentados
+    )
+    # Lista completa de produtos direto do cursor (write_only: memória constante)
+    produtos = db.produtos.find({}, {campo: 1 for campo, _rotulo, _tipo in COLUNAS_PRODUTOS}) \
+        .sort('nome', 1).batch_size(PLANILHA_CURSOR_LOTE)
+    escrever_planilha(destino, [
+        ('Relatório de Estoque', [('indicador', 'Indicador', None), ('valor', 'Valor', None)], resumo),
+        ('Mais Movimentados', [
+            ('produto', 'Produto', None),
+            ('total_movimentacoes', 'Total Movimentações', 'numero'),
+            ('total_quantidade', 'Quantidade Total', 'numero'),
+        ], movimentados),
+        ('Produtos', COLUNAS_PRODUTOS, produtos),
+    ])
+
+
+# tipo -> gerador, formato e perfis autorizados (None = qualquer usuário logado)
+RELATORIOS = {
+    'financeiro_pdf': {
+        'gerar': _relatorio_financeiro_pdf,
+        'extensao': 'pdf',
+        'mimetype': 'application/pdf',
+        'nome': 'relatorio_financeiro',
+        'perfis': ('Admin', 'Gestão'),
+    },
+    'estoque_xlsx': {
+        'gerar': _relatorio_estoque_xlsx,
+        'extensao': 'xlsx',
+        'mimetype': MIMETYPE_XLSX,
+        'nome': 'relatorio_estoque',
+        'perfis': None,
+    },
+}
+
+
+# ==================== JOBS E ARQUIVOS ====================
+
+def normalizar_parametros(tipo, params):
+    """
+    Parâmetros aceitos do relatório em forma canônica (base da deduplicação)
+
+    Datas viram YYYY-MM-DD (aceita também ISO completo vindo do navegador).
+
+    Raises:
+        ValueError: tipo desconhecido ou data inválida
+    """
+    if tipo not in RELATORIOS:
+        raise ValueError(f"Relatório '{tipo}' não suportado")
+    normalizados = {}
+    for campo in ('data_inicio', 'data_fim'):
+        valor = (params or {}).get(campo)
+        if valor:
+            try:
+                normalizados[campo] = datetime.strptime(str(valor)[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f"Data inválida em {campo}: {valor}")
+    return normalizados
+
+
+def chave_exportacao(tipo, params):
+    bruto = json.dumps({'tipo': tipo, 'params': params}, sort_keys=True)
+    return hashlib.sha1(bruto.encode()).hexdigest()
+
+
+def caminho_artefato(chave, tipo):
+    return os.path.join(EXPORT_DIR, f"{chave}.{RELATORIOS[tipo]['extensao']}")
+
+
+def artefato_disponivel(job, agora=None):
+    """Caminho do arquivo de um job concluído, se ainda válido (None caso contrário)"""
+    if not job or job.get('status') != 'concluido':
+        return None
+    resultado = job.get('resultado') or {}
+    expira_em = resultado.get('expira_em')
+    if not expira_em or datetime.fromisoformat(expira_em) <= (agora or datetime.now()):
+        return None
+    caminho = caminho_artefato(job['chave'], job['tipo'])
+    return caminho if os.path.exists(caminho) else None
+
+
+def limpar_artefatos(agora=None):
+    """Remover arquivos vencidos do EXPORT_DIR (chamado a cada nova exportação)"""
+    limite = (agora or datetime.now()) - EXPORT_TTL
+    removidos = 0
+    try:
+        entradas = list(os.scandir(EXPORT_DIR))
+    except FileNotFoundError:
+        return 0
+    for entrada in entradas:
+        try:
+            if entrada.is_file() and datetime.fromtimestamp(entrada.stat().st_mtime) < limite:
+                os.remove(entrada.path)
+                removidos += 1
+        except OSError:
+            pass
+    if removidos:
+        logger.info(f"🧹 {removidos} exportações vencidas removidas")
+    return removidos
+
+
+def executar_exportacao(progresso, db, tipo, params, chave):
+    """Job: gerar o arquivo em temporário e publicar com rename atômico"""
+    inicio = time()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    destino = caminho_artefato(chave, tipo)
+    fd, temporario = tempfile.mkstemp(prefix='.gerando_', dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        RELATORIOS[tipo]['gerar'](db, params, temporario, progresso)
+        os.replace(temporario, destino)
+    except Exception:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+    tamanho = os.path.getsize(destino)
+    logger.info(f"📄 Exportação {tipo} gerada: {tamanho // 1024}KB em {time() - inicio:.1f}s")
+    return {
+        'bytes': tamanho,
+        'mimetype': RELATORIOS[tipo]['mimetype'],
+        'expira_em': (datetime.now() + EXPORT_TTL).isoformat(),
+    }
+
+
+def exportar(db, jobs, tipo, params, usuario_id=None):
+    """
+    Enfileirar a exportação (ou reaproveitar uma idêntica)
+
+    Returns:
+        (job, reaproveitado) - job é o documento da coleção `jobs`
+
+    Raises:
+        ValueError: parâmetros inválidos
+        JobQueueFull: fila de relatórios cheia
+    """
+    params = normalizar_parametros(tipo, params)
+    chave = chave_exportacao(tipo, params)
+    agora = datetime.now()
+
+    concluido = db.jobs.find_one(
+        {'categoria': jobs.categoria, 'chave': chave, 'status': 'concluido'},
+        sort=[('created_at', -1)]
+    )
+    if concluido and artefato_disponivel(concluido, agora):
+        return concluido, True
+
+    ativo = job_ativo(db, jobs.categoria, chave)
+    if ativo is not None:
+        return ativo, True
+
+    limpar_artefatos(agora)
+    # A reserva da chave é o próprio insert do job (índice único em chave_ativa):
+    # dois cliques ou dois workers com os mesmos parâmetros caem no mesmo job
+    for _tentativa in range(2):
+        try:
+            job_id = jobs.submit(
+                db, executar_exportacao, db, tipo, params, chave,
+                descricao=f"{tipo} {_texto_periodo(params)}",
+                usuario_id=usuario_id,
+                campos={'tipo': tipo, 'chave': chave, 'params': params},
+                chave_unica=chave
+            )
+            return db.jobs.find_one({'_id': job_id}), False
+        except JobDuplicado as e:
+            # Órfão é recolhido por job_ativo, liberando a chave para a nova tentativa
+            ativo = job_ativo(db, jobs.categoria, chave) if e.job else None
+            if ativo is not None:
+                return ativo, True
+    raise ValueError('Não foi possível reservar a exportação. Tente novamente.')
+
+
+def nome_download(job):
+    """Nome do arquivo entregue ao navegador"""
+    config = RELATORIOS[job['tipo']]
+    data = job.get('finished_at') or datetime.now()
+    return f"{config['nome']}_{data.strftime('%Y%m%d_%H%M%S')}.{config['extensao']}"
@@ -0,0 +1,742 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Índice de Busca em Memória (trigramas)
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Busca "contém" sem acento e sem caixa sobre os campos pesquisáveis de
+clientes, profissionais, produtos e serviços. Um $regex sem âncora não usa
+índice (varredura completa a cada tecla), então cada processo mantém um
+índice invertido trigrama → ids, montado na inicialização a partir de
+cursores projetados e mantido pelos pontos de escrita (alterado()).
+
+A busca devolve só os ids ranqueados; o Mongo é consultado apenas para
+hidratar os K primeiros resultados (hidratar()).
+
+Campos-sombra (nome_busca, email_busca, cpf_busca...): versão dobrada dos
+campos pesquisáveis, gravada junto com o documento (campos_busca()), para
+que as consultas no Mongo sejam prefixos ancorados (^termo) servidos por
+faixa de índice em vez de $regex com $options 'i'.
+
+Autocomplete (sugerir()): cada índice guarda também um array ordenado com
+os sufixos de palavra do nome ("joao da silva", "da silva", "silva"); o
+prefixo digitado vira uma busca binária e os candidatos são ordenados pela
+popularidade recente (orçamentos dos últimos POPULARIDADE_JANELA dias).
+Prefixos curtos (os mais caros) têm o topo pré-ranqueado e mantido a cada
+escrita; a popularidade é recalculada a cada reconstrução.
+
+Com vários workers cada processo tem o seu índice: escritas feitas em outro
+processo aparecem após a reconstrução periódica (INDICE_BUSCA_TTL) e
+documentos já removidos somem naturalmente na hidratação. O índice é montado
+sob demanda na primeira busca de cada processo - com preload_app do gunicorn
+uma thread iniciada no master não existe nos workers, e o estado herdado no
+fork (lock, reconstruções em andamento) é descartado em _apos_fork().
+"""
+
+import contextvars
+import heapq
+import logging
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from time import time
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import ExecutionTimeout
+
+from application.importer import remover_acentos
+
+logger = logging.getLogger(__name__)
+
+# Campos pesquisáveis por coleção (o primeiro é o nome, usado no ranking)
+CAMPOS_BUSCA = {
+    'clientes': ('nome', 'cpf', 'email', 'telefone'),
+    'profissionais': ('nome', 'cpf', 'email', 'especialidade'),
+    'produtos': ('nome', 'marca', 'sku'),
+    'servicos': ('nome', 'categoria', 'tipo', 'descricao'),
+}
+
+# Campos com versão dobrada gravada no documento (<campo>_busca)
+CAMPOS_SOMBRA = {
+    'clientes': ('nome', 'email', 'cpf', 'telefone'),
+    'profissionais': ('nome', 'email', 'cpf', 'telefone'),
+    'produtos': ('nome', 'marca', 'sku'),
+    'servicos': ('nome', 'categoria', 'tipo', 'descricao'),
+}
+
+# Guardados só com os dígitos (máscara de CPF/telefone não importa)
+CAMPOS_SOMENTE_DIGITOS = ('cpf', 'telefone')
+
+# Incrementar quando a normalização mudar: a migração regrava tudo
+BUSCA_VERSAO = 2  # v2: tipo e descricao dos serviços
+MIGRACAO_BUSCA_LOTE = 500
+
+# Reconstrução completa de uma coleção (escritas de outros workers)
+INDICE_BUSCA_TTL = 300
+
+# Autocomplete: cota por tipo (coleção, tipo na resposta, quantidade) e total
+SUGESTOES_POR_TIPO = (
+    ('clientes', 'cliente', 5),
+    ('produtos', 'produto', 5),
+    ('profissionais', 'profissional', 3),
+    ('servicos', 'servico', 5),
+)
+SUGESTOES_MAX = 15
+
+# Cache HTTP das sugestões (depois disso o navegador revalida pelo ETag)
+SUGESTOES_MAX_AGE = 30
+
+# Prefixos curtos com as sugestões pré-ranqueadas (até SUGESTOES_TOPO por prefixo)
+SUGESTOES_PREFIXO_CURTO = 3
+SUGESTOES_TOPO = 10
+SUGESTOES_MEMO = 2048
+
+# Busca federada: prazo total (relógio) e maxTimeMS de cada fonte
+BUSCA_PRAZO_S = 1.0
+BUSCA_FONTE_MAX_MS = 800
+# Fonte que estourou o prazo há menos de BUSCA_FONTE_LENTA_S segundos: vai por
+# último e com maxTimeMS reduzido (não segura o Mongo enquanto está lenta)
+BUSCA_FONTE_LENTA_S = 60
+BUSCA_FONTE_LENTA_MAX_MS = 200
+BUSCA_WORKERS = 8
+
+# Popularidade = quantidade de orçamentos recentes com o cliente/serviço/produto/profissional
+POPULARIDADE_JANELA = timedelta(days=90)
+
+# Termo só com dígitos e pontuação (CPF/telefone digitado com ou sem máscara)
+_RE_NUMERICO = re.compile(r'^[\d\s.\-()/+]+$')
+_RE_NAO_DIGITO = re.compile(r'\D')
+
+
+def dobrar(texto):
+    """Forma comparável: sem acentos, minúscula e espaços colapsados"""
+    if texto is None:
+        return ''
+    return ' '.join(remover_acentos(str(texto)).lower().split())
+
+
+def valor_busca(campo, valor):
+    """Valor do campo-sombra: só dígitos para CPF/telefone, texto dobrado nos demais"""
+    if campo in CAMPOS_SOMENTE_DIGITOS:
+        return _RE_NAO_DIGITO.sub('', str(valor or ''))
+    return dobrar(valor)
+
+
+def campos_busca(colecao, dados):
+    """
+    Campos-sombra dos campos presentes em `dados` (documento novo ou $set)
+
+    Usar em toda escrita: doc.update(campos_busca('clientes', doc)). Com todos
+    os campos presentes (documento novo, edição completa) inclui busca_versao e
+    migrar_campos_busca não volta a ele; num $set parcial de documento legado
+    os outros campos-sombra ainda faltam, então a versão não é gravada.
+    """
+    campos = CAMPOS_SOMBRA.get(colecao, ())
+    sombra = {
+        f'{campo}_busca': valor_busca(campo, dados[campo])
+        for campo in campos
+        if campo in dados
+    }
+    if campos and all(campo in dados for campo in campos):
+        sombra['busca_versao'] = BUSCA_VERSAO
+    return sombra
+
+
+def consulta_prefixo(colecao, termo, campos=None):
+    """
+    Filtro $or de prefixos ancorados nos campos-sombra
+
+    Campos só-dígitos entram apenas quando o termo é numérico. Returns None se
+    nenhum campo se aplica ao termo.
+    """
+    numerico = bool(_RE_NUMERICO.match(termo or ''))
+    condicoes = []
+    for campo in campos or CAMPOS_SOMBRA[colecao]:
+        if campo in CAMPOS_SOMENTE_DIGITOS and not numerico:
+            continue
+        valor = valor_busca(campo, termo)
+        if valor:
+            condicoes.append({f'{campo}_busca': {'$regex': '^' + re.escape(valor)}})
+    if not condicoes:
+        return None
+    return {'$or': condicoes} if len(condicoes) > 1 else condicoes[0]
+
+
+def migrar_campos_busca(db, progresso=None, lote=MIGRACAO_BUSCA_LOTE):
+    """
+    Preencher os campos-sombra dos documentos gravados antes deles existirem
+
+    Percorre cada coleção em lotes por _id, só os documentos sem busca_versao
+    atual; é idempotente e pode ser interrompida e retomada.
+
+    Returns:
+        dict {colecao: documentos atualizados}
+    """
+    resumo = {}
+    for colecao, campos in CAMPOS_SOMBRA.items():
+        projecao = {campo: 1 for campo in campos}
+        filtro = {'busca_versao': {'$ne': BUSCA_VERSAO}}
+        atualizados = 0
+        while True:
+            docs = list(db[colecao].find(filtro, projecao).sort('_id', 1).limit(lote))
+            if not docs:
+                break
+            db[colecao].bulk_write([
+                UpdateOne({'_id': doc['_id']}, {'$set': campos_busca(colecao, {campo: doc.get(campo) for campo in campos})})
+                for doc in docs
+            ], ordered=False)
+            atualizados += len(docs)
+            filtro['_id'] = {'$gt': docs[-1]['_id']}
+            if progresso:
+                progresso(colecao=colecao, atualizados=atualizados)
+        resumo[colecao] = atualizados
+        if atualizados:
+            logger.info(f"🔎 Campos de busca: {atualizados} documentos de '{colecao}' atualizados")
+    return resumo
+
+
+def trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+def _valores(doc, campos):
+    """Valores dobrados de cada campo; campos com dígitos ganham a versão só-dígitos"""
+    valores = []
+    for campo in campos:
+        valor = dobrar(doc.get(campo))
+        valores.append(valor)
+        digitos = _RE_NAO_DIGITO.sub('', valor)
+        if digitos and digitos != valor:
+            valores.append(digitos)
+    return tuple(valores)
+
+
+def _pontuacao(valores, termo):
+    """
+    Relevância do documento para o termo (menor = melhor), None se não casa
+
+    0: nome começa com o termo, 1: alguma palavra do nome começa com o termo,
+    2: nome contém o termo, 3: outro campo contém o termo.
+    """
+    nome = valores[0] if valores else ''
+    posicao = nome.find(termo)
+    if posicao == 0:
+        return 0
+    if posicao > 0:
+        return 1 if nome[posicao - 1] == ' ' or f' {termo}' in nome else 2
+    for valor in valores[1:]:
+        if termo in valor:
+            return 3
+    return None
+
+
+def _sufixos(nome):
+    """Sufixos de palavra do nome dobrado: o autocomplete casa o início de qualquer palavra"""
+    palavras = nome.split()
+    return {' '.join(palavras[i:]) for i in range(len(palavras))}
+
+
+class IndiceTrigramas:
+    """
+    Índice invertido de uma coleção: trigrama → conjunto de chaves (str(_id))
+
+    Autocomplete: `prefixos` é a lista ordenada de (sufixo do nome, chave) e
+    `topo` guarda, para cada prefixo de até SUGESTOES_PREFIXO_CURTO
+    caracteres, as SUGESTOES_TOPO chaves mais populares (os prefixos curtos
+    casam com boa parte da coleção e seriam os mais caros de ranquear).
+    """
+
+    def __init__(self, campos, popularidade=None):
+        self.campos = campos
+        self.popularidade = popularidade or {}
+        self.docs = {}
+        self.ids = {}
+        self.nomes = {}
+        self.postings = defaultdict(set)
+        self.prefixos = []
+        self.topo = {}
+        self._topo_incompleto = set()
+        # Prefixos longos já respondidos (limpo a cada alteração)
+        self._memo = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _ordem(self, chave):
+        """Ordem das sugestões: mais popular primeiro, depois alfabética"""
+        return (-self.popularidade.get(chave, 0), self.docs[chave][0], chave)
+
+    def carregar(self, docs):
+        """Carga inicial: ordena os prefixos e monta o topo uma única vez no fim"""
+        for doc in docs:
+            self.adicionar(doc, incremental=False)
+        self.prefixos.sort()
+
+        por_prefixo = defaultdict(set)
+        for sufixo, chave in self.prefixos:
+            for n in range(1, min(len(sufixo), SUGESTOES_PREFIXO_CURTO) + 1):
+                por_prefixo[sufixo[:n]].add(chave)
+        self.topo = {
+            prefixo: heapq.nsmallest(SUGESTOES_TOPO, chaves, key=self._ordem)
+            for prefixo, chaves in por_prefixo.items()
+        }
+
+    def adicionar(self, doc, incremental=True):
+        chave = str(doc['_id'])
+        self.remover(chave)
+        self._memo.clear()
+        valores = _valores(doc, self.campos)
+        self.docs[chave] = valores
+        self.ids[chave] = doc['_id']
+        self.nomes[chave] = doc.get('nome') or ''
+        for valor in valores:
+            for trigrama in trigramas(valor):
+                self.postings[trigrama].add(chave)
+        for sufixo in _sufixos(valores[0]):
+            if not incremental:
+                self.prefixos.append((sufixo, chave))
+                continue
+            insort(self.prefixos, (sufixo, chave))
+            ordem = self._ordem(chave)
+            for n in range(1, min(len(sufixo), SUGESTOES_PREFIXO_CURTO) + 1):
+                topo = self.topo.setdefault(sufixo[:n], [])
+                if chave in topo:
+                    continue
+                if len(topo) < SUGESTOES_TOPO or ordem < self._ordem(topo[-1]):
+                    topo.append(chave)
+                    topo.sort(key=self._ordem)
+                    del topo[SUGESTOES_TOPO:]
+
+    def remover(self, chave):
+        valores = self.docs.get(chave)
+        if valores is None:
+            return
+        self._memo.clear()
+        for sufixo in _sufixos(valores[0]):
+            i = bisect_left(self.prefixos, (sufixo, chave))
+            if i < len(self.prefixos) and self.prefixos[i] == (sufixo, chave):
+                del self.prefixos[i]
+            for n in range(1, min(len(sufixo), SUGESTOES_PREFIXO_CURTO) + 1):
+                topo = self.topo.get(sufixo[:n])
+                if topo and chave in topo:
+                    # Lista cheia perdeu um item: o substituto só é conhecido varrendo a faixa
+                    if len(topo) == SUGESTOES_TOPO:
+                        self._topo_incompleto.add(sufixo[:n])
+                    topo.remove(chave)
+        del self.docs[chave]
+        self.ids.pop(chave, None)
+        self.nomes.pop(chave, None)
+        for valor in valores:
+            for trigrama in trigramas(valor):
+                postings = self.postings.get(trigrama)
+                if postings is not None:
+                    postings.discard(chave)
+                    if not postings:
+                        del self.postings[trigrama]
+
+    def _candidatos(self, termo):
+        """Interseção das listas dos trigramas do termo (da menor para a maior)"""
+        grams = trigramas(termo)
+        if not grams:
+            # Termos de 1-2 caracteres: varredura da memória (sem trigramas)
+            return self.docs.keys()
+        listas = []
+        for trigrama in grams:
+            postings = self.postings.get(trigrama)
+            if not postings:
+                return ()
+            listas.append(postings)
+        listas.sort(key=len)
+        return set.intersection(*listas) if len(listas) > 1 else listas[0]
+
+    def buscar(self, termo, limite):
+        """
+        Chaves dos `limite` documentos mais relevantes
+
+        A interseção de trigramas pode trazer falsos positivos (trigramas em
+        campos ou posições diferentes), por isso cada candidato é conferido.
+        """
+        termos = [termo]
+        if _RE_NUMERICO.match(termo):
+            digitos = _RE_NAO_DIGITO.sub('', termo)
+            if digitos and digitos != termo:
+                termos.append(digitos)
+
+        pontuados = {}
+        for t in termos:
+            for chave in self._candidatos(t):
+                valores = self.docs[chave]
+                pontos = _pontuacao(valores, t)
+                if pontos is not None and pontos < pontuados.get(chave, 4):
+                    pontuados[chave] = pontos
+
+        return heapq.nsmallest(
+            limite, pontuados,
+            key=lambda chave: (pontuados[chave], self.docs[chave][0], chave)
+        )
+
+    def _faixa(self, prefixo):
+        """Chaves com algum sufixo começando pelo prefixo (busca binária + varredura da faixa)"""
+        chaves = set()
+        i = bisect_left(self.prefixos, (prefixo,))
+        while i < len(self.prefixos) and self.prefixos[i][0].startswith(prefixo):
+            chaves.add(self.prefixos[i][1])
+            i += 1
+        return chaves
+
+    def sugerir(self, prefixo, limite):
+        """Chaves dos `limite` nomes mais populares com uma palavra começando pelo prefixo"""
+        if len(prefixo) <= SUGESTOES_PREFIXO_CURTO and limite <= SUGESTOES_TOPO:
+            if prefixo in self._topo_incompleto:
+                self.topo[prefixo] = heapq.nsmallest(SUGESTOES_TOPO, self._faixa(prefixo), key=self._ordem)
+                self._topo_incompleto.discard(prefixo)
+            return self.topo.get(prefixo, [])[:limite]
+
+        resultado = self._memo.get((prefixo, limite))
+        if resultado is None:
+            if len(self._memo) >= SUGESTOES_MEMO:
+                self._memo.clear()
+            resultado = self._memo[(prefixo, limite)] = heapq.nsmallest(limite, self._faixa(prefixo), key=self._ordem)
+        return resultado
+
+
+def popularidade_recente(db, agora=None):
+    """
+    Quantidade de orçamentos recentes por cliente, serviço, produto e profissional
+
+    Uma agregação ($facet) sobre os orçamentos da janela; clientes são
+    ligados pelo CPF do orçamento.
+
+    Returns:
+        dict {colecao: {str(_id): quantidade}}
+    """
+    inicio = (agora or datetime.now()) - POPULARIDADE_JANELA
+    como_texto = {'$toString': '$$this.profissional_id'}
+    pipeline = [
+        {'$match': {'created_at': {'$gte': inicio}}},
+        {'$facet': {
+            'clientes': [
+                {'$match': {'cliente_cpf': {'$nin': [None, '']}}},
+                {'$group': {'_id': '$cliente_cpf', 'n': {'$sum': 1}}}
+            ],
+            'servicos': [
+                {'$unwind': '$servicos'},
+                {'$group': {'_id': '$servicos.id', 'n': {'$sum': 1}}}
+            ],
+            'produtos': [
+                {'$unwind': '$produtos'},
+                {'$group': {'_id': '$produtos.id', 'n': {'$sum': 1}}}
+            ],
+            'profissionais': [
+                {'$project': {'ids': {'$setUnion': [
+                    {'$map': {'input': {'$ifNull': ['$servicos', []]}, 'in': como_texto}},
+                    {'$map': {'input': {'$ifNull': ['$profissionais_vinculados', []]}, 'in': como_texto}},
+                ]}}},
+                {'$unwind': '$ids'},
+                {'$group': {'_id': '$ids', 'n': {'$sum': 1}}}
+            ],
+        }}
+    ]
+    facetas = next(db.orcamentos.aggregate(pipeline), {})
+
+    resultado = {}
+    for colecao in ('servicos', 'produtos', 'profissionais'):
+        resultado[colecao] = {str(d['_id']): d['n'] for d in facetas.get(colecao, []) if d['_id']}
+
+    por_cpf = {d['_id']: d['n'] for d in facetas.get('clientes', [])}
+    resultado['clientes'] = {
+        str(c['_id']): por_cpf[c['cpf']]
+        for c in db.clientes.find({'cpf': {'$in': list(por_cpf)}}, {'cpf': 1})
+    } if por_cpf else {}
+    return resultado
+
+
+class IndiceBusca:
+    """
+    Índices de todas as coleções pesquisáveis do processo
+
+    Leituras e escritas pontuais seguram o lock por microssegundos; a
+    reconstrução de uma coleção monta um índice novo fora do lock e troca a
+    referência no fim, reaplicando as alterações que chegaram no meio.
+    """
+
+    def __init__(self, campos=None):
+        self.campos = campos or CAMPOS_BUSCA
+        self._db = None
+        self._indices = {}
+        self._construido_em = {}
+        self._reconstruindo = {}
+        self._popularidade = {}
+        self._lock = threading.RLock()
+        # Processo que disparou a construção inicial (outro pid = worker recém-criado)
+        self._pid = None
+        # Muda a cada alteração: ETag das respostas do autocomplete
+        self.versao = 0
+
+    def _apos_fork(self):
+        """Descartar o estado herdado do processo pai (lock pode estar preso)"""
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+        self._indices = {}
+        self._construido_em = {}
+        self._reconstruindo = {}
+
+    def _garantir_construcao(self):
+        """Primeiro uso no processo: migrar campos-sombra e montar os índices em background"""
+        if self._pid == os.getpid():
+            return
+        from application import extensions
+        with self._lock:
+            if self._pid == os.getpid() or extensions.db is None:
+                return
+            self._pid = os.getpid()
+            self._db = extensions.db
+        threading.Thread(target=self._construcao_inicial, args=(extensions.db,), name='indice-busca', daemon=True).start()
+
+    def _construcao_inicial(self, db):
+        try:
+            migrar_campos_busca(db)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao migrar campos de busca: {e}")
+        try:
+            self.construir(db)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao montar índice de busca: {e}")
+
+    def pronto(self, colecao):
+        return colecao in self._indices
+
+    def construir(self, db, colecoes=None):
+        """Montar (ou remontar) os índices a partir de cursores projetados"""
+        self._db = db
+        try:
+            self._popularidade = popularidade_recente(db)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao calcular popularidade para o autocomplete: {e}")
+        for colecao in colecoes or self.campos:
+            try:
+                self._reconstruir(colecao)
+            except Exception as e:
+                logger.warning(f"⚠️ Falha ao montar índice de busca '{colecao}': {e}")
+
+    def _reconstruir(self, colecao):
+        with self._lock:
+            if self._reconstruindo.get(colecao) is not None:
+                return
+            self._reconstruindo[colecao] = set()
+
+        try:
+            inicio = time()
+            campos = self.campos[colecao]
+            indice = IndiceTrigramas(campos, self._popularidade.get(colecao))
+            indice.carregar(self._db[colecao].find({}, {campo: 1 for campo in campos}))
+
+            with self._lock:
+                self._indices[colecao] = indice
+                self._construido_em[colecao] = time()
+                self.versao += 1
+                pendentes = self._reconstruindo.pop(colecao)
+            if pendentes:
+                self._recarregar(colecao, pendentes)
+            logger.info(f"🔎 Índice de busca '{colecao}': {len(indice)} documentos em {(time() - inicio) * 1000:.0f}ms")
+        except Exception:
+            with self._lock:
+                self._reconstruindo.pop(colecao, None)
+            raise
+
+    def _reconstruir_em_background(self, colecao):
+        threading.Thread(target=self.construir, args=(self._db, [colecao]), name=f'indice-busca-{colecao}', daemon=True).start()
+
+    def _recarregar(self, colecao, ids):
+        """Reler os documentos alterados e atualizar (ou remover) no índice"""
+        campos = self.campos[colecao]
+        chaves = {str(i) for i in ids}
+        docs = list(self._db[colecao].find({'_id': {'$in': list(ids)}}, {campo: 1 for campo in campos}))
+        with self._lock:
+            pendentes = self._reconstruindo.get(colecao)
+            if pendentes is not None:
+                pendentes.update(ids)
+            indice = self._indices.get(colecao)
+            if indice is None:
+                return
+            for doc in docs:
+                indice.adicionar(doc)
+                chaves.discard(str(doc['_id']))
+            for chave in chaves:
+                indice.remover(chave)
+            self.versao += 1
+
+    def alterado(self, colecao, ids=None):
+        """
+        Hook de escrita: ids alterados/criados/removidos, ou None para
+        alterações em massa (reconstrói a coleção em background)
+        """
+        # Sem índice montado neste processo não há o que atualizar: a construção lê o estado atual
+        if colecao not in self.campos or self._db is None:
+            return
+        try:
+            if ids is None:
+                self._reconstruir_em_background(colecao)
+                return
+            if not isinstance(ids, (list, tuple, set)):
+                ids = [ids]
+            # Eventos SSE trazem o id como string
+            ids = [ObjectId(i) if isinstance(i, str) and ObjectId.is_valid(i) else i for i in ids]
+            self._recarregar(colecao, ids)
+        except Exception as e:
+            logger.warning(f"⚠️ Falha ao atualizar índice de busca '{colecao}': {e}")
+
+    def _verificar_validade(self, colecao):
+        expirado = time() - self._construido_em.get(colecao, 0) > INDICE_BUSCA_TTL
+        if expirado and self._reconstruindo.get(colecao) is None:
+            self._reconstruir_em_background(colecao)
+
+    def buscar(self, colecao, termo, limite=10):
+        """
+        Ids (na ordem de relevância) dos documentos que contêm o termo
+
+        Returns:
+            lista de (_id, nome), ou None se o índice ainda não está pronto
+            (a rota deve usar a consulta direta no Mongo)
+        """
+        termo = dobrar(termo)
+        self._garantir_construcao()
+        with self._lock:
+            indice = self._indices.get(colecao)
+            if indice is None:
+                return None
+            chaves = indice.buscar(termo, limite)
+            resultado = [(indice.ids[chave], indice.nomes[chave]) for chave in chaves]
+
+        self._verificar_validade(colecao)
+        return resultado
+
+    def sugerir(self, colecao, termo, limite):
+        """
+        Autocomplete: nomes com alguma palavra começando pelo termo, por popularidade
+
+        Returns:
+            lista de (_id, nome), ou None se o índice ainda não está pronto
+        """
+        prefixo = dobrar(termo)
+        self._garantir_construcao()
+        with self._lock:
+            indice = self._indices.get(colecao)
+            if indice is None:
+                return None
+            resultado = [(indice.ids[chave], indice.nomes[chave]) for chave in indice.sugerir(prefixo, limite)]
+
+        self._verificar_validade(colecao)
+        return resultado
+
+
+def hidratar(collection, ids, projection=None, max_time_ms=None):
+    """Buscar os documentos pelos ids mantendo a ordem de relevância"""
+    if not ids:
+        return []
+    cursor = collection.find({'_id': {'$in': list(ids)}}, projection)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
+    docs = {doc['_id']: doc for doc in cursor}
+    return [docs[i] for i in ids if i in docs]
+
+
+class BuscaFederada:
+    """
+    Executa as buscas de cada fonte (coleção) em paralelo com prazo
+
+    Cada fonte é uma função que recebe o maxTimeMS a aplicar nas consultas.
+    O resultado traz o que terminou até o prazo de relógio; as fontes que não
+    terminaram (ou falharam) são devolvidas como pendentes para a resposta
+    marcar partial. A latência de cada fonte é lembrada (média móvel): as
+    mais lentas são submetidas por último e, se estouraram o prazo
+    recentemente, rodam com maxTimeMS reduzido.
+    """
+
+    def __init__(self, workers=BUSCA_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._latencia = {}
+        self._lenta_ate = {}
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='busca-federada')
+            return self._executor
+
+    def lenta(self, fonte):
+        return self._lenta_ate.get(fonte, 0) > time()
+
+    def _registrar(self, fonte, ms, estourou=False):
+        with self._lock:
+            anterior = self._latencia.get(fonte)
+            self._latencia[fonte] = ms if anterior is None else 0.8 * anterior + 0.2 * ms
+            if estourou:
+                self._lenta_ate[fonte] = time() + BUSCA_FONTE_LENTA_S
+
+    def _medir(self, fonte, funcao, max_time_ms):
+        inicio = time()
+        estourou = False
+        try:
+            return funcao(max_time_ms)
+        except ExecutionTimeout:
+            estourou = True
+            raise
+        finally:
+            # Também registra fontes que terminam depois do prazo da requisição
+            ms = (time() - inicio) * 1000
+            self._registrar(fonte, ms, estourou or ms > BUSCA_PRAZO_S * 1000)
+
+    def executar(self, fontes, prazo=BUSCA_PRAZO_S, max_time_ms=BUSCA_FONTE_MAX_MS):
+        """
+        Args:
+            fontes: dict {nome: funcao(max_time_ms)}
+
+        Returns:
+            (dict {nome: resultado} das fontes concluídas, lista das pendentes)
+        """
+        ordem = sorted(fontes, key=lambda fonte: (self.lenta(fonte), self._latencia.get(fonte, 0)))
+        futures = {}
+        for fonte in ordem:
+            limite = BUSCA_FONTE_LENTA_MAX_MS if self.lenta(fonte) else max_time_ms
+            # Uma cópia do contexto por fonte: a medição da requisição (ContextVar)
+            # segue para a thread e os comandos Mongo dela entram no Server-Timing
+            contexto = contextvars.copy_context()
+            futures[self._pool().submit(contexto.run, self._medir, fonte, fontes[fonte], limite)] = fonte
+
+        concluidos, _ = wait(futures, timeout=prazo)
+        resultados = {}
+        for future in concluidos:
+            fonte = futures[future]
+            try:
+                resultados[fonte] = future.result()
+            except ExecutionTimeout:
+                logger.warning(f"⏱️ Busca federada: '{fonte}' excedeu maxTimeMS")
+            except Exception as e:
+                logger.warning(f"⚠️ Busca federada: falha em '{fonte}': {e}")
+
+        pendentes = [fonte for fonte in ordem if fonte not in resultados]
+        for future, fonte in futures.items():
+            if future not in concluidos:
+                # Se já estava rodando, _medir registra a latência quando terminar
+                if future.cancel():
+                    self._registrar(fonte, prazo * 1000, estourou=True)
+                logger.warning(f"⏱️ Busca federada: '{fonte}' não terminou em {prazo:.1f}s")
+        return resultados, pendentes
+
+
+# Índice do processo (montado em create_app)
+indice_busca = IndiceBusca()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=indice_busca._apos_fork)
+
+# Executor compartilhado da busca global
+busca_federada = BuscaFederada()
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BIOMA UBERABA v7.3 - Serviço de Movimentação de Estoque
+Desenvolvedor: Juan Marco (@juanmarco1999)
+
+Toda alteração de saldo passa por movimentar_estoque: um único
+find_one_and_update com $inc (saídas condicionadas a estoque >= quantidade),
+sem ler-calcular-gravar em Python. A movimentação é registrada na mesma
+unidade lógica: transação quando o MongoDB é replica set/sharded, outbox
+(movimentação 'pendente' + id marcado no produto) caso contrário.
+
+Razão (ledger): as movimentações são a fonte da verdade do saldo e
+`estoque_snapshots` guarda fotografias periódicas de todos os produtos. A
+posição em uma data parte do snapshot mais próximo e aplica só o delta.
+Snapshots são gravados por um job (job_snapshot_estoque), nunca dentro da
+requisição; sem snapshot recente a posição parte do saldo atual. Diários
+ficam SNAPSHOT_RETENCAO_DIARIA; depois disso só o primeiro de cada mês.
+
+Valorização: um único pipeline (avaliar_estoque) soma estoque x preço e
+estoque x custo no servidor, total e por categoria, com top-N opcional; o
+resultado fica no CacheManager e é invalidado pelas escritas de saldo.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+from application.extensions import CacheManager
+
+logger = logging.getLogger(__name__)
+
+# Tipos de movimentação que somam ao saldo (os demais subtraem)
+TIPOS_ENTRADA = ('entrada', 'ajuste_entrada', 'devolucao')
+
+# Ids de movimentações recentes guardados no produto (idempotência do outbox)
+MOVIMENTACOES_RECENTES_MAX = 50
+
+# Idade mínima de uma movimentação 'pendente' para ser reconciliada
+OUTBOX_RECONCILIAR_APOS = timedelta(minutes=5)
+
+# Intervalo entre snapshots do ledger (job agendado pela previsão diária e pela consulta de posição)
+SNAPSHOT_INTERVALO = timedelta(days=1)
+
+# Snapshots diários mantidos; mais antigos ficam só o primeiro de cada mês
+SNAPSHOT_RETENCAO_DIARIA = timedelta(days=90)
+
+# Campos do produto fotografados em cada snapshot
+SNAPSHOT_CAMPOS = ('nome', 'marca', 'categoria', 'status', 'estoque', 'estoque_minimo', 'preco', 'custo', 'created_at')
+
+# Lote de escrita dos snapshots
+SNAPSHOT_LOTE = 1000
+
+# Níveis de estoque (campo nivel_estoque mantido em toda escrita de saldo)
+NIVEL_CRITICO = 'critico'
+NIVEL_ATENCAO = 'atencao'
+NIVEL_NORMAL = 'normal'
+NIVEIS_ALERTA = (NIVEL_CRITICO, NIVEL_ATENCAO)
+NIVEL_LABELS = {
+    NIVEL_CRITICO: 'Crítico',
+    NIVEL_ATENCAO: 'Atenção',
+    NIVEL_NORMAL: 'Normal',
+}
+
+# Atenção: acima do mínimo mas abaixo de mínimo x FATOR_ATENCAO
+FATOR_ATENCAO = 1.5
+
+# Cache da valorização (por worker; o TTL limita a defasagem entre workers)
+VALORIZACAO_CACHE_PREFIXO = 'estoque:valorizacao'
+VALORIZACAO_TTL = 120
+
+# Projeção devolvida ao chamador (saldo + dados usados nas respostas)
+PRODUTO_PROJECAO = {'nome': 1, 'estoque': 1, 'estoque_minimo': 1, 'nivel_estoque': 1}
+
+
+class ProdutoNaoEncontrado(Exception):
+    """Produto inexistente"""
+
+
+class EstoqueInsuficiente(Exception):
+    """Saída maior que o saldo disponível"""
+
+    def __init__(self, disponivel):
+        self.disponivel = disponivel
+        super().__init__(f'Estoque insuficiente. Disponível: {disponivel}')
+
+
+def _numero(valor):
+    try:
+        return float(valor or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def classificar_nivel(estoque, estoque_minimo):
+    """Classificador único de nível de estoque (crítico ≤ mínimo < atenção < 1,5x mínimo)"""
+    estoque, estoque_minimo = _numero(estoque), _numero(estoque_minimo)
+    if estoque <= estoque_minimo:
+        return NIVEL_CRITICO
+    if estoque < estoque_minimo * FATOR_ATENCAO:
+        return NIVEL_ATENCAO
+    return NIVEL_NORMAL
+
+
+def _expr_numero(campo):
+    """Campo numérico tolerante (strings/ausente viram 0, como _numero)"""
+    return {'$convert': {'input': f'${campo}', 'to': 'double', 'onError': 0, 'onNull': 0}}
+
+
+def expr_nivel_estoque():
+    """classificar_nivel como expressão de agregação (updates com pipeline)"""
+    return {'$switch': {
+        'branches': [
+            {'case': {'$lte': [_expr_numero('estoque'), _expr_numero('estoque_minimo')]}, 'then': NIVEL_CRITICO},
+            {'case': {'$lt': [_expr_numero('estoque'), {'$multiply': [_expr_numero('estoque_minimo'), FATOR_ATENCAO]}]},
+             'then': NIVEL_ATENCAO},
+        ],
+        'default': NIVEL_NORMAL
+    }}
+
+
+def filtro_nivel(niveis=NIVEIS_ALERTA):
+    """
+    Filtro por nível que usa os índices parciais (um por nível não normal)
+
+    $or de igualdades em vez de $in: cada ramo casa com o filtro de um índice parcial.
+    """
+    niveis = list(niveis)
+    if len(niveis) == 1:
+        return {'nivel_estoque': niveis[0]}
+    return {'$or': [{'nivel_estoque': nivel} for nivel in niveis]}
+
+
+def atualizar_niveis_estoque(db, filtro=None):
+    """
+    Recalcular nivel_estoque no servidor (um update_many com pipeline)
+
+    Só toca documentos cujo nível gravado diverge do calculado.
+
+    Returns:
+        quantidade de produtos alterados
+    """
+    expr = expr_nivel_estoque()
+    consulta = {'$expr': {'$ne': [{'$ifNull': ['$nivel_estoque', None]}, expr]}}
+    if filtro:
+        consulta = {'$and': [filtro, consulta]}
+    result = db.produtos.update_many(consulta, [{'$set': {'nivel_estoque': expr}}])
+    if result.modified_count:
+        logger.info(f"📊 nivel_estoque atualizado em {result.modified_count} produtos")
+    return result.modified_count
+
+
+def normalizar_saldos_legados(db, filtro=None):
+    """
+    Converter estoque gravado como texto/nulo em número (no servidor)
+
+    $inc falha em texto e o guarda {'estoque': {'$gte': n}} nunca casa com ele;
+    vírgula decimal é aceita e o que não converte vira 0, como em _numero.
+
+    Returns:
+        quantidade de produtos convertidos
+    """
+    consulta = {'estoque': {'$type': ['string', 'null']}}
+    if filtro:
+        consulta = {'$and': [filtro, consulta]}
+    texto = {'$replaceAll': {'input': {'$trim': {'input': '$estoque'}}, 'find': ',', 'replacement': '.'}}
+    result = db.produtos.update_many(consulta, [{'$set': {
+        'estoque': {'$toInt': {'$convert': {'input': texto, 'to': 'double', 'onError': 0, 'onNull': 0}}}
+    }}])
+    if result.modified_count:
+        logger.warning(f"⚠️ Estoque em texto convertido para número em {result.modified_count} produtos")
+    return result.modified_count
+
+
+def _sincronizar_nivel(db, produto, session=None):
+    """
+    Gravar o nível após um $inc (condicionado ao saldo lido)
+
+    Se outra movimentação alterou o saldo nesse meio tempo, o filtro não casa
+    e o nível fica a cargo dela.
+    """
+    nivel = classificar_nivel(produto.get('estoque'), produto.get('estoque_minimo'))
+    if produto.get('nivel_estoque') != nivel:
+        db.produtos.update_one(
+            {'_id': produto['_id'], 'estoque': produto.get('estoque')},
+            {'$set': {'nivel_estoque': nivel}},
+            session=session
+        )
+        produto['nivel_estoque'] = nivel
+
+
+def _suporta_transacoes(db):
+    """Transações exigem replica set ou mongos (Atlas sempre é replica set)"""
+    try:
+        tipo = db.client.topology_description.topology_type_name
+    except Exception:
+        return False
+    return tipo in ('ReplicaSetWithPrimary', 'Sharded')
+
+
+def _falha_guarda(db, produto_id, session=None):
+    """Distinguir produto inexistente de saldo insuficiente (só no caminho de erro)"""
+    produto = db.produtos.find_one({'_id': produto_id}, {'estoque': 1}, session=session)
+    if not produto:
+        return ProdutoNaoEncontrado('Produto não encontrado')
+    return EstoqueInsuficiente(produto.get('estoque', 0) or 0)
+
+
+def movimentar_estoque(db, produto_id, tipo, quantidade, motivo='', usuario=None, extras=None):
+    """
+    Aplicar uma movimentação de estoque de forma atômica
+
+    Args:
+        produto_id: ObjectId ou str
+        tipo: 'entrada' (e TIPOS_ENTRADA) somam; 'saida' e demais subtraem
+        quantidade: inteiro positivo
+        extras: campos adicionais gravados na movimentação
+
+    Returns:
+        (produto, movimentacao) - produto com o saldo já atualizado
+
+    Raises:
+        ProdutoNaoEncontrado, EstoqueInsuficiente, ValueError
+    """
+    quantidade = int(quantidade)
+    if quantidade <= 0:
+        raise ValueError('Quantidade inválida')
+
+    produto_id = ObjectId(produto_id)
+    entrada = str(tipo).lower() in TIPOS_ENTRADA
+    delta = quantidade if entrada else -quantidade
+    agora = datetime.now()
+
+    filtro = {'_id': produto_id}
+    if not entrada:
+        # Decremento guardado: nunca deixa o saldo negativo, mesmo com vendas simultâneas
+        filtro['estoque'] = {'$gte': quantidade}
+
+    movimentacao = {
+        '_id': ObjectId(),
+        'produto_id': produto_id,
+        'tipo': tipo,
+        'quantidade': quantidade,
+        'motivo': motivo,
+        'usuario': usuario,
+        'data': agora,
+        **(extras or {})
+    }
+
+    movimentar = _movimentar_transacao if _suporta_transacoes(db) else _movimentar_outbox
+    try:
+        produto = movimentar(db, filtro, delta, movimentacao)
+    except (EstoqueInsuficiente, OperationFailure):
+        # Saldo legado em texto: converte e tenta uma vez mais (com outro id no outbox)
+        if not normalizar_saldos_legados(db, {'_id': produto_id}):
+            raise
+        movimentacao['_id'] = ObjectId()
+        produto = movimentar(db, filtro, delta, movimentacao)
+
+    invalidar_valorizacao()
+    logger.info(
+        f"📦 Estoque {produto.get('nome', produto_id)}: {tipo} {quantidade} → saldo {produto.get('estoque')}"
+    )
+    return produto, movimentacao
+
+
+def ajustar_estoque(db, produto_id, saldo, motivo='Ajuste de saldo', usuario=None):
+    """
+    Levar o saldo a um valor informado (edição do produto, contagem)
+
+    Vira uma movimentação 'ajuste_entrada'/'ajuste_saida' com a diferença para o
+    saldo lido, então o ledger continua batendo com o produto. Uma venda que
+    chegue entre a leitura e o $inc é preservada: o ajuste é um delta, não $set.
+
+    Returns:
+        (produto, movimentacao) - movimentacao é None se o saldo já era esse
+
+    Raises:
+        ProdutoNaoEncontrado, EstoqueInsuficiente, ValueError
+    """
+    saldo = int(saldo)
+    if saldo < 0:
+        raise ValueError('Estoque não pode ser negativo')
+
+    produto_id = ObjectId(produto_id)
+    produto = db.produtos.find_one({'_id': produto_id}, PRODUTO_PROJECAO)
+    if produto is None:
+        raise ProdutoNaoEncontrado('Produto não encontrado')
+
+    delta = saldo - int(_numero(produto.get('estoque')))
+    if delta == 0:
+        return produto, None
+    return movimentar_estoque(
+        db, produto_id, 'ajuste_entrada' if delta > 0 else 'ajuste_saida', abs(delta),
+        motivo=motivo, usuario=usuario, extras={'saldo_informado': saldo}
+    )
+
+
+def _completar_movimentacao(movimentacao, produto, delta):
+    movimentacao.setdefault('produto_nome', produto.get('nome'))
+    movimentacao['estoque_posterior'] = produto.get('estoque', 0)
+    movimentacao['estoque_anterior'] = produto.get('estoque', 0) - delta
+
+
+def _movimentar_transacao(db, filtro, delta, movimentacao):
+    def executar(session):
+        produto = db.produtos.find_one_and_update(
+            filtro,
+            {'$inc': {'estoque': delta}, '$set': {'updated_at': movimentacao['data']}},
+            projection=PRODUTO_PROJECAO,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if produto is None:
+            raise _falha_guarda(db, filtro['_id'], session)
+        _completar_movimentacao(movimentacao, produto, delta)
+        db.estoque_movimentacoes.insert_one(movimentacao, session=session)
+        _sincronizar_nivel(db, produto, session)
+        return produto
+
+    with db.client.start_session() as session:
+        # with_transaction repete automaticamente em erros transitórios
+        return session.with_transaction(executar)
+
+
+def _movimentar_outbox(db, filtro, delta, movimentacao):
+    """
+    Sem transações: movimentação gravada antes como 'pendente' (outbox)
+
+    O $inc marca o id da movimentação no produto, na mesma operação atômica;
+    assim reconciliar_movimentacoes sabe se uma pendente foi aplicada ou não.
+    """
+    mov_id = movimentacao['_id']
+    db.estoque_movimentacoes.insert_one({**movimentacao, 'status': 'pendente'})
+
+    produto = db.produtos.find_one_and_update(
+        {**filtro, 'movimentacoes_recentes': {'$ne': mov_id}},
+        {
+            '$inc': {'estoque': delta},
+            '$set': {'updated_at': movimentacao['data']},
+            '$push': {'movimentacoes_recentes': {'$each': [mov_id], '$slice': -MOVIMENTACOES_RECENTES_MAX}}
+        },
+        projection=PRODUTO_PROJECAO,
+        return_document=ReturnDocument.AFTER
+    )
+    if produto is None:
+        db.estoque_movimentacoes.delete_one({'_id': mov_id})
+        raise _falha_guarda(db, filtro['_id'])
+
+    _completar_movimentacao(movimentacao, produto, delta)
+    db.estoque_movimentacoes.update_one({'_id': mov_id}, {
+        '$set': {
+            'produto_nome': movimentacao['produto_nome'],
+            'estoque_anterior': movimentacao['estoque_anterior'],
+            'estoque_posterior': movimentacao['estoque_posterior']
+        },
+        '$unset': {'status': ''}
+    })
+    _sincronizar_nivel(db, produto)
+    return produto
+
+
+def movimentacao_aplicada(db, filtro):
+    """
+    Alguma movimentação que casa com o filtro chegou ao saldo?
+
+    Usado para desfazer reservas (ex.: aprovação de entrada) após uma falha sem
+    arriscar somar duas vezes: no outbox, pendente só conta se o id já está no produto.
+    """
+    for mov in db.estoque_movimentacoes.find(filtro, {'produto_id': 1, 'status': 1}):
+        if mov.get('status') != 'pendente':
+            return True
+        if db.produtos.find_one({'_id': mov['produto_id'], 'movimentacoes_recentes': mov['_id']}, {'_id': 1}):
+            return True
+    return False
+
+
+def reconciliar_movimentacoes(db):
+    """
+    Resolver movimentações 'pendente' deixadas por um worker interrompido
+
+    Aplicadas (id presente no produto) são confirmadas; as demais nunca
+    alteraram o saldo e são removidas. Nada é reaplicado.
+
+    Returns:
+        (confirmadas, removidas)
+    """
+    limite = datetime.now() - OUTBOX_RECONCILIAR_APOS
+    confirmadas = removidas = 0
+
+    for mov in db.estoque_movimentacoes.find({'status': 'pendente', 'data': {'$lt': limite}}, {'produto_id': 1}):
+        aplicada = db.produtos.find_one(
+            {'_id': mov['produto_id'], 'movimentacoes_recentes': mov['_id']}, {'_id': 1}
+        )
+        if aplicada:
+            db.estoque_movimentacoes.update_one({'_id': mov['_id']}, {'$unset': {'status': ''}})
+            confirmadas += 1
+        else:
+            db.estoque_movimentacoes.delete_one({'_id': mov['_id'], 'status': 'pendente'})
+            removidas += 1
+
+    if confirmadas or removidas:
+        logger.warning(f"⚠️ Outbox de estoque reconciliado: {confirmadas} confirmadas, {removidas} descartadas")
+    return confirmadas, removidas
+
+
+# ==================== LEDGER / POSIÇÃO HISTÓRICA ====================
+
+def _expr_delta():
+    """Quantidade com sinal da movimentação (entrada +, demais -), tolerando legado em texto"""
+    quantidade = {'$convert': {'input': '$quantidade', 'to': 'double', 'onError': 0, 'onNull': 0}}
+    return {'$cond': [
+        {'$in': [{'$toLower': {'$ifNull': ['$tipo', '']}}, list(TIPOS_ENTRADA)]},
+        quantidade,
+        {'$multiply': [quantidade, -1]}
+    ]}
+
+
+def deltas_movimentacoes(db, inicio, fim):
+    """
+    Variação líquida de saldo por produto no intervalo (inicio, fim]
+
+    Returns:
+        dict {produto_id: delta}
+    """
+    pipeline = [
+        {'$match': {'data': {'$gt': inicio, '$lte': fim}, 'status': {'$ne': 'pendente'}}},
+        {'$group': {'_id': '$produto_id', 'delta': {'$sum': _expr_delta()}}}
+    ]
+    return {d['_id']: d['delta'] for d in db.estoque_movimentacoes.aggregate(pipeline)}
+
+
+def registrar_snapshot_estoque(db):
+    """
+    Fotografar o saldo atual de todos os produtos (um documento por produto)
+
+    A data do snapshot é o fim da leitura, não o início: produtos movimentados
+    durante a varredura (updated_at >= início) são relidos depois de fixada a
+    data, então cada saldo gravado inclui as movimentações até ela e
+    posicao_estoque desfaz o delta certo a partir desse ponto.
+
+    Returns:
+        (data, quantidade de produtos fotografados)
+    """
+    projecao = {campo: 1 for campo in SNAPSHOT_CAMPOS}
+    inicio = datetime.now()
+    produtos = {p['_id']: p for p in db.produtos.find({}, projecao)}
+
+    data = datetime.now()
+    for produto in db.produtos.find({'updated_at': {'$gte': inicio}}, projecao):
+        produtos[produto['_id']] = produto
+
+    lote = []
+    for produto_id, produto in produtos.items():
+        produto.pop('_id', None)
+        lote.append({'produto_id': produto_id, 'data': data, **produto})
+        if len(lote) >= SNAPSHOT_LOTE:
+            db.estoque_snapshots.insert_many(lote, ordered=False)
+            lote = []
+    if lote:
+        db.estoque_snapshots.insert_many(lote, ordered=False)
+
+    logger.info(f"📸 Snapshot de estoque {data:%d/%m/%Y %H:%M}: {len(produtos)} produtos")
+    return data, len(produtos)
+
+
+def snapshot_pendente(db):
+    """O último snapshot tem mais de SNAPSHOT_INTERVALO (ou não existe)?"""
+    ultimo = db.estoque_snapshots.find_one({}, {'data': 1}, sort=[('data', -1)])
+    return ultimo is None or datetime.now() - ultimo['data'] >= SNAPSHOT_INTERVALO
+
+
+def podar_snapshots_estoque(db, agora=None):
+    """
+    Retenção dos snapshots: diários até SNAPSHOT_RETENCAO_DIARIA, depois mensais
+
+    Entre os anteriores ao corte fica o primeiro de cada mês; posicao_estoque
+    continua achando um snapshot em/após qualquer data, só com um delta maior.
+
+    Returns:
+        quantidade de documentos removidos
+    """
+    corte = (agora or datetime.now()) - SNAPSHOT_RETENCAO_DIARIA
+    datas = sorted(
+        d['_id'] for d in db.estoque_snapshots.aggregate([
+            {'$match': {'data': {'$lt': corte}}},
+            {'$group': {'_id': '$data'}}
+        ])
+    )
+    meses = set()
+    remover = []
+    for data in datas:
+        if (data.year, data.month) in meses:
+            remover.append(data)
+        else:
+            meses.add((data.year, data.month))
+    if not remover:
+        return 0
+
+    removidos = db.estoque_snapshots.delete_many({'data': {'$in': remover}}).deleted_count
+    logger.info(f"📸 Retenção de snapshots: {len(remover)} datas antigas removidas ({removidos} documentos)")
+    return removidos
+
+
+def job_snapshot_estoque(progresso, db):
+    """Função de job (JobManager.submit) - o snapshot não roda dentro da requisição"""
+    if not snapshot_pendente(db):
+        return {'criado': False}
+    data, total = registrar_snapshot_estoque(db)
+    progresso(etapa='retencao')
+    removidos = podar_snapshots_estoque(db)
+    return {'criado': True, 'data': data.isoformat(), 'produtos': total, 'removidos': removidos}
+
+
+def posicao_estoque(db, as_of, filtro=None):
+    """
+    Posição de estoque de cada produto em uma data
+
+    Parte do primeiro snapshot em/após as_of (ou do saldo atual) e desfaz
+    apenas as movimentações entre as_of e esse ponto, então o custo depende
+    da distância até o snapshot e não do tamanho do histórico. Preço/custo
+    são os do snapshot usado.
+
+    Args:
+        as_of: datetime
+        filtro: filtro adicional sobre os campos do produto (ex.: {'status': 'Ativo'})
+
+    Returns:
+        lista de dicts com produto_id + SNAPSHOT_CAMPOS (estoque na data)
+    """
+    filtro = filtro or {}
+    projecao = {campo: 1 for campo in SNAPSHOT_CAMPOS}
+    agora = datetime.now()
+
+    if as_of >= agora:
+        produtos = list(db.produtos.find(filtro, projecao))
+        for p in produtos:
+            p['produto_id'] = p.pop('_id')
+        return produtos
+
+    snapshot = db.estoque_snapshots.find_one({'data': {'$gte': as_of}}, {'data': 1}, sort=[('data', 1)])
+
+    if snapshot:
+        base = snapshot['data']
+        projecao['produto_id'] = 1
+        produtos = list(db.estoque_snapshots.find({'data': base, **filtro}, {**projecao, '_id': 0}))
+    else:
+        base = agora
+        produtos = list(db.produtos.find(filtro, projecao))
+        for p in produtos:
+            p['produto_id'] = p.pop('_id')
+
+    deltas = deltas_movimentacoes(db, as_of, base)
+
+    posicao = []
+    for p in produtos:
+        criado = p.get('created_at')
+        if isinstance(criado, datetime) and criado > as_of:
+            continue  # produto ainda não existia na data
+        p['estoque'] = (p.get('estoque', 0) or 0) - deltas.get(p['produto_id'], 0)
+        posicao.append(p)
+    return posicao
+
+
+# ==================== VALORIZAÇÃO ====================
+
+def pipeline_valorizacao(filtro=None, top=None):
+    """
+    Pipeline de valorização do estoque (venda = estoque x preço, custo = estoque x custo)
+
+    Facetas: `total` (um documento), `por_categoria` (maior valor primeiro) e,
+    se top não for None, `itens` ordenados por valor de venda (top=0: todos).
+    """
+    totais = {
+        'produtos': {'$sum': 1},
+        'unidades': {'$sum': '$estoque'},
+        'valor_venda': {'$sum': '$valor_venda'},
+        'valor_custo': {'$sum': '$valor_custo'},
+        'zerados': {'$sum': {'$cond': [{'$eq': ['$estoque', 0]}, 1, 0]}},
+    }
+    facetas = {
+        'total': [{'$group': {'_id': None, **totais}}],
+        'por_categoria': [
+            {'$group': {'_id': {'$ifNull': ['$categoria', 'Sem categoria']}, **totais}},
+            {'$sort': {'valor_venda': -1, '_id': 1}},
+        ],
+    }
+    if top is not None:
+        facetas['itens'] = [{'$sort': {'valor_venda': -1, '_id': 1}}]
+        if top:
+            facetas['itens'].append({'$limit': int(top)})
+
+    return [
+        {'$match': filtro or {}},
+        {'$project': {
+            'nome': 1,
+            'marca': 1,
+            'categoria': 1,
+            'estoque': _expr_numero('estoque'),
+            'preco': _expr_numero('preco'),
+            'custo': _expr_numero('custo'),
+            'valor_venda': {'$multiply': [_expr_numero('estoque'), _expr_numero('preco')]},
+            'valor_custo': {'$multiply': [_expr_numero('estoque'), _expr_numero('custo')]},
+        }},
+        {'$facet': facetas},
+    ]
+
+
+def avaliar_estoque(db, filtro=None, top=None, ttl=VALORIZACAO_TTL):
+    """
+    Valorização do estoque calculada no MongoDB (com cache)
+
+    Args:
+        filtro: filtro sobre produtos (ex.: {'status': 'Ativo'})
+        top: None sem lista de itens; N para os N de maior valor; 0 para todos
+
+    Returns:
+        {'total': {...}, 'por_categoria': [...], 'itens': [...]}
+    """
+    chave = CacheManager.get_cache_key(VALORIZACAO_CACHE_PREFIXO, {'filtro': filtro or {}, 'top': top})
+    cached = CacheManager.get(chave, ttl=ttl)
+    if cached is not None:
+        return cached
+
+    resultado = next(db.produtos.aggregate(pipeline_valorizacao(filtro, top)), {})
+
+    vazio = {'produtos': 0, 'unidades': 0, 'valor_venda': 0, 'valor_custo': 0, 'zerados': 0}
+    total = (resultado.get('total') or [vazio])[0]
+    total.pop('_id', None)
+    categorias = [{'categoria': c.pop('_id'), **c} for c in resultado.get('por_categoria', [])]
+
+    valorizacao = {'total': total, 'por_categoria': categorias, 'itens': resultado.get('itens', [])}
+    CacheManager.set(chave, valorizacao, ttl=ttl)
+    return valorizacao
+
+
+def invalidar_valorizacao():
+    """Descartar valorizações em cache (chamado em toda escrita de saldo/preço)"""
+    CacheManager.invalidate(VALORIZACAO_CACHE_PREFIXO)
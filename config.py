@@ -33,10 +33,26 @@ class Config:
     MONGO_TIMEOUT = 30000  # 30s - Aumentado para produção
     MONGO_MAX_POOL_SIZE = 50  # Aumentado para suportar mais conexões simultâneas
     MONGO_MIN_POOL_SIZE = 5  # Aumentado para manter pool aquecido
+    # Monitor de comandos: log de lentos, N+1 e fração de requisições detalhadas
+    MONGO_LENTA_MS = float(os.getenv('MONGO_LENTA_MS', '100'))
+    MONGO_N1_LIMITE = int(os.getenv('MONGO_N1_LIMITE', '10'))
+    MONGO_AMOSTRAGEM = float(os.getenv('MONGO_AMOSTRAGEM', '0.05'))
 
     # Cache
     CACHE_TTL = 60  # segundos
 
+    # Importação de planilhas (documentos por lote de insert_many/bulk_write)
+    IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+    # Importações em background: execução simultânea e fila por worker
+    IMPORT_MAX_WORKERS = int(os.getenv('IMPORT_MAX_WORKERS', '1'))
+    IMPORT_MAX_FILA = int(os.getenv('IMPORT_MAX_FILA', '4'))
+    # Exportações de relatórios (PDF/XLSX) em background
+    REPORT_MAX_WORKERS = int(os.getenv('REPORT_MAX_WORKERS', '2'))
+    REPORT_MAX_FILA = int(os.getenv('REPORT_MAX_FILA', '8'))
+
+    # Instrumentação por rota (histogramas em memória + cabeçalho Server-Timing)
+    INSTRUMENTACAO_ATIVA = os.getenv('INSTRUMENTACAO_ATIVA', '1') == '1'
+
     # Celery (para tarefas assíncronas)
     CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
     CELERY_RESULT_BACKEND = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
@@ -11,6 +11,8 @@ bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
 
 # Workers
 # Recomendação: 2-4 workers para 512MB RAM
+# Cada worker abre seu próprio pool de PDFs (PDF_WORKERS processos, ~37MB cada):
+# total de processos de renderização = workers x PDF_WORKERS
 workers = int(os.getenv('GUNICORN_WORKERS', '2'))
 
 # Threads por worker (aumenta throughput sem usar muita RAM)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Teste do Modo 'atualizar' da Importação (BulkUpserter)
+
+Regressão: uma planilha com só algumas colunas (ex.: tabela de preços com
+sku, nome e preço) não pode sobrescrever os outros campos do documento com
+os valores padrão do parser. O $set de cada upsert é aplicado sobre um
+documento já existente e os campos fora da planilha devem continuar iguais.
+
+Uso:
+    python testar_importacao_atualizar.py
+"""
+
+import sys
+
+from application.importer import BulkUpserter, ImportReport, parse_cliente, parse_produto
+from application.search import campos_busca
+
+
+class ColecaoGravada:
+    """Coleção mínima: nenhum hash existente e bulk_write apenas registrado"""
+
+    def __init__(self):
+        self.operacoes = []
+
+    def find(self, filtro, projecao=None):
+        return []
+
+    def bulk_write(self, operacoes, ordered=False):
+        self.operacoes.extend(operacoes)
+
+        class Resultado:
+            upserted_count = 0
+            modified_count = len(operacoes)
+        return Resultado()
+
+
+def aplicar(existente, tipo, parser, row):
+    """Upsert de uma linha sobre um documento existente (semântica de $set)"""
+    colecao = ColecaoGravada()
+    writer = BulkUpserter(colecao, ImportReport(tipo, 'lote'), tipo, carimbo={'import_batch_id': 'lote'})
+    documentos = parser(row, {})
+    for doc in documentos:
+        doc.update(campos_busca(tipo, doc))
+    writer.add(2, documentos)
+    writer.flush()
+    atualizado = dict(existente)
+    for operacao in colecao.operacoes:
+        atualizado.update(operacao._doc['$set'])
+    return atualizado, colecao.operacoes
+
+
+falhas = 0
+
+
+def verificar(descricao, condicao):
+    global falhas
+    print(f"  {'✅' if condicao else '❌'} {descricao}")
+    if not condicao:
+        falhas += 1
+
+
+print("=" * 80)
+print("PRODUTO: PLANILHA SÓ COM SKU, NOME E PREÇO")
+print("=" * 80)
+
+produto = {
+    'sku': 'SH-01', 'nome': 'Shampoo', 'marca': 'Marca X', 'categoria': 'Cabelo',
+    'preco': 10.0, 'custo': 4.5, 'codigo_barras': '7890000000001', 'estoque': 12,
+    'marca_busca': 'marca x',
+}
+atualizado, operacoes = aplicar(produto, 'produtos', parse_produto, {'sku': 'SH-01', 'nome': 'Shampoo', 'preco': '12,90'})
+verificar('upsert pela chave natural (sku)', operacoes[0]._filter == {'sku': 'SH-01'})
+verificar('preço atualizado', atualizado['preco'] == 12.9)
+for campo in ('marca', 'categoria', 'custo', 'codigo_barras', 'estoque', 'marca_busca'):
+    verificar(f"{campo} inalterado ({produto[campo]!r})", atualizado[campo] == produto[campo])
+verificar('padrões só em $setOnInsert', 'marca' in operacoes[0]._doc['$setOnInsert'])
+
+print("\n" + "=" * 80)
+print("CLIENTE: PLANILHA SÓ COM CPF, NOME E TELEFONE")
+print("=" * 80)
+
+cliente = {
+    'cpf': '123.456.789-00', 'nome': 'Ana', 'email': 'ana@exemplo.com',
+    'telefone': '34 99999-0000', 'endereco': 'Rua A, 1',
+}
+atualizado, _ = aplicar(cliente, 'clientes', parse_cliente,
+                        {'cpf': '123.456.789-00', 'nome': 'Ana', 'telefone': '34 98888-1111'})
+verificar('telefone atualizado', atualizado['telefone'] == '34 98888-1111')
+for campo in ('email', 'endereco'):
+    verificar(f"{campo} inalterado ({cliente[campo]!r})", atualizado[campo] == cliente[campo])
+
+print("\n" + "=" * 80)
+print("RESULTADO DO TESTE:", "OK" if falhas == 0 else f"{falhas} FALHA(S)")
+print("=" * 80)
+sys.exit(1 if falhas else 0)
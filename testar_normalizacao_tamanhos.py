@@ -3,167 +3,275 @@
 """
 Teste de Normalização de Colunas para Importação de Serviços
 Testa se as colunas da planilha estão sendo detectadas corretamente
+
+Regressão: o mapeamento pré-compilado (MapeamentoColunas) deve produzir
+exatamente os mesmos documentos que a detecção v7.2 linha a linha.
+Benchmark: compara a vazão das duas implementações.
+
+Uso:
+    python testar_normalizacao_tamanhos.py [linhas_benchmark]
 """
 
-import unicodedata
+import random
 import re
+import sys
+import unicodedata
+from collections import OrderedDict
+from time import perf_counter
+
+from application.importer import (
+    LinhaInvalida, detectar_tamanho, normalizar_coluna, parse_preco, parse_servico
+)
+
 
-def normalizar_coluna(texto):
-    """Normalização extrema de nomes de colunas para máxima compatibilidade"""
+# ==================== REFERÊNCIA v7.2 (linha a linha) ====================
+
+def normalizar_coluna_v72(texto):
+    """Normalização extrema de nomes de colunas (sem memoização)"""
     if not texto:
         return ''
+    texto = unicodedata.normalize('NFD', str(texto))
+    texto = ''.join(char for char in texto if unicodedata.category(char) != 'Mn')
+    texto = re.sub(r'[^a-z0-9_]', '', texto.lower())
+    texto = re.sub(r'_+', '_', texto)
+    return texto.strip('_')
 
-    # Converter para string
-    texto = str(texto)
 
-    # Remover acentos (NFD = Canonical Decomposition)
-    texto = unicodedata.normalize('NFD', texto)
-    texto = ''.join(char for char in texto if unicodedata.category(char) != 'Mn')
+def parse_servico_v72(row):
+    """Detecção v7.2 original: normaliza cabeçalhos e padrões em cada linha"""
+    r = {normalizar_coluna_v72(k): v for k, v in row.items() if k and v is not None}
+    if not r or all(not v for v in r.values()):
+        return None
 
-    # Converter para lowercase
-    texto = texto.lower()
+    nome = None
+    for col in [normalizar_coluna_v72(x) for x in ['nome', 'servico', 'serviço', 'name', 'service']]:
+        if col in r and r[col]:
+            nome = str(r[col]).strip()
+            break
+    if not nome or len(nome) < 2:
+        raise LinhaInvalida('nome do serviço inválido ou ausente')
 
-    # Remover caracteres especiais, manter apenas alfanuméricos e underscores
-    texto = re.sub(r'[^a-z0-9_]', '', texto)
+    categoria = 'Serviço'
+    for col in [normalizar_coluna_v72(x) for x in ['categoria', 'category', 'tipo', 'type']]:
+        if col in r and r[col]:
+            categoria = str(r[col]).strip().title()
+            break
+
+    duracao = 60
+    for col in [normalizar_coluna_v72(x) for x in ['duracao', 'duração', 'tempo', 'duration', 'minutos', 'minutes', 'min']]:
+        if col in r and r[col]:
+            try:
+                duracao = int(float(r[col]))
+                break
+            except (ValueError, TypeError):
+                continue
+
+    tamanhos_patterns = OrderedDict([
+        ('extra_longo', ['extralongo', 'extra_longo', 'extralong', 'extra_long', 'extralarge', 'extra_large', 'muitolongo']),
+        ('kids', ['kids', 'crianca', 'infantil', 'child', 'kid', 'bebe']),
+        ('masculino', ['masculino', 'male', 'homem', 'masc', 'barba', 'beard']),
+        ('curto', ['curto', 'short', 'pequeno', 'mini', 'small']),
+        ('medio', ['medio', 'medium', 'media', 'normal']),
+        ('longo', ['longo', 'long', 'grande', 'large', 'big']),
+    ])
+    tamanhos_letras = {
+        'curto': ['p', 's'],
+        'medio': ['m'],
+        'longo': ['g', 'l'],
+        'extra_longo': ['gg', 'xl', 'xxl']
+    }
+
+    tamanhos_precos = {}
+    for coluna_normalizada, valor in r.items():
+        if not valor:
+            continue
+        tamanho_detectado = None
+        if len(coluna_normalizada) <= 3:
+            for tam, letras in tamanhos_letras.items():
+                if coluna_normalizada in letras:
+                    tamanho_detectado = tam
+                    break
+        if not tamanho_detectado:
+            for tam, patterns in tamanhos_patterns.items():
+                for pattern in patterns:
+                    if normalizar_coluna_v72(pattern) in coluna_normalizada:
+                        tamanho_detectado = tam
+                        break
+                if tamanho_detectado:
+                    break
+        if not tamanho_detectado and len(coluna_normalizada) > 1:
+            ultima_letra = coluna_normalizada[-1]
+            # v7.3: GG/XL verificado antes da última letra (na v7.2 era inalcançável)
+            if coluna_normalizada[-2:] in ['gg', 'xl']:
+                tamanho_detectado = 'extra_longo'
+            elif ultima_letra in ['p', 's']:
+                tamanho_detectado = 'curto'
+            elif ultima_letra == 'm':
+                tamanho_detectado = 'medio'
+            elif ultima_letra in ['g', 'l']:
+                tamanho_detectado = 'longo'
+        if tamanho_detectado:
+            try:
+                preco = parse_preco(valor)
+            except ValueError:
+                continue
+            if preco > 0 and (tamanho_detectado not in tamanhos_precos or preco > tamanhos_precos[tamanho_detectado]):
+                tamanhos_precos[tamanho_detectado] = preco
+
+    if not tamanhos_precos:
+        preco_unico = 0.0
+        for col in [normalizar_coluna_v72(x) for x in ['preco', 'preço', 'price', 'valor', 'value', 'cost']]:
+            if col in r and r[col]:
+                try:
+                    preco_unico = parse_preco(r[col])
+                    break
+                except ValueError:
+                    continue
+        if preco_unico <= 0:
+            raise LinhaInvalida('sem preços válidos')
+        tamanhos_precos = {'unico': preco_unico}
+
+    return [(nome, categoria, duracao, tam, preco) for tam, preco in tamanhos_precos.items()]
+
+
+def resumo(documentos):
+    """Documentos do importador → tuplas comparáveis com a referência"""
+    if documentos is None:
+        return None
+    chaves = {'Kids': 'kids', 'Masculino': 'masculino', 'Curto': 'curto', 'Médio': 'medio',
+              'Longo': 'longo', 'Extra Longo': 'extra_longo', 'Único': 'unico'}
+    return [(d['nome'], d['categoria'], d['duracao'], chaves[d['tamanho']], d['preco']) for d in documentos]
 
-    # Remover espaços/underscores duplicados
-    texto = re.sub(r'_+', '_', texto)
 
-    # Remover underscores no início/fim
-    texto = texto.strip('_')
+def executar(parser, row):
+    try:
+        return ('ok', parser(row))
+    except LinhaInvalida:
+        return ('invalida', None)
 
-    return texto
 
+# ==================== CASOS ====================
 
-# Testar com colunas que o usuário pode ter
+# Colunas que o usuário pode ter → tamanho esperado
 colunas_teste = [
     # Tamanhos do usuário
-    'Kids',
-    'Masculino',
-    'Curto',
-    'Médio',
-    'Longo',
-    'Extra Longo',
+    ('Kids', 'kids'),
+    ('Masculino', 'masculino'),
+    ('Curto', 'curto'),
+    ('Médio', 'medio'),
+    ('Longo', 'longo'),
+    ('Extra Longo', 'extra_longo'),
 
     # Variações possíveis
-    'P',
-    'M',
-    'G',
-    'GG',
-    'Preço Kids',
-    'Preço Masculino',
-    'Preço Curto',
-    'Preço Médio',
-    'Preço Longo',
-    'Preço Extra Longo',
+    ('P', 'curto'),
+    ('M', 'medio'),
+    ('G', 'longo'),
+    ('GG', 'extra_longo'),
+    ('Preço Kids', 'kids'),
+    ('Preço Masculino', 'masculino'),
+    ('Preço Curto', 'curto'),
+    ('Preço Médio', 'medio'),
+    ('Preço Longo', 'longo'),
+    ('Preço Extra Longo', 'extra_longo'),
 
     # Com acentos
-    'Preço',
-    'Preço P',
-    'Preço M',
-    'Preço G',
-    'Preço GG',
+    ('Preço', None),
+    ('Preço P', 'curto'),
+    ('Preço M', 'medio'),
+    ('Preço G', 'longo'),
+    ('Preço GG', 'extra_longo'),
 ]
 
+cabecalhos_planilha = [
+    ['Nome', 'Categoria', 'Duração', 'Kids', 'Masculino', 'Curto', 'Médio', 'Longo', 'Extra Longo'],
+    ['Serviço', 'Tipo', 'Tempo', 'P', 'M', 'G', 'GG'],
+    ['nome', 'categoria', 'preço'],
+    ['Name', 'Category', 'Minutes', 'Preço Curto', 'Preço Longo', 'preco_curto'],
+    ['NOME', 'Preço P', 'Preço M', 'Preço G', 'Preço GG', 'Observação'],
+]
+
+valores_preco = ['R$ 35,00', '1.234,50', '80', 45.5, 0, '', 'abc', None, '120,00']
+
+
+def gerar_linhas(quantidade, semente=7):
+    aleatorio = random.Random(semente)
+    linhas = []
+    for i in range(quantidade):
+        cabecalho = cabecalhos_planilha[i % len(cabecalhos_planilha)]
+        row = {}
+        for coluna in cabecalho:
+            chave = normalizar_coluna_v72(coluna)
+            if chave in ('nome', 'servico', 'name'):
+                row[coluna] = aleatorio.choice([f'Corte {i}', 'X', '', f'Escova {i % 13}'])
+            elif chave in ('categoria', 'tipo', 'category'):
+                row[coluna] = aleatorio.choice(['cabelo', 'unhas', None])
+            elif chave in ('duracao', 'tempo', 'minutes'):
+                row[coluna] = aleatorio.choice([30, '45', 'uma hora', None])
+            else:
+                row[coluna] = aleatorio.choice(valores_preco)
+        linhas.append(row)
+    return linhas
+
+
+# ==================== EXECUÇÃO ====================
+
+falhas = 0
+
 print("=" * 80)
-print("TESTE DE NORMALIZAÇÃO DE COLUNAS")
+print("TESTE DE DETECÇÃO DE TAMANHOS")
 print("=" * 80)
 
-for coluna in colunas_teste:
-    normalizado = normalizar_coluna(coluna)
-    print(f"{coluna:25} -> {normalizado}")
+for coluna, esperado in colunas_teste:
+    tamanho, metodo = detectar_tamanho(normalizar_coluna(coluna))
+    ok = tamanho == esperado
+    falhas += 0 if ok else 1
+    status = "OK  " if ok else "ERRO"
+    print(f"  {status} {coluna:25} -> {tamanho or 'NAO DETECTADO':15} ({metodo or '-'})")
 
 print("\n" + "=" * 80)
-print("TESTE DE DETECÇÃO DE TAMANHOS")
+print("REGRESSÃO: MAPEAMENTO PRÉ-COMPILADO x DETECÇÃO v7.2")
 print("=" * 80)
 
-# Simular a detecção v7.2 - Ordem importa! (extra_longo ANTES de longo)
-from collections import OrderedDict
-tamanhos_patterns = OrderedDict([
-    ('extra_longo', ['extralongo', 'extra_longo', 'extralong', 'extra_long', 'extralarge', 'extra_large', 'muitolongo']),
-    ('kids', ['kids', 'crianca', 'infantil', 'child', 'kid', 'bebe']),
-    ('masculino', ['masculino', 'male', 'homem', 'masc', 'barba', 'beard']),
-    ('curto', ['curto', 'short', 'pequeno', 'mini', 'small']),
-    ('medio', ['medio', 'medium', 'media', 'normal']),
-    ('longo', ['longo', 'long', 'grande', 'large', 'big']),
-])
-
-tamanhos_letras = {
-    'curto': ['p', 's'],
-    'medio': ['m'],
-    'longo': ['g', 'l'],
-    'extra_longo': ['gg', 'xl', 'xxl']
-}
-
-def detectar_tamanho(coluna_original):
-    """Detecta o tamanho baseado na coluna v7.2 - ORDEM CORRIGIDA"""
-    coluna_normalizada = normalizar_coluna(coluna_original)
-
-    tamanho_detectado = None
-    metodo = None
-
-    # 1. Letra exata (P, M, G, GG, etc)
-    if len(coluna_normalizada) <= 3:
-        for tam, letras in tamanhos_letras.items():
-            if coluna_normalizada in letras:
-                tamanho_detectado = tam
-                metodo = "letra exata"
-                break
+linhas = gerar_linhas(5000)
+contexto = {}
+divergencias = 0
+for numero, row in enumerate(linhas, 2):
+    status_novo, docs = executar(lambda r: parse_servico(r, contexto), row)
+    novo = (status_novo, resumo(docs))
+    referencia = executar(parse_servico_v72, row)
+    if novo != referencia:
+        divergencias += 1
+        if divergencias <= 5:
+            print(f"  ERRO linha {numero}: {row}\n       novo={novo}\n       v7.2={referencia}")
 
-    # 2. PADRÃO TEXTUAL (ANTES de "termina com" para evitar "kids" -> "curto")
-    if not tamanho_detectado:
-        for tam, patterns in tamanhos_patterns.items():
-            for pattern in patterns:
-                pattern_norm = normalizar_coluna(pattern)
-                # v7.2: Match unidirecional para evitar "longo" in "extralongo"
-                if pattern_norm in coluna_normalizada:
-                    tamanho_detectado = tam
-                    metodo = "padrao textual"
-                    break
-            if tamanho_detectado:
-                break
+falhas += divergencias
+print(f"  {len(linhas)} linhas comparadas, {divergencias} divergências")
 
-    # 3. TERMINA COM (ÚLTIMA PRIORIDADE)
-    if not tamanho_detectado and len(coluna_normalizada) > 1:
-        ultima_letra = coluna_normalizada[-1]
-        if ultima_letra in ['p', 's']:
-            tamanho_detectado = 'curto'
-            metodo = "termina com"
-        elif ultima_letra == 'm':
-            tamanho_detectado = 'medio'
-            metodo = "termina com"
-        elif ultima_letra in ['g', 'l']:
-            tamanho_detectado = 'longo'
-            metodo = "termina com"
-
-        if not tamanho_detectado and len(coluna_normalizada) >= 2:
-            ultimas_duas = coluna_normalizada[-2:]
-            if ultimas_duas in ['gg', 'xl']:
-                tamanho_detectado = 'extra_longo'
-                metodo = "termina com"
+print("\n" + "=" * 80)
+print("BENCHMARK")
+print("=" * 80)
 
-    return tamanho_detectado, metodo
+quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+linhas = gerar_linhas(quantidade)
 
-# Testar detecção
-for coluna in colunas_teste:
-    tamanho, metodo = detectar_tamanho(coluna)
-    if tamanho:
-        print(f"{coluna:25} -> {tamanho:15} (metodo: {metodo})")
-    else:
-        print(f"{coluna:25} -> NAO DETECTADO")
 
-print("\n" + "=" * 80)
-print("RESULTADO DO TESTE")
-print("=" * 80)
+def medir(parser):
+    inicio = perf_counter()
+    for row in linhas:
+        executar(parser, row)
+    return perf_counter() - inicio
+
 
-# Verificar se todos os tamanhos do usuário foram detectados
-tamanhos_usuario = ['Kids', 'Masculino', 'Curto', 'Médio', 'Longo', 'Extra Longo']
-print("\nTamanhos do usuário:")
-for tam in tamanhos_usuario:
-    detectado, metodo = detectar_tamanho(tam)
-    if detectado:
-        print(f"  OK {tam:15} -> {detectado:15}")
-    else:
-        print(f"  ERRO {tam:15} -> NAO DETECTADO")
+tempo_v72 = medir(parse_servico_v72)
+contexto = {}
+tempo_novo = medir(lambda r: parse_servico(r, contexto))
+
+print(f"  v7.2 (linha a linha):   {tempo_v72:.3f}s ({quantidade / tempo_v72:,.0f} linhas/s)")
+print(f"  mapeamento por arquivo: {tempo_novo:.3f}s ({quantidade / tempo_novo:,.0f} linhas/s)")
+print(f"  ganho: {tempo_v72 / tempo_novo:.1f}x")
 
 print("\n" + "=" * 80)
+print("RESULTADO DO TESTE:", "OK" if falhas == 0 else f"{falhas} FALHA(S)")
+print("=" * 80)
+
+sys.exit(1 if falhas else 0)